@@ -0,0 +1,250 @@
+"""Benchmarks converting and uploading a synthetic Metathesaurus release
+
+Each table is converted with UMLSBuilder.create_parquet in its own process, so that
+its peak memory use can be measured on its own, and then uploaded through
+upload_utils to a directory standing in for the remote database. Results are
+compared against a stored baseline, and any metric more than the tolerance worse
+than the baseline is reported as a regression.
+
+Baselines are only comparable on the same machine, with the same settings.
+
+Usage:
+    python -m benchmarks.run --rows 1000000 [--update-baseline]
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import pathlib
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import platformdirs
+from pyarrow import parquet
+
+from benchmarks import synthetic
+from cumulus_library_umls import parquet_utils, umls_builder, upload_utils
+
+BASELINE_FILE = pathlib.Path(__file__).parent / "baseline.json"
+
+# Metrics where a larger number is better. Any others are better when smaller.
+HIGHER_IS_BETTER = {"rows_per_sec", "mb_per_sec"}
+
+
+class LocalDatabase:
+    """A stand in for a database backend, which uploads files to a local directory"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+
+    def upload_file(self, *, file, study, topic, remote_filename=None, force_upload=False):
+        remote_path = self.path / study / topic
+        remote_path.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(file, remote_path / (remote_filename or file.name))
+        return str(remote_path)
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident memory of the current process, in megabytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, while macOS reports bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def convert_table(
+    ctl_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    engine: str,
+    memory_budget_mb: int | None = None,
+) -> tuple[dict, list[pathlib.Path]]:
+    """Converts a single table, measuring how long it takes & how much memory it uses
+
+    This is intended to run in a fresh process, so that the peak memory use is
+    that of this table's conversion alone.
+
+    :param ctl_path: the location of the table's .ctl file
+    :param parquet_path: the location to write parquet to
+    :param engine: the library to parse with, either 'pandas' or 'arrow'
+    :param memory_budget_mb: if set, the memory budget to convert with
+    :returns: the conversion's metrics, and the parquet files written
+    """
+    builder = umls_builder.UMLSBuilder()
+    with open(ctl_path) as f:
+        datasource, table = builder.parse_ctl_file(f.readlines())
+    rrf_path = ctl_path.with_name(datasource)
+    table = parquet_utils.set_memory_budget(table, (memory_budget_mb or 0) * 1024**2)
+    start = time.perf_counter()
+    parts = builder.create_parquet(rrf_path, parquet_path, table, force_upload=True, engine=engine)
+    seconds = time.perf_counter() - start
+    paths = [path for path, _ in parts]
+    input_mb = rrf_path.stat().st_size / 1024**2
+    rows = sum(parquet.read_metadata(path).num_rows for path in paths)
+    metrics = {
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds),
+        "mb_per_sec": round(input_mb / seconds, 2),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        "output_bytes": sum(path.stat().st_size for path in paths),
+    }
+    return metrics, paths
+
+
+def upload_table(
+    db: LocalDatabase, name: str, paths: list[pathlib.Path], workers: int
+) -> dict[str, float]:
+    """Uploads a table's parquet files, measuring the upload rate
+
+    :param db: the database stand in to upload to
+    :param name: the name of the table
+    :param paths: the table's parquet files
+    :param workers: the number of upload threads
+    :returns: the upload's metrics
+    """
+    start = time.perf_counter()
+    upload_utils.upload_parts(
+        db, paths, study="umls", topic=name, force_upload=True, workers=workers
+    )
+    seconds = time.perf_counter() - start
+    size_mb = sum(path.stat().st_size for path in paths) / 1024**2
+    return {"seconds": round(seconds, 3), "mb_per_sec": round(size_mb / seconds, 2)}
+
+
+def run(
+    meta_path: pathlib.Path,
+    work_path: pathlib.Path,
+    engine: str = "pandas",
+    upload_workers: int = 1,
+    memory_budget_mb: int | None = None,
+) -> dict[str, dict]:
+    """Benchmarks the conversion & upload of each table in a META directory
+
+    :param meta_path: the directory containing the .ctl & .rrf files
+    :param work_path: a scratch directory for parquet output & uploads
+    :param engine: the library to parse with, either 'pandas' or 'arrow'
+    :param upload_workers: the number of upload threads
+    :param memory_budget_mb: if set, the memory budget to convert with
+    :returns: a dict of table names to {stage: metrics}
+    """
+    db = LocalDatabase(work_path / "remote")
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for ctl_path in sorted(meta_path.glob("*.ctl")):
+        name = ctl_path.stem
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            conversion, paths = executor.submit(
+                convert_table, ctl_path, work_path / "parquet", engine, memory_budget_mb
+            ).result()
+        results[name] = {
+            "convert": conversion,
+            "upload": upload_table(db, name, paths, upload_workers),
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Lists the metrics which are worse than the baseline by more than the tolerance
+
+    :param results: the results of this run, from run()
+    :param baseline: the results of a previous run
+    :param tolerance: the allowed fraction of change, i.e. 0.2 for 20%
+    :returns: a description of each regression
+    """
+    regressions = []
+    for name, stages in results.items():
+        for stage, metrics in stages.items():
+            for metric, value in metrics.items():
+                expected = baseline.get(name, {}).get(stage, {}).get(metric)
+                if not expected or metric in ("rows", "seconds"):
+                    continue
+                change = value / expected - 1
+                if metric in HIGHER_IS_BETTER:
+                    change = -change
+                if change > tolerance:
+                    regressions.append(
+                        f"{name} {stage} {metric}: {value} vs baseline {expected} "
+                        f"({change:.0%} worse)"
+                    )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows in each table")
+    parser.add_argument(
+        "--tables",
+        default=",".join(synthetic.TABLES),
+        help="a comma separated list of tables to benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=("pandas", "arrow"), default="pandas")
+    parser.add_argument("--upload-workers", type=int, default=1)
+    parser.add_argument("--memory-budget-mb", type=int, help="convert with a memory budget")
+    parser.add_argument(
+        "--data-dir",
+        type=pathlib.Path,
+        help="where to keep generated releases (default: the cumulus-library cache)",
+    )
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE_FILE)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="the fraction a metric can be worse than the baseline (default: 0.2)",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store these results as the baseline for these settings",
+    )
+    args = parser.parse_args(argv)
+
+    tables = sorted(name.strip().upper() for name in args.tables.split(","))
+    settings = f"rows={args.rows},seed={args.seed},engine={args.engine},tables={'+'.join(tables)}"
+    if args.memory_budget_mb:
+        settings += f",memory_budget_mb={args.memory_budget_mb}"
+    data_path = args.data_dir or (
+        pathlib.Path(platformdirs.user_cache_dir("cumulus-library", "smart-on-fhir")) / "benchmarks"
+    )
+    # Generated releases are reused between runs, since they can take minutes to write
+    release_path = data_path / f"synthetic-{args.rows}-{args.seed}-{'+'.join(tables)}"
+    meta_path = release_path / "META"
+    if not meta_path.exists():
+        print(f"Generating {args.rows} rows of {', '.join(tables)} in {release_path}...")
+        synthetic.generate_release(
+            release_path.with_suffix(".tmp"), dict.fromkeys(tables, args.rows), seed=args.seed
+        )
+        release_path.with_suffix(".tmp").rename(release_path)
+
+    with tempfile.TemporaryDirectory() as work_path:
+        results = run(
+            meta_path,
+            pathlib.Path(work_path),
+            args.engine,
+            args.upload_workers,
+            args.memory_budget_mb,
+        )
+    print(json.dumps(results, indent=2))
+
+    baselines = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.update_baseline:
+        baselines[settings] = results
+        args.baseline.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Updated baseline for {settings}")
+        return 0
+    if settings not in baselines:
+        print(f"No baseline for {settings}, run with --update-baseline to store one")
+        return 0
+    if regressions := compare(results, baselines[settings], args.tolerance):
+        print("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
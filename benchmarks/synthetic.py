@@ -0,0 +1,300 @@
+"""Generates a synthetic Metathesaurus release, for benchmarking at realistic sizes
+
+The generated MRCONSO, MRREL, MRSTY and MRSAT tables have the same columns & .ctl
+files as a real release, with values drawn to roughly match a real release's
+vocabulary mix and field widths (i.e. mostly short strings, with a long tail of
+multi-hundred character ones). The data is otherwise meaningless, and deterministic
+for a given seed.
+
+Usage:
+    python -m benchmarks.synthetic OUTPUT_DIR --rows 1000000
+"""
+
+import argparse
+import pathlib
+from collections.abc import Callable
+
+import numpy
+
+# Rows are generated & written in batches of this size, to bound memory use
+BATCH_ROWS = 100_000
+
+CTL_TEMPLATE = """options (direct=true)
+load data
+characterset UTF8 length semantics char
+infile '{name}.RRF'
+badfile '{name}.bad'
+discardfile '{name}.dsc'
+truncate
+into table {name}
+fields terminated by '|'
+trailing nullcols
+({columns}
+)"""
+
+# Vocabularies and their approximate share of MRCONSO atoms
+SABS = {
+    "MSH": 0.12,
+    "SNOMEDCT_US": 0.11,
+    "MDR": 0.09,
+    "RXNORM": 0.08,
+    "NCI": 0.08,
+    "LNC": 0.08,
+    "MEDCIN": 0.07,
+    "ICD10CM": 0.04,
+    "ICD10PCS": 0.04,
+    "MTHSPL": 0.04,
+    "NDDF": 0.03,
+    "VANDF": 0.03,
+    "GS": 0.03,
+    "MMSL": 0.03,
+    "HCPCS": 0.03,
+    "CPT": 0.02,
+    "ATC": 0.02,
+    "HPO": 0.02,
+    "GO": 0.02,
+    "MTH": 0.02,
+}
+LANGUAGES = {"ENG": 0.72, "SPA": 0.08, "FRE": 0.05, "GER": 0.04, "JPN": 0.04, "DUT": 0.03}
+LANGUAGES["POR"] = 1 - sum(LANGUAGES.values())
+TERM_TYPES = ["PT", "SY", "FN", "PN", "IN", "SCD", "SBD", "BN", "LLT", "MH", "ET", "HT", "LN"]
+RELATIONSHIPS = {"SIB": 0.3, "RO": 0.25, "CHD": 0.12, "PAR": 0.12, "RB": 0.06, "RN": 0.06}
+RELATIONSHIPS["SY"] = 1 - sum(RELATIONSHIPS.values())
+RELATIONSHIP_ATTRIBUTES = [
+    "isa",
+    "inverse_isa",
+    "has_ingredient",
+    "ingredient_of",
+    "tradename_of",
+    "has_tradename",
+    "mapped_to",
+    "mapped_from",
+    "has_finding_site",
+    "finding_site_of",
+    "member_of",
+    "has_member",
+]
+SEMANTIC_TYPES = [
+    ("T047", "B2.2.1.2.1", "Disease or Syndrome"),
+    ("T121", "A1.4.1.1.1", "Pharmacologic Substance"),
+    ("T109", "A1.4.1.2.1", "Organic Chemical"),
+    ("T061", "B1.3.1.3", "Therapeutic or Preventive Procedure"),
+    ("T033", "A2.2", "Finding"),
+    ("T023", "A1.2.3.1", "Body Part, Organ, or Organ Component"),
+    ("T184", "A2.2.2", "Sign or Symptom"),
+    ("T037", "B2.3", "Injury or Poisoning"),
+    ("T191", "B2.2.1.2.1.2", "Neoplastic Process"),
+    ("T059", "B1.3.1.1", "Laboratory Procedure"),
+    ("T201", "A2.3", "Clinical Attribute"),
+    ("T200", "A1.3.3", "Clinical Drug"),
+    ("T116", "A1.4.1.2.1.7", "Amino Acid, Peptide, or Protein"),
+    ("T074", "A1.3.1.1", "Medical Device"),
+]
+ATTRIBUTE_NAMES = ["NDC", "DID", "DA", "MED_ID", "AMT", "DCSA", "SOS", "CODE_ALSO", "TH"]
+WORDS = (
+    "acute chronic disease disorder syndrome of the left right upper lower tablet oral "
+    "solution injection mg ml hydrochloride sodium fracture carcinoma infection pain "
+    "procedure surgical finding history family measurement serum blood urine level "
+    "neoplasm malignant benign primary secondary unspecified other type with without "
+    "complication extended release capsule topical cream cell receptor protein gene"
+).split()
+
+
+def choice(rng: numpy.random.Generator, values, n: int, weights=None) -> numpy.ndarray:
+    """Picks n values, weighted by a dict of value to probability, or uniformly"""
+    if isinstance(values, dict):
+        values, weights = list(values), list(values.values())
+    return numpy.asarray(values, dtype=object)[rng.choice(len(values), n, p=weights)]
+
+
+def identifiers(rng: numpy.random.Generator, prefix: str, digits: int, n: int) -> numpy.ndarray:
+    """Creates UMLS style identifiers, i.e. C0000123, from a fixed size id space"""
+    values = rng.integers(0, 10**digits, n).astype(str)
+    return numpy.char.add(prefix, numpy.char.zfill(values, digits)).astype(object)
+
+
+def sometimes(rng: numpy.random.Generator, values: numpy.ndarray, p: float) -> numpy.ndarray:
+    """Blanks out values, keeping each with probability p"""
+    return numpy.where(rng.random(len(values)) < p, values, "")
+
+
+class TextPool:
+    """Draws free text fields with a log-normal length distribution
+
+    Text is sliced out of a pool of random words, which is far faster than
+    building each string word by word.
+    """
+
+    def __init__(self, rng: numpy.random.Generator, size: int = 1_000_000):
+        words = choice(rng, WORDS, size // 6)
+        self.pool = " ".join(words)
+
+    def draw(
+        self, rng: numpy.random.Generator, n: int, median: float, sigma: float, max_len: int
+    ) -> list[str]:
+        lengths = numpy.clip(rng.lognormal(numpy.log(median), sigma, n), 1, max_len).astype(int)
+        starts = rng.integers(0, len(self.pool) - max_len, n)
+        return [
+            self.pool[s : s + length].strip() for s, length in zip(starts, lengths, strict=True)
+        ]
+
+
+def mrconso(rng: numpy.random.Generator, text: TextPool, n: int) -> dict[str, list]:
+    sabs = choice(rng, SABS, n)
+    codes = identifiers(rng, "", 7, n)
+    return {
+        "CUI	char(8)": identifiers(rng, "C", 7, n),
+        "LAT	char(3)": choice(rng, LANGUAGES, n),
+        "TS	char(1)": choice(rng, {"P": 0.35, "S": 0.65}, n),
+        "LUI	char(10)": identifiers(rng, "L", 8, n),
+        "STT	char(3)": choice(rng, {"PF": 0.8, "VO": 0.1, "VC": 0.05, "VCW": 0.05}, n),
+        "SUI	char(10)": identifiers(rng, "S", 8, n),
+        "ISPREF	char(1)": choice(rng, {"Y": 0.85, "N": 0.15}, n),
+        "AUI	char(9)": identifiers(rng, "A", 8, n),
+        "SAUI	char(50)": sometimes(rng, identifiers(rng, "", 9, n), 0.5),
+        "SCUI	char(100)": sometimes(rng, codes, 0.8),
+        "SDUI	char(100)": sometimes(rng, identifiers(rng, "D", 6, n), 0.15),
+        "SAB	char(40)": sabs,
+        "TTY	char(40)": choice(rng, TERM_TYPES, n),
+        "CODE	char(100)": codes,
+        "STR	char(3000)": text.draw(rng, n, median=32, sigma=0.7, max_len=3000),
+        "SRL	integer external": choice(rng, {"0": 0.6, "3": 0.1, "4": 0.1, "9": 0.2}, n),
+        "SUPPRESS	char(1)": choice(rng, {"N": 0.9, "O": 0.05, "E": 0.03, "Y": 0.02}, n),
+        "CVF	integer external": sometimes(rng, choice(rng, ["256", "4096", "8448"], n), 0.2),
+    }
+
+
+def mrrel(rng: numpy.random.Generator, text: TextPool, n: int) -> dict[str, list]:
+    sabs = choice(rng, SABS, n)
+    stypes = {"SCUI": 0.35, "SDUI": 0.25, "AUI": 0.2, "CUI": 0.1, "CODE": 0.1}
+    return {
+        "CUI1	char(8)": identifiers(rng, "C", 7, n),
+        "AUI1	char(9)": identifiers(rng, "A", 8, n),
+        "STYPE1	char(50)": choice(rng, stypes, n),
+        "REL	char(4)": choice(rng, RELATIONSHIPS, n),
+        "CUI2	char(8)": identifiers(rng, "C", 7, n),
+        "AUI2	char(9)": identifiers(rng, "A", 8, n),
+        "STYPE2	char(50)": choice(rng, stypes, n),
+        "RELA	char(100)": sometimes(rng, choice(rng, RELATIONSHIP_ATTRIBUTES, n), 0.7),
+        "RUI	char(10)": identifiers(rng, "R", 9, n),
+        "SRUI	char(50)": sometimes(rng, identifiers(rng, "", 8, n), 0.2),
+        "SAB	char(40)": sabs,
+        "SL	char(40)": sabs,
+        "RG	char(10)": sometimes(rng, choice(rng, ["0", "1", "2", "3"], n), 0.2),
+        "DIR	char(1)": choice(rng, {"": 0.6, "Y": 0.3, "N": 0.1}, n),
+        "SUPPRESS	char(1)": choice(rng, {"N": 0.95, "O": 0.03, "Y": 0.02}, n),
+        "CVF	integer external": sometimes(rng, choice(rng, ["256", "4096"], n), 0.1),
+    }
+
+
+def mrsty(rng: numpy.random.Generator, text: TextPool, n: int) -> dict[str, list]:
+    types = numpy.asarray(SEMANTIC_TYPES, dtype=object)[rng.integers(0, len(SEMANTIC_TYPES), n)]
+    return {
+        "CUI	char(8)": identifiers(rng, "C", 7, n),
+        "TUI	char(4)": types[:, 0],
+        "STN	char(100)": types[:, 1],
+        "STY	char(50)": types[:, 2],
+        "ATUI	char(11)": identifiers(rng, "AT", 8, n),
+        "CVF	integer external": sometimes(rng, choice(rng, ["256", "4096"], n), 0.1),
+    }
+
+
+def mrsat(rng: numpy.random.Generator, text: TextPool, n: int) -> dict[str, list]:
+    return {
+        "CUI	char(8)": identifiers(rng, "C", 7, n),
+        "LUI	char(10)": sometimes(rng, identifiers(rng, "L", 8, n), 0.05),
+        "SUI	char(10)": sometimes(rng, identifiers(rng, "S", 8, n), 0.05),
+        "METAUI	char(100)": identifiers(rng, "A", 8, n),
+        "STYPE	char(50)": choice(rng, {"AUI": 0.5, "CODE": 0.3, "SCUI": 0.1, "RUI": 0.1}, n),
+        "CODE	char(100)": identifiers(rng, "", 7, n),
+        "ATUI	char(11)": identifiers(rng, "AT", 9, n),
+        "SATUI	char(50)": sometimes(rng, identifiers(rng, "", 8, n), 0.1),
+        "ATN	char(100)": choice(rng, ATTRIBUTE_NAMES, n),
+        "SAB	char(40)": choice(rng, SABS, n),
+        "ATV	char(4000)": text.draw(rng, n, median=12, sigma=1.0, max_len=4000),
+        "SUPPRESS	char(1)": choice(rng, {"N": 0.97, "O": 0.02, "Y": 0.01}, n),
+        "CVF	integer external": sometimes(rng, choice(rng, ["256", "4096"], n), 0.1),
+    }
+
+
+TABLES: dict[str, Callable[[numpy.random.Generator, TextPool, int], dict[str, list]]] = {
+    "MRCONSO": mrconso,
+    "MRREL": mrrel,
+    "MRSTY": mrsty,
+    "MRSAT": mrsat,
+}
+
+
+def write_table(
+    meta_path: pathlib.Path,
+    name: str,
+    rows: int,
+    rng: numpy.random.Generator,
+    text: TextPool,
+) -> pathlib.Path:
+    """Writes a table's .ctl file, and an .rrf file with the given number of rows
+
+    :param meta_path: the META directory to write to
+    :param name: the table to generate, one of TABLES
+    :param rows: the number of rows to write
+    :param rng: the random number generator to draw values with
+    :param text: the pool to draw free text fields from
+    :returns: the location of the .rrf file
+    """
+    generate = TABLES[name]
+    # The column definitions are the keys of any generated batch
+    columns = list(generate(numpy.random.default_rng(), text, 1))
+    (meta_path / f"{name}.ctl").write_text(
+        CTL_TEMPLATE.format(name=name, columns=",\n".join(columns))
+    )
+    rrf_path = meta_path / f"{name}.RRF"
+    with open(rrf_path, "w", encoding="utf-8") as f:
+        for start in range(0, rows, BATCH_ROWS):
+            batch = generate(rng, text, min(BATCH_ROWS, rows - start)).values()
+            # Like the real files, every line ends with a trailing delimiter
+            f.writelines("|".join(row) + "|\n" for row in zip(*batch, strict=True))
+    return rrf_path
+
+
+def generate_release(
+    path: pathlib.Path,
+    rows: dict[str, int],
+    seed: int = 0,
+) -> pathlib.Path:
+    """Writes a synthetic release's META directory
+
+    :param path: the directory to create the release in
+    :param rows: a dict of table names (from TABLES) to the number of rows to write
+    :param seed: the seed for the random values, so releases are reproducible
+    :returns: the location of the META directory
+    """
+    if unknown := sorted(rows.keys() - TABLES.keys()):
+        raise ValueError(f"Can't generate {', '.join(unknown)}, only {', '.join(TABLES)}")
+    meta_path = path / "META"
+    meta_path.mkdir(parents=True, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    text = TextPool(rng)
+    for name, count in rows.items():
+        write_table(meta_path, name, count, rng, text)
+    return meta_path
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output", type=pathlib.Path, help="the directory to write to")
+    parser.add_argument(
+        "--rows", type=int, default=1_000_000, help="the number of rows in each table"
+    )
+    parser.add_argument(
+        "--tables",
+        default=",".join(TABLES),
+        help=f"a comma separated list of tables to generate (default: {','.join(TABLES)})",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    tables = {name.strip().upper(): args.rows for name in args.tables.split(",")}
+    print(generate_release(args.output, tables, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Reading Metathesaurus files directly out of a downloaded release archive"""
+
+import calendar
+import dataclasses
+import io
+import pathlib
+import types
+import zipfile
+
+
+@dataclasses.dataclass(frozen=True, order=True)
+class ZipMember:
+    """A file inside a zip archive, usable in place of the path of an extracted file
+
+    This implements the subset of pathlib.Path used when converting .ctl & .rrf
+    files: name/stem, with_name, stat, and open. Opening a member decompresses it
+    as a stream, so nothing is extracted to disk. Instances only hold the archive's
+    location, so they can be sent to conversion worker processes, each of which
+    opens the archive independently.
+
+    Members can't be mmapped or seeked cheaply, so they can't be split into byte
+    ranges for parallel conversion.
+    """
+
+    zip_path: pathlib.Path
+    member: str
+
+    @property
+    def name(self) -> str:
+        return self.member.rsplit("/", 1)[-1]
+
+    @property
+    def stem(self) -> str:
+        return pathlib.PurePosixPath(self.member).stem
+
+    def with_name(self, name: str) -> "ZipMember":
+        """Returns the member with the given name in the same archive directory"""
+        return ZipMember(self.zip_path, str(pathlib.PurePosixPath(self.member).with_name(name)))
+
+    def stat(self) -> types.SimpleNamespace:
+        """Describes the member's uncompressed size and modification time
+
+        :returns: an object with st_size and st_mtime_ns attributes, like os.stat_result
+        """
+        with zipfile.ZipFile(self.zip_path) as archive:
+            info = archive.getinfo(self.member)
+        # Zip timestamps have no timezone, so they're read as UTC to be deterministic
+        mtime = calendar.timegm((*info.date_time, 0, 0, 0))
+        return types.SimpleNamespace(st_size=info.file_size, st_mtime_ns=mtime * 10**9)
+
+    def open(self, mode: str = "r", encoding: str = "utf-8") -> io.IOBase:
+        """Opens the member for streaming reads
+
+        :param mode: either 'r' for text, or 'rb' for bytes
+        :param encoding: the text encoding, when opened in text mode
+        """
+        if mode not in ("r", "rb"):
+            raise ValueError(f"Zip members can only be opened for reading, not '{mode}'")
+        # The archive's file handle stays open until the member is closed, even
+        # though the ZipFile object itself is closed here
+        with zipfile.ZipFile(self.zip_path) as archive:
+            file = archive.open(self.member)
+        if mode == "rb":
+            return file
+        return io.TextIOWrapper(file, encoding=encoding)
+
+
+def list_members(zip_path: pathlib.Path, suffix: str) -> list[ZipMember]:
+    """Lists the files in the META directory of a release archive with a suffix
+
+    :param zip_path: the location of the release archive
+    :param suffix: the file extension to match, i.e. '.ctl'
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        names = archive.namelist()
+    return [
+        ZipMember(zip_path, name)
+        for name in names
+        if pathlib.PurePosixPath(name).parent.name == "META" and name.endswith(suffix)
+    ]
+
+
+def find_archive(path: pathlib.Path) -> pathlib.Path | None:
+    """Finds a downloaded release archive in a directory, if there is one
+
+    :param path: the directory a release was downloaded to
+    """
+    if not path.is_dir():
+        return None
+    # A partially downloaded archive is missing its central directory
+    archives = [archive for archive in sorted(path.glob("*.zip")) if zipfile.is_zipfile(archive)]
+    return archives[0] if archives else None
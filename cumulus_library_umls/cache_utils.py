@@ -0,0 +1,194 @@
+"""Keeping several releases in the cache directory, within a disk budget
+
+Each release has two artifacts in the cumulus-library cache directory: its download
+(the extracted Metathesaurus files, or the archive itself when streaming from it),
+under `downloads/<release>`, and its converted parquet, under
+`generated_parquet/<release>`. Rather than deleting every other release as soon as
+a new one is seen, releases are kept side by side, and only evicted once a build
+has finished, if the cache is over its budget.
+
+Releases are evicted least recently built first, and downloads before parquet,
+since a download only matters if the release needs converting again, while its
+parquet allows rolling back to it, or building the next release's delta tables.
+The release being built is never evicted, and nor is any release another builder
+sharing the cache directory holds a lock in, whether to build it, or to copy a
+table into it from a parquet store.
+"""
+
+import dataclasses
+import pathlib
+import shutil
+import time
+
+from cumulus_library_umls import delta_utils, json_utils
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+INDEX_FILE = "release_cache.json"
+DOWNLOADS_DIR = "downloads"
+PARQUET_DIR = "generated_parquet"
+# Held (shared) in a release's parquet directory by each builder building it
+BUILD_LOCK = ".build.lock"
+
+# The kinds of artifact of a release, in the order they're evicted
+ARTIFACTS = (DOWNLOADS_DIR, PARQUET_DIR)
+
+
+@dataclasses.dataclass(kw_only=True, frozen=True)
+class Artifact:
+    """A directory in the cache belonging to a single release"""
+
+    release: str
+    kind: str
+    path: pathlib.Path
+
+
+def get_files(path: pathlib.Path) -> dict[tuple[int, int], int]:
+    """Lists the files under a directory, by identity
+
+    :returns: a dict of (device, inode) pairs to file sizes, so that hard links to
+        the same file (i.e. from a delta table) are only counted once
+    """
+    files = {}
+    for file in path.rglob("*"):
+        stat = file.lstat()
+        if file.is_file() and not file.is_symlink():
+            files[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return files
+
+
+def is_locked(path: pathlib.Path) -> bool:
+    """Checks if any lock file directly in a directory is held, by any process
+
+    :param path: the directory, i.e. a release's parquet
+    """
+    if fcntl is None:
+        return False
+    for lock_path in path.glob("*.lock"):
+        with lock_path.open("a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return False
+
+
+class ReleaseCache:
+    """The releases in the cache directory, and when each was last built
+
+    The index of when releases were built is kept in `release_cache.json`, along
+    with the most recently built release, which the other builders read from.
+    """
+
+    def __init__(self, base_path: pathlib.Path, budget: int = 0):
+        """
+        :param base_path: the cumulus-library cache directory
+        :param budget: the bytes that releases other than the one being built may use.
+            With the default of 0, only the release being built is kept.
+        """
+        if budget < 0:
+            raise ValueError(f"The cache budget can't be negative, got {budget}")
+        self.base_path = base_path
+        self.budget = budget
+        self.index = json_utils.read_json(base_path / INDEX_FILE) or {}
+        self._lock_file = None
+
+    def lock(self, release: str) -> None:
+        """Marks a release as being built, so other builders don't evict it
+
+        The lock is shared between builders, and held until unlock is called, or the
+        process exits.
+        """
+        if fcntl is None or self._lock_file is not None:
+            return
+        path = self.base_path / PARQUET_DIR / release
+        path.mkdir(parents=True, exist_ok=True)
+        self._lock_file = (path / BUILD_LOCK).open("a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+
+    def unlock(self) -> None:
+        """Releases the lock taken by lock, if held"""
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def record_build(self, release: str) -> None:
+        """Records that a release was built, as the current release"""
+        self.index.setdefault("last_built", {})[release] = time.time()
+        self.index["current"] = release
+        json_utils.write_json_atomic(self.base_path / INDEX_FILE, self.index)
+
+    def list_artifacts(self) -> list[Artifact]:
+        """Lists every release's artifacts, in the order they'd be evicted
+
+        Only directories named like a release are listed, so anything else kept in
+        the same directories is left alone.
+        """
+        artifacts = [
+            Artifact(release=path.name, kind=kind, path=path)
+            for kind in ARTIFACTS
+            if (self.base_path / kind).is_dir()
+            for path in (self.base_path / kind).iterdir()
+            if path.is_dir() and delta_utils.RELEASE_PATTERN.fullmatch(path.name)
+        ]
+        last_built = self.index.get("last_built", {})
+        return sorted(
+            artifacts,
+            key=lambda artifact: (
+                ARTIFACTS.index(artifact.kind),
+                last_built.get(artifact.release, 0),
+                artifact.release,
+            ),
+        )
+
+    def evict(self, keep: set[str], kinds: tuple[str] = ARTIFACTS) -> list[Artifact]:
+        """Evicts artifacts of other releases until they fit in the budget
+
+        :param keep: the releases which mustn't be evicted. Releases with a lock
+            held in any of their artifacts are kept too.
+        :param kinds: the kinds of artifact which may be evicted
+        :returns: the artifacts evicted
+        """
+        artifacts = self.list_artifacts()
+        keep = keep | {artifact.release for artifact in artifacts if is_locked(artifact.path)}
+        files = {artifact: get_files(artifact.path) for artifact in artifacts}
+        kept = {}
+        for artifact in artifacts:
+            if artifact.release in keep:
+                kept.update(files[artifact])
+
+        def get_size(remaining: list[Artifact]) -> int:
+            # Each file is counted once, however many artifacts link to it, and not
+            # at all if a kept release links to it too
+            used = {}
+            for artifact in remaining:
+                used.update(files[artifact])
+            return sum(size for key, size in used.items() if key not in kept)
+
+        remaining = [artifact for artifact in artifacts if artifact.release not in keep]
+        evicted = []
+        for artifact in list(remaining):
+            if get_size(remaining) <= self.budget:
+                break
+            if artifact.kind not in kinds:
+                continue
+            shutil.rmtree(artifact.path)
+            remaining.remove(artifact)
+            evicted.append(artifact)
+        if evicted:
+            last_built = self.index.get("last_built", {})
+            for release in {artifact.release for artifact in evicted}:
+                if not any((self.base_path / kind / release).exists() for kind in ARTIFACTS):
+                    last_built.pop(release, None)
+            json_utils.write_json_atomic(self.base_path / INDEX_FILE, self.index)
+        return evicted
+
+
+def get_current_release(base_path: pathlib.Path) -> str | None:
+    """Reads the release most recently built into a cache directory, if recorded"""
+    return (json_utils.read_json(base_path / INDEX_FILE) or {}).get("current")
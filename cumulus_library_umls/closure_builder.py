@@ -0,0 +1,98 @@
+"""Builder for transitive closure tables of vocabulary hierarchies in MRREL"""
+
+import pathlib
+
+import platformdirs
+from cumulus_library import BaseTableBuilder, base_utils, log_utils, study_manifest
+from cumulus_library.template_sql import base_templates
+
+from cumulus_library_umls import (
+    closure_utils,
+    metrics_utils,
+    parquet_utils,
+    release_utils,
+    upload_utils,
+)
+
+
+class ClosureBuilder(BaseTableBuilder):
+    display_text = "Building hierarchy closure tables..."
+
+    def prepare_queries(
+        self,
+        config: base_utils.StudyConfig,
+        manifest: study_manifest.StudyManifest,
+        *args,
+        **kwargs,
+    ):
+        closures = closure_utils.get_closure_configs(config)
+        if not closures:
+            return
+        prefix = manifest.get_study_prefix()
+        base_path = pathlib.Path(platformdirs.user_cache_dir("cumulus-library", "smart-on-fhir"))
+        release_path = release_utils.get_release_path(base_path / "generated_parquet", ["MRREL"])
+        release = release_path.name
+        metrics = metrics_utils.BuildMetrics(f"closure_{release}")
+        with metrics.measure("read"):
+            relations = release_utils.read_rows(
+                release_path,
+                "MRREL",
+                closure_utils.RELATION_COLUMNS,
+                {closure.sab for closure in closures},
+                **release_utils.get_table_layout(config, "MRREL"),
+            )
+        metrics.add("read", rows=len(relations))
+
+        parquet_paths = {}
+        hashes = {}
+        cycles = []
+        for closure in closures:
+            name = closure_utils.get_table_name(closure.sab)
+            path = parquet_utils.get_part_path(release_path, name, 0)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with metrics.measure("build", name):
+                rows, cyclic = closure_utils.get_closure(
+                    closure_utils.get_edges(relations, closure)
+                )
+                chunk = parquet_utils.write_arrow_table(
+                    rows, path, closure_utils.get_layout(config, name)
+                )
+            hashes[path] = chunk["sha256"]
+            metrics.add("build", name, rows=chunk["rows"], output_bytes=path.stat().st_size)
+            parquet_paths[name] = [path]
+            if cyclic:
+                cycles.append(f"{len(cyclic)} {closure.sab} concepts are in cycles")
+                print(f"{cycles[-1]}, i.e. {', '.join(cyclic[:5])}")
+
+        remote_paths = upload_utils.upload_tables(
+            config.db,
+            parquet_paths,
+            study=prefix,
+            force_upload=config.force_upload,
+            workers=len(parquet_paths),
+            hashes=hashes,
+            ledger=upload_utils.UploadLedger(
+                base_path / upload_utils.LEDGER_FILE, upload_utils.get_destination(config.db)
+            ),
+            release=release,
+            metrics=metrics,
+        )
+        for name in parquet_paths:
+            self.queries.append(
+                base_templates.get_ctas_from_parquet_query(
+                    schema_name=config.schema,
+                    table_name=f"{prefix}__{name}",
+                    local_location=release_path / f"{name}/*.parquet",
+                    remote_location=remote_paths[name],
+                    table_cols=closure_utils.SCHEMA.names,
+                    remote_table_cols_types=closure_utils.PARQUET_TYPES,
+                )
+            )
+        metrics.write_report(base_path / metrics_utils.REPORT_DIR)
+        log_utils.log_transaction(
+            config=config,
+            manifest=manifest,
+            message="; ".join(
+                [f"Closure tables from UMLS version {release}: {metrics.summary()}", *cycles]
+            ),
+        )
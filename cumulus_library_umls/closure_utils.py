@@ -0,0 +1,202 @@
+"""Transitive closures of vocabulary hierarchies in MRREL
+
+A closure table lists every ancestor/descendant pair of concepts in a vocabulary's
+hierarchy, along with the fewest relationships between them, so that finding all
+descendants of a concept is a single equi-join on `ancestor_cui`, rather than a
+recursive query.
+
+The hierarchy is the graph of MRREL rows of one vocabulary which match a set of
+relationships, with CUI1 as the parent and CUI2 as the child. Rows with a REL of
+PAR or RB are never edges, as those point from the child up to the parent. The
+closure is found a depth at a time: every pair found at one depth is extended by
+the children of its descendant, keeping only the pairs not already found.
+
+Hierarchies can contain cycles, where a concept is its own ancestor. Every concept
+in a cycle is still an ancestor of the others, but pairs of a concept with itself
+are left out of the table, and the concepts are reported instead.
+"""
+
+import dataclasses
+import re
+
+import numpy
+import pandas
+import pyarrow
+from cumulus_library import base_utils
+
+from cumulus_library_umls import ingestion_utils, parquet_utils
+
+# The relationships the mrrel_drug_is_a table counts as concept 2 being a member
+# of concept 1, used unless the closure_rels & closure_relas options are set
+DEFAULT_RELS = ("CHD",)
+DEFAULT_RELAS = ("isa", "tradename_of", "has_tradename", "has_basis_of_strength_substance")
+
+# Relationships from the child up to the parent, which are never followed
+EXCLUDED_RELS = ("PAR", "RB")
+
+# The columns read from the converted MRREL, by release_utils.read_rows
+RELATION_COLUMNS = ["CUI1", "CUI2", "REL", "RELA", "SAB"]
+
+SCHEMA = pyarrow.schema(
+    [
+        ("ancestor_cui", pyarrow.string()),
+        ("descendant_cui", pyarrow.string()),
+        ("depth", pyarrow.int32()),
+    ]
+)
+PARQUET_TYPES = ["String", "String", "Integer"]
+
+# Rows are sorted by ancestor (by get_closure), and written in small row groups,
+# so that looking up the descendants of a concept only reads the row groups
+# containing it
+WRITE_OPTIONS = {"row_group_rows": 100_000}
+
+
+@dataclasses.dataclass(kw_only=True)
+class ClosureConfig:
+    """The relationships making up the hierarchy of a vocabulary
+
+    An MRREL row is an edge if its REL is in rels, or its RELA is in relas.
+    """
+
+    sab: str
+    rels: set[str]
+    relas: set[str]
+
+
+def get_closure_configs(config: base_utils.StudyConfig) -> list[ClosureConfig]:
+    """Reads which closure tables to build from the study options
+
+    The following options are read, each a comma separated list:
+      - closure_sabs: the vocabularies to build closure tables for, i.e. RXNORM
+      - closure_rels: the REL values which are edges, defaulting to DEFAULT_RELS
+      - closure_relas: the RELA values which are edges, defaulting to DEFAULT_RELAS
+
+    The relationship options may be set for a single vocabulary by prefixing them
+    with its name, i.e. `--option SNOMEDCT_US.closure_relas:isa`.
+
+    :param config: the study config containing CLI options
+    """
+    options = config.options or {}
+    configs = []
+    for sab in sorted(ingestion_utils.parse_list_option(options.get("closure_sabs"))):
+        relationships = {}
+        for option, default in (("closure_rels", DEFAULT_RELS), ("closure_relas", DEFAULT_RELAS)):
+            key = f"{sab}.{option}" if f"{sab}.{option}" in options else option
+            relationships[option] = (
+                ingestion_utils.parse_list_option(options[key]) if key in options else set(default)
+            )
+        configs.append(
+            ClosureConfig(
+                sab=sab, rels=relationships["closure_rels"], relas=relationships["closure_relas"]
+            )
+        )
+    return configs
+
+
+def get_table_name(sab: str) -> str:
+    """Returns the name of a vocabulary's closure table, i.e. snomedct_us_closure"""
+    return f"{re.sub('[^a-z0-9]+', '_', sab.lower())}_closure"
+
+
+def get_edges(relations: pandas.DataFrame, closure: ClosureConfig) -> pandas.DataFrame:
+    """Selects the distinct parent/child edges of a vocabulary's hierarchy
+
+    :param relations: MRREL rows, with at least RELATION_COLUMNS
+    :param closure: the relationships making up the hierarchy
+    :returns: a dataframe of `parent` and `child` CUIs
+    """
+    rows = relations[
+        (relations["SAB"] == closure.sab)
+        & (relations["REL"].isin(closure.rels) | relations["RELA"].isin(closure.relas))
+        & ~relations["REL"].isin(EXCLUDED_RELS)
+    ].dropna(subset=["CUI1", "CUI2"])
+    edges = pandas.DataFrame({"parent": rows["CUI1"], "child": rows["CUI2"]})
+    return edges.drop_duplicates(ignore_index=True)
+
+
+def expand(
+    ancestors: numpy.ndarray,
+    nodes: numpy.ndarray,
+    parents: numpy.ndarray,
+    children: numpy.ndarray,
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Pairs each ancestor with every child of its node
+
+    :param ancestors: the ancestor of each pair
+    :param nodes: the descendant of each pair, whose children are looked up
+    :param parents: the parent of each edge, sorted
+    :param children: the child of each edge, in the same order as parents
+    :returns: the ancestors & children of the new pairs
+    """
+    starts = numpy.searchsorted(parents, nodes, "left")
+    counts = numpy.searchsorted(parents, nodes, "right") - starts
+    # Each node's children are a slice of the sorted edges, which are gathered by
+    # offsetting a running count of the output by where each slice starts
+    offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+    return numpy.repeat(ancestors, counts), children[offsets + numpy.arange(counts.sum())]
+
+
+def get_closure(edges: pandas.DataFrame) -> tuple[pyarrow.Table, list[str]]:
+    """Finds every ancestor/descendant pair of a hierarchy
+
+    :param edges: the hierarchy's edges, from get_edges
+    :returns: a table of `ancestor_cui`, `descendant_cui`, and `depth`, the fewest
+        edges between them, sorted in that order, and the sorted CUIs of any
+        concepts in cycles
+    """
+    # Concepts are numbered in CUI order, so sorting by number sorts by CUI
+    codes, cuis = pandas.factorize(pandas.concat([edges["parent"], edges["child"]]), sort=True)
+    count = len(cuis)
+    parents, children = codes[: len(edges)], codes[len(edges) :]
+    order = numpy.argsort(parents, kind="stable")
+    parents, children = parents[order], children[order]
+
+    # Pairs are encoded as single integers, which sort by ancestor
+    found = numpy.unique(parents.astype(numpy.int64) * count + children)
+    levels = [found]
+    frontier = found
+    while len(frontier):
+        pairs = expand(frontier // count, frontier % count, parents, children)
+        candidates = numpy.unique(pairs[0].astype(numpy.int64) * count + pairs[1])
+        positions = numpy.searchsorted(found, candidates)
+        known = found[numpy.minimum(positions, len(found) - 1)] == candidates
+        frontier = candidates[~known]
+        found = numpy.insert(found, positions[~known], frontier)
+        levels.append(frontier)
+
+    keys = numpy.concatenate(levels)
+    depths = numpy.repeat(
+        numpy.arange(1, len(levels) + 1, dtype=numpy.int32), [len(level) for level in levels]
+    )
+    ancestors, descendants = keys // count, keys % count
+    cyclic = ancestors == descendants
+    ancestors, descendants, depths = ancestors[~cyclic], descendants[~cyclic], depths[~cyclic]
+    order = numpy.lexsort((descendants, depths, ancestors))
+    # CUIs are only looked up once sorted, into arrow strings, which take a
+    # fraction of the memory of a column of python strings
+    names = pyarrow.array(cuis.to_numpy(), pyarrow.string())
+    closure = pyarrow.table(
+        [
+            names.take(ancestors[order]),
+            names.take(descendants[order]),
+            pyarrow.array(depths[order], pyarrow.int32()),
+        ],
+        schema=SCHEMA,
+    )
+    return closure, sorted(cuis[keys[cyclic] % count])
+
+
+def get_layout(config: base_utils.StudyConfig, name: str) -> dict:
+    """Returns the layout settings a closure table is written with
+
+    Any parquet layout options are applied on top of WRITE_OPTIONS, i.e.
+    `--option parquet_compression:zstd`.
+
+    :param config: the study config containing CLI options
+    :param name: the name of the closure table
+    """
+    return parquet_utils.set_write_options(
+        {"headers": SCHEMA.names},
+        {**WRITE_OPTIONS, **ingestion_utils.get_write_options(config, name)},
+    )
@@ -0,0 +1,472 @@
+"""Incremental conversion of a table, reusing the parquet of the previous release
+
+Most rows of the large tables are identical between consecutive UMLS releases. A
+delta table is written as Hive style partitions of the release each file was first
+written for, i.e. `umls_release=2024AA/`:
+
+- files of the previous release which are still mostly current are reused as-is
+- rows which are new or changed since the previous release are written to files
+  in this release's partition
+- rows of reused files which are no longer current are listed in a separate
+  tombstones table, by their stable identifier and partition
+
+The table is then the reused & new files, minus the rows matching a tombstone.
+Rows are matched between releases by their identifier and a hash of every column:
+a row whose identifier is in the previous release with different contents is an
+update, and its previous version is tombstoned like a deleted row. An index of
+each row's identifier & hash is kept with the table's parquet for use by the next
+release.
+
+Files of the previous release which aren't reused are left out of the table's
+part list, and their earlier uploads are deleted along with any other remote file
+not in it (see upload_utils.remove_stale_files), so they need no tombstones.
+"""
+
+import os
+import pathlib
+import re
+import shutil
+from collections.abc import Callable
+
+import numpy
+import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
+import pyarrow.parquet
+
+from cumulus_library_umls import json_utils, parquet_utils
+
+# The stable identifier of each row, for the tables which support delta builds
+DELTA_KEYS = {"MRCONSO": "AUI", "MRREL": "RUI", "MRSAT": "ATUI"}
+# The partition column holding the release a file was written for
+GENERATION_COLUMN = "umls_release"
+# Written alongside a table's parquet, listing the hash of every row in each file
+INDEX_FILE = "_delta_index.parquet"
+# The tables a delta table's files & tombstones are loaded into, before being
+# combined into a view with the delta table's name
+PARTS_SUFFIX = "_parts"
+TOMBSTONE_SUFFIX = "_tombstones"
+# A previous file is only reused if at least this fraction of its rows are unchanged.
+# Otherwise its unchanged rows are rewritten, so tombstones don't pile up forever.
+REUSE_FRACTION = 0.5
+# UMLS releases are named for their year & edition, i.e. 2024AA
+RELEASE_PATTERN = re.compile(r"\d{4}[A-Z]{2}")
+
+
+def delta_table(table: dict[list], key: str, base_path: pathlib.Path | None) -> dict[list]:
+    """Marks a table definition to be converted as a delta of a previous release
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param key: the column uniquely identifying each row, from DELTA_KEYS
+    :param base_path: the directory of the table's parquet from the previous
+        release, if there is one
+    :returns: the delta table definition
+    """
+    if key not in table["headers"]:
+        raise ValueError(f"Delta builds need the {key} column, which is not an output column")
+    return {
+        **table,
+        "delta_key": key,
+        "delta_base": str(base_path) if base_path else None,
+        "profile": {**(table.get("profile") or {}), "delta_key": key},
+    }
+
+
+def find_base(parquet_path: pathlib.Path, release: str, stem: str) -> pathlib.Path | None:
+    """Finds the most recent earlier release's complete copy of a table
+
+    Only directories named like a release are considered, so other directories in
+    the cache aren't mistaken for one, and releases whose copy of the table is
+    missing or incomplete (i.e. partly evicted, or interrupted) are skipped.
+
+    :param parquet_path: the directory each release's parquet is written under
+    :param release: the release being built
+    :param stem: the name of the table
+    :returns: the directory of the table's parquet in the earlier release, or None
+        if there isn't one to build a delta from
+    """
+    releases = sorted(
+        (
+            path
+            for path in parquet_path.iterdir()
+            if path.is_dir() and RELEASE_PATTERN.fullmatch(path.name) and path.name < release
+        ),
+        reverse=True,
+    )
+    for path in releases:
+        if (
+            json_utils.read_json(path / stem / parquet_utils.MANIFEST_FILE) is not None
+            and (path / stem / INDEX_FILE).exists()
+        ):
+            return path / stem
+    print(f"No earlier release has a complete copy of {stem}, so it is converted in full")
+    return None
+
+
+def get_parts_name(stem: str) -> str:
+    """Returns the name of the table holding every file of a delta table"""
+    return f"{stem}{PARTS_SUFFIX}"
+
+
+def get_tombstone_name(stem: str) -> str:
+    """Returns the name of the tombstones table of a delta table"""
+    return f"{stem}{TOMBSTONE_SUFFIX}"
+
+
+def get_tombstone_path(parquet_path: pathlib.Path, stem: str) -> pathlib.Path:
+    """Returns the location of the tombstones file of a delta table
+
+    :param parquet_path: the location output parquet is written to
+    :param stem: the name of the delta table
+    """
+    return parquet_utils.get_part_path(parquet_path, get_tombstone_name(stem), 0)
+
+
+def get_generation(part: str) -> str:
+    """Returns the release a file was written for, from its relative path"""
+    return pathlib.PurePosixPath(part).parent.name.split("=", 1)[1]
+
+
+def read_live_rows(
+    parquet_path: pathlib.Path,
+    stem: str,
+    key: str,
+    columns: list[str],
+    expression: pyarrow.compute.Expression | None = None,
+) -> pyarrow.Table:
+    """Reads the current rows of a converted delta table, as its view would
+
+    :param parquet_path: the location output parquet was written to
+    :param stem: the name of the delta table
+    :param key: the table's stable row identifier
+    :param columns: the columns to read
+    :param expression: if provided, only rows matching this filter are read
+    :returns: the rows of every file in the table, minus those with a tombstone
+    """
+    partitioning = pyarrow.dataset.partitioning(
+        pyarrow.schema([(GENERATION_COLUMN, pyarrow.string())]), flavor="hive"
+    )
+    dataset = pyarrow.dataset.dataset(
+        parquet_path / stem, format="parquet", partitioning=partitioning
+    )
+    rows = dataset.to_table(
+        columns=list(dict.fromkeys([*columns, key, GENERATION_COLUMN])), filter=expression
+    )
+    tombstones = pyarrow.parquet.read_table(get_tombstone_path(parquet_path, stem))
+    live = rows.join(tombstones, keys=[key, GENERATION_COLUMN], join_type="left anti")
+    return live.select(columns)
+
+
+def hash_rows(rows: pyarrow.Table, table: dict[list]) -> numpy.ndarray:
+    """Hashes the output columns of each row, for matching rows across releases
+
+    :param rows: rows with every output column of the table
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :returns: an array of uint64 hashes, one per row
+    """
+    df = rows.select(table["headers"]).to_pandas()
+    return pandas.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def hash_keys(keys: pyarrow.ChunkedArray, batch_rows: int = 1_000_000) -> numpy.ndarray:
+    """Hashes the stable identifiers of rows, a batch at a time to bound memory
+
+    :param keys: the identifiers
+    :param batch_rows: the number of identifiers converted to python at once
+    :returns: an array of uint64 hashes, one per identifier
+    """
+    keys = keys.cast(pyarrow.string())
+    batches = [
+        pandas.util.hash_array(keys.slice(start, batch_rows).to_numpy())
+        for start in range(0, len(keys), batch_rows)
+    ]
+    return numpy.concatenate(batches) if batches else numpy.empty(0, numpy.uint64)
+
+
+def read_base(table: dict[list]) -> tuple[dict, pyarrow.Table] | None:
+    """Loads the manifest & row index of the previous release's copy of a table
+
+    :param table: a delta table definition, from delta_table
+    :returns: the manifest and index, or None if there is no usable previous copy,
+        because it doesn't exist, is incomplete, or was written with a different
+        profile
+    """
+    if not table.get("delta_base"):
+        return None
+    base_path = pathlib.Path(table["delta_base"])
+    manifest = json_utils.read_json(base_path / parquet_utils.MANIFEST_FILE)
+    if (
+        manifest is None
+        or manifest.get("profile") != table.get("profile")
+        or not (base_path / INDEX_FILE).exists()
+    ):
+        return None
+    return manifest, pyarrow.parquet.read_table(base_path / INDEX_FILE)
+
+
+def link_file(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """Hard links a file into place, or copies it if it's on another file system"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class DeltaWriter:
+    """Writes the parts of a delta table, in place of a parquet_utils.PartWriter
+
+    Rows are streamed in with write(). Those matching a row of the previous release,
+    by both identifier & contents, are set aside, and everything else is written to
+    this release's partition. close() then decides which previous files to reuse,
+    and writes the tombstones and row index.
+
+    counts tallies the rows which are unchanged, updated (the identifier is in the
+    previous release, with other contents), added, and removed since the previous
+    release.
+    """
+
+    def __init__(
+        self,
+        parquet_path: pathlib.Path,
+        stem: str,
+        table: dict[list],
+        release: str,
+        max_rows: int | None = None,
+        on_part: Callable[[pathlib.Path, str], None] | None = None,
+    ):
+        """
+        :param parquet_path: the location to write output parquet to
+        :param stem: the name of the table
+        :param table: a delta table definition, from delta_table
+        :param release: the UMLS release being converted
+        :param max_rows: the maximum number of rows to write to a single file
+        :param on_part: if provided, called with the path and sha256 hash of each
+            parquet file once it is completely written or reused
+        """
+        self.parquet_path = parquet_path
+        self.table_path = parquet_path / stem
+        self.stem = stem
+        self.table = table
+        self.release = release
+        self.on_part = on_part or (lambda path, sha256: None)
+        self.writer = parquet_utils.PartWriter(
+            parquet_path,
+            stem,
+            {**table, "partition_column": GENERATION_COLUMN},
+            max_rows,
+            on_part=self.on_part,
+        )
+        self.counts = dict.fromkeys(("unchanged", "updated", "added", "removed"), 0)
+        self.manifest, self.index = read_base(table) or (None, None)
+        if self.index is not None:
+            hashes = self.index["row_hash"].to_numpy()
+            key_hashes = hash_keys(self.index["key"])
+            # The index is searched in hash & then identifier order, and mapped back
+            # by position
+            self._order = numpy.lexsort((key_hashes, hashes))
+            self._hashes = hashes[self._order]
+            self._key_hashes = key_hashes[self._order]
+            # ...and separately by identifier, to tell updated rows from added ones
+            self._keys = numpy.sort(key_hashes)
+            self._live = numpy.zeros(len(hashes), dtype=bool)
+
+    def write(self, rows: pyarrow.Table) -> None:
+        """Writes any rows which aren't already in the previous release
+
+        :param rows: rows with every output column
+        """
+        found = numpy.zeros(rows.num_rows, dtype=bool)
+        key_hashes = hash_keys(rows[self.table["delta_key"]])
+        if self.index is not None and len(self._hashes):
+            hashes = hash_rows(rows, self.table)
+            starts = numpy.searchsorted(self._hashes, hashes)
+            ends = numpy.searchsorted(self._hashes, hashes, side="right")
+            positions = numpy.minimum(starts, len(self._hashes) - 1)
+            found = (starts < ends) & (self._key_hashes[positions] == key_hashes)
+            # Previous rows sharing a hash are in identifier order, so a row whose
+            # identifier isn't first among them is searched for within them
+            for i in numpy.flatnonzero((ends - starts > 1) & ~found):
+                group = self._key_hashes[starts[i] : ends[i]]
+                offset = numpy.searchsorted(group, key_hashes[i])
+                if offset < len(group) and group[offset] == key_hashes[i]:
+                    positions[i] = starts[i] + offset
+                    found[i] = True
+            self._live[positions[found]] = True
+            rows = rows.filter(pyarrow.array(~found))
+            key_hashes = key_hashes[~found]
+            known = (
+                self._keys[
+                    numpy.minimum(numpy.searchsorted(self._keys, key_hashes), len(self._keys) - 1)
+                ]
+                == key_hashes
+            )
+        else:
+            known = numpy.zeros(len(key_hashes), dtype=bool)
+        self.counts["unchanged"] += int(found.sum())
+        self.counts["updated"] += int(known.sum())
+        self.counts["added"] += int((~known).sum())
+        self._write_new(rows)
+
+    def close(self) -> dict[int, dict]:
+        """Reuses previous files, writes tombstones & the row index, and closes files
+
+        :returns: a dict of part numbers to the `rows`, `sha256` hash, and relative
+            `path` of each file in the table, as returned by PartWriter.close
+        """
+        chunks = {}
+        tombstones = []
+        index = []
+        if self.index is not None:
+            parts = self._get_live_parts()
+            # Each updated row's previous version isn't live, but wasn't removed
+            self.counts["removed"] = max(int((~self._live).sum()) - self.counts["updated"], 0)
+            base_path = pathlib.Path(self.table["delta_base"])
+            base_chunks = {
+                path: (rows, sha256)
+                for path, rows, sha256 in zip(
+                    self.manifest["path_per_chunk"],
+                    self.manifest["rows_per_chunk"],
+                    self.manifest["sha256_per_chunk"],
+                    strict=True,
+                )
+            }
+            for part, (positions, live) in parts.items():
+                rows, sha256 = base_chunks[part]
+                if not live.any():
+                    continue
+                entries = self.index.take(positions)
+                if live.mean() < REUSE_FRACTION:
+                    # Too little of this file is current, so its rows are rewritten
+                    self._rewrite(base_path / part, entries["row_hash"].to_numpy()[live])
+                    continue
+                link_file(base_path / part, self.table_path / part)
+                chunks[len(chunks)] = {"rows": rows, "sha256": sha256, "path": part}
+                self.on_part(self.table_path / part, sha256)
+                index.append(entries)
+                dead = entries.filter(pyarrow.array(~live))
+                tombstones.append(
+                    pyarrow.table(
+                        {
+                            self.table["delta_key"]: dead["key"],
+                            GENERATION_COLUMN: pyarrow.array(
+                                [get_generation(part)] * dead.num_rows, pyarrow.string()
+                            ),
+                        }
+                    )
+                )
+        for chunk in self.writer.close(empty_file=not chunks).values():
+            chunks[len(chunks)] = chunk
+            index.append(self._index_part(chunk["path"]))
+        self._write_tombstones(tombstones)
+        parquet_utils.write_arrow_table(pyarrow.concat_tables(index), self.table_path / INDEX_FILE)
+        return chunks
+
+    def _write_new(self, rows: pyarrow.Table) -> None:
+        if rows.num_rows:
+            generation = pyarrow.array([self.release] * rows.num_rows, pyarrow.string())
+            self.writer.write(rows.append_column(GENERATION_COLUMN, generation))
+
+    def _get_live_parts(self) -> dict[str, tuple[numpy.ndarray, numpy.ndarray]]:
+        """Finds which index rows of each previous file are still current
+
+        :returns: a dict of each previous file's relative path to the positions of
+            its rows in the index, and a mask of which of those rows are current
+        """
+        # Identical rows share a hash & identifier, but only one of them was marked
+        # when matched
+        starts = numpy.flatnonzero(
+            numpy.r_[True, (numpy.diff(self._hashes) != 0) | (numpy.diff(self._key_hashes) != 0)]
+        )
+        if len(starts):
+            group_live = numpy.maximum.reduceat(self._live, starts)
+            self._live = numpy.repeat(group_live, numpy.diff(numpy.r_[starts, len(self._hashes)]))
+        live = numpy.empty_like(self._live)
+        live[self._order] = self._live
+        codes, parts = pandas.factorize(self.index["part"].to_numpy(zero_copy_only=False))
+        result = {}
+        for code, part in enumerate(parts):
+            positions = numpy.flatnonzero(codes == code)
+            result[part] = (positions, live[positions])
+        return result
+
+    def _rewrite(self, path: pathlib.Path, live_hashes: numpy.ndarray) -> None:
+        """Writes the current rows of a previous file into this release's partition"""
+        rows = pyarrow.parquet.read_table(path).select(self.table["headers"])
+        current = numpy.isin(hash_rows(rows, self.table), live_hashes)
+        self._write_new(rows.filter(pyarrow.array(current)))
+
+    def _index_part(self, part: str) -> pyarrow.Table:
+        """Builds the index rows of a newly written file"""
+        rows = pyarrow.parquet.read_table(self.table_path / part).select(self.table["headers"])
+        hashes = hash_rows(rows, self.table)
+        return pyarrow.table(
+            {
+                "key": rows[self.table["delta_key"]].cast(pyarrow.string()),
+                "row_hash": pyarrow.array(hashes, pyarrow.uint64()),
+                "part": pyarrow.array([part] * rows.num_rows, pyarrow.string()),
+            }
+        )
+
+    def _write_tombstones(self, tombstones: list[pyarrow.Table]) -> None:
+        path = get_tombstone_path(self.parquet_path, self.stem)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        schema = pyarrow.schema(
+            [(self.table["delta_key"], pyarrow.string()), (GENERATION_COLUMN, pyarrow.string())]
+        )
+        parquet_utils.write_arrow_table(
+            pyarrow.concat_tables(tombstones) if tombstones else schema.empty_table(), path
+        )
+
+
+def convert_rrf_delta(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    table: dict[list],
+    force_upload=False,
+    engine: str = "arrow",
+    on_part: Callable[[pathlib.Path, str | None], None] | None = None,
+    release: str | None = None,
+    chunksize: int = 500_000,
+) -> list[tuple[pathlib.Path, str | None]]:
+    """Converts a .rrf file to a delta table, reusing the previous release's parquet
+
+    This takes the same arguments as parquet_utils.convert_rrf, so can be used in its
+    place. Delta tables are always parsed with the arrow engine, so that rows hash
+    identically whether they are read from a .rrf or from parquet.
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location to write output parquet to
+    :param table: a delta table definition, from delta_table
+    :param force_upload: if true, regenerate parquet regardless of what already
+        exists on disk
+    :param engine: ignored; delta tables are always parsed with the arrow engine
+    :param on_part: if provided, called with the path and sha256 hash of each
+        parquet file in the table, whether written or reused
+    :param release: the UMLS release the file is from
+    :param chunksize: the maximum number of rows to write to each new parquet file
+    :returns: (path, sha256 hash) tuples of the parquet files for this table
+    """
+    on_part = on_part or (lambda path, sha256: None)
+    profile = table.get("profile")
+    parts = (
+        None
+        if force_upload
+        else parquet_utils.get_converted_parts(rrf_path, parquet_path, release, profile)
+    )
+    if parts is not None:
+        for part, sha256 in parts:
+            on_part(part, sha256)
+        return parts
+    layout = {"engine": "arrow", "profile": profile}
+    parquet_utils.start_conversion(rrf_path, parquet_path, release, layout, resume=False)
+    writer = DeltaWriter(parquet_path, rrf_path.stem, table, release, chunksize, on_part)
+    chunks = parquet_utils.stream_rrf(rrf_path, table, writer)
+    if writer.index is not None:
+        base = pathlib.Path(table["delta_base"]).parent.name
+        print(
+            f"{rrf_path.stem} since {base}: "
+            + ", ".join(f"{count} rows {kind}" for kind, count in writer.counts.items())
+        )
+    return parquet_utils.finish_conversion(rrf_path, parquet_path, release, chunks, profile)
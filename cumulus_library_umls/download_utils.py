@@ -0,0 +1,340 @@
+"""Downloading release archives in parallel byte ranges, resumable across runs
+
+A release archive is several gigabytes. Rather than a single stream, which has to
+start over if the connection drops, the archive is fetched as fixed size byte ranges
+by several threads at once, each written in place into a partial file. Finished
+ranges are recorded next to the partial file, so a later run only fetches the
+ranges that are missing. Servers which don't support range requests are read as a
+single stream instead.
+
+Before the archive is moved into place, its size is checked against the size the
+server reported, and its central directory & the local header of every member are
+checked, which catches a truncated or misassembled download without reading the
+whole archive. Members are checked against their CRC32 checksums as they're
+extracted (or streamed from), since that reads them anyway.
+"""
+
+import concurrent.futures
+import os
+import pathlib
+import re
+import shutil
+import time
+import zipfile
+import zlib
+from collections.abc import Callable
+
+import requests
+from cumulus_library import base_utils, errors
+
+from cumulus_library_umls import json_utils
+
+DOWNLOAD_URL = "https://uts-ws.nlm.nih.gov/download"
+
+DEFAULT_WORKERS = 4
+DEFAULT_CHUNK_SIZE = 64 * 1024**2
+
+# The suffixes of the partial archive, and of the record of which ranges of it are
+# written, next to where the finished archive goes
+PARTIAL_SUFFIX = ".partial"
+STATE_SUFFIX = ".download.json"
+
+# The size of the blocks read from a response and written at once
+BLOCK_SIZE = 1024**2
+# Seconds to wait on a connection, or between bytes of a response
+TIMEOUT = 60
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+def get_chunks(size: int, chunk_size: int) -> list[tuple[int, int]]:
+    """Splits a file into byte ranges
+
+    :param size: the size of the file
+    :param chunk_size: the size of each range, apart from the last
+    :returns: (first, last) byte offsets of each range, inclusive, as in a Range header
+    """
+    return [
+        (start, min(start + chunk_size, size) - 1) for start in range(0, size, max(chunk_size, 1))
+    ]
+
+
+def parse_content_range(header: str | None) -> tuple[int, int, int] | None:
+    """Parses a Content-Range header, i.e. `bytes 0-1023/4096`
+
+    :returns: the first & last byte offsets of the range, and the full size, or None
+        if the header is missing or describes an unknown size
+    """
+    match = _CONTENT_RANGE.fullmatch((header or "").strip())
+    if not match:
+        return None
+    return tuple(int(value) for value in match.groups())
+
+
+def verify_archive(path: pathlib.Path, size: int | None) -> None:
+    """Checks a downloaded archive is complete, without decompressing it
+
+    :param path: the location of the archive
+    :param size: the size the server reported, if it did
+    """
+    actual_size = path.stat().st_size
+    if size is not None and actual_size != size:
+        raise errors.ApiError(f"Downloaded {actual_size} bytes of {path.name}, expected {size}")
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile as e:
+        raise errors.ApiError(f"Downloaded {path.name} is not a valid zip archive: {e}") from e
+    with archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            f.seek(info.header_offset)
+            if (
+                f.read(4) != zipfile.stringFileHeader
+                or info.header_offset + info.compress_size > actual_size
+            ):
+                raise errors.ApiError(f"{info.filename} in downloaded {path.name} is corrupt")
+
+
+def extract_archive(path: pathlib.Path, destination: pathlib.Path) -> None:
+    """Extracts an archive, checking each member against its CRC32 as it's written
+
+    If a member fails its checksum, the directories the archive extracts to are
+    removed, so a partial release isn't mistaken for an extracted one.
+
+    :param path: the location of the archive
+    :param destination: the location to extract to
+    """
+    with zipfile.ZipFile(path) as archive:
+        roots = {destination / name.split("/", 1)[0] for name in archive.namelist()}
+        for info in archive.infolist():
+            try:
+                archive.extract(info, destination)
+            except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                for root in roots:
+                    if root.is_dir():
+                        shutil.rmtree(root)
+                    else:
+                        root.unlink(missing_ok=True)
+                raise errors.ApiError(
+                    f"{info.filename} in {path.name} failed its checksum: {e}"
+                ) from e
+
+
+def read_state(state_path: pathlib.Path, source: str, size: int, chunk_size: int) -> set[int]:
+    """Reads which ranges a previous attempt at a download finished
+
+    :param state_path: the location of the record of the previous attempt
+    :param source: an identifier of the file being downloaded
+    :param size: the size of the file
+    :param chunk_size: the size of each range
+    :returns: the offsets of the ranges already written, or an empty set if the
+        previous attempt was at a different file, or split it differently
+    """
+    state = json_utils.read_json(state_path) or {}
+    if {key: state.get(key) for key in ("source", "size", "chunk_size")} != {
+        "source": source,
+        "size": size,
+        "chunk_size": chunk_size,
+    }:
+        return set()
+    return set(state.get("done", []))
+
+
+def fetch_range(
+    url: str,
+    params: dict | None,
+    partial_path: pathlib.Path,
+    first: int,
+    last: int,
+    on_bytes: Callable[[int], None],
+) -> None:
+    """Fetches a byte range of a file, writing it in place in the partial file
+
+    :param url: the location of the file
+    :param params: any query parameters for the request
+    :param partial_path: the location of the partial file, already at its full size
+    :param first: the first byte offset of the range
+    :param last: the last byte offset of the range, inclusive
+    :param on_bytes: called with the number of bytes written, after each block
+    """
+    with requests.get(
+        url,
+        params=params,
+        headers={"Range": f"bytes={first}-{last}"},
+        stream=True,
+        timeout=TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        content_range = parse_content_range(response.headers.get("Content-Range"))
+        if response.status_code != 206 or (content_range or ())[:2] != (first, last):
+            raise errors.ApiError(
+                f"Expected bytes {first}-{last}, got status {response.status_code} "
+                f"with range {response.headers.get('Content-Range')}"
+            )
+        written = 0
+        with open(partial_path, "r+b") as f:
+            f.seek(first)
+            for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                f.write(block)
+                written += len(block)
+                on_bytes(len(block))
+            f.flush()
+            os.fsync(f.fileno())
+    if written != last - first + 1:
+        raise errors.ApiError(f"Expected {last - first + 1} bytes at {first}, got {written}")
+
+
+def fetch_with_retries(*args, retries: int = 3, backoff: float = 1.0, **kwargs) -> None:
+    """Fetches a byte range, retrying failures with exponential backoff
+
+    Takes the arguments of fetch_range, plus:
+
+    :keyword retries: the number of times to retry after a failed attempt
+    :keyword backoff: the number of seconds to wait before the first retry. This
+        doubles with each subsequent retry.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fetch_range(*args, **kwargs)
+        except (requests.RequestException, errors.ApiError):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def stream_file(
+    response: requests.Response, partial_path: pathlib.Path, on_bytes: Callable[[int], None]
+):
+    """Writes the whole body of a response to the partial file"""
+    with open(partial_path, "wb") as f:
+        for block in response.iter_content(chunk_size=BLOCK_SIZE):
+            f.write(block)
+            on_bytes(len(block))
+
+
+def download_file(
+    url: str,
+    path: pathlib.Path,
+    *,
+    params: dict | None = None,
+    source: str | None = None,
+    workers: int = DEFAULT_WORKERS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retries: int = 3,
+    backoff: float = 1.0,
+) -> pathlib.Path:
+    """Downloads an archive, in parallel byte ranges if the server supports them
+
+    :param url: the location of the archive
+    :param path: the location to write the finished archive to
+    :keyword params: any query parameters for the requests
+    :keyword source: an identifier of the archive, recorded to check a previous
+        attempt was at the same file (defaulting to the url). This shouldn't include
+        secrets, such as an API key in the params.
+    :keyword workers: the number of ranges fetched at once
+    :keyword chunk_size: the size of each range
+    :keyword retries: the number of times each range is retried after a failure
+    :keyword backoff: the number of seconds to wait before the first retry
+    :returns: the path of the finished archive
+    """
+    partial_path = path.with_name(path.name + PARTIAL_SUFFIX)
+    state_path = path.with_name(path.name + STATE_SUFFIX)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with base_utils.get_progress_bar() as progress:
+        task = progress.add_task(f"Downloading {path.name}...", total=None)
+
+        def on_bytes(count: int) -> None:
+            progress.advance(task, count)
+
+        # A single byte range request tells us if ranges are supported, and the size
+        probe = requests.get(
+            url, params=params, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+        )
+        with probe:
+            probe.raise_for_status()
+            content_range = parse_content_range(probe.headers.get("Content-Range"))
+            ranged = probe.status_code == 206 and content_range is not None
+            if not ranged:
+                # The server ignored the range, and is sending the whole file
+                size = probe.headers.get("Content-Length")
+                size = int(size) if size and not probe.headers.get("Content-Encoding") else None
+                progress.update(task, total=size)
+                stream_file(probe, partial_path, on_bytes)
+                state_path.unlink(missing_ok=True)
+        if ranged:
+            size = content_range[2]
+            progress.update(task, total=size)
+            source = source or url
+            done = read_state(state_path, source, size, chunk_size)
+            if not done or not partial_path.exists():
+                done = set()
+                with open(partial_path, "wb") as f:
+                    f.truncate(size)
+            chunks = [chunk for chunk in get_chunks(size, chunk_size) if chunk[0] not in done]
+            progress.advance(task, size - sum(last - first + 1 for first, last in chunks))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                futures = {
+                    pool.submit(
+                        fetch_with_retries,
+                        url,
+                        params,
+                        partial_path,
+                        first,
+                        last,
+                        on_bytes,
+                        retries=retries,
+                        backoff=backoff,
+                    ): first
+                    for first, last in chunks
+                }
+                error = None
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception():
+                        error = error or future.exception()
+                        continue
+                    # Ranges are recorded as they finish, so a failed attempt can resume
+                    done.add(futures[future])
+                    json_utils.write_json_atomic(
+                        state_path,
+                        {
+                            "source": source,
+                            "size": size,
+                            "chunk_size": chunk_size,
+                            "done": sorted(done),
+                        },
+                    )
+                if error:
+                    raise error
+    try:
+        verify_archive(partial_path, size)
+    except errors.ApiError:
+        # Start over next time, since there's no telling which range was corrupt
+        partial_path.unlink(missing_ok=True)
+        state_path.unlink(missing_ok=True)
+        raise
+    partial_path.replace(path)
+    state_path.unlink(missing_ok=True)
+    return path
+
+
+def download_release(
+    api_key: str,
+    metadata: dict,
+    path: pathlib.Path,
+    **kwargs,
+) -> pathlib.Path:
+    """Downloads a release archive from the UMLS download API
+
+    :param api_key: the UMLS API key
+    :param metadata: the release's metadata, from UmlsApi.get_latest_umls_file_release
+    :param path: the directory to write the archive to
+    :param kwargs: additional arguments for download_file
+    :returns: the path of the archive
+    """
+    return download_file(
+        DOWNLOAD_URL,
+        path / metadata["fileName"],
+        # This endpoint takes the API key as a param, rather than via basic auth
+        params={"url": metadata["downloadUrl"], "apiKey": api_key},
+        source=metadata["downloadUrl"],
+        **kwargs,
+    )
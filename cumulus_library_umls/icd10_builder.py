@@ -0,0 +1,94 @@
+"""Builder for the ICD-10-CM hierarchy tables, from the converted Metathesaurus"""
+
+import pathlib
+
+import platformdirs
+from cumulus_library import BaseTableBuilder, base_utils, log_utils, study_manifest
+from cumulus_library.template_sql import base_templates
+
+from cumulus_library_umls import (
+    icd10_utils,
+    metrics_utils,
+    parquet_utils,
+    release_utils,
+    upload_utils,
+)
+
+
+class ICD10Builder(BaseTableBuilder):
+    display_text = "Building ICD-10 hierarchy tables..."
+
+    def prepare_queries(
+        self,
+        config: base_utils.StudyConfig,
+        manifest: study_manifest.StudyManifest,
+        *args,
+        **kwargs,
+    ):
+        prefix = manifest.get_study_prefix()
+        base_path = pathlib.Path(platformdirs.user_cache_dir("cumulus-library", "smart-on-fhir"))
+        release_path = release_utils.get_release_path(
+            base_path / "generated_parquet", ["MRCONSO", "MRREL"]
+        )
+        release = release_path.name
+        metrics = metrics_utils.BuildMetrics(f"icd10_{release}")
+        with metrics.measure("build"):
+            concepts, relations = (
+                release_utils.read_rows(
+                    release_path,
+                    stem,
+                    columns,
+                    {icd10_utils.SAB},
+                    **release_utils.get_table_layout(config, stem),
+                )
+                for stem, columns in (
+                    ("MRCONSO", icd10_utils.CONCEPT_COLUMNS),
+                    ("MRREL", icd10_utils.RELATION_COLUMNS),
+                )
+            )
+            tables = icd10_utils.build_tables(concepts, relations)
+
+        parquet_paths = {}
+        hashes = {}
+        for name, df in tables.items():
+            path = parquet_utils.get_part_path(release_path, name, 0)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with metrics.measure("build", name):
+                chunk = parquet_utils.write_arrow_table(icd10_utils.to_arrow(name, df), path)
+            hashes[path] = chunk["sha256"]
+            metrics.add("build", name, rows=chunk["rows"], output_bytes=path.stat().st_size)
+            parquet_paths[name] = [path]
+
+        remote_paths = upload_utils.upload_tables(
+            config.db,
+            parquet_paths,
+            study=prefix,
+            force_upload=config.force_upload,
+            workers=len(parquet_paths),
+            hashes=hashes,
+            ledger=upload_utils.UploadLedger(
+                base_path / upload_utils.LEDGER_FILE, upload_utils.get_destination(config.db)
+            ),
+            release=release,
+            metrics=metrics,
+        )
+        for name in tables:
+            schema = icd10_utils.get_schema(name)
+            self.queries.append(
+                base_templates.get_ctas_from_parquet_query(
+                    schema_name=config.schema,
+                    table_name=f"{prefix}__{name}",
+                    local_location=release_path / f"{name}/*.parquet",
+                    remote_location=remote_paths[name],
+                    table_cols=schema.names,
+                    remote_table_cols_types=[
+                        icd10_utils.PARQUET_TYPES[field.type] for field in schema
+                    ],
+                )
+            )
+        metrics.write_report(base_path / metrics_utils.REPORT_DIR)
+        log_utils.log_transaction(
+            config=config,
+            manifest=manifest,
+            message=f"ICD-10 tables from UMLS version {release}: {metrics.summary()}",
+        )
@@ -0,0 +1,247 @@
+"""Builds the ICD-10-CM hierarchy tables from the converted MRCONSO & MRREL
+
+Each level of the hierarchy (chapter, block, category, subcategories, and extension)
+is the set of ICD10CM concepts which are children of a concept in the level above,
+and which have the term types & code shape of that level. The levels are stacked
+into `icd10_tree`, and walked down from each chapter into the flattened
+`icd10_hierarchy`.
+
+These match the output of the SQL these tables used to be created with, quirks
+included, but are computed in memory from the parquet already on disk, rather
+than by a chain of queries each rescanning MRREL.
+"""
+
+import dataclasses
+
+import numpy
+import pandas
+import pyarrow
+
+SAB = "ICD10CM"
+
+# The ICD10CM root concept, which chapters are the children of
+ROOT_CUI = "C2880081"
+
+# The columns of each level, which the tree adds a depth to
+LEVEL_COLUMNS = ["rui", "cui1", "cui2", "tty", "code", "str"]
+
+# The columns read from each converted table, by release_utils.read_rows
+CONCEPT_COLUMNS = ["CUI", "SAB", "TTY", "CODE", "STR"]
+RELATION_COLUMNS = ["RUI", "CUI1", "CUI2", "REL", "SAB"]
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class Level:
+    """A level of the ICD-10 hierarchy, and how its concepts are found"""
+
+    name: str
+    # The level this level's concepts are children of, or None for the root
+    parent: str | None
+    ttys: tuple[str, ...]
+    depth: int
+    # The length of this level's codes, if fixed
+    code_length: int | None = None
+    # Whether this level's codes are ranges, i.e. A00-A09
+    code_range: bool = False
+
+
+# In dependency order. Extensions are looked for under subcategory_1, and both
+# categories & subcategory_1 share a depth, as they always have.
+LEVELS = (
+    Level(name="chapter", parent=None, ttys=("HT",), depth=2),
+    Level(name="block", parent="chapter", ttys=("HT",), depth=3, code_range=True),
+    Level(name="category", parent="block", ttys=("HT", "PT"), depth=4, code_length=3),
+    Level(name="subcategory_1", parent="category", ttys=("HT", "PT"), depth=4, code_length=5),
+    Level(name="subcategory_2", parent="subcategory_1", ttys=("HT", "PT"), depth=5, code_length=6),
+    Level(name="subcategory_3", parent="subcategory_2", ttys=("HT", "PT"), depth=6, code_length=7),
+    Level(name="extension", parent="subcategory_1", ttys=("HT", "PT"), depth=7, code_length=8),
+)
+
+# The levels of icd10_hierarchy below chapter: the code length of each, and the
+# level whose code it must start with. Blocks are any child of a chapter.
+HIERARCHY_LEVELS = (
+    ("block", None, None),
+    ("category", 3, None),
+    ("subcategory_1", 5, "category"),
+    ("subcategory_2", 6, "subcategory_1"),
+    ("subcategory_3", 7, "subcategory_2"),
+    ("extension", 8, "subcategory_1"),
+)
+
+HIERARCHY_COLUMNS = [
+    f"{name}_{column}"
+    for name in ("chapter", *(level for level, _, _ in HIERARCHY_LEVELS))
+    for column in ("code", "str")
+] + ["leaf_code"]
+
+# The database types of each arrow type the tables are written with
+PARQUET_TYPES = {pyarrow.string(): "String", pyarrow.int32(): "Integer"}
+
+
+def get_table_name(name: str) -> str:
+    """Returns the name of an ICD-10 table, i.e. icd10_chapter"""
+    return f"icd10_{name}"
+
+
+def get_table_names() -> list[str]:
+    """Lists every ICD-10 table, in the order they are built"""
+    return [get_table_name(level.name) for level in LEVELS] + [
+        get_table_name("tree"),
+        get_table_name("hierarchy"),
+    ]
+
+
+def get_schema(name: str) -> pyarrow.Schema:
+    """Returns the columns of an ICD-10 table, and their types
+
+    :param name: the name of the table, from get_table_names
+    """
+    if name == get_table_name("tree"):
+        return pyarrow.schema(
+            [(column, pyarrow.string()) for column in LEVEL_COLUMNS] + [("depth", pyarrow.int32())]
+        )
+    columns = HIERARCHY_COLUMNS if name == get_table_name("hierarchy") else LEVEL_COLUMNS
+    return pyarrow.schema([(column, pyarrow.string()) for column in columns])
+
+
+def to_arrow(name: str, df: pandas.DataFrame) -> pyarrow.Table:
+    """Converts the rows of an ICD-10 table to arrow, with its schema
+
+    Columns are typed explicitly, as levels may be empty, or entirely null in
+    the hierarchy, which arrow would otherwise write as null typed columns.
+
+    :param name: the name of the table, from get_table_names
+    :param df: the table's rows, from build_tables
+    """
+    return pyarrow.Table.from_pandas(df, schema=get_schema(name), preserve_index=False)
+
+
+def get_level(
+    concepts: pandas.DataFrame,
+    relations: pandas.DataFrame,
+    level: Level,
+    parents: pandas.DataFrame | None,
+) -> pandas.DataFrame:
+    """Finds the distinct rows of a level of the hierarchy
+
+    :param concepts: the ICD10CM rows of MRCONSO
+    :param relations: the ICD10CM rows of MRREL
+    :param level: the level to find
+    :param parents: the rows of the level's parent level, or None for chapters
+    :returns: the level's rows, with LEVEL_COLUMNS
+    """
+    concepts = concepts[concepts["TTY"].isin(level.ttys)]
+    if level.code_range:
+        concepts = concepts[concepts["CODE"].str.contains("-", regex=False, na=False)]
+    if level.code_length is not None:
+        concepts = concepts[concepts["CODE"].str.len() == level.code_length]
+    if parents is None:
+        # Chapters are the children of the root, and any relation to it counts
+        relations = relations[relations["CUI1"] == ROOT_CUI]
+    else:
+        relations = relations[
+            (relations["REL"] == "CHD") & relations["CUI1"].isin(parents["cui2"].dropna())
+        ]
+    rows = relations.dropna(subset=["CUI2"]).merge(
+        concepts.dropna(subset=["CUI"]), left_on="CUI2", right_on="CUI"
+    )
+    rows = rows[["RUI", "CUI1", "CUI2", "TTY", "CODE", "STR"]]
+    rows.columns = LEVEL_COLUMNS
+    return rows.drop_duplicates(ignore_index=True)
+
+
+def get_tree(levels: dict[str, pandas.DataFrame]) -> pandas.DataFrame:
+    """Stacks every level into a single table, with the depth of each row
+
+    :param levels: a dict of level names to their rows, from get_level
+    """
+    return pandas.concat(
+        [
+            levels[level.name].assign(
+                depth=pandas.array([level.depth] * len(levels[level.name]), dtype="Int32")
+            )
+            for level in LEVELS
+        ],
+        ignore_index=True,
+    )
+
+
+def join_children(
+    rows: pandas.DataFrame,
+    tree: pandas.DataFrame,
+    name: str,
+    code_length: int | None,
+    prefix: str | None,
+) -> pandas.DataFrame:
+    """Adds the children of each row's deepest concept as the next hierarchy level
+
+    This is a left join: rows without a matching child are kept, with the new
+    level's columns (and cui2, the concept children are looked for under) empty.
+
+    :param rows: the hierarchy so far, with the cui2 of each row's deepest concept
+    :param tree: the rows of icd10_tree
+    :param name: the name of the new level
+    :param code_length: if set, the length of the new level's codes
+    :param prefix: if set, the level whose code each child's code must start with
+    """
+    children = tree[["cui1", "cui2", "code", "str"]].rename(
+        columns={"code": f"{name}_code", "str": f"{name}_str"}
+    )
+    if code_length is not None:
+        children = children[children[f"{name}_code"].str.len() == code_length]
+    rows = rows.reset_index(drop=True)
+    parents = rows[["cui2"] + ([f"{prefix}_code"] if prefix else [])]
+    matches = (
+        parents.dropna(subset=["cui2"])
+        .reset_index(names="_row")
+        .merge(children, left_on="cui2", right_on="cui1", suffixes=("_parent", ""))
+    )
+    if prefix is not None:
+        starts = [
+            isinstance(start, str) and code.startswith(start)
+            for code, start in zip(matches[f"{name}_code"], matches[f"{prefix}_code"], strict=True)
+        ]
+        matches = matches[numpy.array(starts, dtype=bool)]
+    return (
+        rows.drop(columns="cui2")
+        .reset_index(names="_row")
+        .merge(matches[["_row", "cui2", f"{name}_code", f"{name}_str"]], on="_row", how="left")
+        .drop(columns="_row")
+    )
+
+
+def get_hierarchy(tree: pandas.DataFrame) -> pandas.DataFrame:
+    """Flattens the tree into one row per path from each chapter down
+
+    :param tree: the rows of icd10_tree, from get_tree
+    :returns: the hierarchy's rows, with HIERARCHY_COLUMNS
+    """
+    chapters = tree[tree["depth"] == 2][["code", "str", "cui2"]]
+    rows = chapters.rename(columns={"code": "chapter_code", "str": "chapter_str"})
+    for name, code_length, prefix in HIERARCHY_LEVELS:
+        rows = join_children(rows, tree, name, code_length, prefix)
+    # The deepest code each row reaches, below the block
+    leaf_code = rows["extension_code"]
+    for name in ("subcategory_3", "subcategory_2", "subcategory_1", "category"):
+        leaf_code = leaf_code.where(leaf_code.notna(), rows[f"{name}_code"])
+    rows["leaf_code"] = leaf_code
+    return rows[HIERARCHY_COLUMNS]
+
+
+def build_tables(concepts: pandas.DataFrame, relations: pandas.DataFrame) -> dict:
+    """Computes every ICD-10 table
+
+    :param concepts: the ICD10CM rows of MRCONSO, with at least CONCEPT_COLUMNS
+    :param relations: the ICD10CM rows of MRREL, with at least RELATION_COLUMNS
+    :returns: a dict of table names, from get_table_names, to their rows
+    """
+    levels = {}
+    for level in LEVELS:
+        levels[level.name] = get_level(
+            concepts, relations, level, levels[level.parent] if level.parent else None
+        )
+    tree = get_tree(levels)
+    tables = {get_table_name(name): rows for name, rows in levels.items()}
+    tables[get_table_name("tree")] = tree
+    tables[get_table_name("hierarchy")] = get_hierarchy(tree)
+    return tables
@@ -0,0 +1,155 @@
+"""Study options controlling what is ingested from the Metathesaurus, and how"""
+
+import dataclasses
+
+from cumulus_library import base_utils
+
+# Prefix of study options defining a row filter, i.e. `--option filter_LAT:ENG`
+FILTER_PREFIX = "filter_"
+
+# Maps study options for parquet layout to their table write_options setting
+WRITE_OPTIONS = {
+    "parquet_compression": "compression",
+    "parquet_row_group_rows": "row_group_rows",
+    "parquet_dictionary_columns": "dictionary_columns",
+    "parquet_sort_by": "sort_by",
+    "parquet_target_file_mb": "target_file_bytes",
+}
+
+
+@dataclasses.dataclass(kw_only=True)
+class IngestionProfile:
+    """Describes the tables, columns, and rows to convert from a UMLS release
+
+    Columns in exclude_columns may either be bare column names, which are removed
+    from every table, or `TABLE.COLUMN`, which are removed from a single table.
+    row_filters maps column names to the values allowed in that column; rows with
+    any other value (including null) are dropped from every table with that column.
+    """
+
+    include_tables: set[str] | None = None
+    exclude_tables: set[str] = dataclasses.field(default_factory=set)
+    exclude_columns: set[str] = dataclasses.field(default_factory=set)
+    row_filters: dict[str, set[str]] = dataclasses.field(default_factory=dict)
+
+    def includes_table(self, name: str) -> bool:
+        """Checks if a table should be converted at all
+
+        :param name: the name of the table, i.e. MRCONSO
+        """
+        if self.include_tables is not None and name not in self.include_tables:
+            return False
+        return name not in self.exclude_tables
+
+    def apply(self, name: str, table: dict[list]) -> dict[list]:
+        """Restricts a table definition to the columns and rows in this profile
+
+        The returned definition's headers, dtype, and parquet_types describe the
+        projected output columns, and its other settings (i.e. widths) are kept. The
+        full column list of the .rrf file is kept in source_headers/source_dtype, and
+        any filters on this table's columns are kept in filters, for use by the
+        converters in parquet_utils.
+
+        :param name: the name of the table, i.e. MRCONSO
+        :param table: a table definition created by UMLSBuilder.parse_ctl_file
+        :returns: the restricted table definition, or the original one if nothing
+            in the profile applies to this table
+        """
+        headers = table["headers"]
+        excluded = {
+            header
+            for header in headers
+            if header in self.exclude_columns or f"{name}.{header}" in self.exclude_columns
+        }
+        filters = {
+            column: sorted(values)
+            for column, values in sorted(self.row_filters.items())
+            if column in headers
+        }
+        if not excluded and not filters:
+            return table
+        kept = [header for header in headers if header not in excluded]
+        if not kept:
+            raise ValueError(f"exclude_columns would remove every column of {name}")
+        return {
+            **table,
+            "headers": kept,
+            "dtype": {header: table["dtype"][header] for header in kept},
+            "parquet_types": [
+                parquet_type
+                for header, parquet_type in zip(headers, table["parquet_types"], strict=True)
+                if header not in excluded
+            ],
+            "source_headers": headers,
+            "source_dtype": table["dtype"],
+            "filters": filters,
+            # Recorded in conversion manifests, so that output from a different
+            # profile isn't mistaken for a completed conversion
+            "profile": {**(table.get("profile") or {}), "headers": kept, "filters": filters},
+        }
+
+
+def parse_list_option(value: str | None) -> set[str]:
+    """Splits a comma separated option value into a set of its non-empty items"""
+    if not value:
+        return set()
+    return {item.strip() for item in value.split(",") if item.strip()}
+
+
+def get_ingestion_profile(config: base_utils.StudyConfig) -> IngestionProfile:
+    """Builds an ingestion profile from the study options
+
+    The following options are read, each a comma separated list:
+      - include_tables: if set, only these tables are converted
+      - exclude_tables: tables which are not converted
+      - exclude_columns: columns which are dropped, as COLUMN or TABLE.COLUMN
+      - filter_<COLUMN>: the values allowed in a column, i.e. `filter_LAT:ENG`
+
+    :param config: the study config containing CLI options
+    """
+    options = config.options or {}
+    include_tables = parse_list_option(options.get("include_tables"))
+    return IngestionProfile(
+        include_tables=include_tables or None,
+        exclude_tables=parse_list_option(options.get("exclude_tables")),
+        exclude_columns=parse_list_option(options.get("exclude_columns")),
+        row_filters={
+            key.removeprefix(FILTER_PREFIX): parse_list_option(value)
+            for key, value in options.items()
+            if key.startswith(FILTER_PREFIX)
+        },
+    )
+
+
+def get_write_options(config: base_utils.StudyConfig, name: str) -> dict:
+    """Reads the parquet layout settings for a table from the study options
+
+    Each option in WRITE_OPTIONS applies to every table, i.e.
+    `--option parquet_compression:zstd`, unless overridden for a single table by
+    prefixing it with the table name, i.e. `--option MRCONSO.parquet_sort_by:CUI`.
+
+    :param config: the study config containing CLI options
+    :param name: the name of the table, i.e. MRCONSO
+    :returns: a dict of settings, suitable for parquet_utils.set_write_options
+    """
+    options = config.options or {}
+    settings = {}
+    for option, setting in WRITE_OPTIONS.items():
+        key = f"{name}.{option}" if f"{name}.{option}" in options else option
+        if (value := options.get(key)) is None:
+            continue
+        match setting:
+            case "compression":
+                settings[setting] = value.lower()
+            case "dictionary_columns" | "sort_by":
+                # Order matters for sort keys, so this isn't parse_list_option's set
+                settings[setting] = [item.strip() for item in value.split(",") if item.strip()]
+            case _:
+                try:
+                    number = int(value)
+                except ValueError as e:
+                    raise ValueError(f"{key} must be an integer, got '{value}'") from e
+                if setting == "target_file_bytes":
+                    number *= 1024**2
+                settings[setting] = number
+    return settings
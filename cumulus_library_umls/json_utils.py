@@ -0,0 +1,63 @@
+"""Reading & writing the small json files that record progress in the cache directory
+
+These are kept apart from parquet_utils, so that builds which only check what's
+already cached (i.e. of the static tables) don't import pandas or pyarrow.
+"""
+
+import json
+import os
+import pathlib
+import tempfile
+from collections.abc import Callable
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+
+def write_json_atomic(path: pathlib.Path, data: dict) -> None:
+    """Writes a json file such that readers see either the old or new file, never part
+
+    The file is written under a unique temporary name first, so that builders
+    sharing a cache directory don't write over each other's unfinished files.
+
+    :param path: the location to write to
+    :param data: the json serializable data to write
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(data, indent=2))
+        os.replace(tmp_name, path)
+    except BaseException:
+        pathlib.Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def read_json(path: pathlib.Path) -> dict | None:
+    """Reads a json file, returning None if it is missing or unreadable"""
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def update_json(path: pathlib.Path, update: Callable[[dict], None]) -> dict:
+    """Changes a json file that other processes on the host may also be changing
+
+    The file is read, changed, and written while holding a lock on a file beside
+    it, so that changes made by another process in the meantime aren't lost.
+    Where the platform has no file locks, the change is made without one.
+
+    :param path: the location of the json file, which needn't exist yet
+    :param update: called with the file's current contents, to change in place
+    :returns: the new contents of the file
+    """
+    with path.with_name(f".{path.name}.lock").open("a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        data = read_json(path) or {}
+        update(data)
+        write_json_atomic(path, data)
+    return data
@@ -0,0 +1,399 @@
+"""Fast local lookups of concepts, from the converted parquet of a UMLS release
+
+Looking up a handful of concepts shouldn't need a database query, or reading
+millions of MRCONSO rows into memory. Instead, an index is built once per release
+from the parquet already converted for the build, and written beside it:
+
+  - the preferred string of each CUI, from MRCONSO
+  - the CUIs of each vocabulary's codes, from MRCONSO
+  - the semantic types of each CUI, from MRSTY, if it was converted
+
+Each is a sorted array of fixed width integer keys, with the values either in a
+parallel array, or as a table of offsets into a file of UTF-8 strings. The files
+are memory mapped when opened, so opening an index reads nothing but its json
+description, lookups are a binary search reading only the pages they touch, and
+every process using an index shares the same pages of the OS file cache.
+
+CUIs (i.e. C0004030) are keyed by their number. Codes are keyed by the CRC-32 of
+`SAB|CODE`, with the code kept alongside to tell apart codes with the same hash.
+"""
+
+import bisect
+import mmap
+import os
+import pathlib
+import shutil
+import sys
+import zlib
+
+import numpy
+import platformdirs
+import pyarrow
+import pyarrow.compute
+
+from cumulus_library_umls import json_utils, release_utils
+
+# The directory an index is written to, in the release's parquet directory
+INDEX_DIR = "_lookup"
+INDEX_FILE = "index.json"
+
+# Bumped whenever the files of an index change, so that older indexes are rebuilt
+INDEX_VERSION = 1
+
+CONCEPT_COLUMNS = ["CUI", "LAT", "TS", "STT", "ISPREF", "SAB", "CODE", "STR"]
+SEMANTIC_TYPE_COLUMNS = ["CUI", "TUI", "STY"]
+
+# The atom of a concept chosen as its preferred string, in order of precedence:
+# English, then the preferred term, string, & atom of the concept, as in MRCONSO's
+# documentation. Each column's weight is more than all those after it combined.
+PREFERENCE = [("LAT", "ENG", 8), ("TS", "P", 4), ("STT", "PF", 2), ("ISPREF", "Y", 1)]
+
+# The key & value files of each part of the index, and their memoryview formats
+FILES = {
+    "preferred_cuis": "I",
+    "preferred_offsets": "Q",
+    "preferred_strings": "B",
+    "code_hashes": "I",
+    "code_cuis": "I",
+    "code_offsets": "Q",
+    "code_keys": "B",
+    "semantic_type_cuis": "I",
+    "semantic_type_tuis": "H",
+}
+NUMPY_TYPES = {"I": numpy.uint32, "Q": numpy.uint64, "H": numpy.uint16}
+
+
+def get_index_path(release_path: pathlib.Path) -> pathlib.Path:
+    """Returns the location of a release's index"""
+    return release_path / INDEX_DIR
+
+
+def get_code_key(sab: str, code: str) -> bytes:
+    """Returns the key a vocabulary's code is hashed & stored as"""
+    return f"{sab}|{code}".encode()
+
+
+def parse_identifiers(values: pyarrow.ChunkedArray, prefix: str, digits: int) -> numpy.ndarray:
+    """Converts identifiers like C0004030 to their numbers
+
+    :param values: the identifiers
+    :param prefix: the letter identifiers start with
+    :param digits: the number of digits following the letter
+    :returns: the numbers, as uint32
+    """
+    valid = pyarrow.compute.match_substring_regex(values, f"^{prefix}[0-9]{{{digits}}}$")
+    if not pyarrow.compute.all(valid.fill_null(False), min_count=0).as_py():
+        raise ValueError(f"Expected identifiers like {prefix}{'0' * digits}, to index them")
+    numbers = pyarrow.compute.utf8_slice_codeunits(values, 1)
+    return pyarrow.compute.cast(numbers, pyarrow.uint32()).to_numpy()
+
+
+def get_string_offsets(strings: pyarrow.Array) -> tuple[numpy.ndarray, pyarrow.Buffer]:
+    """Returns the offsets & UTF-8 data of an array of strings
+
+    :param strings: the strings, with any nulls stored as empty strings
+    :returns: an offset per string plus one for the end, and the data they index
+    """
+    strings = pyarrow.compute.cast(strings.fill_null(""), pyarrow.large_string())
+    if isinstance(strings, pyarrow.ChunkedArray):
+        strings = strings.combine_chunks()
+    offsets = numpy.frombuffer(strings.buffers()[1], numpy.int64)[
+        strings.offset : strings.offset + len(strings) + 1
+    ]
+    data = strings.buffers()[2] or pyarrow.py_buffer(b"")
+    return (offsets - offsets[0]).astype(numpy.uint64), data[offsets[0] : offsets[-1]]
+
+
+def write_array(path: pathlib.Path, values: numpy.ndarray | pyarrow.Buffer, fmt: str) -> None:
+    """Writes an index file, of native byte order numbers or raw bytes"""
+    with open(path, "wb") as f:
+        if fmt == "B":
+            f.write(values)
+        else:
+            f.write(numpy.ascontiguousarray(values, NUMPY_TYPES[fmt]).tobytes())
+
+
+def index_concepts(concepts: pyarrow.Table, index_path: pathlib.Path) -> dict:
+    """Writes the preferred string & code parts of an index
+
+    :param concepts: MRCONSO rows, with at least CONCEPT_COLUMNS
+    :param index_path: the directory to write to
+    :returns: the number of CUIs & codes indexed
+    """
+    cuis = parse_identifiers(concepts["CUI"], "C", 7)
+    rank = numpy.zeros(len(concepts), numpy.int8)
+    for column, value, weight in PREFERENCE:
+        matches = pyarrow.compute.equal(concepts[column], value).fill_null(False)
+        rank += numpy.where(matches.to_numpy(), 0, weight).astype(numpy.int8)
+    order = numpy.lexsort((rank, cuis))
+    sorted_cuis = cuis[order]
+    first = numpy.ones(len(order), bool)
+    first[1:] = sorted_cuis[1:] != sorted_cuis[:-1]
+    offsets, strings = get_string_offsets(concepts["STR"].take(order[first]))
+    write_array(index_path / "preferred_cuis", sorted_cuis[first], "I")
+    write_array(index_path / "preferred_offsets", offsets, "Q")
+    write_array(index_path / "preferred_strings", strings, "B")
+
+    codes = pyarrow.table(
+        {
+            "key": pyarrow.compute.binary_join_element_wise(
+                concepts["SAB"], concepts["CODE"], "|", null_handling="skip"
+            ),
+            "cui": cuis,
+        }
+    )
+    codes = (
+        codes.filter(pyarrow.compute.is_valid(codes["key"])).group_by(["key", "cui"]).aggregate([])
+    )
+    # There's no vectorized CRC-32, but this is only done once per release
+    hashes = numpy.fromiter(
+        (zlib.crc32(key.encode()) for key in codes["key"].to_pylist()), numpy.uint32, len(codes)
+    )
+    order = numpy.argsort(hashes, kind="stable")
+    offsets, keys = get_string_offsets(codes["key"].take(order))
+    write_array(index_path / "code_hashes", hashes[order], "I")
+    write_array(index_path / "code_cuis", codes["cui"].to_numpy()[order], "I")
+    write_array(index_path / "code_offsets", offsets, "Q")
+    write_array(index_path / "code_keys", keys, "B")
+    return {"cuis": int(first.sum()), "codes": len(codes)}
+
+
+def index_semantic_types(semantic_types: pyarrow.Table | None, index_path: pathlib.Path) -> dict:
+    """Writes the semantic type part of an index
+
+    :param semantic_types: MRSTY rows, with at least SEMANTIC_TYPE_COLUMNS, or None
+        if MRSTY wasn't converted, in which case the part is left empty
+    :param index_path: the directory to write to
+    :returns: the name of each semantic type, by TUI
+    """
+    if semantic_types is None:
+        semantic_types = pyarrow.table(
+            {column: pyarrow.array([], pyarrow.string()) for column in SEMANTIC_TYPE_COLUMNS}
+        )
+    names = semantic_types.group_by(["TUI", "STY"]).aggregate([])
+    semantic_types = semantic_types.group_by(["CUI", "TUI"]).aggregate([])
+    cuis = parse_identifiers(semantic_types["CUI"], "C", 7)
+    tuis = parse_identifiers(semantic_types["TUI"], "T", 3)
+    order = numpy.lexsort((tuis, cuis))
+    write_array(index_path / "semantic_type_cuis", cuis[order], "I")
+    write_array(index_path / "semantic_type_tuis", tuis[order], "H")
+    return dict(sorted(zip(names["TUI"].to_pylist(), names["STY"].to_pylist(), strict=True)))
+
+
+def build_index(release_path: pathlib.Path, rebuild: bool = False) -> pathlib.Path:
+    """Builds the lookup index of a release, unless it was already built
+
+    :param release_path: the location the release's parquet was written to
+    :param rebuild: if True, replace any existing index
+    :returns: the location of the index
+    """
+    index_path = get_index_path(release_path)
+    if not rebuild and is_current(index_path):
+        return index_path
+    if not (release_path / "MRCONSO").is_dir():
+        raise ValueError(
+            f"The lookup index is built from the converted MRCONSO table, which was not "
+            f"found in {release_path}. Make sure it is not excluded from the build."
+        )
+
+    # The index is written to a temporary directory and renamed into place, so
+    # processes opening it never see a partial index
+    build_path = release_path / f"{INDEX_DIR}.{os.getpid()}"
+    shutil.rmtree(build_path, ignore_errors=True)
+    build_path.mkdir()
+    try:
+        concepts = release_utils.read_table(
+            release_path,
+            "MRCONSO",
+            CONCEPT_COLUMNS,
+            **release_utils.detect_table_layout(release_path, "MRCONSO"),
+        )
+        counts = index_concepts(concepts, build_path)
+        del concepts
+        semantic_types = None
+        if (release_path / "MRSTY").is_dir():
+            semantic_types = release_utils.read_table(
+                release_path,
+                "MRSTY",
+                SEMANTIC_TYPE_COLUMNS,
+                **release_utils.detect_table_layout(release_path, "MRSTY"),
+            )
+        type_names = index_semantic_types(semantic_types, build_path)
+        json_utils.write_json_atomic(
+            build_path / INDEX_FILE,
+            {
+                "version": INDEX_VERSION,
+                "release": release_path.name,
+                "byteorder": sys.byteorder,
+                "semantic_types_indexed": semantic_types is not None,
+                "counts": counts,
+                "semantic_type_names": type_names,
+            },
+        )
+        shutil.rmtree(index_path, ignore_errors=True)
+        try:
+            build_path.rename(index_path)
+        except OSError:
+            # Another process building the same index finished first
+            if not is_current(index_path):
+                raise
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
+    return index_path
+
+
+def is_current(index_path: pathlib.Path) -> bool:
+    """Checks whether an index exists, and can be read by this version & machine"""
+    index = json_utils.read_json(index_path / INDEX_FILE)
+    return (
+        index is not None
+        and index.get("version") == INDEX_VERSION
+        and index.get("byteorder") == sys.byteorder
+        and all((index_path / name).exists() for name in FILES)
+    )
+
+
+def get_cui_number(cui: str) -> int | None:
+    """Returns the number a CUI is keyed by, or None if it isn't a CUI"""
+    if len(cui) != 8 or cui[0] != "C" or not cui[1:].isdigit():
+        return None
+    return int(cui[1:])
+
+
+class ConceptLookup:
+    """Looks up concepts in the memory mapped index of a release
+
+    Lookups are thread safe, and an instance may be shared. Indexes are usually
+    opened with ConceptLookup.open(), which builds them if needed.
+    """
+
+    def __init__(self, index_path: pathlib.Path):
+        """Opens an index
+
+        :param index_path: the location of an index, from build_index
+        """
+        if not is_current(index_path):
+            raise ValueError(f"No current lookup index was found in {index_path}.")
+        self.index = json_utils.read_json(index_path / INDEX_FILE)
+        self.release = self.index["release"]
+        self._maps = []
+        self._views = {name: self._map(index_path / name, fmt) for name, fmt in FILES.items()}
+        self._preferred_cuis = self._views["preferred_cuis"]
+        self._preferred_offsets = self._views["preferred_offsets"]
+        self._preferred_strings = self._views["preferred_strings"]
+        self._code_hashes = self._views["code_hashes"]
+        self._code_cuis = self._views["code_cuis"]
+        self._code_offsets = self._views["code_offsets"]
+        self._code_keys = self._views["code_keys"]
+        self._semantic_type_cuis = self._views["semantic_type_cuis"]
+        self._semantic_type_tuis = self._views["semantic_type_tuis"]
+
+    @classmethod
+    def open(
+        cls, release: str | None = None, parquet_path: pathlib.Path | None = None
+    ) -> "ConceptLookup":
+        """Opens the index of a converted release, building it if needed
+
+        :param release: the UMLS release, i.e. 2024AA, defaulting to the most recent
+            release with MRCONSO converted
+        :param parquet_path: the directory each release's parquet is written under,
+            defaulting to the one in the cumulus-library cache directory
+        """
+        if parquet_path is None:
+            parquet_path = (
+                pathlib.Path(platformdirs.user_cache_dir("cumulus-library", "smart-on-fhir"))
+                / "generated_parquet"
+            )
+        if release:
+            release_path = parquet_path / release
+        else:
+            release_path = release_utils.get_release_path(parquet_path, ["MRCONSO"])
+        return cls(build_index(release_path))
+
+    def _map(self, path: pathlib.Path, fmt: str) -> memoryview:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be memory mapped
+                return memoryview(b"").cast(fmt)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped).cast(fmt)
+
+    def close(self) -> None:
+        """Unmaps the index's files"""
+        for view in self._views.values():
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def __enter__(self) -> "ConceptLookup":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def get_preferred_string(self, cui: str) -> str | None:
+        """Returns the preferred string of a concept, or None if it isn't found"""
+        number = get_cui_number(cui)
+        if number is None:
+            return None
+        i = bisect.bisect_left(self._preferred_cuis, number)
+        if i == len(self._preferred_cuis) or self._preferred_cuis[i] != number:
+            return None
+        start, end = self._preferred_offsets[i], self._preferred_offsets[i + 1]
+        return str(self._preferred_strings[start:end], "utf-8")
+
+    def get_preferred_strings(self, cuis: list[str]) -> dict[str, str]:
+        """Returns the preferred strings of many concepts, with one binary search
+
+        Per concept, this is much faster than get_preferred_string for more than a
+        few dozen CUIs.
+
+        :param cuis: the concepts to look up
+        :returns: the preferred string of each concept found, by CUI
+        """
+        valid = [cui for cui in cuis if get_cui_number(cui) is not None]
+        numbers = numpy.fromiter((int(cui[1:]) for cui in valid), numpy.uint32, len(valid))
+        keys = numpy.frombuffer(self._preferred_cuis, numpy.uint32)
+        positions = numpy.searchsorted(keys, numbers)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == numbers[found]
+        offsets = numpy.frombuffer(self._preferred_offsets, numpy.uint64)
+        starts, ends = offsets[positions[found]], offsets[positions[found] + 1]
+        strings = {}
+        for cui, start, end in zip(
+            numpy.asarray(valid, object)[found], starts.tolist(), ends.tolist(), strict=True
+        ):
+            strings[cui] = str(self._preferred_strings[start:end], "utf-8")
+        return strings
+
+    def get_cuis(self, sab: str, code: str) -> list[str]:
+        """Returns the sorted CUIs of a vocabulary's code, i.e. ("ICD10CM", "B44.9")"""
+        key = get_code_key(sab, code)
+        crc = zlib.crc32(key)
+        cuis = []
+        i = bisect.bisect_left(self._code_hashes, crc)
+        while i < len(self._code_hashes) and self._code_hashes[i] == crc:
+            if self._code_keys[self._code_offsets[i] : self._code_offsets[i + 1]] == key:
+                cuis.append(f"C{self._code_cuis[i]:07d}")
+            i += 1
+        return sorted(cuis)
+
+    def get_semantic_types(self, cui: str) -> list[str]:
+        """Returns the sorted TUIs of a concept's semantic types, i.e. ["T047"]"""
+        if not self.index["semantic_types_indexed"]:
+            raise ValueError(
+                "Semantic types are looked up in the converted MRSTY table, which was not "
+                f"found for UMLS version {self.release}."
+            )
+        number = get_cui_number(cui)
+        if number is None:
+            return []
+        start = bisect.bisect_left(self._semantic_type_cuis, number)
+        end = bisect.bisect_right(self._semantic_type_cuis, number, lo=start)
+        return [f"T{tui:03d}" for tui in self._semantic_type_tuis[start:end]]
+
+    def get_semantic_type_name(self, tui: str) -> str | None:
+        """Returns the name of a semantic type, i.e. "Disease or Syndrome" for T047"""
+        return self.index["semantic_type_names"].get(tui)
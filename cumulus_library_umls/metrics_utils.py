@@ -0,0 +1,161 @@
+"""Timing & throughput measurements of a build, per stage and per table"""
+
+import collections
+import contextlib
+import datetime
+import pathlib
+import threading
+import time
+from collections.abc import Callable
+
+from cumulus_library_umls import json_utils
+
+REPORT_DIR = "build_reports"
+
+TIMES = ("wall_seconds", "cpu_seconds")
+
+# Counters recorded for each stage & table, in report order
+COUNTERS = (
+    "rows",
+    "input_bytes",
+    "output_bytes",
+    "parts_uploaded",
+    "parts_skipped",
+    "retries",
+)
+
+
+class BuildMetrics:
+    """Collects wall time, CPU time and counters for each stage of a build
+
+    Measurements are recorded against a stage (i.e. 'convert' or 'upload'), and
+    optionally a table within that stage. Time measured for a table accumulates, so
+    for work split across processes or threads it is the total time spent on that
+    table, which can exceed the stage's elapsed time. Stages can also overlap, since
+    parquet files are uploaded while the rest of the conversion continues.
+
+    This is safe to update from multiple threads.
+    """
+
+    def __init__(self, label: str):
+        """
+        :param label: a name for the build, i.e. its UMLS release, used in the report
+        """
+        self.label = label
+        self.started = datetime.datetime.now(datetime.UTC)
+        self._lock = threading.Lock()
+        # A dict of stage names to a dict of table names (or None, for the stage as
+        # a whole) to a dict of measurement names to values
+        self._stages = collections.defaultdict(lambda: collections.defaultdict(collections.Counter))
+
+    def add(self, stage: str, table: str | None = None, **values: float) -> None:
+        """Adds to the measurements of a stage, or a table within it
+
+        :param stage: the name of the stage
+        :param table: the name of the table, if the values are for a single table
+        :param values: the amounts to add, i.e. rows=10, or wall_seconds=1.5
+        """
+        with self._lock:
+            self._stages[stage][table].update(values)
+
+    @contextlib.contextmanager
+    def measure(
+        self,
+        stage: str,
+        table: str | None = None,
+        cpu_clock: Callable[[], float] = time.process_time,
+    ):
+        """Measures the wall & CPU time taken by a block of code
+
+        :param stage: the name of the stage
+        :param table: the name of the table, if the block works on a single table
+        :param cpu_clock: the CPU clock to measure with. The default measures the
+            whole process; time.thread_time only measures the current thread.
+        """
+        wall, cpu = time.perf_counter(), cpu_clock()
+        try:
+            yield
+        finally:
+            self.add(
+                stage,
+                table,
+                wall_seconds=time.perf_counter() - wall,
+                cpu_seconds=cpu_clock() - cpu,
+            )
+
+    def to_dict(self) -> dict:
+        """Describes the measurements, with each stage's totals over its tables"""
+        stages = {}
+        with self._lock:
+            for stage, entries in self._stages.items():
+                tables = {
+                    table: format_values(entries[table])
+                    for table in sorted(table for table in entries if table is not None)
+                }
+                totals = collections.Counter(entries.get(None, {}))
+                # Stages without an overall time (i.e. uploads, which happen on many
+                # threads) are described by the total time spent on their tables
+                keys = COUNTERS if "wall_seconds" in totals else (*TIMES, *COUNTERS)
+                for table in tables.values():
+                    totals.update({key: table[key] for key in keys if key in table})
+                stages[stage] = {**format_values(totals), "tables": tables}
+        return {
+            "label": self.label,
+            "started": self.started.isoformat(),
+            "stages": stages,
+        }
+
+    def summary(self) -> str:
+        """Describes each stage's time & throughput in a single line"""
+        descriptions = []
+        for stage, values in self.to_dict()["stages"].items():
+            parts = [f"{values.get('wall_seconds', 0):.1f}s"]
+            if "cpu_seconds" in values:
+                parts.append(f"{values['cpu_seconds']:.1f}s CPU")
+            if values.get("rows"):
+                parts.append(f"{values['rows']} rows")
+            for key in ("input_bytes", "output_bytes"):
+                if values.get(key):
+                    parts.append(f"{values[key] / 1024**2:.1f}MB {key.split('_')[0]}")
+            for key in ("parts_uploaded", "parts_skipped", "retries"):
+                if values.get(key):
+                    parts.append(f"{values[key]} {key.replace('_', ' ')}")
+            descriptions.append(f"{stage} {', '.join(parts)}")
+        return "; ".join(descriptions)
+
+    def write_report(self, path: pathlib.Path) -> pathlib.Path:
+        """Writes the measurements as a json report in a directory
+
+        :param path: the directory to write the report to
+        :returns: the location of the report
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        timestamp = self.started.strftime("%Y%m%dT%H%M%SZ")
+        report_path = path / f"{self.label}_{timestamp}.json"
+        json_utils.write_json_atomic(report_path, self.to_dict())
+        return report_path
+
+
+def format_values(values: collections.Counter) -> dict:
+    """Orders a set of measurements for a report, rounding times to milliseconds"""
+    formatted = {}
+    for key in TIMES:
+        if key in values:
+            formatted[key] = round(values[key], 3)
+    for key in COUNTERS:
+        if values.get(key):
+            formatted[key] = values[key]
+    return formatted
+
+
+def call_measured(func: Callable, *args) -> tuple[object, float, float]:
+    """Calls a function, measuring how long it took
+
+    This is intended for work sent to another process, where the caller's clocks
+    can't see the CPU time used.
+
+    :returns: the function's result, and the wall & CPU seconds it took
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
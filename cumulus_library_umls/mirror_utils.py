@@ -0,0 +1,106 @@
+"""Finding releases in a local mirror, and caching the latest release's metadata
+
+A mirror is a release already on a local or shared filesystem, so that build nodes
+don't each download it: either a release archive, as downloaded from UTS, an
+extracted release directory containing META, or the META directory itself. Builds
+reading from a mirror make no calls to the UTS API, and don't need an API key.
+
+Otherwise, the metadata of the latest release is cached for a while after it is
+fetched, so a rebuild of a release already on disk doesn't call the API at all.
+"""
+
+import dataclasses
+import pathlib
+import time
+import zipfile
+
+import requests
+from cumulus_library.apis import umls
+
+from cumulus_library_umls import json_utils
+
+METADATA_FILE = "release_metadata.json"
+DEFAULT_METADATA_TTL_HOURS = 24
+
+RELEASE_TARGET = "umls-metathesaurus-full-subset"
+
+
+@dataclasses.dataclass(kw_only=True, frozen=True)
+class Mirror:
+    """A release on the local filesystem
+
+    :param release: the release's version, i.e. 2024AA
+    :param archive: the location of the release archive, if it's an archive
+    :param meta_path: the location of the META directory, if it's extracted
+    """
+
+    release: str
+    archive: pathlib.Path | None = None
+    meta_path: pathlib.Path | None = None
+
+
+def find_mirror(path: pathlib.Path) -> Mirror:
+    """Finds the release in a mirror
+
+    :param path: a release archive, a release directory containing META, or a META
+        directory. The release is named after the directory containing META.
+    """
+    path = pathlib.Path(path).expanduser()
+    if path.is_file():
+        if not zipfile.is_zipfile(path):
+            raise ValueError(f"umls_mirror '{path}' is not a zip archive")
+        with zipfile.ZipFile(path) as archive:
+            meta_paths = {
+                pathlib.PurePosixPath(name).parent
+                for name in archive.namelist()
+                if pathlib.PurePosixPath(name).parent.name == "META" and name.endswith(".ctl")
+            }
+        if len(meta_paths) != 1:
+            raise ValueError(
+                f"umls_mirror '{path}' should contain a single META directory, "
+                f"found {len(meta_paths)}"
+            )
+        return Mirror(release=meta_paths.pop().parent.name, archive=path)
+    if (path / "META").is_dir():
+        path = path / "META"
+    if path.name == "META" and any(path.glob("*.ctl")):
+        return Mirror(release=path.resolve().parent.name, meta_path=path)
+    raise ValueError(
+        f"umls_mirror must be a release archive, or a directory containing META, got '{path}'"
+    )
+
+
+def get_release_metadata(
+    umls_key: str | None,
+    metadata_path: pathlib.Path | None = None,
+    ttl_hours: int = DEFAULT_METADATA_TTL_HOURS,
+    refresh: bool = False,
+) -> dict:
+    """Gets the metadata of the latest release, from the cache if it's fresh enough
+
+    If the API can't be reached, previously cached metadata is used, however old.
+
+    :param umls_key: the UMLS API key
+    :param metadata_path: the location of the cached metadata, or None to not cache
+    :param ttl_hours: how long cached metadata is used for before fetching it again
+    :param refresh: if True, the metadata is fetched regardless of the cache
+    :returns: the release's metadata, as from UmlsApi.get_latest_umls_file_release
+    """
+    cached = json_utils.read_json(metadata_path) if metadata_path else None
+    if cached and not refresh and time.time() - cached["fetched"] < ttl_hours * 3600:
+        return cached["metadata"]
+    try:
+        metadata = umls.UmlsApi(api_key=umls_key).get_latest_umls_file_release(
+            target=RELEASE_TARGET
+        )
+    except requests.ConnectionError:
+        if not cached:
+            raise
+        print(
+            "Could not reach the UMLS API, using the release metadata cached "
+            f"{(time.time() - cached['fetched']) / 3600:.0f} hours ago"
+        )
+        return cached["metadata"]
+    if metadata_path:
+        json_utils.write_json_atomic(metadata_path, {"fetched": time.time(), "metadata": metadata})
+    return metadata
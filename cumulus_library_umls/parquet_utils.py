@@ -0,0 +1,1112 @@
+"""Helpers for converting UMLS .RRF files to parquet
+
+These live outside of the builder modules so that they can be imported by
+worker processes (cumulus-library loads builders under a synthetic module name,
+which can't be unpickled in a subprocess).
+"""
+
+import collections
+import hashlib
+import io
+import itertools
+import mmap
+import pathlib
+from collections.abc import Callable
+
+import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.parquet
+
+from cumulus_library_umls import json_utils
+
+# Maps the pandas dtypes produced by UMLSBuilder.sql_type_to_df_parquet_type to
+# their arrow equivalents, so both engines write identical parquet schemas
+ARROW_TYPES = {
+    "string": pyarrow.string(),
+    "Int64": pyarrow.int64(),
+    "float": pyarrow.float64(),
+}
+
+ENGINES = ("pandas", "arrow")
+
+COMPRESSION_CODECS = ("snappy", "zstd", "gzip", "none")
+
+# RRF lines end with a trailing delimiter, which arrow sees as an extra column
+TRAILING_COLUMN = "__trailing"
+
+
+# Written alongside a table's parquet once every part of it has been converted
+MANIFEST_FILE = "_manifest.json"
+# Records the parts of a table converted so far, for resuming an interrupted run
+PROGRESS_FILE = "_progress.json"
+
+# The Hive convention for naming the partition of rows with a null partition value
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+# With a memory budget, the share of it that a single batch of parsed rows may use.
+# The rest leaves room for the batch's conversion to parquet, and parser buffers.
+CHUNK_BUDGET_FRACTION = 0.25
+# The number of rows parsed to measure a table's in-memory row size, before the
+# remaining chunks are sized to a memory budget
+BUDGET_SAMPLE_ROWS = 10_000
+# The share of a memory budget for each arrow read block, several of which may be
+# in flight at once
+BLOCK_BUDGET_FRACTION = 0.125
+# The share of a memory budget for a byte range converted in one go, which is read
+# into memory, parsed, and then written out
+RANGE_BUDGET_FRACTION = 0.2
+
+# Text columns declared at most this wide in a .ctl file hold short codes, i.e. LAT
+# or SUPPRESS, with only a handful of distinct values
+CATEGORICAL_MAX_WIDTH = 4
+# Code columns with few distinct values, which the .ctl files declare much wider
+CATEGORICAL_COLUMNS = frozenset(
+    {"SAB", "SL", "TTY", "STT", "RELA", "STYPE", "STYPE1", "STYPE2", "ATN", "STY", "STN"}
+)
+
+
+def get_source_info(rrf_path: pathlib.Path, release: str | None) -> dict:
+    """Describes a .rrf file, for detecting when previous output is out of date
+
+    :param rrf_path: the location of the .rrf file
+    :param release: the UMLS release the file is from
+    """
+    stat = rrf_path.stat()
+    return {
+        "release": release,
+        "file": rrf_path.name,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def read_manifest(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None = None,
+    profile: dict | None = None,
+) -> dict | None:
+    """Reads the completion manifest of a table, if it matches the current .rrf file
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param profile: the ingestion profile applied to the table, if any
+    :returns: the manifest, or None if the table has not been completely converted
+        from this version of the source file, with this profile
+    """
+    manifest = json_utils.read_json(parquet_path / rrf_path.stem / MANIFEST_FILE)
+    if (
+        manifest is None
+        or manifest.get("source") != get_source_info(rrf_path, release)
+        or manifest.get("profile") != profile
+    ):
+        return None
+    return manifest
+
+
+def is_converted(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None = None,
+    profile: dict | None = None,
+) -> bool:
+    """Checks if a .rrf file has already been completely converted to parquet
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param profile: the ingestion profile applied to the table, if any
+    """
+    return read_manifest(rrf_path, parquet_path, release, profile) is not None
+
+
+def get_converted_parts(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None = None,
+    profile: dict | None = None,
+) -> list[tuple[pathlib.Path, str | None]] | None:
+    """Lists the parquet files of a completely converted table
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param profile: the ingestion profile applied to the table, if any
+    :returns: (path, sha256 hash) tuples in part order, or None if the table isn't
+        converted
+    """
+    if (manifest := read_manifest(rrf_path, parquet_path, release, profile)) is None:
+        return None
+    hashes = manifest.get("sha256_per_chunk") or [None] * manifest["chunks"]
+    if paths := manifest.get("path_per_chunk"):
+        return [(parquet_path / rrf_path.stem / path, hashes[i]) for i, path in enumerate(paths)]
+    return [
+        (get_part_path(parquet_path, rrf_path.stem, i), hashes[i])
+        for i in range(manifest["chunks"])
+    ]
+
+
+def start_conversion(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None,
+    layout: dict,
+    resume: bool = True,
+) -> dict[int, dict]:
+    """Prepares a table's output directory, resuming a previous run if possible
+
+    If the recorded progress of an earlier run is for the same source file and the
+    same way of splitting it into parts, the parts it completed are kept. Otherwise,
+    any existing output for the table is removed.
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param layout: a description of how the file is split into parts
+    :param resume: if False, always start the conversion from scratch
+    :returns: a dict of completed part numbers to the `rows` and `sha256` hash of
+        each part
+    """
+    table_path = parquet_path / rrf_path.stem
+    progress = json_utils.read_json(table_path / PROGRESS_FILE)
+    if (
+        resume
+        and progress is not None
+        and progress.get("source") == get_source_info(rrf_path, release)
+        and progress.get("layout") == layout
+    ):
+        return {int(part): chunk for part, chunk in progress["chunks"].items()}
+    if table_path.exists():
+        for stale in table_path.rglob("*.parquet"):
+            stale.unlink()
+        for partition_dir in table_path.glob("*=*"):
+            partition_dir.rmdir()
+        (table_path / MANIFEST_FILE).unlink(missing_ok=True)
+    table_path.mkdir(parents=True, exist_ok=True)
+    record_progress(rrf_path, parquet_path, release, layout, {})
+    return {}
+
+
+def record_progress(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None,
+    layout: dict,
+    chunks: dict[int, dict],
+) -> None:
+    """Records the parts of a table that have been completely written
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param layout: a description of how the file is split into parts
+    :param chunks: a dict of completed part numbers to their `rows` and `sha256`
+    """
+    json_utils.write_json_atomic(
+        parquet_path / rrf_path.stem / PROGRESS_FILE,
+        {
+            "source": get_source_info(rrf_path, release),
+            "layout": layout,
+            "chunks": chunks,
+        },
+    )
+
+
+def finish_conversion(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    release: str | None,
+    chunks: dict[int, dict],
+    profile: dict | None = None,
+) -> list[tuple[pathlib.Path, str]]:
+    """Writes the completion manifest for a table, marking it as fully converted
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location output parquet is written to
+    :param release: the UMLS release the file is from
+    :param chunks: a dict of part numbers to their `rows` and `sha256` hash, and
+        for partitioned tables, the `path` of the part relative to the table
+    :param profile: the ingestion profile applied to the table, if any
+    :returns: (path, sha256 hash) tuples for the table, in part order
+    """
+    table_path = parquet_path / rrf_path.stem
+    count = len(chunks)
+    if sorted(chunks) != list(range(count)):
+        raise ValueError(f"Missing parts of {rrf_path.stem}: converted {sorted(chunks)}")
+    json_utils.write_json_atomic(
+        table_path / MANIFEST_FILE,
+        {
+            "source": get_source_info(rrf_path, release),
+            "chunks": count,
+            "rows_per_chunk": [chunks[i]["rows"] for i in range(count)],
+            "sha256_per_chunk": [chunks[i]["sha256"] for i in range(count)],
+            "path_per_chunk": [chunks[i].get("path") for i in range(count)]
+            if count and "path" in chunks[0]
+            else None,
+            "profile": profile,
+        },
+    )
+    (table_path / PROGRESS_FILE).unlink(missing_ok=True)
+    return get_converted_parts(rrf_path, parquet_path, release, profile)
+
+
+def get_part_path(parquet_path: pathlib.Path, stem: str, part: int) -> pathlib.Path:
+    """Returns the location of a numbered parquet file for a table
+
+    :param parquet_path: the location output parquet is written to
+    :param stem: the name of the table
+    :param part: the number of the file within the table
+    """
+    return parquet_path / stem / f"{stem}_{part}.parquet"
+
+
+def partition_table(table: dict[list], column: str) -> dict[list]:
+    """Marks a table definition to be written as Hive style partitions of a column
+
+    Each distinct value of the column gets its own directory, i.e. `sab=RXNORM/`,
+    and the column itself is left out of the parquet files, since its value is
+    implied by their location.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param column: the name of the column to partition on
+    :returns: the partitioned table definition
+    """
+    if column not in table["headers"]:
+        raise ValueError(f"Cannot partition on {column}, which is not an output column")
+    return {
+        **table,
+        "partition_column": column,
+        "profile": {**(table.get("profile") or {}), "partition_column": column},
+    }
+
+
+def get_partition_dir(column: str, value: str | None) -> str:
+    """Returns the Hive style directory name for a partition value, i.e. `sab=RXNORM`"""
+    return f"{column.lower()}={HIVE_NULL_PARTITION if value is None else value}"
+
+
+def get_partition_values(parts: list[tuple[pathlib.Path, str | None]]) -> list[str]:
+    """Lists the partition values present in a partitioned table's parts
+
+    :param parts: (path, sha256 hash) tuples, as returned by convert_rrf
+    :returns: the sorted, distinct values of the partition column
+    """
+    return sorted({path.parent.name.split("=", 1)[1] for path, _ in parts})
+
+
+class HashingFile(io.RawIOBase):
+    """A writable file which computes a sha256 hash of its contents as it is written
+
+    This lets us fingerprint parquet files for upload without a second read pass.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._file = open(path, "wb")
+        self._hash = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        super().close()
+        self._file.close()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def set_write_options(table: dict[list], options: dict) -> dict[list]:
+    """Attaches parquet layout settings to a table definition
+
+    Supported settings, all optional:
+      - compression: the parquet codec, one of COMPRESSION_CODECS
+      - row_group_rows: the maximum number of rows in a row group
+      - dictionary_columns: the only columns to dictionary encode. By default,
+        every column is dictionary encoded.
+      - sort_by: columns to sort each file's rows by, so that row group statistics
+        are useful for point lookups
+      - target_file_bytes: the approximate size to aim for in each parquet file,
+        instead of a fixed number of rows
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param options: a dict of layout settings
+    :returns: the table definition, with the settings applied
+    """
+    options = {key: value for key, value in options.items() if value is not None}
+    if not options:
+        return table
+    if options.get("compression", "snappy") not in COMPRESSION_CODECS:
+        raise ValueError(
+            f"Unknown compression '{options['compression']}', expected one of {COMPRESSION_CODECS}"
+        )
+    # Settings naming columns only apply to the columns this table has
+    for key in ("dictionary_columns", "sort_by"):
+        if key in options:
+            options[key] = [column for column in options[key] if column in table["headers"]]
+    return {
+        **table,
+        "write_options": options,
+        "profile": {**(table.get("profile") or {}), "write_options": options},
+    }
+
+
+def set_memory_budget(table: dict[list], budget_bytes: int | None) -> dict[list]:
+    """Attaches a memory budget to a table definition
+
+    With a budget, tables are parsed in batches sized in bytes rather than rows, and
+    held in memory in compact types (see get_read_dtypes). This changes how rows
+    are split into parquet files, but not the rows themselves.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param budget_bytes: the memory a conversion of the table may use for its data,
+        or None for no limit
+    :returns: the table definition, with the budget applied
+    """
+    if not budget_bytes:
+        return table
+    return {**table, "memory_budget": budget_bytes}
+
+
+def get_memory_budget(table: dict[list] | None) -> int | None:
+    """Gets the memory budget of a table, see set_memory_budget"""
+    return (table or {}).get("memory_budget")
+
+
+def get_categorical_columns(table: dict[list]) -> set[str]:
+    """Lists the text columns of a table with few distinct values
+
+    These are the columns the .ctl file declares as short, and known code columns.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    """
+    widths = table.get("widths", {})
+    return {
+        header
+        for header, dtype in table.get("source_dtype", table["dtype"]).items()
+        if dtype == "string"
+        and (header in CATEGORICAL_COLUMNS or 0 < widths.get(header, 0) <= CATEGORICAL_MAX_WIDTH)
+    }
+
+
+def get_read_dtypes(table: dict[list]) -> dict[str, str]:
+    """Gets the pandas dtypes to parse a table's source columns as
+
+    With a memory budget, low cardinality text columns are parsed as categoricals,
+    and the others as arrow backed strings, rather than as python objects, which use
+    several times the memory.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    """
+    dtypes = table.get("source_dtype", table["dtype"])
+    if not get_memory_budget(table):
+        return dtypes
+    categorical = get_categorical_columns(table)
+    return {
+        header: ("category" if header in categorical else "string[pyarrow]")
+        if dtype == "string"
+        else dtype
+        for header, dtype in dtypes.items()
+    }
+
+
+def get_budget_rows(table: dict[list], df: pandas.DataFrame) -> int | None:
+    """Estimates how many rows like a parsed batch fit in a table's memory budget
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param df: a batch of rows parsed from the table's .rrf file
+    :returns: a number of rows, or None if the table has no budget
+    """
+    if not (budget := get_memory_budget(table)):
+        return None
+    if not len(df):
+        return BUDGET_SAMPLE_ROWS
+    row_bytes = df.memory_usage(deep=True, index=False).sum() / len(df)
+    return max(int(budget * CHUNK_BUDGET_FRACTION / row_bytes), 1)
+
+
+def get_block_size(table: dict[list], default: int = 64 * 1024**2) -> int:
+    """Gets the number of bytes arrow should read from a .rrf file at a time
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param default: the block size to use if the table has no memory budget
+    """
+    if not (budget := get_memory_budget(table)):
+        return default
+    return min(max(int(budget * BLOCK_BUDGET_FRACTION), 1024**2), default)
+
+
+def get_write_options(table: dict[list] | None) -> dict:
+    """Gets the parquet layout settings of a table, see set_write_options"""
+    return (table or {}).get("write_options") or {}
+
+
+def get_parquet_kwargs(table: dict[list] | None) -> dict:
+    """Converts a table's layout settings to pyarrow parquet writer arguments"""
+    options = get_write_options(table)
+    kwargs = {"compression": options.get("compression", "snappy")}
+    if "dictionary_columns" in options:
+        kwargs["use_dictionary"] = options["dictionary_columns"]
+    return kwargs
+
+
+def sort_arrow_table(arrow_table: pyarrow.Table, table: dict[list] | None) -> pyarrow.Table:
+    """Sorts rows by a table's sort_by setting, if it has one"""
+    if sort_by := [
+        column
+        for column in get_write_options(table).get("sort_by", [])
+        if column in arrow_table.column_names
+    ]:
+        return arrow_table.sort_by([(column, "ascending") for column in sort_by])
+    return arrow_table
+
+
+def write_dataframe(
+    df: pandas.DataFrame, path: pathlib.Path, table: dict[list] | None = None
+) -> dict:
+    """Writes a dataframe to parquet, hashing it on the way out
+
+    :param df: the dataframe to write
+    :param path: the location of the parquet file
+    :param table: if provided, the table definition whose layout settings to use
+    :returns: a dict of the `rows` written and the `sha256` hash of the file
+    """
+    if get_memory_budget(table):
+        # Categoricals would otherwise be written as dictionary typed columns, so the
+        # batch is written with the same schema as any other
+        arrow_table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        return write_arrow_table(
+            arrow_table.cast(get_arrow_schema(table, list(df.columns))), path, table
+        )
+    if sort_by := [
+        column for column in get_write_options(table).get("sort_by", []) if column in df.columns
+    ]:
+        df = df.sort_values(sort_by, kind="stable", ignore_index=True)
+    with HashingFile(path) as f:
+        df.to_parquet(
+            f,
+            row_group_size=get_write_options(table).get("row_group_rows"),
+            **get_parquet_kwargs(table),
+        )
+    return {"rows": len(df), "sha256": f.hexdigest()}
+
+
+def write_arrow_table(
+    arrow_table: pyarrow.Table, path: pathlib.Path, table: dict[list] | None = None
+) -> dict:
+    """Writes an arrow table to parquet, hashing it on the way out
+
+    :param arrow_table: the table to write
+    :param path: the location of the parquet file
+    :param table: if provided, the table definition whose layout settings to use
+    :returns: a dict of the `rows` written and the `sha256` hash of the file
+    """
+    arrow_table = sort_arrow_table(arrow_table, table)
+    with HashingFile(path) as f:
+        pyarrow.parquet.write_table(
+            arrow_table,
+            f,
+            row_group_size=get_write_options(table).get("row_group_rows"),
+            **get_parquet_kwargs(table),
+        )
+    return {"rows": arrow_table.num_rows, "sha256": f.hexdigest()}
+
+
+def get_rows_per_part(target_bytes: int, path: pathlib.Path) -> int:
+    """Estimates the number of rows that will fill a parquet file of a target size
+
+    The estimate scales the row count of a previously written file by its bytes
+    per row, leaving out the file's fixed overhead (its footer and schema), which
+    would otherwise make small files look more expensive per row than they are.
+
+    :param target_bytes: the size the file should be
+    :param path: a previously written parquet file of the same table
+    """
+    metadata = pyarrow.parquet.read_metadata(path)
+    data_bytes = sum(
+        metadata.row_group(i).column(j).total_compressed_size
+        for i in range(metadata.num_row_groups)
+        for j in range(metadata.num_columns)
+    )
+    overhead = path.stat().st_size - data_bytes
+    if not metadata.num_rows or data_bytes <= 0:
+        return 1
+    return max(int(metadata.num_rows * (target_bytes - overhead) / data_bytes), 1)
+
+
+def get_source_headers(table: dict[list]) -> list[str]:
+    """Lists every column of a table's .rrf file, in file order
+
+    This differs from the table's headers when an ingestion profile has projected
+    some of the columns away.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    """
+    return table.get("source_headers", table["headers"])
+
+
+def get_read_columns(table: dict[list]) -> list[str]:
+    """Lists the columns that must be parsed from a .rrf file to produce a table
+
+    These are the output columns, plus any columns only needed to filter rows.
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    """
+    needed = set(table["headers"]) | set(table.get("filters", {}))
+    return [header for header in get_source_headers(table) if header in needed]
+
+
+def get_arrow_schema(table: dict[list], columns: list[str] | None = None) -> pyarrow.Schema:
+    """Builds an arrow schema from a table definition
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param columns: the columns to include, defaulting to the table's output columns
+    """
+    source_dtype = table.get("source_dtype", table["dtype"])
+    return pyarrow.schema(
+        [(header, ARROW_TYPES[source_dtype[header]]) for header in columns or table["headers"]]
+    )
+
+
+def read_rrf_dataframe(source, table: dict[list], **kwargs) -> pandas.DataFrame:
+    """Parses .rrf data with pandas
+
+    Unlike the arrow engine, this parses every column, since pandas can't pad out
+    rows with missing trailing fields when only some columns are selected. The
+    result needs to go through filter_dataframe to project & filter it.
+
+    :param source: a path or file-like object containing .rrf rows
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param kwargs: additional arguments for pandas.read_csv, i.e. chunksize
+    """
+    return pandas.read_csv(
+        source,
+        delimiter="|",
+        names=get_source_headers(table),
+        dtype=get_read_dtypes(table),
+        index_col=False,
+        **kwargs,
+    )
+
+
+def get_empty_dataframe(table: dict[list]) -> pandas.DataFrame:
+    """Creates a dataframe with a table's output columns and no rows"""
+    return pandas.DataFrame(columns=table["headers"]).astype(table["dtype"])
+
+
+def filter_dataframe(df: pandas.DataFrame, table: dict[list]) -> pandas.DataFrame:
+    """Applies a table's row filters and column projection to parsed rows
+
+    :param df: rows parsed with read_rrf_dataframe, with every source column
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :returns: the rows matching every filter, with only the output columns
+    """
+    filters = table.get("filters")
+    if not filters and list(df.columns) == table["headers"]:
+        return df
+    for column, values in (filters or {}).items():
+        df = df[df[column].isin(values)]
+    return df[table["headers"]].reset_index(drop=True)
+
+
+def filter_arrow_table(arrow_table: pyarrow.Table, table: dict[list]) -> pyarrow.Table:
+    """Applies a table's row filters and column projection to parsed rows
+
+    :param arrow_table: rows parsed with get_arrow_csv_options
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :returns: the rows matching every filter, with only the output columns
+    """
+    filters = table.get("filters")
+    if not filters and arrow_table.column_names == table["headers"]:
+        return arrow_table
+    for column, values in (filters or {}).items():
+        mask = pyarrow.compute.is_in(arrow_table[column], value_set=pyarrow.array(values))
+        arrow_table = arrow_table.filter(mask)
+    return arrow_table.select(table["headers"])
+
+
+class ShortRowCollector:
+    """An arrow invalid row handler that sets aside rows with missing trailing fields
+
+    The .ctl files specify `trailing nullcols`, so a row may omit trailing fields
+    entirely. Arrow's CSV parser can't pad these, so we skip them during the
+    streaming read and parse them separately once padded out.
+    """
+
+    def __init__(self, num_columns: int):
+        self.num_columns = num_columns
+        self.rows = []
+
+    def __call__(self, row) -> str:
+        if row.actual_columns > row.expected_columns:
+            return "error"
+        self.rows.append(row.text)
+        return "skip"
+
+    def read_rows(self, table: dict[list]) -> pyarrow.Table | None:
+        """Parses & filters collected rows, after padding them to the full column count"""
+        if not self.rows:
+            return None
+        padded = []
+        for row in self.rows:
+            fields = row.split("|")
+            padded.append("|".join(fields + [""] * (self.num_columns - len(fields))))
+        return filter_arrow_table(
+            pyarrow.csv.read_csv(
+                io.BytesIO("\n".join(padded).encode()),
+                **get_arrow_csv_options(table),
+            ),
+            table,
+        )
+
+
+def get_arrow_csv_options(
+    table: dict[list],
+    invalid_row_handler: ShortRowCollector | None = None,
+    block_size: int | None = None,
+) -> dict:
+    """Creates the arrow CSV reader options for parsing a .rrf file
+
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param invalid_row_handler: a handler for rows with a mismatched column count
+    :param block_size: the number of bytes to read per streamed record batch
+    :returns: a dict of keyword arguments for pyarrow.csv.read_csv/open_csv. Only
+        the columns in get_read_columns are parsed, so the result still needs to go
+        through filter_arrow_table.
+    """
+    return {
+        "read_options": pyarrow.csv.ReadOptions(
+            column_names=[*get_source_headers(table), TRAILING_COLUMN],
+            block_size=block_size,
+        ),
+        # RRF files do not quote fields, so quotes in STR values are literal
+        "parse_options": pyarrow.csv.ParseOptions(
+            delimiter="|",
+            quote_char=False,
+            invalid_row_handler=invalid_row_handler,
+        ),
+        "convert_options": pyarrow.csv.ConvertOptions(
+            column_types=get_arrow_schema(table, get_read_columns(table)),
+            include_columns=get_read_columns(table),
+            null_values=[""],
+            strings_can_be_null=True,
+        ),
+    }
+
+
+def convert_rrf(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    table: dict[list],
+    force_upload=False,
+    engine: str = "pandas",
+    on_part: Callable[[pathlib.Path, str | None], None] | None = None,
+    release: str | None = None,
+    chunksize: int = 500_000,
+) -> list[tuple[pathlib.Path, str | None]]:
+    """Creates a set of parquet files from a .rrf metathesaurus file
+
+    Progress is recorded after each part is written, so that an interrupted
+    conversion picks up after the last completed part. Once every part is written,
+    a manifest is recorded, and later calls skip the table entirely.
+
+    :param rrf_path: the location of the .rrf file, or an archive_utils.ZipMember
+        to stream it out of a release archive
+    :param parquet_path: the location to write output parquet to
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param force_upload: if true, regenerate parquet regardless of what already
+        exists on disk
+    :param engine: the library to parse with, either 'pandas' or 'arrow'
+    :param on_part: if provided, called with the path and sha256 hash of each
+        parquet file as soon as it has been completely written
+    :param release: the UMLS release the file is from, recorded in the manifest
+    :param chunksize: the number of rows to write to each parquet file (pandas and
+        partitioned tables only). If the table has a target_file_bytes setting,
+        this is only the size of the first part. If the table has a memory budget,
+        parts are instead sized to fit in it.
+    :returns: (path, sha256 hash) tuples of the parquet files for this table
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown conversion engine '{engine}', expected one of {ENGINES}")
+    on_part = on_part or (lambda path, sha256: None)
+    profile = table.get("profile")
+    parts = None if force_upload else get_converted_parts(rrf_path, parquet_path, release, profile)
+    if parts is not None:
+        for part, sha256 in parts:
+            on_part(part, sha256)
+        return parts
+    layout = {"engine": engine, "profile": profile}
+    if engine == "arrow" or table.get("partition_column"):
+        # These are written in a single streaming pass, so there's nothing to resume
+        start_conversion(rrf_path, parquet_path, release, layout, resume=False)
+        if table.get("partition_column"):
+            chunks = convert_rrf_partitioned(
+                rrf_path, parquet_path, table, chunksize=chunksize, on_part=on_part
+            )
+        else:
+            chunks = convert_rrf_arrow(rrf_path, parquet_path, table, on_part=on_part)
+        return finish_conversion(rrf_path, parquet_path, release, chunks, profile)
+    chunks = start_conversion(rrf_path, parquet_path, release, layout, resume=not force_upload)
+    for filenum in sorted(chunks):
+        on_part(get_part_path(parquet_path, rrf_path.stem, filenum), chunks[filenum]["sha256"])
+    target_bytes = get_write_options(table).get("target_file_bytes")
+    rows_per_part = BUDGET_SAMPLE_ROWS if get_memory_budget(table) else chunksize
+    with rrf_path.open("rb") as source:
+        try:
+            reader = read_rrf_dataframe(
+                source,
+                table,
+                iterator=True,
+                # Lines already converted by an interrupted run are skipped. With row
+                # filters, a part may hold fewer rows than the lines it was read from.
+                skiprows=sum(chunk.get("lines", chunk["rows"]) for chunk in chunks.values()),
+            )
+        except pandas.errors.EmptyDataError:
+            reader = None
+        while True:
+            filenum = len(chunks)
+            part = get_part_path(parquet_path, rrf_path.stem, filenum)
+            try:
+                if reader is None:
+                    raise StopIteration
+                df = reader.get_chunk(rows_per_part)
+            except StopIteration:
+                if not chunks:
+                    # Always write at least one file, so the table has a schema
+                    empty = get_empty_dataframe(table)
+                    chunks[0] = {**write_dataframe(empty, part, table), "lines": 0}
+                    on_part(part, chunks[0]["sha256"])
+                break
+            chunks[filenum] = {
+                **write_dataframe(filter_dataframe(df, table), part, table),
+                "lines": len(df),
+            }
+            record_progress(rrf_path, parquet_path, release, layout, chunks)
+            on_part(part, chunks[filenum]["sha256"])
+            if target_bytes:
+                # Size the next part based on how large this one came out
+                rows_per_part = get_rows_per_part(target_bytes, part)
+            if budget_rows := get_budget_rows(table, df):
+                # ...and on how much memory this one's rows took up
+                rows_per_part = min(rows_per_part, budget_rows) if target_bytes else budget_rows
+    return finish_conversion(rrf_path, parquet_path, release, chunks, profile)
+
+
+class PartWriter:
+    """Streams rows into a table's parquet files, following its layout settings
+
+    For partitioned tables, one file is kept open per partition, so each value's
+    rows go to as few files as possible in a single pass over the source.
+
+    A file is closed and reported to on_part once it holds max_rows rows, or once
+    it reaches the table's target_file_bytes (checked after each row_group_rows
+    rows, if set, or else after each batch), and a new one is started. If the table
+    has a sort_by setting, each file's rows are buffered until it is full, so that
+    the whole file can be sorted (in which case target_file_bytes is measured
+    against the buffered rows' size in memory, which is larger than on disk). With
+    a memory budget, a sorted file is also closed once its buffer reaches the share
+    of the budget a batch of rows may use.
+    """
+
+    def __init__(
+        self,
+        parquet_path: pathlib.Path,
+        stem: str,
+        table: dict[list],
+        max_rows: int | None = None,
+        on_part: Callable[[pathlib.Path, str], None] | None = None,
+    ):
+        """
+        :param parquet_path: the location to write output parquet to
+        :param stem: the name of the table
+        :param table: a table definition created by UMLSBuilder.parse_ctl_file
+        :param max_rows: the maximum number of rows to write to a single file
+        :param on_part: if provided, called with the path and sha256 hash of each
+            parquet file once it is completely written
+        """
+        self.table_path = parquet_path / stem
+        self.stem = stem
+        self.table = table
+        self.column = table.get("partition_column")
+        self.schema = get_arrow_schema(
+            table, [header for header in table["headers"] if header != self.column]
+        )
+        self.options = get_write_options(table)
+        self.max_rows = max_rows
+        self.target_bytes = self.options.get("target_file_bytes")
+        self.buffer_bytes = (get_memory_budget(table) or 0) * CHUNK_BUDGET_FRACTION or None
+        self.on_part = on_part or (lambda path, sha256: None)
+        self.chunks = {}
+        self._open = {}
+        self._file_counts = collections.Counter()
+
+    def write(self, arrow_table: pyarrow.Table) -> None:
+        """Writes rows to the open file for their partition
+
+        :param arrow_table: rows with every output column, including any partition
+            column
+        """
+        if self.column is None:
+            self._write_file(None, arrow_table)
+            return
+        # Sorting groups each partition's rows into one contiguous slice
+        arrow_table = arrow_table.sort_by(self.column)
+        offset = 0
+        for item in pyarrow.compute.value_counts(arrow_table[self.column]):
+            count = item["counts"].as_py()
+            rows = arrow_table.slice(offset, count).drop_columns([self.column])
+            self._write_file(item["values"].as_py(), rows)
+            offset += count
+
+    def close(self, empty_file: bool = True) -> dict[int, dict]:
+        """Closes any open files
+
+        :param empty_file: if no rows were written, write a single empty file, so
+            that the table has a schema
+        :returns: a dict of part numbers to the `rows` and `sha256` hash of each
+            file written, and for partitioned tables, its relative `path`
+        """
+        for value in list(self._open):
+            self._close_file(value)
+        if not self.chunks and empty_file:
+            # Always write at least one file, so the table has a schema
+            self._open_file(None)
+            self._close_file(None)
+        return self.chunks
+
+    def _write_file(self, value: str | None, rows: pyarrow.Table) -> None:
+        while rows.num_rows:
+            if value not in self._open:
+                self._open_file(value)
+            state = self._open[value]
+            batch = rows
+            if self.max_rows:
+                batch = rows.slice(0, self.max_rows - state["rows"])
+            if self.target_bytes and self.options.get("row_group_rows"):
+                # Check the file's size after every row group, not just every batch
+                batch = batch.slice(0, self.options["row_group_rows"])
+            rows = rows.slice(batch.num_rows)
+            state["rows"] += batch.num_rows
+            if self.options.get("sort_by"):
+                state["buffer"].append(batch)
+                size = sum(buffered.nbytes for buffered in state["buffer"])
+            else:
+                self._write_row_groups(state, batch)
+                size = state["file"].tell()
+            if (
+                (self.max_rows and state["rows"] >= self.max_rows)
+                or (self.target_bytes and size >= self.target_bytes)
+                or (state["buffer"] and self.buffer_bytes and size >= self.buffer_bytes)
+            ):
+                self._close_file(value)
+
+    def _write_row_groups(self, state: dict, rows: pyarrow.Table) -> None:
+        state["writer"].write_table(rows, row_group_size=self.options.get("row_group_rows"))
+
+    def _open_file(self, value: str | None) -> None:
+        filename = f"{self.stem}_{self._file_counts[value]}.parquet"
+        self._file_counts[value] += 1
+        if self.column is None:
+            path = pathlib.Path(filename)
+        else:
+            path = pathlib.Path(get_partition_dir(self.column, value)) / filename
+        (self.table_path / path.parent).mkdir(parents=True, exist_ok=True)
+        file = HashingFile(self.table_path / path)
+        self._open[value] = {
+            "path": path,
+            "file": file,
+            "writer": pyarrow.parquet.ParquetWriter(
+                file, self.schema, **get_parquet_kwargs(self.table)
+            ),
+            "rows": 0,
+            "buffer": [],
+        }
+
+    def _close_file(self, value: str | None) -> None:
+        state = self._open.pop(value)
+        if state["buffer"]:
+            rows = pyarrow.concat_tables(state["buffer"])
+            self._write_row_groups(state, sort_arrow_table(rows, self.table))
+        state["writer"].close()
+        state["file"].close()
+        sha256 = state["file"].hexdigest()
+        chunk = {"rows": state["rows"], "sha256": sha256}
+        if self.column is not None:
+            chunk["path"] = state["path"].as_posix()
+        self.chunks[len(self.chunks)] = chunk
+        self.on_part(self.table_path / state["path"], sha256)
+
+
+def stream_rrf(
+    rrf_path: pathlib.Path,
+    table: dict[list],
+    writer: PartWriter,
+    block_size: int | None = None,
+) -> dict[int, dict]:
+    """Streams a .rrf file through arrow's CSV reader into a PartWriter
+
+    Each record batch is filtered as it is read, so filtered rows are never
+    written, and memory use is bounded by the block size rather than the size of
+    the file.
+
+    :param rrf_path: the location of the .rrf file
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param writer: the writer to send rows to
+    :param block_size: the number of bytes of the .rrf to read per batch, by
+        default sized to the table's memory budget, if it has one
+    :returns: the parts written, as returned by PartWriter.close
+    """
+    block_size = block_size or get_block_size(table)
+    short_rows = ShortRowCollector(len(get_source_headers(table)) + 1)
+    if rrf_path.stat().st_size > 0:
+        with rrf_path.open("rb") as source:
+            reader = pyarrow.csv.open_csv(
+                source, **get_arrow_csv_options(table, short_rows, block_size)
+            )
+            for batch in reader:
+                writer.write(filter_arrow_table(pyarrow.Table.from_batches([batch]), table))
+    if (padded := short_rows.read_rows(table)) is not None:
+        writer.write(padded)
+    return writer.close()
+
+
+def convert_rrf_arrow(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    table: dict[list],
+    on_part: Callable[[pathlib.Path, str], None] | None = None,
+    block_size: int | None = None,
+) -> dict[int, dict]:
+    """Streams a .rrf file into parquet, without going through pandas
+
+    Unless the table has a target_file_bytes setting, this writes a single file.
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location to write output parquet to
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param on_part: if provided, called with the path and sha256 hash of each
+        parquet file once it is completely written
+    :param block_size: the number of bytes of the .rrf to read per batch
+    :returns: a dict of part numbers to the `rows` and `sha256` hash of each file
+    """
+    writer = PartWriter(parquet_path, rrf_path.stem, table, on_part=on_part)
+    return stream_rrf(rrf_path, table, writer, block_size)
+
+
+def convert_rrf_partitioned(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    table: dict[list],
+    chunksize: int = 500_000,
+    on_part: Callable[[pathlib.Path, str], None] | None = None,
+    block_size: int | None = None,
+) -> dict[int, dict]:
+    """Streams a .rrf file into Hive style partitions of its partition column
+
+    This always parses with arrow, reading the file once and routing each batch's
+    rows to the open file for their partition.
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location to write output parquet to
+    :param table: a partitioned table definition, from partition_table
+    :param chunksize: the maximum number of rows to write to each parquet file
+    :param on_part: if provided, called with the path and sha256 hash of each
+        parquet file once it is completely written
+    :param block_size: the number of bytes of the .rrf to read per batch
+    :returns: a dict of part numbers to the `rows`, `sha256` hash, and relative
+        `path` of each file written
+    """
+    writer = PartWriter(parquet_path, rrf_path.stem, table, chunksize, on_part)
+    return stream_rrf(rrf_path, table, writer, block_size)
+
+
+def split_rrf(rrf_path: pathlib.Path, num_ranges: int) -> list[tuple[int, int]]:
+    """Splits a .rrf file into byte ranges that each end on a line boundary
+
+    :param rrf_path: the location of the .rrf file
+    :param num_ranges: the number of ranges to try to produce. Fewer may be returned
+        for small files, since a range is never empty or split mid-line.
+    :returns: a list of (start, end) byte offsets, suitable for slicing
+    """
+    size = rrf_path.stat().st_size
+    if size == 0:
+        return [(0, 0)]
+    boundaries = [0]
+    with open(rrf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, num_ranges):
+            target = max(size * i // num_ranges, boundaries[-1] + 1)
+            if target >= size:
+                break
+            # Searching from the byte before the target means a target that already
+            # sits at the start of a line is used as is
+            newline = mm.find(b"\n", target - 1)
+            if newline == -1 or newline + 1 >= size:
+                break
+            if newline + 1 > boundaries[-1]:
+                boundaries.append(newline + 1)
+    boundaries.append(size)
+    return list(itertools.pairwise(boundaries))
+
+
+def convert_rrf_range(
+    rrf_path: pathlib.Path,
+    parquet_path: pathlib.Path,
+    table: dict[list],
+    start: int,
+    end: int,
+    part: int,
+    engine: str = "pandas",
+) -> dict:
+    """Converts a byte range of a .rrf file to a single numbered parquet file
+
+    :param rrf_path: the location of the .rrf file
+    :param parquet_path: the location to write output parquet to
+    :param table: a table definition created by UMLSBuilder.parse_ctl_file
+    :param start: the byte offset of the first line of the range
+    :param end: the byte offset just past the last line of the range
+    :param part: the number of this range, used in the output filename
+    :param engine: the library to parse with, either 'pandas' or 'arrow'
+    :returns: a dict of the `rows` written and the `sha256` hash of the file
+    """
+    part_path = get_part_path(parquet_path, rrf_path.stem, part)
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+    if engine == "arrow":
+        schema = get_arrow_schema(table)
+        arrow_table = schema.empty_table()
+        if start != end:
+            short_rows = ShortRowCollector(len(get_source_headers(table)) + 1)
+            with (
+                open(rrf_path, "rb") as f,
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+            ):
+                arrow_table = filter_arrow_table(
+                    pyarrow.csv.read_csv(
+                        pyarrow.BufferReader(mm[start:end]),
+                        **get_arrow_csv_options(table, short_rows),
+                    ),
+                    table,
+                )
+            if (padded := short_rows.read_rows(table)) is not None:
+                arrow_table = pyarrow.concat_tables([arrow_table, padded])
+        return write_arrow_table(arrow_table, part_path, table)
+    if start == end:
+        df = get_empty_dataframe(table)
+    else:
+        with (
+            open(rrf_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            df = filter_dataframe(read_rrf_dataframe(io.BytesIO(mm[start:end]), table), table)
+    return write_dataframe(df, part_path, table)
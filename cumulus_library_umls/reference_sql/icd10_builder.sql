@@ -0,0 +1,141 @@
+-- noqa: disable=all
+-- This sql was autogenerated as a reference example using the library
+-- CLI. Its format is tied to the specific database it was run against,
+-- and it may not be correct for all databases. Use the CLI's build 
+-- option to derive the best SQL for your dataset.
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_chapter` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_chapter'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_block` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_block'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_category` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_category'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_subcategory_1` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_subcategory_1'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_subcategory_2` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_subcategory_2'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_subcategory_3` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_subcategory_3'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_extension` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_extension'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_tree` (
+    rui String,
+    cui1 String,
+    cui2 String,
+    tty String,
+    code String,
+    str String,
+    depth Integer
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_tree'
+tblproperties ("parquet.compression"="SNAPPY");
+
+-- ###########################################################
+
+CREATE EXTERNAL TABLE IF NOT EXISTS `umls`.`umls__icd10_hierarchy` (
+    chapter_code String,
+    chapter_str String,
+    block_code String,
+    block_str String,
+    category_code String,
+    category_str String,
+    subcategory_1_code String,
+    subcategory_1_str String,
+    subcategory_2_code String,
+    subcategory_2_str String,
+    subcategory_3_code String,
+    subcategory_3_str String,
+    extension_code String,
+    extension_str String,
+    leaf_code String
+)
+STORED AS PARQUET
+LOCATION 's3://bucket/db_path/umls/icd10_hierarchy'
+tblproperties ("parquet.compression"="SNAPPY");
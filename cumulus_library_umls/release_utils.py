@@ -0,0 +1,138 @@
+"""Finds & reads the converted tables of a UMLS release, for building derived tables
+
+Derived tables (i.e. the ICD-10 hierarchy) are computed from the parquet that
+UMLSBuilder already wrote for the build, rather than by querying the database.
+Those tables may be laid out as plain files, partitioned by vocabulary, or as
+delta tables, depending on the study options, and are read here the same way.
+"""
+
+import pathlib
+
+import pandas
+import pyarrow
+import pyarrow.dataset
+from cumulus_library import base_utils
+
+from cumulus_library_umls import cache_utils, delta_utils, ingestion_utils
+
+# The column tables listed in the partitioned_tables option are partitioned on
+PARTITION_COLUMN = "SAB"
+
+
+def get_release_path(parquet_path: pathlib.Path, stems: list[str]) -> pathlib.Path:
+    """Finds the parquet of the release last built with a set of tables converted
+
+    The cache can hold several releases, so this is the release recorded as last
+    built, if it has the tables, falling back to the most recent release which does.
+
+    :param parquet_path: the directory each release's parquet is written under
+    :param stems: the names of the tables needed, i.e. MRCONSO
+    """
+    releases = sorted(
+        path for path in parquet_path.glob("*") if all((path / stem).is_dir() for stem in stems)
+    )
+    if not releases:
+        raise ValueError(
+            f"This table is built from the converted {' and '.join(stems)} tables, which "
+            "were not found. Make sure they are not excluded from the build."
+        )
+    current = parquet_path / (cache_utils.get_current_release(parquet_path.parent) or "")
+    return current if current in releases else releases[-1]
+
+
+def get_table_layout(config: base_utils.StudyConfig, stem: str) -> dict:
+    """Reads how a table was converted from the study options
+
+    :param config: the study config containing CLI options
+    :param stem: the name of the table, i.e. MRCONSO
+    :returns: the `partition_column` and `delta_key` keyword arguments for read_rows
+    """
+    options = config.options or {}
+    partitioned = ingestion_utils.parse_list_option(options.get("partitioned_tables"))
+    delta = ingestion_utils.parse_list_option(options.get("delta_tables"))
+    return {
+        "partition_column": PARTITION_COLUMN if stem in partitioned else None,
+        "delta_key": delta_utils.DELTA_KEYS.get(stem) if stem in delta else None,
+    }
+
+
+def detect_table_layout(release_path: pathlib.Path, stem: str) -> dict:
+    """Works out how a table was converted from its files, without the study options
+
+    :param release_path: the location the release's parquet was written to
+    :param stem: the name of the table, i.e. MRCONSO
+    :returns: the `partition_column` and `delta_key` keyword arguments for read_rows
+    """
+    # Stale tombstones can outlive a delta table, but its directories can't, as
+    # they're removed whenever the table is converted again
+    names = {path.name.split("=", 1)[0] for path in (release_path / stem).glob("*=*")}
+    return {
+        "partition_column": PARTITION_COLUMN if PARTITION_COLUMN.lower() in names else None,
+        "delta_key": delta_utils.DELTA_KEYS.get(stem)
+        if delta_utils.GENERATION_COLUMN in names
+        else None,
+    }
+
+
+def read_table(
+    release_path: pathlib.Path,
+    stem: str,
+    columns: list[str],
+    sabs: set[str] | None = None,
+    partition_column: str | None = None,
+    delta_key: str | None = None,
+) -> pyarrow.Table:
+    """Reads the rows of a converted table, as an arrow table
+
+    :param release_path: the location the release's parquet was written to
+    :param stem: the name of the table, i.e. MRCONSO
+    :param columns: the columns to read, which must include SAB if sabs is given
+    :param sabs: the vocabularies to read rows of, or None for every row
+    :param partition_column: the column the table was partitioned on, if any
+    :param delta_key: the row identifier of the table, if it is a delta table
+    :returns: the rows, with only the requested columns
+    """
+    if partition_column:
+        # Partition values are only in the directory names, so only the
+        # directories of the requested vocabularies are read
+        field = partition_column.lower()
+        partitioning = pyarrow.dataset.partitioning(
+            pyarrow.schema([(field, pyarrow.string())]), flavor="hive"
+        )
+        dataset = pyarrow.dataset.dataset(
+            release_path / stem, format="parquet", partitioning=partitioning
+        )
+        return dataset.to_table(
+            columns=[field if column == partition_column else column for column in columns],
+            filter=None if sabs is None else pyarrow.dataset.field(field).isin(sorted(sabs)),
+        ).rename_columns(columns)
+    expression = (
+        None if sabs is None else pyarrow.dataset.field(PARTITION_COLUMN).isin(sorted(sabs))
+    )
+    if delta_key:
+        return delta_utils.read_live_rows(release_path, stem, delta_key, columns, expression)
+    dataset = pyarrow.dataset.dataset(release_path / stem, format="parquet")
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def read_rows(
+    release_path: pathlib.Path,
+    stem: str,
+    columns: list[str],
+    sabs: set[str],
+    partition_column: str | None = None,
+    delta_key: str | None = None,
+) -> pandas.DataFrame:
+    """Reads the rows of a converted table from a set of vocabularies
+
+    :param release_path: the location the release's parquet was written to
+    :param stem: the name of the table, i.e. MRCONSO
+    :param columns: the columns to read, which must include SAB
+    :param sabs: the vocabularies to read rows of
+    :param partition_column: the column the table was partitioned on, if any
+    :param delta_key: the row identifier of the table, if it is a delta table
+    :returns: the rows, with only the requested columns
+    """
+    rows = read_table(release_path, stem, columns, sabs, partition_column, delta_key)
+    # Parts written by either engine are read with the same dtypes
+    return rows.to_pandas(ignore_metadata=True)
@@ -0,0 +1,380 @@
+"""Slices of the main tables, written alongside them as they are converted
+
+A slice is a subset of a table's rows (i.e. only the drug vocabularies of MRCONSO),
+defined as a filter and a set of columns. Rather than creating each slice in the
+database with a query scanning the whole table, every part of the source table is
+split into its slices as soon as it is written, while it's still in the OS file
+cache. Each slice is uploaded and created as a table of its own.
+
+Slice parts are recorded against the hash of the source part they came from, so a
+source part which hasn't changed since the last build isn't read again. Delta
+tables are the exception: their slices need tombstoned rows removed, so they're
+read whole once the table is converted.
+"""
+
+import dataclasses
+import pathlib
+from collections.abc import Callable
+
+import pyarrow
+import pyarrow.compute
+import pyarrow.parquet
+
+from cumulus_library_umls import delta_utils, json_utils, parquet_utils
+
+# The vocabularies of the mrconso_drugs slice
+DRUG_SABS = (
+    "ATC",
+    "CVX",
+    "DRUGBANK",
+    "GS",
+    "MED-RT",
+    "MMSL",
+    "MMX",
+    "MTHCMSFRF",
+    "MTHSPL",
+    "NDDF",
+    "RXNORM",
+    "SNOMEDCT_US",
+    "USP",
+    "VANDF",
+)
+
+# The relationships the mrrel_drug_is_a slice counts as concept 2 being a member of
+# concept 1. Rows with a REL of RB or PAR point from the child up to the parent.
+DRUG_IS_A_RELS = ("CHD",)
+DRUG_IS_A_RELAS = ("isa", "tradename_of", "has_tradename", "has_basis_of_strength_substance")
+DRUG_IS_A_EXCLUDED_RELS = ("RB", "PAR")
+
+# MRCONSO's columns, minus SRL, SUPPRESS & CVF
+CONCEPT_COLUMNS = [
+    "CUI",
+    "LAT",
+    "TS",
+    "LUI",
+    "STT",
+    "SUI",
+    "ISPREF",
+    "AUI",
+    "SAUI",
+    "SCUI",
+    "SDUI",
+    "SAB",
+    "TTY",
+    "CODE",
+    "STR",
+]
+
+# The record of the slice parts written from each source part, in a slice's directory
+MANIFEST_FILE = "_slice_manifest.json"
+
+
+def not_in(column: str, values: tuple[str]) -> pyarrow.compute.Expression:
+    """Matches rows whose column has a value, which isn't one of values
+
+    Unlike inverting is_in, this doesn't match nulls, following SQL's `NOT IN`.
+    """
+    field = pyarrow.compute.field(column)
+    return field.is_valid() & ~field.isin(values)
+
+
+@dataclasses.dataclass(kw_only=True, frozen=True)
+class Slice:
+    """A subset of a table's rows & columns, created as a table of its own
+
+    :param name: the name of the slice's table
+    :param source: the name of the table it's a slice of, i.e. MRCONSO
+    :param expression: the filter rows must match, following SQL's handling of
+        nulls (a null result excludes the row)
+    :param filter_columns: the columns the filter reads
+    :param columns: the columns of the slice, in order, or None for every column of
+        the source. Columns excluded from the source are left out.
+    """
+
+    name: str
+    source: str
+    expression: pyarrow.compute.Expression
+    filter_columns: tuple[str]
+    columns: tuple[str] | None = None
+
+    def get_columns(self, headers: list[str]) -> list[str]:
+        """Returns the columns of the slice, given the source table's columns"""
+        if self.columns is None:
+            return list(headers)
+        return [column for column in self.columns if column in headers]
+
+
+SLICES = (
+    Slice(
+        name="mrrel_drug_is_a",
+        source="MRREL",
+        expression=(
+            pyarrow.compute.field("REL").isin(DRUG_IS_A_RELS)
+            | pyarrow.compute.field("RELA").isin(DRUG_IS_A_RELAS)
+        )
+        & not_in("REL", DRUG_IS_A_EXCLUDED_RELS),
+        filter_columns=("REL", "RELA"),
+    ),
+    Slice(
+        name="mrconso_drugs",
+        source="MRCONSO",
+        expression=pyarrow.compute.field("SAB").isin(DRUG_SABS),
+        filter_columns=("SAB",),
+        columns=tuple(CONCEPT_COLUMNS),
+    ),
+    Slice(
+        name="mrconso_icd10cm",
+        source="MRCONSO",
+        expression=pyarrow.compute.field("SAB") == "ICD10CM",
+        filter_columns=("SAB",),
+        columns=tuple(CONCEPT_COLUMNS),
+    ),
+    Slice(
+        name="mrrel_icd10cm",
+        source="MRREL",
+        expression=pyarrow.compute.field("SAB") == "ICD10CM",
+        filter_columns=("SAB",),
+    ),
+)
+
+
+def get_slices(tables: dict[str, dict], slices: tuple[Slice] = SLICES) -> list[Slice]:
+    """Finds the slices which can be written from the tables being converted
+
+    :param tables: a dict of table names to table definitions
+    :param slices: the slices to choose from
+    :returns: the slices whose source is being converted, without any of the
+        columns their filter reads excluded
+    """
+    return [
+        table_slice
+        for table_slice in slices
+        if table_slice.source in tables
+        and set(table_slice.filter_columns) <= set(tables[table_slice.source]["headers"])
+    ]
+
+
+def get_profile_warnings(tables: dict[str, dict], slices: tuple[Slice] = SLICES) -> list[str]:
+    """Describes how an ingestion profile changes the slices, from the full tables
+
+    Slices are written from each part after the profile has been applied, so they
+    only hold the rows & columns it keeps.
+
+    :param tables: a dict of table names to table definitions, with the profile
+        applied
+    :param slices: the slices to check
+    :returns: a message for each slice the profile skips, or changes
+    """
+    warnings = []
+    for table_slice in slices:
+        if table_slice.source not in tables:
+            continue
+        table = tables[table_slice.source]
+        headers = table["headers"]
+        if excluded := [column for column in table_slice.filter_columns if column not in headers]:
+            warnings.append(
+                f"{table_slice.name} is not built, since the ingestion profile excludes "
+                f"{', '.join(excluded)} from {table_slice.source}"
+            )
+            continue
+        source_headers = table.get("source_headers", headers)
+        if missing := [
+            column for column in table_slice.get_columns(source_headers) if column not in headers
+        ]:
+            warnings.append(
+                f"{table_slice.name} is missing {', '.join(missing)}, which the ingestion "
+                f"profile excludes from {table_slice.source}"
+            )
+        if filters := table.get("filters"):
+            warnings.append(
+                f"{table_slice.name} only has the rows of {table_slice.source} kept by the "
+                f"ingestion profile's filters on {', '.join(filters)}"
+            )
+    return warnings
+
+
+def get_slice_part_path(
+    parquet_path: pathlib.Path, table_slice: Slice, source_part: str
+) -> pathlib.Path:
+    """Returns the location of the slice of a source part
+
+    :param parquet_path: the location output parquet is written to
+    :param table_slice: the slice
+    :param source_part: the source part's path, relative to its table, i.e.
+        `MRCONSO_3.parquet` or `sab=RXNORM/MRCONSO_3.parquet`
+    :returns: i.e. `mrconso_drugs/mrconso_drugs_3.parquet`, or
+        `mrconso_drugs/mrconso_drugs_RXNORM_3.parquet`
+    """
+    path = pathlib.PurePosixPath(source_part)
+    suffix = [part.split("=", 1)[1] for part in path.parent.parts]
+    suffix.append(path.stem.rsplit("_", 1)[1])
+    return parquet_path / table_slice.name / f"{table_slice.name}_{'_'.join(suffix)}.parquet"
+
+
+def read_part(path: pathlib.Path, source_part: str, table: dict[list]) -> pyarrow.Table:
+    """Reads a part of a converted table, restoring any partition column
+
+    :param path: the location of the part
+    :param source_part: the part's path, relative to its table
+    :param table: the table's definition
+    """
+    rows = pyarrow.parquet.read_table(path)
+    if column := table.get("partition_column"):
+        value = pathlib.PurePosixPath(source_part).parent.name.split("=", 1)[1]
+        value = None if value == parquet_utils.HIVE_NULL_PARTITION else value
+        rows = rows.append_column(column, pyarrow.array([value] * rows.num_rows, pyarrow.string()))
+    return rows
+
+
+class SliceWriter:
+    """Writes the slices of each part of a table, as the table is converted
+
+    Usage:
+        writer = SliceWriter(parquet_path, tables, on_part=pipeline.put)
+        ...for each part of a table, once written:
+            writer.put(table, path, sha256)
+        ...once every part of it is written:
+            for name in writer.finish_table(table):
+                pipeline.finish_table(name)
+    """
+
+    def __init__(
+        self,
+        parquet_path: pathlib.Path,
+        tables: dict[str, dict],
+        on_part: Callable[[str, pathlib.Path, str], None] | None = None,
+        slices: tuple[Slice] = SLICES,
+    ):
+        """
+        :param parquet_path: the location output parquet is written to
+        :param tables: a dict of the names of the tables being converted to their
+            definitions
+        :param on_part: if provided, called with a slice's name, and the path and
+            sha256 hash of each of its parts, once written
+        :param slices: the slices to write, of those whose source is being converted
+        """
+        self.parquet_path = parquet_path
+        self.tables = tables
+        self.on_part = on_part or (lambda name, path, sha256: None)
+        self.slices = get_slices(tables, slices)
+        self.sources = {table_slice.source for table_slice in self.slices}
+        self.rows = {}
+        # The parts written by previous builds, and by this one, by source part
+        self._previous = {
+            table_slice.name: (
+                json_utils.read_json(parquet_path / table_slice.name / MANIFEST_FILE) or {}
+            ).get("parts", {})
+            for table_slice in self.slices
+        }
+        self._parts = {table_slice.name: {} for table_slice in self.slices}
+
+    def get_columns(self, table_slice: Slice) -> list[str]:
+        """Returns the columns of a slice, given what is converted of its source"""
+        return table_slice.get_columns(self.tables[table_slice.source]["headers"])
+
+    def get_schema(self, table_slice: Slice) -> pyarrow.Schema:
+        """Returns the schema of a slice's parquet"""
+        table = self.tables[table_slice.source]
+        return parquet_utils.get_arrow_schema(table, self.get_columns(table_slice))
+
+    def get_parquet_types(self, table_slice: Slice) -> list[str]:
+        """Returns the column types of a slice, for its CREATE TABLE query"""
+        table = self.tables[table_slice.source]
+        types = dict(zip(table["headers"], table["parquet_types"], strict=True))
+        return [types[column] for column in self.get_columns(table_slice)]
+
+    def put(self, name: str, path: pathlib.Path, sha256: str | None) -> None:
+        """Writes the slices of a part of a table
+
+        :param name: the name of the table
+        :param path: the location of the part
+        :param sha256: the hash of the part, if known
+        """
+        table = self.tables.get(name)
+        if table is None or table.get("delta_key"):
+            return
+        source_part = path.relative_to(self.parquet_path / name).as_posix()
+        rows = None
+        for table_slice in self.slices:
+            if table_slice.source != name:
+                continue
+            part = self._previous[table_slice.name].get(source_part)
+            if (
+                sha256 is None
+                or part is None
+                or part["source_sha256"] != sha256
+                or (part["sha256"] and not (self.parquet_path / part["path"]).exists())
+            ):
+                if rows is None:
+                    rows = read_part(path, source_part, table)
+                part = self._write(
+                    table_slice,
+                    rows,
+                    get_slice_part_path(self.parquet_path, table_slice, source_part),
+                )
+                part["source_sha256"] = sha256
+            self._parts[table_slice.name][source_part] = part
+            if part["sha256"]:
+                self.on_part(table_slice.name, self.parquet_path / part["path"], part["sha256"])
+
+    def finish_table(self, name: str) -> list[str]:
+        """Finishes the slices of a table, once every part of it has been written
+
+        :param name: the name of the table
+        :returns: the names of the slices finished
+        """
+        finished = []
+        for table_slice in self.slices:
+            if table_slice.source != name:
+                continue
+            parts = self._parts[table_slice.name]
+            table = self.tables[name]
+            if table.get("delta_key"):
+                rows = delta_utils.read_live_rows(
+                    self.parquet_path,
+                    name,
+                    table["delta_key"],
+                    list(
+                        dict.fromkeys([*self.get_columns(table_slice), *table_slice.filter_columns])
+                    ),
+                )
+                path = self.parquet_path / table_slice.name / f"{table_slice.name}_0.parquet"
+                parts[""] = self._write(table_slice, rows, path)
+            if not any(part["sha256"] for part in parts.values()):
+                # Always write at least one file, so the table has a schema
+                path = self.parquet_path / table_slice.name / f"{table_slice.name}_0.parquet"
+                parts[""] = self._write(
+                    table_slice, self.get_schema(table_slice).empty_table(), path
+                )
+            current = {part["path"] for part in parts.values() if part["sha256"]}
+            for stale in (self.parquet_path / table_slice.name).glob("*.parquet"):
+                if stale.relative_to(self.parquet_path).as_posix() not in current:
+                    stale.unlink()
+            if "" in parts:
+                self.on_part(
+                    table_slice.name, self.parquet_path / parts[""]["path"], parts[""]["sha256"]
+                )
+            json_utils.write_json_atomic(
+                self.parquet_path / table_slice.name / MANIFEST_FILE, {"parts": parts}
+            )
+            self.rows[table_slice.name] = sum(part["rows"] for part in parts.values())
+            finished.append(table_slice.name)
+        return finished
+
+    def _write(self, table_slice: Slice, rows: pyarrow.Table, path: pathlib.Path) -> dict:
+        """Filters & writes rows of a slice, unless none match
+
+        :returns: the `rows`, relative `path` and `sha256` hash of the part, which
+            has no path or hash if no rows matched
+        """
+        schema = self.get_schema(table_slice)
+        rows = rows.filter(table_slice.expression).select(schema.names).cast(schema)
+        if not rows.num_rows and path.stem != f"{table_slice.name}_0":
+            return {"rows": 0, "path": None, "sha256": None}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        chunk = parquet_utils.write_arrow_table(rows, path)
+        return {
+            "rows": chunk["rows"],
+            "path": path.relative_to(self.parquet_path).as_posix(),
+            "sha256": chunk["sha256"],
+        }
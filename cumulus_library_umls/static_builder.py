@@ -1,12 +1,28 @@
-"""Builder for UMLS files that generally do not change over time"""
+"""Builder for UMLS files that generally do not change over time
+
+The files ship with this package, so their parquet is converted once and cached in
+the cumulus-library cache directory, keyed by a hash of the file and how it's read.
+Later builds only hash the files, and reuse the cached parquet, whose hashes the
+upload ledger already has, so nothing is converted or uploaded, and pandas isn't
+imported.
+"""
 
 import dataclasses
+import hashlib
+import json
 import pathlib
 
-import pandas
-from cumulus_library import BaseTableBuilder, base_utils, study_manifest
+import platformdirs
+from cumulus_library import BaseTableBuilder, base_utils, log_utils, study_manifest
 from cumulus_library.template_sql import base_templates
 
+from cumulus_library_umls import json_utils, metrics_utils, upload_utils
+
+# The directory cached parquet is written to, in the cumulus-library cache directory
+CACHE_DIR = "static_parquet"
+# Written alongside each cached parquet file, with the hash of the file it's from
+MANIFEST_FILE = "_manifest.json"
+
 
 @dataclasses.dataclass(kw_only=True)
 class StaticTableConfig:
@@ -18,10 +34,76 @@ class StaticTableConfig:
     headers: list[str]
     dtypes: dict
     parquet_types: list[str]
-    local_location: str
     ignore_header: bool = False
 
 
+def get_source_hash(table: StaticTableConfig) -> str:
+    """Hashes a static file, and the settings it's read with
+
+    :param table: the config of the table the file is read into
+    :returns: a hex sha256 hash, which changes if the parquet would
+    """
+    digest = hashlib.sha256(pathlib.Path(table.file_path).read_bytes())
+    settings = {
+        "delimiter": table.delimiter,
+        "headers": table.headers,
+        "dtypes": table.dtypes,
+        "ignore_header": table.ignore_header,
+    }
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def get_parquet_path(cache_path: pathlib.Path, table: StaticTableConfig) -> pathlib.Path:
+    """Returns the location of a static file's cached parquet"""
+    stem = pathlib.Path(table.file_path).stem
+    return cache_path / CACHE_DIR / stem / f"{stem}.parquet"
+
+
+def read_cached_hash(parquet_path: pathlib.Path, source_hash: str) -> str | None:
+    """Returns the hash of a static file's cached parquet, if it's still current
+
+    :param parquet_path: the location of the cached parquet
+    :param source_hash: the hash of the static file, from get_source_hash
+    :returns: the sha256 hash of the parquet, or None if it must be converted again
+    """
+    manifest = json_utils.read_json(parquet_path.parent / MANIFEST_FILE)
+    if manifest is None or manifest.get("source_sha256") != source_hash:
+        return None
+    if not parquet_path.exists():
+        return None
+    return manifest["sha256"]
+
+
+def convert_file(path: pathlib.Path, table: StaticTableConfig, parquet_path: pathlib.Path) -> dict:
+    """Converts a static file to parquet
+
+    pandas (and pyarrow) are only imported here, so a build with every file cached
+    doesn't pay for importing them.
+
+    :param path: the location of the static file
+    :param table: the config of the table the file is read into
+    :param parquet_path: the location to write the parquet to
+    :returns: the number of rows & sha256 hash of the parquet
+    """
+    import pandas
+
+    from cumulus_library_umls import parquet_utils
+
+    parquet_path.parent.mkdir(parents=True, exist_ok=True)
+    # Read the file, using lots of the TableConfig params, and generate a parquet file
+    df = pandas.read_csv(
+        path,
+        delimiter=table.delimiter,
+        names=table.headers,
+        header=0 if table.ignore_header else None,
+        dtype=table.dtypes,
+        index_col=False,
+        na_values=["\\N"],
+    )
+    return parquet_utils.write_dataframe(df, parquet_path)
+
+
 class StaticBuilder(BaseTableBuilder):
     base_path = pathlib.Path(__file__).resolve().parent
     display_text = "Building static UMLS tables..."
@@ -31,10 +113,6 @@ class StaticBuilder(BaseTableBuilder):
             # https://lhncbc.nlm.nih.gov/ii/tools/MetaMap/documentation/SemanticTypesAndGroups.html
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/SemanticTypes_2018AB.txt",
-                local_location=str(
-                    self.base_path
-                    / "./static_files/SemanticTypes_2018AB/SemanticTypes_2018AB.parquet",
-                ),
                 delimiter="|",
                 table_name="semantic_types",
                 headers=["abbrev", "TUI", "full_type_name"],
@@ -47,9 +125,6 @@ class StaticBuilder(BaseTableBuilder):
             ),
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/SemGroups_2018.txt",
-                local_location=str(
-                    self.base_path / "./static_files/SemGroups_2018/SemGroups_2018.parquet",
-                ),
                 delimiter="|",
                 table_name="semantic_groups",
                 headers=["abbrev", "group_name", "TUI", "full_type_name"],
@@ -64,9 +139,6 @@ class StaticBuilder(BaseTableBuilder):
             # https://www.nlm.nih.gov/research/umls/knowledge_sources/metathesaurus/release/abbreviations.html
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/umls_rel.tsv",
-                local_location=str(
-                    self.base_path / "./static_files/umls_rel/umls_rel.parquet",
-                ),
                 delimiter="\t",
                 table_name="rel_description",
                 headers=["REL", "REL_STR"],
@@ -79,9 +151,6 @@ class StaticBuilder(BaseTableBuilder):
             ),
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/umls_rela.tsv",
-                local_location=str(
-                    self.base_path / "./static_files/umls_rela/umls_rela.parquet",
-                ),
                 delimiter="\t",
                 table_name="rela_description",
                 headers=["RELA", "RELA_STR"],
@@ -94,9 +163,6 @@ class StaticBuilder(BaseTableBuilder):
             ),
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/umls_tty.tsv",
-                local_location=str(
-                    self.base_path / "./static_files/umls_tty/umls_tty.parquet",
-                ),
                 delimiter="\t",
                 table_name="tty_description",
                 headers=["TTY", "TTY_STR"],
@@ -109,9 +175,6 @@ class StaticBuilder(BaseTableBuilder):
             ),
             StaticTableConfig(
                 file_path=self.base_path / "./static_files/umls_tui.tsv",
-                local_location=str(
-                    self.base_path / "./static_files/umls_tui/umls_tui.parquet",
-                ),
                 delimiter="\t",
                 table_name="tui_description",
                 headers=["STY", "TUI", "TUI_STR"],
@@ -134,46 +197,76 @@ class StaticBuilder(BaseTableBuilder):
     ):
         # fetch and add vsac tables
         self.tables = self.get_table_configs()
+        prefix = manifest.get_study_prefix()
+        parquet_paths = {}
+        hashes = {}
+        metrics = metrics_utils.BuildMetrics("static")
+        cache_path = pathlib.Path(platformdirs.user_cache_dir("cumulus-library", "smart-on-fhir"))
         with base_utils.get_progress_bar() as progress:
             task = progress.add_task("Uploading UMLS dictionary files...", total=len(self.tables))
 
             for table in self.tables:
                 # Determine what we're using as a source file
                 path = self.base_path / table.file_path
-                parquet_path = (
-                    table.file_path.parent
-                    / table.file_path.stem
-                    / f"{table.file_path.stem}.parquet"
-                )
-                parquet_path.parent.mkdir(parents=True, exist_ok=True)
-                # Read the file, using lots of the TableConfig params, and generate
-                # a parquet file
-                df = pandas.read_csv(
-                    path,
-                    delimiter=table.delimiter,
-                    names=table.headers,
-                    header=0 if table.ignore_header else None,
-                    dtype=table.dtypes,
-                    index_col=False,
-                    na_values=["\\N"],
+                parquet_path = get_parquet_path(cache_path, table)
+                with metrics.measure("convert", parquet_path.stem):
+                    source_hash = get_source_hash(table)
+                    cached_hash = read_cached_hash(parquet_path, source_hash)
+                if cached_hash:
+                    hashes[parquet_path] = cached_hash
+                    metrics.add("convert", parquet_path.stem, parts_skipped=1)
+                    parquet_paths[parquet_path.stem] = [parquet_path]
+                    continue
+
+                with metrics.measure("convert", parquet_path.stem):
+                    chunk = convert_file(path, table, parquet_path)
+                json_utils.write_json_atomic(
+                    parquet_path.parent / MANIFEST_FILE,
+                    {"source_sha256": source_hash, **chunk},
                 )
-                df.to_parquet(parquet_path)
-                # Upload to S3 and create a table that reads from it
-                prefix = manifest.get_study_prefix()
-                remote_path = config.db.upload_file(
-                    file=parquet_path,
-                    study=prefix,
-                    topic=parquet_path.stem,
-                    force_upload=config.force_upload,
+                hashes[parquet_path] = chunk["sha256"]
+                metrics.add(
+                    "convert",
+                    parquet_path.stem,
+                    rows=chunk["rows"],
+                    input_bytes=path.stat().st_size,
+                    output_bytes=parquet_path.stat().st_size,
                 )
+                parquet_paths[parquet_path.stem] = [parquet_path]
+
+            # Upload all the files to S3 at once, skipping any the shared upload
+            # ledger shows are already there
+            cache_path.mkdir(exist_ok=True, parents=True)
+            remote_paths = upload_utils.upload_tables(
+                config.db,
+                parquet_paths,
+                study=prefix,
+                force_upload=config.force_upload,
+                workers=len(parquet_paths),
+                hashes=hashes,
+                ledger=upload_utils.UploadLedger(
+                    cache_path / upload_utils.LEDGER_FILE,
+                    upload_utils.get_destination(config.db),
+                ),
+                release="static",
+                metrics=metrics,
+            )
+            # ...and create tables that read from them
+            for table, topic in zip(self.tables, parquet_paths, strict=True):
                 self.queries.append(
                     base_templates.get_ctas_from_parquet_query(
                         schema_name=config.schema,
                         table_name=f"{prefix}__{table.table_name}",
-                        local_location=table.local_location,
-                        remote_location=remote_path,
+                        local_location=str(parquet_paths[topic][0]),
+                        remote_location=remote_paths[topic],
                         table_cols=table.headers,
                         remote_table_cols_types=table.parquet_types,
                     )
                 )
                 progress.advance(task)
+            metrics.write_report(cache_path / metrics_utils.REPORT_DIR)
+            log_utils.log_transaction(
+                config=config,
+                manifest=manifest,
+                message=f"UMLS static tables: {metrics.summary()}",
+            )
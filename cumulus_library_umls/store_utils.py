@@ -0,0 +1,219 @@
+"""A parquet store shared between builders, i.e. on a network file system
+
+Each builder converts releases into its own cache directory. With a shared store,
+the first builder to need a table converts it, while any others wait for it to
+finish, and then copy (or hard link) its files, rather than converting the same
+table again.
+
+Tables are stored by a hash of everything that determines their contents: the
+release, the size of the source file, the columns & their types, and the
+ingestion profile. Each stored table is a directory named for its key, which is
+written under a temporary name and only renamed into place once complete, so
+readers never see part of a table.
+
+Builders coordinate with a lock file per key. Builders copying a table out of the
+store share its lock, while the builder converting it holds the lock exclusively.
+Delta tables are built from the builder's own copy of the previous release, so
+aren't stored.
+
+Builders on the same host may also share a cache directory. Tables are only
+converted there under the store's exclusive lock, and are copied out of the store
+into a temporary directory which is then renamed into place, so a complete table
+another builder may be uploading is never removed or written over.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import uuid
+
+from cumulus_library_umls import delta_utils, json_utils, parquet_utils
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+STORE_MANIFEST_FILE = "_store.json"
+
+
+def get_key(rrf_path: pathlib.Path, table: dict[list], release: str | None) -> str:
+    """Hashes everything that determines the parquet a table is converted to
+
+    Settings which only change how the rows are split into files, like the engine
+    or memory budget, aren't included, so builders with different settings share
+    each other's tables. The source file is identified by its release, name & size,
+    rather than hashing its contents, which would take nearly as long as
+    converting it.
+
+    :param rrf_path: the location of the .rrf file
+    :param table: the table definition
+    :param release: the UMLS release the file is from
+    :returns: a hex sha256 hash
+    """
+    inputs = {
+        "release": release,
+        "file": rrf_path.name,
+        "size": rrf_path.stat().st_size,
+        "headers": table["headers"],
+        "parquet_types": table["parquet_types"],
+        "profile": table.get("profile"),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class ParquetStore:
+    """A directory of converted tables, keyed by get_key, shared between builders
+
+    Locks are held on open files, so a lock taken by one store object blocks other
+    store objects, even in the same process.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        """
+        :param path: the store's directory, which is created if needed
+        """
+        if fcntl is None:
+            raise ValueError("parquet_store requires file locks, which this platform lacks")
+        self.path = pathlib.Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._locks = {}
+
+    def is_stored(self, key: str) -> bool:
+        """Checks if a table has been completely written to the store"""
+        return (self.path / key / STORE_MANIFEST_FILE).exists()
+
+    def lock(self, key: str, exclusive: bool, blocking: bool = True) -> bool:
+        """Takes the lock of a key, see unlock
+
+        :param key: the table's key
+        :param exclusive: if True, the lock is held by this store alone, to write
+            the table. Otherwise it's shared with other readers.
+        :param blocking: if False, returns straight away if the lock is taken
+        :returns: whether the lock was taken
+        """
+        if key in self._locks:
+            raise ValueError(f"The lock of {key} is already held")
+        lock_file = (self.path / f"{key}.lock").open("a")
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(lock_file, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._locks[key] = lock_file
+        return True
+
+    def unlock(self, key: str) -> None:
+        """Releases the lock of a key, if held"""
+        if lock_file := self._locks.pop(key, None):
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def unlock_all(self) -> None:
+        """Releases every lock held, i.e. after a failed build"""
+        for key in list(self._locks):
+            self.unlock(key)
+
+    def fetch(
+        self,
+        key: str,
+        rrf_path: pathlib.Path,
+        parquet_path: pathlib.Path,
+        release: str | None,
+        profile: dict | None = None,
+    ) -> bool:
+        """Copies a stored table into a release's parquet, as if it were converted there
+
+        The caller should hold the key's lock, shared or exclusive. Builders may share
+        a parquet directory as well as the store, so a complete copy of the table
+        there is left as it is, since another builder may be uploading it. Otherwise,
+        the table is linked into a temporary directory, which replaces any incomplete
+        or outdated copy once complete.
+
+        :param key: the table's key
+        :param rrf_path: the location of the table's .rrf file
+        :param parquet_path: the location output parquet is written to
+        :param release: the UMLS release the file is from
+        :param profile: the ingestion profile applied to the table, if any
+        :returns: False if the table isn't stored
+        """
+        manifest = json_utils.read_json(self.path / key / STORE_MANIFEST_FILE)
+        if manifest is None:
+            return False
+        parquet_path.mkdir(parents=True, exist_ok=True)
+        # Builders fetching into the same parquet directory take turns
+        with (parquet_path / f".{rrf_path.stem}.lock").open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if parquet_utils.is_converted(rrf_path, parquet_path, release, profile):
+                return True
+            tmp_path = parquet_path / f".{rrf_path.stem}.{uuid.uuid4().hex}.tmp"
+            stale_path = parquet_path / f".{rrf_path.stem}.{uuid.uuid4().hex}.stale"
+            table_path = parquet_path / rrf_path.stem
+            try:
+                chunks = {}
+                for part, chunk in enumerate(manifest["chunks"]):
+                    delta_utils.link_file(
+                        self.path / key / chunk["path"], tmp_path / rrf_path.stem / chunk["path"]
+                    )
+                    chunks[part] = {"rows": chunk["rows"], "sha256": chunk["sha256"]}
+                    if manifest["partitioned"]:
+                        chunks[part]["path"] = chunk["path"]
+                (tmp_path / rrf_path.stem).mkdir(parents=True, exist_ok=True)
+                parquet_utils.finish_conversion(rrf_path, tmp_path, release, chunks, profile)
+                if table_path.exists():
+                    os.rename(table_path, stale_path)
+                os.rename(tmp_path / rrf_path.stem, table_path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                shutil.rmtree(stale_path, ignore_errors=True)
+        return True
+
+    def publish(
+        self,
+        key: str,
+        rrf_path: pathlib.Path,
+        parquet_path: pathlib.Path,
+        release: str | None,
+        profile: dict | None = None,
+    ) -> None:
+        """Writes a table converted in a release's parquet to the store
+
+        The caller should hold the key's lock exclusively. The table is written to a
+        temporary directory, which replaces any stored copy once complete.
+
+        :param key: the table's key
+        :param rrf_path: the location of the table's .rrf file
+        :param parquet_path: the location the table was converted to
+        :param release: the UMLS release the file is from
+        :param profile: the ingestion profile applied to the table, if any
+        """
+        manifest = parquet_utils.read_manifest(rrf_path, parquet_path, release, profile)
+        if manifest is None:
+            raise ValueError(f"{rrf_path.stem} must be converted before it's stored")
+        table_path = parquet_path / rrf_path.stem
+        parts = parquet_utils.get_converted_parts(rrf_path, parquet_path, release, profile)
+        tmp_path = self.path / f".{key}.{uuid.uuid4().hex}.tmp"
+        chunks = []
+        for (path, sha256), rows in zip(parts, manifest["rows_per_chunk"], strict=True):
+            relative = path.relative_to(table_path).as_posix()
+            delta_utils.link_file(path, tmp_path / relative)
+            chunks.append({"rows": rows, "sha256": sha256, "path": relative})
+        json_utils.write_json_atomic(
+            tmp_path / STORE_MANIFEST_FILE,
+            {
+                "table": rrf_path.stem,
+                "release": release,
+                "partitioned": manifest.get("path_per_chunk") is not None,
+                "chunks": chunks,
+            },
+        )
+        # A stored copy is moved aside first, since a directory can't be renamed
+        # over a non-empty one. Readers hold the lock, so none are reading it.
+        stale_path = self.path / f".{key}.{uuid.uuid4().hex}.stale"
+        if (self.path / key).exists():
+            os.rename(self.path / key, stale_path)
+        os.rename(tmp_path, self.path / key)
+        shutil.rmtree(stale_path, ignore_errors=True)
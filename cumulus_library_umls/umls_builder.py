@@ -1,11 +1,34 @@
+import collections
+import concurrent.futures
+import functools
+import math
 import pathlib
+import re
+import time
+from collections.abc import Callable
 
-import pandas
 import platformdirs
 from cumulus_library import BaseTableBuilder, base_utils, log_utils, study_manifest
-from cumulus_library.apis import umls
 from cumulus_library.template_sql import base_templates
 
+from cumulus_library_umls import (
+    archive_utils,
+    cache_utils,
+    delta_utils,
+    download_utils,
+    ingestion_utils,
+    metrics_utils,
+    mirror_utils,
+    parquet_utils,
+    release_utils,
+    slice_utils,
+    store_utils,
+    umls_templates,
+    upload_utils,
+)
+
+PARTITION_COLUMN = release_utils.PARTITION_COLUMN
+
 
 class UMLSBuilder(BaseTableBuilder):
     def rmtree(self, root: pathlib.Path):
@@ -34,37 +57,128 @@ class UMLSBuilder(BaseTableBuilder):
         parquet_path: pathlib.Path,
         force_upload: bool,
         umls_key: str,
+        stream_from_zip: bool = False,
+        cache: cache_utils.ReleaseCache | None = None,
+        download_workers: int = download_utils.DEFAULT_WORKERS,
+        download_chunk_size: int = download_utils.DEFAULT_CHUNK_SIZE,
+        mirror: pathlib.Path | None = None,
+        metadata_path: pathlib.Path | None = None,
+        metadata_ttl_hours: int = mirror_utils.DEFAULT_METADATA_TTL_HOURS,
     ) -> (list, bool, str):
-        """Fetches and extracts data from the UMLS API
+        """Fetches and extracts data from the UMLS API, or a local mirror
 
         :param download_path: the location to read from
-        :param parquet_path: the location output is written; only used for deletion
-            if a new dataset is downloaded
+        :param parquet_path: the location output is written
         :param force_upload: if True, will download from UMLS regardless of data on disk
         :param umls_key: the UMLS API key to use to auth requests
+        :param stream_from_zip: if True, the release archive is kept as downloaded,
+            in `<download_path>/<release>/`, rather than extracted, and the returned
+            files are archive_utils.ZipMembers inside it
+        :param cache: if provided, the downloads of other releases are evicted from
+            it before a new release is downloaded, if it's over budget. Their parquet
+            is only evicted once the new release is converted.
+        :param download_workers: the number of byte ranges of the archive downloaded
+            at once
+        :param download_chunk_size: the size of each byte range
+        :param mirror: if provided, the release is read from this archive or extracted
+            release directory, rather than the UMLS API, which isn't called at all
+        :param metadata_path: if provided, the latest release's metadata is cached here
+        :param metadata_ttl_hours: how long cached release metadata is used for
         :returns:
             - filtered_files - a list of files to process (excluding language tables)
             - download_required - if True, a new UMLS release needed to be retrieved
             - release_version - the name of the folder data was extracted to
         """
-        api = umls.UmlsApi(api_key=umls_key)
-        metadata = api.get_latest_umls_file_release(target="umls-metathesaurus-full-subset")
+        if mirror:
+            files, download_required, release = self.get_mirror_data(
+                mirror_utils.find_mirror(mirror),
+                download_path,
+                parquet_path,
+                force_upload,
+                stream_from_zip=stream_from_zip,
+                cache=cache,
+            )
+            return self.filter_files(files), download_required, release
+        metadata = mirror_utils.get_release_metadata(
+            umls_key, metadata_path, metadata_ttl_hours, refresh=force_upload
+        )
         download_required = False
         if not (download_path / metadata["releaseVersion"]).exists():
             print("New UMLS release available, downloading & updating...")
             download_required = True
+            # Other releases are kept until this one is built, apart from partial
+            # downloads of them. A partial download of this one is resumed.
             for version in download_path.iterdir():
-                self.rmtree(version)
-            for version in (parquet_path).iterdir():
-                self.rmtree(version)
-        if download_required or force_upload:
-            api.download_umls_files(target="umls-metathesaurus-full-subset", path=download_path)
-        files = list(download_path.glob(f"./{metadata['releaseVersion']}/META/*.ctl"))
-        filtered_files = []
-        for file in files:
-            if not file.stem.startswith("MRX"):
-                filtered_files.append(file)
-        return filtered_files, download_required, metadata["releaseVersion"]
+                if version.is_file() and not version.name.startswith(metadata["fileName"]):
+                    self.rmtree(version)
+            if cache:
+                cache.evict({metadata["releaseVersion"]}, kinds=(cache_utils.DOWNLOADS_DIR,))
+        # The archive is fetched in resumable byte ranges, and verified before use
+        download = functools.partial(
+            download_utils.download_release,
+            umls_key,
+            metadata,
+            workers=download_workers,
+            chunk_size=download_chunk_size,
+        )
+        if stream_from_zip:
+            release_path = download_path / metadata["releaseVersion"]
+            archive = archive_utils.find_archive(release_path)
+            if download_required or force_upload or archive is None:
+                archive = download(release_path)
+            files = archive_utils.list_members(archive, ".ctl")
+        else:
+            if download_required or force_upload:
+                archive = download(download_path)
+                # A corrupt archive is fetched again next time
+                try:
+                    download_utils.extract_archive(archive, download_path)
+                finally:
+                    archive.unlink()
+            files = list(download_path.glob(f"./{metadata['releaseVersion']}/META/*.ctl"))
+        return self.filter_files(files), download_required, metadata["releaseVersion"]
+
+    def get_mirror_data(
+        self,
+        mirror: mirror_utils.Mirror,
+        download_path: pathlib.Path,
+        parquet_path: pathlib.Path,
+        force_upload: bool,
+        stream_from_zip: bool = False,
+        cache: cache_utils.ReleaseCache | None = None,
+    ) -> (list, bool, str):
+        """Finds the files of a release in a local mirror
+
+        Extracted mirrors are read in place. Archives are streamed from in place, or
+        extracted into the download path like a downloaded archive.
+
+        :param mirror: the release in the mirror
+        :param download_path: the location archives are extracted to
+        :param parquet_path: the location output is written
+        :param force_upload: if True, an archive is extracted again
+        :param stream_from_zip: if True, an archive is streamed from, not extracted
+        :param cache: if provided, the downloads of other releases are evicted from
+            it before an archive is extracted, if it's over budget
+        :returns: the same as get_umls_data, with the release counted as new if it
+            hasn't been converted yet
+        """
+        download_required = not (parquet_path / mirror.release).is_dir()
+        if mirror.meta_path:
+            files = list(mirror.meta_path.glob("*.ctl"))
+        elif stream_from_zip:
+            files = archive_utils.list_members(mirror.archive, ".ctl")
+        else:
+            meta_path = download_path / mirror.release / "META"
+            if force_upload or not meta_path.is_dir():
+                if cache:
+                    cache.evict({mirror.release}, kinds=(cache_utils.DOWNLOADS_DIR,))
+                download_utils.extract_archive(mirror.archive, download_path)
+            files = list(meta_path.glob("*.ctl"))
+        return files, download_required, mirror.release
+
+    def filter_files(self, files: list) -> list:
+        """Drops the .ctl files of tables which aren't converted (the MRX indexes)"""
+        return [file for file in files if not file.stem.startswith("MRX")]
 
     def sql_type_to_df_parquet_type(self, text: str) -> str:
         """Converts types extract from the MySQL .ctl definition to parquet types
@@ -89,10 +203,11 @@ class UMLSBuilder(BaseTableBuilder):
         :param contents: an array of strings, expected from a file.readlines call()
         :returns:
             - datasource - the name of the datasource for population
-            - table -a dict describing the table
+            - table -a dict describing the table, including the declared `widths`
+              of its text columns
         """
         datasource = None
-        table = {"headers": [], "dtype": {}, "parquet_types": []}
+        table = {"headers": [], "dtype": {}, "parquet_types": [], "widths": {}}
         is_col_def_section = False
         for line in contents:
             if line is None:
@@ -111,6 +226,8 @@ class UMLSBuilder(BaseTableBuilder):
                     table["headers"].append(line[0])
                     table["dtype"][line[0]] = df_type
                     table["parquet_types"].append(parquet_type)
+                    if width := re.match(r"char\((\d+)\)", line[1]):
+                        table["widths"][line[0]] = int(width[1])
         return datasource, table
 
     def create_parquet(
@@ -119,7 +236,10 @@ class UMLSBuilder(BaseTableBuilder):
         parquet_path: pathlib.Path,
         table: dict[list],
         force_upload=False,
-    ):
+        engine: str = "pandas",
+        on_part: Callable[[pathlib.Path, str | None], None] | None = None,
+        release: str | None = None,
+    ) -> list[tuple[pathlib.Path, str | None]]:
         """Creates a parquet file from a .rrf metathesaurus file
 
         :param rrf_path: the location of the .rrf files
@@ -127,24 +247,483 @@ class UMLSBuilder(BaseTableBuilder):
         :param table: a table definition created by parse_ctl_files
         :param force_upload: if true, upload to a remote source regardless of what
             already exists there
+        :param engine: the library to parse with, either 'pandas' or 'arrow'
+        :param on_part: if provided, called with each parquet file and its sha256
+            hash as it is written
+        :param release: the UMLS release the file is from
+        :returns: (path, sha256 hash) tuples of the parquet files for this table
         """
-        parquet_path = parquet_path / rrf_path.stem
-        if not force_upload:
-            if (parquet_path / f"{rrf_path.stem}.parquet").exists():
-                return
-        chunks = pandas.read_csv(
+        convert = (
+            delta_utils.convert_rrf_delta if table.get("delta_key") else parquet_utils.convert_rrf
+        )
+        return convert(
             rrf_path,
-            delimiter="|",
-            names=table["headers"],
-            dtype=table["dtype"],
-            index_col=False,
-            chunksize=500_000,
+            parquet_path,
+            table,
+            force_upload=force_upload,
+            engine=engine,
+            on_part=on_part,
+            release=release,
         )
-        parquet_path.mkdir(parents=True, exist_ok=True)
-        filenum = 0
-        for chunk in chunks:
-            chunk.to_parquet(parquet_path / f"{rrf_path.stem}_{filenum}.parquet")
-            filenum += 1
+
+    def get_int_option(self, config: base_utils.StudyConfig, name: str, default: int) -> int:
+        """Reads an integer valued study option, set via `--option name:value`
+
+        :param config: the study config containing CLI options
+        :param name: the name of the option
+        :param default: the value to use if the option is not set
+        """
+        options = config.options or {}
+        try:
+            return int(options.get(name, default))
+        except ValueError as e:
+            raise ValueError(f"{name} must be an integer, got '{options[name]}'") from e
+
+    def get_bool_option(self, config: base_utils.StudyConfig, name: str) -> bool:
+        """Reads a true/false study option, set via `--option name:true`
+
+        :param config: the study config containing CLI options
+        :param name: the name of the option, which is False if not set
+        """
+        value = (config.options or {}).get(name, "false").lower()
+        if value not in ("true", "false"):
+            raise ValueError(f"{name} must be 'true' or 'false', got '{value}'")
+        return value == "true"
+
+    def get_worker_count(self, config: base_utils.StudyConfig) -> int:
+        """Reads the number of conversion processes to use from the study options
+
+        This is set via `--option conversion_workers:N`. If unset, conversion
+        runs in the current process, one file at a time.
+        """
+        return max(self.get_int_option(config, "conversion_workers", 1), 1)
+
+    def get_engine(self, config: base_utils.StudyConfig) -> str:
+        """Reads the conversion engine to use from the study options
+
+        This is set via `--option conversion_engine:arrow`. pandas is used by default.
+        """
+        engine = (config.options or {}).get("conversion_engine", "pandas")
+        if engine not in parquet_utils.ENGINES:
+            raise ValueError(
+                f"conversion_engine must be one of {parquet_utils.ENGINES}, got '{engine}'"
+            )
+        return engine
+
+    def record_conversion(
+        self,
+        metrics: metrics_utils.BuildMetrics,
+        name: str,
+        rrf_path: pathlib.Path,
+        table: dict[list],
+        parquet_path: pathlib.Path,
+        release: str | None,
+    ) -> None:
+        """Records the rows & sizes of a table, once it is completely converted
+
+        :param metrics: the build's metrics
+        :param name: the name of the table
+        :param rrf_path: the location of the table's .rrf file
+        :param table: the table definition
+        :param parquet_path: the location output parquet was written to
+        :param release: the UMLS release the file is from
+        """
+        manifest = parquet_utils.read_manifest(
+            rrf_path, parquet_path, release, table.get("profile")
+        )
+        parts = parquet_utils.get_converted_parts(
+            rrf_path, parquet_path, release, table.get("profile")
+        )
+        metrics.add(
+            "convert",
+            name,
+            rows=sum(manifest["rows_per_chunk"]) if manifest else 0,
+            input_bytes=rrf_path.stat().st_size,
+            output_bytes=sum(path.stat().st_size for path, _ in parts or []),
+        )
+
+    def convert_tables(
+        self,
+        tables: dict[str, tuple[pathlib.Path, dict]],
+        parquet_path: pathlib.Path,
+        force_upload: bool,
+        workers: int,
+        progress,
+        task,
+        range_size: int | None = None,
+        engine: str = "pandas",
+        on_part: Callable[[str, pathlib.Path, str | None], None] | None = None,
+        on_table: Callable[[str], None] | None = None,
+        release: str | None = None,
+        metrics: metrics_utils.BuildMetrics | None = None,
+    ):
+        """Converts a set of .rrf files to parquet, optionally across a process pool
+
+        When running in parallel, the largest pieces of work are dispatched first, so
+        that the biggest tables aren't left as a single threaded tail at the end.
+        Files larger than range_size are split into line aligned byte ranges, and
+        each range is converted by its own worker.
+
+        :param tables: a dict of table names to (rrf path, table definition) tuples
+        :param parquet_path: the location to write output parquet to
+        :param force_upload: if true, regenerate parquet regardless of what's on disk
+        :param workers: the number of processes to convert with
+        :param progress: a progress bar to update as tables finish
+        :param task: the progress bar task to advance
+        :param range_size: if set, the approximate size in bytes of a byte range
+            to convert in a single worker. Only used when workers > 1.
+        :param engine: the library to parse with, either 'pandas' or 'arrow'
+        :param on_part: if provided, called with a table name, the path of a
+            parquet file and its sha256 hash, as soon as that file is completely written
+        :param on_table: if provided, called with a table name once all of its
+            parquet files have been written
+        :param release: the UMLS release the files are from, recorded in each
+            table's manifest
+        :param metrics: if provided, the time spent converting each table, and its
+            rows & sizes, are recorded
+        """
+        on_part = on_part or (lambda name, path, sha256: None)
+        on_table = on_table or (lambda name: None)
+        metrics = metrics or metrics_utils.BuildMetrics(release)
+        if workers == 1:
+            for name, (rrf_path, table) in tables.items():
+                progress.update(task, description=f"Compressing {name}...")
+                with metrics.measure("convert", name):
+                    self.create_parquet(
+                        rrf_path,
+                        parquet_path,
+                        table,
+                        force_upload=force_upload,
+                        engine=engine,
+                        on_part=functools.partial(on_part, name),
+                        release=release,
+                    )
+                self.record_conversion(metrics, name, rrf_path, table, parquet_path, release)
+                on_table(name)
+                progress.advance(task)
+            return
+
+        # Each unit of work is (size in bytes, table name, range part number, function, args)
+        work = []
+        # For tables split into ranges, the parent process tracks which parts are done
+        # (as a dict of part number to row count & hash), so that a rerun can resume
+        ranged = {}
+        for name, (rrf_path, table) in tables.items():
+            size = rrf_path.stat().st_size
+            # Partitioned & delta tables are written in one pass, and files streamed
+            # out of an archive can't be seeked into, so none of them are split up
+            if (
+                range_size
+                and size > range_size
+                and not table.get("partition_column")
+                and not table.get("delta_key")
+                and isinstance(rrf_path, pathlib.Path)
+                and (
+                    force_upload
+                    or not parquet_utils.is_converted(
+                        rrf_path, parquet_path, release, table.get("profile")
+                    )
+                )
+            ):
+                ranges = parquet_utils.split_rrf(rrf_path, math.ceil(size / range_size))
+                layout = {
+                    "engine": engine,
+                    "profile": table.get("profile"),
+                    "ranges": [list(r) for r in ranges],
+                }
+                chunks = parquet_utils.start_conversion(
+                    rrf_path, parquet_path, release, layout, resume=not force_upload
+                )
+                ranged[name] = (layout, chunks)
+                for part, (start, end) in enumerate(ranges):
+                    if part in chunks:
+                        on_part(
+                            name,
+                            parquet_utils.get_part_path(parquet_path, name, part),
+                            chunks[part]["sha256"],
+                        )
+                        continue
+                    work.append(
+                        (
+                            end - start,
+                            name,
+                            part,
+                            parquet_utils.convert_rrf_range,
+                            (rrf_path, parquet_path, table, start, end, part, engine),
+                        )
+                    )
+            else:
+                work.append(
+                    (
+                        size,
+                        name,
+                        None,
+                        delta_utils.convert_rrf_delta
+                        if table.get("delta_key")
+                        else parquet_utils.convert_rrf,
+                        (rrf_path, parquet_path, table, force_upload, engine, None, release),
+                    )
+                )
+        work.sort(key=lambda unit: unit[0], reverse=True)
+        remaining = collections.Counter(unit[1] for unit in work)
+
+        def finish_table(name: str):
+            if name in ranged:
+                rrf_path, table = tables[name]
+                parquet_utils.finish_conversion(
+                    rrf_path, parquet_path, release, ranged[name][1], table.get("profile")
+                )
+            self.record_conversion(metrics, name, *tables[name], parquet_path, release)
+            on_table(name)
+            progress.update(task, description=f"Compressed {name}...")
+            progress.advance(task)
+
+        # Tables whose ranges were all converted by a previous, interrupted run
+        for name in ranged:
+            if remaining[name] == 0:
+                finish_table(name)
+
+        progress.update(task, description=f"Compressing {len(tables)} tables...")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        try:
+            # Workers time themselves, since their CPU time isn't visible from here
+            futures = {
+                executor.submit(metrics_utils.call_measured, func, *args): (name, part)
+                for _, name, part, func, args in work
+            }
+            for future in concurrent.futures.as_completed(futures):
+                result, wall_seconds, cpu_seconds = future.result()
+                name, part = futures[future]
+                metrics.add("convert", name, wall_seconds=wall_seconds, cpu_seconds=cpu_seconds)
+                if part is None:
+                    # convert_rrf returns the paths & hashes of all the files it wrote
+                    for part_path, sha256 in result:
+                        on_part(name, part_path, sha256)
+                else:
+                    # convert_rrf_range returns the row count & hash of its part
+                    layout, chunks = ranged[name]
+                    chunks[part] = result
+                    parquet_utils.record_progress(
+                        tables[name][0], parquet_path, release, layout, chunks
+                    )
+                    on_part(
+                        name,
+                        parquet_utils.get_part_path(parquet_path, name, part),
+                        result["sha256"],
+                    )
+                remaining[name] -= 1
+                if remaining[name] == 0:
+                    finish_table(name)
+        finally:
+            # If a conversion fails, don't wait on anything that hasn't started yet
+            executor.shutdown(cancel_futures=True)
+
+    def convert_shared_tables(
+        self,
+        store: store_utils.ParquetStore,
+        tables: dict[str, tuple[pathlib.Path, dict]],
+        parquet_path: pathlib.Path,
+        force_upload: bool,
+        *args,
+        on_table: Callable[[str], None] | None = None,
+        release: str | None = None,
+        **kwargs,
+    ):
+        """Converts a set of .rrf files to parquet, sharing the work with other builders
+
+        Tables already in the store are copied out of it. Of the rest, the tables no
+        other builder is converting are converted and then stored. Only then does
+        this builder wait on the tables others are converting, and copy them once
+        they're stored. Delta tables are always converted here.
+
+        :param store: the parquet store shared with other builders
+        :param tables: a dict of table names to (rrf path, table definition) tuples
+        :param parquet_path: the location to write output parquet to
+        :param force_upload: if true, convert every table again, and replace them in
+            the store, rather than copying them from it
+        :param on_table: if provided, called with a table name once all of its
+            parquet files have been written
+        :param release: the UMLS release the files are from
+        :param args: passed on to convert_tables, along with kwargs
+        """
+        on_table = on_table or (lambda name: None)
+        keys = {}
+        claimed = set()
+        waiting = []
+
+        def share(name: str, blocking: bool) -> bool:
+            # Copies the table out of the store, or claims it to convert. Without
+            # blocking, returns False if another builder holds the table's lock.
+            rrf_path, table = tables[name]
+            key, profile = keys[name], table.get("profile")
+            if not force_upload and store.lock(key, exclusive=False, blocking=blocking):
+                try:
+                    if store.fetch(key, rrf_path, parquet_path, release, profile):
+                        return True
+                finally:
+                    store.unlock(key)
+            if not store.lock(key, exclusive=True, blocking=blocking):
+                return False
+            # Another builder may have stored it between the two locks
+            if not force_upload and store.fetch(key, rrf_path, parquet_path, release, profile):
+                store.unlock(key)
+            else:
+                claimed.add(name)
+            return True
+
+        def finish_table(name: str):
+            if name in claimed:
+                rrf_path, table = tables[name]
+                store.publish(keys[name], rrf_path, parquet_path, release, table.get("profile"))
+                store.unlock(keys[name])
+                claimed.discard(name)
+            on_table(name)
+
+        try:
+            for name, (rrf_path, table) in tables.items():
+                if table.get("delta_key"):
+                    continue
+                keys[name] = store_utils.get_key(rrf_path, table, release)
+                if (
+                    not force_upload
+                    and store.is_stored(keys[name])
+                    and parquet_utils.is_converted(
+                        rrf_path, parquet_path, release, table.get("profile")
+                    )
+                ):
+                    continue
+                if not share(name, blocking=False):
+                    waiting.append(name)
+            self.convert_tables(
+                {name: tables[name] for name in tables if name not in waiting},
+                parquet_path,
+                force_upload,
+                *args,
+                on_table=finish_table,
+                release=release,
+                **kwargs,
+            )
+            # This builder's own tables are all stored, so it holds no locks others
+            # could be waiting on
+            for name in waiting:
+                share(name, blocking=True)
+            self.convert_tables(
+                {name: tables[name] for name in waiting},
+                parquet_path,
+                force_upload,
+                *args,
+                on_table=finish_table,
+                release=release,
+                **kwargs,
+            )
+        finally:
+            store.unlock_all()
+
+    def get_partitioned_ctas_query(
+        self,
+        config: base_utils.StudyConfig,
+        name: str,
+        rrf_path: pathlib.Path,
+        table: dict[list],
+        parquet_path: pathlib.Path,
+        release: str,
+        pipeline: upload_utils.UploadPipeline,
+    ) -> str:
+        """Creates the query for a table written as Hive style partitions
+
+        :param config: the study config
+        :param name: the name of the table
+        :param rrf_path: the location of the table's .rrf file
+        :param table: a partitioned table definition, from partition_table
+        :param parquet_path: the location output parquet was written to
+        :param release: the UMLS release the table is from
+        :param pipeline: the pipeline the table's parts were uploaded with
+        """
+        column = table["partition_column"]
+        parts = parquet_utils.get_converted_parts(
+            rrf_path, parquet_path, release, table.get("profile")
+        )
+        cols, types = zip(
+            *[
+                (header, parquet_type)
+                for header, parquet_type in zip(
+                    table["headers"], table["parquet_types"], strict=True
+                )
+                if header != column
+            ],
+            strict=True,
+        )
+        return umls_templates.get_ctas_from_partitioned_parquet_query(
+            schema_name=config.schema,
+            table_name=name,
+            local_files=[path for path, _ in parts],
+            remote_location=pipeline.remote_paths.get(name),
+            table_cols=list(cols),
+            remote_table_cols_types=list(types),
+            partition_col=column,
+            partition_col_type=table["parquet_types"][table["headers"].index(column)],
+            partition_values=parquet_utils.get_partition_values(parts),
+        )
+
+    def get_delta_queries(
+        self,
+        config: base_utils.StudyConfig,
+        name: str,
+        rrf_path: pathlib.Path,
+        table: dict[list],
+        parquet_path: pathlib.Path,
+        release: str,
+        pipeline: upload_utils.UploadPipeline,
+    ) -> list[str]:
+        """Creates the queries for a table written as a delta of a previous release
+
+        The table's files and tombstones are each loaded into their own table, and
+        the table itself is a view of the files' rows which aren't tombstoned.
+
+        :param config: the study config
+        :param name: the name of the table
+        :param rrf_path: the location of the table's .rrf file
+        :param table: a delta table definition, from delta_utils.delta_table
+        :param parquet_path: the location output parquet was written to
+        :param release: the UMLS release the table is from
+        :param pipeline: the pipeline the table's parts were uploaded with
+        """
+        column = delta_utils.GENERATION_COLUMN
+        parts = parquet_utils.get_converted_parts(
+            rrf_path, parquet_path, release, table.get("profile")
+        )
+        parts_table = delta_utils.get_parts_name(name)
+        tombstones_table = delta_utils.get_tombstone_name(name)
+        return [
+            umls_templates.get_ctas_from_partitioned_parquet_query(
+                schema_name=config.schema,
+                table_name=parts_table,
+                local_files=[path for path, _ in parts],
+                remote_location=pipeline.remote_paths.get(name),
+                table_cols=table["headers"],
+                remote_table_cols_types=table["parquet_types"],
+                partition_col=column,
+                partition_col_type="String",
+                partition_values=parquet_utils.get_partition_values(parts),
+            ),
+            base_templates.get_ctas_from_parquet_query(
+                schema_name=config.schema,
+                table_name=tombstones_table,
+                local_location=parquet_path / f"{tombstones_table}/*.parquet",
+                remote_location=pipeline.remote_paths.get(tombstones_table),
+                table_cols=[table["delta_key"], column],
+                remote_table_cols_types=["String", "String"],
+            ),
+            umls_templates.get_delta_view_query(
+                schema_name=config.schema,
+                view_name=name,
+                parts_table=parts_table,
+                tombstones_table=tombstones_table,
+                table_cols=table["headers"],
+                key_col=table["delta_key"],
+                partition_col=column,
+            ),
+        ]
 
     def prepare_queries(
         self,
@@ -158,45 +737,217 @@ class UMLSBuilder(BaseTableBuilder):
         download_path.mkdir(exist_ok=True, parents=True)
         parquet_path = base_path / "generated_parquet"
         parquet_path.mkdir(exist_ok=True, parents=True)
-        files, new_version, umls_version = self.get_umls_data(
-            download_path, parquet_path, config.force_upload, config.umls_key
+        options = config.options or {}
+        partitioned = ingestion_utils.parse_list_option(options.get("partitioned_tables"))
+        delta = ingestion_utils.parse_list_option(options.get("delta_tables"))
+        if unsupported := sorted(delta - delta_utils.DELTA_KEYS.keys() | delta & partitioned):
+            raise ValueError(
+                f"delta_tables only supports {', '.join(delta_utils.DELTA_KEYS)}, and not "
+                f"partitioned tables, got {', '.join(unsupported)}"
+            )
+        cache = cache_utils.ReleaseCache(
+            base_path, self.get_int_option(config, "cache_budget_gb", 0) * 1024**3
         )
+        metrics = metrics_utils.BuildMetrics("umls")
+        with metrics.measure("download"):
+            files, new_version, umls_version = self.get_umls_data(
+                download_path,
+                parquet_path,
+                config.force_upload,
+                config.umls_key,
+                stream_from_zip=self.get_bool_option(config, "stream_from_zip"),
+                cache=cache,
+                download_workers=self.get_int_option(
+                    config, "download_workers", download_utils.DEFAULT_WORKERS
+                ),
+                download_chunk_size=self.get_int_option(
+                    config, "download_chunk_mb", download_utils.DEFAULT_CHUNK_SIZE // 1024**2
+                )
+                * 1024**2,
+                mirror=options.get("umls_mirror"),
+                metadata_path=base_path / mirror_utils.METADATA_FILE,
+                metadata_ttl_hours=self.get_int_option(
+                    config,
+                    "release_metadata_ttl_hours",
+                    mirror_utils.DEFAULT_METADATA_TTL_HOURS,
+                ),
+            )
+        metrics.label = f"umls_{umls_version}"
+        release_root = parquet_path
         parquet_path = parquet_path / umls_version
         parquet_path.mkdir(exist_ok=True, parents=True)
+        # Other builders sharing the cache directory mustn't evict this release
+        # while it's being built
+        cache.lock(umls_version)
+
+        # The ingestion profile drops whole tables here, and is applied to the
+        # remaining table definitions so that columns & rows are filtered as each
+        # file is streamed
+        profile = ingestion_utils.get_ingestion_profile(config)
+        memory_budget = self.get_int_option(config, "memory_budget_mb", 0) * 1024**2
+        tables = {}
+        for file in sorted(files):
+            if not profile.includes_table(file.stem):
+                continue
+            with file.open() as f:
+                datasource, table = self.parse_ctl_file(f.readlines())
+            # The .rrf lives alongside its .ctl, whether extracted or in the archive
+            rrf_path = file.with_name(datasource)
+            table = profile.apply(file.stem, table)
+            table = parquet_utils.set_write_options(
+                table, ingestion_utils.get_write_options(config, file.stem)
+            )
+            table = parquet_utils.set_memory_budget(table, memory_budget)
+            if file.stem in partitioned:
+                table = parquet_utils.partition_table(table, PARTITION_COLUMN)
+            if file.stem in delta:
+                # Delta tables are built against the most recent earlier release
+                # with a complete copy of the table
+                table = delta_utils.delta_table(
+                    table,
+                    delta_utils.DELTA_KEYS[file.stem],
+                    delta_utils.find_base(release_root, umls_version, file.stem),
+                )
+            tables[file.stem] = (rrf_path, table)
+        delta_tables = [name for name, (_, table) in tables.items() if table.get("delta_key")]
+
+        ledger = upload_utils.UploadLedger(
+            base_path / upload_utils.LEDGER_FILE, upload_utils.get_destination(config.db)
+        )
+        # Files reused from the previous release were uploaded for it already
+        for name in delta_tables:
+            if base := tables[name][1]["delta_base"]:
+                ledger.carry_forward(pathlib.Path(base).parent.name, umls_version, name)
+
+        definitions = {name: table for name, (_, table) in tables.items()}
+        slices = slice_utils.SliceWriter(parquet_path, definitions)
+        # Slices are written after the ingestion profile has filtered the rows
+        for warning in slice_utils.get_profile_warnings(definitions):
+            print(f"Warning: {warning}")
 
         with base_utils.get_progress_bar() as progress:
+            # Each table is advanced once when converted, and once when uploaded,
+            # along with the upload of each delta table's tombstones, and each slice
             task = progress.add_task(
                 None,
-                total=len(files),
+                total=len(tables) * 2 + len(delta_tables) + len(slices.slices),
             )
-            for file in files:
-                with open(file) as f:
-                    datasource, table = self.parse_ctl_file(f.readlines())
-                    progress.update(task, description=f"Compressing {datasource}...")
-                    rrf_path = download_path / f"./{umls_version}/META/{datasource}"
-                    self.create_parquet(
-                        rrf_path, parquet_path, table, force_upload=config.force_upload
+            # Parts are uploaded by the pipeline's threads as soon as they're written,
+            # so that uploads overlap with the conversion of the remaining data
+            with upload_utils.UploadPipeline(
+                config.db,
+                "umls",
+                # Files reused by delta tables keep their remote names, so must not be
+                # forced to upload again just because the release is new
+                force_upload=config.force_upload or (new_version and not delta_tables),
+                workers=self.get_int_option(config, "upload_workers", 1),
+                max_queued=self.get_int_option(config, "upload_queue_size", 8),
+                retries=self.get_int_option(config, "upload_retries", 3),
+                on_table_uploaded=lambda name: progress.advance(task),
+                ledger=ledger,
+                release=umls_version,
+                metrics=metrics,
+                # The engine & layout options change which files a table is written
+                # as, and its table is created from every file in its remote location
+                remove_stale=True,
+            ) as pipeline:
+                # Each part is split into its slices as soon as it's written, and the
+                # slices uploaded alongside it
+                slices.on_part = pipeline.put
+
+                def put(name: str, path: pathlib.Path, sha256: str | None):
+                    pipeline.put(name, path, sha256)
+                    if name in slices.sources:
+                        with metrics.measure("slice", name):
+                            slices.put(name, path, sha256)
+
+                def finish_table(name: str):
+                    if name in delta_tables:
+                        tombstones = delta_utils.get_tombstone_name(name)
+                        pipeline.put(tombstones, delta_utils.get_tombstone_path(parquet_path, name))
+                        pipeline.finish_table(tombstones)
+                    pipeline.finish_table(name)
+                    if name in slices.sources:
+                        with metrics.measure("slice", name):
+                            finished = slices.finish_table(name)
+                        for slice_name in finished:
+                            pipeline.finish_table(slice_name)
+
+                range_size = self.get_int_option(config, "conversion_range_mb", 256) * 1024**2
+                if memory_budget:
+                    # Each range is read into memory whole
+                    range_size = min(
+                        range_size, int(memory_budget * parquet_utils.RANGE_BUDGET_FRACTION)
                     )
-                    progress.update(task, description=f"Uploading {datasource}...")
-                    for file_path in (parquet_path / file.stem).iterdir():
-                        remote_path = config.db.upload_file(
-                            file=file_path,
-                            study="umls",
-                            topic=file.stem,
-                            remote_filename=file_path.name,
-                            force_upload=config.force_upload or new_version,
-                        )
+                # With a shared store, tables converted by other builders are reused
+                convert = self.convert_tables
+                if options.get("parquet_store"):
+                    convert = functools.partial(
+                        self.convert_shared_tables,
+                        store_utils.ParquetStore(pathlib.Path(options["parquet_store"])),
+                    )
+                with metrics.measure("convert"):
+                    convert(
+                        tables,
+                        parquet_path,
+                        config.force_upload,
+                        self.get_worker_count(config),
+                        progress,
+                        task,
+                        range_size=range_size,
+                        engine=self.get_engine(config),
+                        on_part=put,
+                        on_table=finish_table,
+                        release=umls_version,
+                        metrics=metrics,
+                    )
+                # Leaving the pipeline waits on any uploads still in flight, which is
+                # time the build is purely bound by the network
+                waiting = time.perf_counter()
+            metrics.add("upload_wait", wall_seconds=time.perf_counter() - waiting)
+            for name, (rrf_path, table) in tables.items():
+                if table.get("delta_key"):
+                    self.queries += self.get_delta_queries(
+                        config, name, rrf_path, table, parquet_path, umls_version, pipeline
+                    )
+                    continue
+                if table.get("partition_column"):
                     self.queries.append(
-                        base_templates.get_ctas_from_parquet_query(
-                            schema_name=config.schema,
-                            table_name=file.stem,
-                            local_location=parquet_path / f"{rrf_path.stem}/*.parquet",
-                            remote_location=remote_path,
-                            table_cols=table["headers"],
-                            remote_table_cols_types=table["parquet_types"],
+                        self.get_partitioned_ctas_query(
+                            config, name, rrf_path, table, parquet_path, umls_version, pipeline
                         )
                     )
-                    progress.advance(task)
+                    continue
+                self.queries.append(
+                    base_templates.get_ctas_from_parquet_query(
+                        schema_name=config.schema,
+                        table_name=name,
+                        local_location=parquet_path / f"{rrf_path.stem}/*.parquet",
+                        remote_location=pipeline.remote_paths.get(name),
+                        table_cols=table["headers"],
+                        remote_table_cols_types=table["parquet_types"],
+                    )
+                )
+            for table_slice in slices.slices:
+                self.queries.append(
+                    base_templates.get_ctas_from_parquet_query(
+                        schema_name=config.schema,
+                        table_name=table_slice.name,
+                        local_location=parquet_path / f"{table_slice.name}/*.parquet",
+                        remote_location=pipeline.remote_paths.get(table_slice.name),
+                        table_cols=slices.get_columns(table_slice),
+                        remote_table_cols_types=slices.get_parquet_types(table_slice),
+                    )
+                )
+            report_path = metrics.write_report(base_path / metrics_utils.REPORT_DIR)
+            print(f"Build timings written to {report_path}")
             log_utils.log_transaction(
-                config=config, manifest=manifest, message=f"UMLS version: {umls_version}"
+                config=config,
+                manifest=manifest,
+                message=f"UMLS version: {umls_version}; {metrics.summary()}",
             )
+        # Only now that this release is built can older ones be evicted. Files delta
+        # tables reused are hard links, so evicting the previous release keeps them.
+        cache.record_build(umls_version)
+        cache.evict({umls_version})
+        cache.unlock()
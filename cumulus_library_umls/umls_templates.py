@@ -0,0 +1,90 @@
+"""Query templates specific to the UMLS study"""
+
+import pathlib
+
+from cumulus_library.template_sql import base_templates
+
+PATH = pathlib.Path(__file__).parent / "template_sql"
+
+
+def get_ctas_from_partitioned_parquet_query(
+    schema_name: str,
+    table_name: str,
+    local_files: list[pathlib.Path],
+    remote_location: str,
+    table_cols: list[str],
+    remote_table_cols_types: list[str],
+    partition_col: str,
+    partition_col_type: str,
+    partition_values: list[str],
+) -> str:
+    """Generates a create table query for a directory of Hive partitioned parquet
+
+    This mirrors base_templates.get_ctas_from_parquet_query, for tables written with
+    one subdirectory per partition value, i.e. `sab=RXNORM/`. Queries filtering on
+    the partition column then only read the matching directories.
+
+    :param schema_name: (athena) The schema to create the table in
+    :param table_name: (all) The name of the table to create
+    :param local_files: (duckdb) the parquet files of every partition. These are
+        listed rather than globbed, so files left in the partition directories by
+        other builds aren't read
+    :param remote_location: (athena) An S3 URL to the directory containing the
+        partition directories. Athena reads every file under a projected partition,
+        so this must hold only the table's current files, as left by an
+        UploadPipeline which removes stale files
+    :param table_cols: (all) names of the non-partition fields in the parquet
+    :param remote_table_cols_types: (athena) The parquet types of table_cols
+    :param partition_col: (all) the name of the column the table is partitioned on
+    :param partition_col_type: (athena) the parquet type of the partition column
+    :param partition_values: (athena) the values of the partition column in
+        local_files, which are the only partitions projected
+    """
+    return base_templates.get_template(
+        "ctas_from_partitioned_parquet",
+        PATH,
+        schema_name=schema_name,
+        table_name=table_name,
+        local_files=local_files,
+        remote_location=remote_location,
+        table_cols=table_cols,
+        remote_table_cols_types=remote_table_cols_types,
+        partition_col=partition_col,
+        partition_col_type=partition_col_type,
+        partition_values=partition_values,
+    )
+
+
+def get_delta_view_query(
+    schema_name: str,
+    view_name: str,
+    parts_table: str,
+    tombstones_table: str,
+    table_cols: list[str],
+    key_col: str,
+    partition_col: str,
+) -> str:
+    """Generates a create view query combining a delta table's files & tombstones
+
+    :param schema_name: (all) The schema containing the tables, and to create the
+        view in
+    :param view_name: (all) The name of the view to create
+    :param parts_table: (all) A table of every file of the delta table, partitioned
+        by the release each was written for
+    :param tombstones_table: (all) A table of the key & partition of each row in
+        parts_table which is no longer current
+    :param table_cols: (all) The columns of the view
+    :param key_col: (all) The column uniquely identifying each row
+    :param partition_col: (all) The partition column of parts_table
+    """
+    return base_templates.get_template(
+        "delta_view",
+        PATH,
+        schema_name=schema_name,
+        view_name=view_name,
+        parts_table=parts_table,
+        tombstones_table=tombstones_table,
+        table_cols=table_cols,
+        key_col=key_col,
+        partition_col=partition_col,
+    )
@@ -0,0 +1,598 @@
+"""Helpers for uploading generated parquet to a remote database"""
+
+import concurrent.futures
+import hashlib
+import pathlib
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+import boto3
+from cumulus_library import databases, errors
+
+from cumulus_library_umls import json_utils, metrics_utils
+
+# Placed on the queue once per worker to signal that no more parts are coming
+_DONE = None
+
+# Errors which indicate a problem with the request itself, rather than a transient
+# network/service failure, and so are not worth retrying
+_PERMANENT_ERRORS = (errors.FileUploadError, errors.AWSError)
+
+LEDGER_FILE = "upload_ledger.json"
+
+
+def get_file_hash(path: pathlib.Path) -> str:
+    """Computes the sha256 hash of a file, for files not hashed as they were written"""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024**2):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_remote_filename(file: pathlib.Path) -> str:
+    """Gets the name a file is uploaded under, relative to its table's location
+
+    Hive style partition directories (i.e. `sab=RXNORM/`) are kept, so that the
+    remote copy of a partitioned table has the same layout as the local one.
+
+    :param file: the location of the file to upload
+    """
+    if "=" in file.parent.name:
+        return f"{file.parent.name}/{file.name}"
+    return file.name
+
+
+def get_destination(db: databases.DatabaseBackend) -> str:
+    """Builds a key identifying where a database backend uploads files to
+
+    This only looks at how the backend was configured, so that it can be used
+    without any network requests.
+
+    :param db: the database backend to upload with
+    :returns: a string which differs between backends uploading to different places
+    """
+    attrs = vars(db)
+    return ":".join(
+        str(attrs.get(attr) or "")
+        for attr in ("db_type", "region", "work_group", "s3_staging_dir", "db_file")
+    )
+
+
+def get_s3_client(db: databases.DatabaseBackend):
+    """Creates an S3 client with the same credentials the backend uploads with"""
+    session = boto3.Session(profile_name=db.connection.profile_name)
+    return session.client("s3", region_name=db.region)
+
+
+def remove_stale_files(
+    db: databases.DatabaseBackend, remote_path: str | None, keep: Iterable[str]
+) -> list[str]:
+    """Deletes the files uploaded to a table's remote location which aren't part of it
+
+    Tables are created from every file under their remote location, so files left
+    by an earlier build with a different layout (i.e. a different number of parts,
+    or partitions) would otherwise be read as part of the table.
+
+    :param db: the database backend the files were uploaded with
+    :param remote_path: the remote location of the table's files, as returned when
+        uploading them. Nothing is deleted if this isn't an S3 URL.
+    :param keep: the remote names of the table's current files, relative to
+        remote_path, from get_remote_filename
+    :returns: the remote names of the deleted files
+    """
+    if not remote_path or not remote_path.startswith("s3://"):
+        return []
+    bucket, _, prefix = remote_path.removeprefix("s3://").rstrip("/").partition("/")
+    keep = set(keep)
+    client = get_s3_client(db)
+    stale = []
+    for page in client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=f"{prefix}/"
+    ):
+        for item in page.get("Contents", []):
+            if (name := item["Key"].removeprefix(f"{prefix}/")) not in keep:
+                stale.append(name)
+    # delete_objects takes at most 1000 keys at a time
+    for start in range(0, len(stale), 1000):
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [{"Key": f"{prefix}/{name}"} for name in stale[start : start + 1000]],
+                "Quiet": True,
+            },
+        )
+    return stale
+
+
+class UploadLedger:
+    """A local record of which parquet files have already been uploaded, and where
+
+    Entries are keyed by destination, release, table, and remote file name, and store
+    the sha256 hash of the file along with the remote location it was uploaded to. A
+    file whose hash matches its entry doesn't need to be uploaded again, or even
+    checked against the remote copy.
+
+    Builders on the same host share the ledger, so each change is merged into the
+    file as it is on disk, rather than writing over it with this ledger's entries.
+    """
+
+    def __init__(self, path: pathlib.Path, destination: str):
+        """
+        :param path: the location of the ledger's json file
+        :param destination: a key for the upload location, from get_destination()
+        """
+        self.path = path
+        self.destination = destination
+        self._lock = threading.Lock()
+        self._entries = json_utils.read_json(path) or {}
+
+    def lookup(self, release: str, table: str, file: pathlib.Path, sha256: str) -> dict | None:
+        """Finds the record of a previous upload of a file with identical contents
+
+        :param release: the release the file was generated from
+        :param table: the name of the table the file belongs to
+        :param file: the location of the file
+        :param sha256: the sha256 hash of the file
+        :returns: a dict containing the `remote` location of the uploaded file, or
+            None if these contents haven't been uploaded
+        """
+        with self._lock:
+            entry = (
+                self._entries.get(self.destination, {})
+                .get(str(release), {})
+                .get(table, {})
+                .get(get_remote_filename(file))
+            )
+        if entry is None or entry["sha256"] != sha256:
+            return None
+        return entry
+
+    def record(
+        self, release: str, table: str, file: pathlib.Path, sha256: str, remote: str | None
+    ) -> None:
+        """Records a successful upload, saving the ledger to disk
+
+        :param release: the release the file was generated from
+        :param table: the name of the table the file belongs to
+        :param file: the location of the file
+        :param sha256: the sha256 hash of the file
+        :param remote: the remote location the file was uploaded to
+        """
+
+        def update(entries: dict) -> None:
+            tables = entries.setdefault(self.destination, {}).setdefault(str(release), {})
+            tables.setdefault(table, {})[get_remote_filename(file)] = {
+                "sha256": sha256,
+                "remote": remote,
+            }
+
+        with self._lock:
+            self._entries = json_utils.update_json(self.path, update)
+
+    def forget(self, table: str, names: Iterable[str]) -> None:
+        """Removes the record of files deleted from a table's remote location
+
+        The remote location is shared by every release of a table, so the files are
+        forgotten for each release.
+
+        :param table: the name of the table the files belonged to
+        :param names: the remote names of the deleted files
+        """
+        names = set(names)
+        if not names:
+            return
+
+        def update(entries: dict) -> None:
+            for tables in entries.get(self.destination, {}).values():
+                for name in names & tables.get(table, {}).keys():
+                    del tables[table][name]
+
+        with self._lock:
+            self._entries = json_utils.update_json(self.path, update)
+
+    def carry_forward(self, from_release: str, to_release: str, table: str) -> None:
+        """Copies a table's uploads from one release to another
+
+        This is for files which are reused unchanged by a later release, under the
+        same remote name, so they aren't uploaded again. Entries already recorded for
+        to_release are kept, and lookup() still checks each file's hash.
+
+        :param from_release: the release the files were uploaded for
+        :param to_release: the release reusing the files
+        :param table: the name of the table the files belong to
+        """
+
+        def update(entries: dict) -> None:
+            releases = entries.setdefault(self.destination, {})
+            if previous := releases.get(str(from_release), {}).get(table):
+                tables = releases.setdefault(str(to_release), {})
+                tables[table] = {**previous, **tables.get(table, {})}
+
+        with self._lock:
+            self._entries = json_utils.update_json(self.path, update)
+
+
+def upload_with_retries(
+    db: databases.DatabaseBackend,
+    *,
+    file: pathlib.Path,
+    study: str,
+    topic: str,
+    force_upload: bool = False,
+    retries: int = 3,
+    backoff: float = 1.0,
+    metrics: metrics_utils.BuildMetrics | None = None,
+) -> str | None:
+    """Uploads a single file, retrying transient failures with exponential backoff
+
+    :param db: the database backend to upload with
+    :keyword file: the location of the file to upload
+    :keyword study: the study name used to build the remote path
+    :keyword topic: the table name used to build the remote path
+    :keyword force_upload: if true, upload regardless of what exists remotely
+    :keyword retries: the number of times to retry after a failed attempt
+    :keyword backoff: the number of seconds to wait before the first retry. This
+        doubles with each subsequent retry.
+    :keyword metrics: if provided, retries are counted against the topic's upload
+    :returns: the remote location of the directory the file was uploaded to
+    """
+    for attempt in range(retries + 1):
+        try:
+            return db.upload_file(
+                file=file,
+                study=study,
+                topic=topic,
+                remote_filename=get_remote_filename(file),
+                force_upload=force_upload,
+            )
+        except _PERMANENT_ERRORS:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            if metrics is not None:
+                metrics.add("upload", topic, retries=1)
+            time.sleep(backoff * 2**attempt)
+
+
+def upload_part(
+    db: databases.DatabaseBackend,
+    *,
+    file: pathlib.Path,
+    study: str,
+    topic: str,
+    sha256: str | None = None,
+    ledger: UploadLedger | None = None,
+    release: str | None = None,
+    force_upload: bool = False,
+    retries: int = 3,
+    backoff: float = 1.0,
+    metrics: metrics_utils.BuildMetrics | None = None,
+) -> str | None:
+    """Uploads a single file, unless the ledger shows it was already uploaded
+
+    :param db: the database backend to upload with
+    :keyword file: the location of the file to upload
+    :keyword study: the study name used to build the remote path
+    :keyword topic: the table name used to build the remote path
+    :keyword sha256: the hash of the file, if already known. Otherwise, the file is
+        read to compute it.
+    :keyword ledger: if provided, the record of previous uploads to check & update
+    :keyword release: the release the file was generated from, used as a ledger key
+    :keyword force_upload: if true, upload regardless of the ledger or what exists
+        remotely
+    :keyword retries: the number of times to retry after a failed attempt
+    :keyword backoff: the number of seconds to wait before the first retry
+    :keyword metrics: if provided, the time taken, bytes sent, and whether the file
+        was uploaded or skipped are recorded against the topic's upload
+    :returns: the remote location of the directory the file was uploaded to
+    """
+    metrics = metrics or metrics_utils.BuildMetrics(topic)
+    if ledger is not None:
+        sha256 = sha256 or get_file_hash(file)
+        if not force_upload and (entry := ledger.lookup(release, topic, file, sha256)):
+            metrics.add("upload", topic, parts_skipped=1)
+            return entry["remote"]
+    # Uploads run on their own threads, so only this thread's CPU time is theirs
+    with metrics.measure("upload", topic, cpu_clock=time.thread_time):
+        remote_path = upload_with_retries(
+            db,
+            file=file,
+            study=study,
+            topic=topic,
+            force_upload=force_upload,
+            retries=retries,
+            backoff=backoff,
+            metrics=metrics,
+        )
+    metrics.add("upload", topic, parts_uploaded=1, input_bytes=file.stat().st_size)
+    if ledger is not None:
+        ledger.record(release, topic, file, sha256, remote_path)
+    return remote_path
+
+
+def upload_tables(
+    db: databases.DatabaseBackend,
+    tables: dict[str, list[pathlib.Path]],
+    *,
+    study: str,
+    force_upload: bool = False,
+    workers: int = 4,
+    retries: int = 3,
+    backoff: float = 1.0,
+    hashes: dict[pathlib.Path, str] | None = None,
+    ledger: UploadLedger | None = None,
+    release: str | None = None,
+    metrics: metrics_utils.BuildMetrics | None = None,
+    remove_stale: bool = False,
+) -> dict[str, str | None]:
+    """Uploads the parquet files for a set of tables concurrently
+
+    All files share a single bounded thread pool and database backend. Each file is
+    retried independently, so one flaky request doesn't restart a whole table.
+
+    :param db: the database backend to upload with
+    :param tables: a dict of table names to the parquet files making up that table
+    :keyword study: the study name used to build the remote path
+    :keyword force_upload: if true, upload regardless of what exists remotely
+    :keyword workers: the maximum number of concurrent uploads
+    :keyword retries: the number of times to retry each file after a failure
+    :keyword backoff: the number of seconds to wait before the first retry
+    :keyword hashes: a dict of file paths to their sha256 hashes, for files which
+        were hashed as they were written
+    :keyword ledger: if provided, files already uploaded with the same hash are
+        skipped
+    :keyword release: the release the files were generated from, used as a ledger key
+    :keyword metrics: if provided, each table's upload time & counts are recorded
+    :keyword remove_stale: if true, any other files in a table's remote location are
+        deleted once its files are uploaded, see remove_stale_files
+    :returns: a dict of table names to the remote location of that table's files,
+        suitable for use as the location of a table created from them
+    """
+    remote_paths = {}
+    hashes = hashes or {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {
+            executor.submit(
+                upload_part,
+                db,
+                file=part,
+                study=study,
+                topic=table,
+                sha256=hashes.get(part),
+                ledger=ledger,
+                release=release,
+                force_upload=force_upload,
+                retries=retries,
+                backoff=backoff,
+                metrics=metrics,
+            ): table
+            for table, parts in tables.items()
+            for part in parts
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                table = futures[future]
+                remote_path = future.result()
+                if remote_paths.setdefault(table, remote_path) != remote_path:
+                    raise errors.FileUploadError(
+                        f"Parts of {table} were uploaded to different locations: "
+                        f"{remote_paths[table]}, {remote_path}"
+                    )
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    if remove_stale:
+        for table, parts in tables.items():
+            removed = remove_stale_files(
+                db, remote_paths.get(table), [get_remote_filename(part) for part in parts]
+            )
+            if ledger is not None:
+                ledger.forget(table, removed)
+    return remote_paths
+
+
+def upload_parts(
+    db: databases.DatabaseBackend,
+    parts: list[pathlib.Path],
+    *,
+    study: str,
+    topic: str,
+    **kwargs,
+) -> str | None:
+    """Uploads the parquet files for a single table concurrently
+
+    See upload_tables for available keyword arguments.
+
+    :param db: the database backend to upload with
+    :param parts: the parquet files making up the table
+    :keyword study: the study name used to build the remote path
+    :keyword topic: the table name used to build the remote path
+    :returns: the remote location of the table's files
+    """
+    return upload_tables(db, {topic: parts}, study=study, **kwargs).get(topic)
+
+
+class UploadPipeline:
+    """Uploads parquet files on a pool of threads while more are still being written
+
+    Parts are handed over with put(), which blocks once max_queued parts are waiting,
+    so a fast producer can't get too far ahead of the network. If any upload fails,
+    the remaining queued parts are discarded, the next put() raises, and leaving the
+    context raises a FileUploadError listing the parts which did make it.
+
+    With remove_stale, once a table is finished and its parts uploaded, any other
+    files in its remote location are deleted, see remove_stale_files.
+
+    Usage:
+        with UploadPipeline(db, "umls") as pipeline:
+            for table, path in parts:
+                pipeline.put(table, path)
+            pipeline.finish_table(table)
+        pipeline.remote_paths[table]
+    """
+
+    def __init__(
+        self,
+        db: databases.DatabaseBackend,
+        study: str,
+        *,
+        force_upload: bool = False,
+        workers: int = 1,
+        max_queued: int = 8,
+        retries: int = 3,
+        backoff: float = 1.0,
+        on_table_uploaded: Callable[[str], None] | None = None,
+        ledger: UploadLedger | None = None,
+        release: str | None = None,
+        metrics: metrics_utils.BuildMetrics | None = None,
+        remove_stale: bool = False,
+    ):
+        """
+        :param db: the database backend to upload with
+        :param study: the study name used to build the remote path
+        :keyword force_upload: if true, upload regardless of what exists remotely
+        :keyword workers: the number of upload threads
+        :keyword max_queued: the number of parts that can be waiting for upload before
+            put() blocks
+        :keyword retries: the number of times to retry each file after a failure
+        :keyword backoff: the number of seconds to wait before the first retry
+        :keyword on_table_uploaded: if provided, called with a table name once
+            finish_table() has been called for it and all its parts are uploaded
+        :keyword ledger: if provided, parts already uploaded with the same hash are
+            skipped
+        :keyword release: the release the parts were generated from, used as a
+            ledger key
+        :keyword metrics: if provided, each table's upload time & counts are recorded
+        :keyword remove_stale: if true, the files in a table's remote location which
+            weren't put for it are deleted before on_table_uploaded is called
+        """
+        self.db = db
+        self.study = study
+        self.force_upload = force_upload
+        self.retries = retries
+        self.backoff = backoff
+        self.on_table_uploaded = on_table_uploaded or (lambda table: None)
+        self.ledger = ledger
+        self.release = release
+        self.metrics = metrics
+        self.remove_stale = remove_stale
+        self.remote_paths = {}
+        self.uploaded = []
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._pending = {}
+        self._finished_tables = set()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(max(workers, 1))
+        ]
+
+    def __enter__(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._cancelled.set()
+        self.close()
+        if self.error is not None:
+            uploaded = "\n".join(
+                f"  {table}: {get_remote_filename(path)}" for table, path in self.uploaded
+            )
+            raise errors.FileUploadError(
+                f"Upload of parquet files was cancelled: {self.error}\n"
+                f"Files uploaded before cancellation:\n{uploaded or '  (none)'}"
+            ) from self.error
+        return False
+
+    def put(self, table: str, path: pathlib.Path, sha256: str | None = None) -> None:
+        """Queues a parquet file for upload, blocking if the queue is full
+
+        :param table: the name of the table the file belongs to
+        :param path: the location of the parquet file
+        :param sha256: the hash of the file, if it was computed while writing
+        """
+        with self._lock:
+            self._pending[table] = self._pending.get(table, 0) + 1
+        while True:
+            if self._cancelled.is_set():
+                raise errors.FileUploadError(f"Upload cancelled, not queueing {path.name}")
+            try:
+                self._queue.put((table, path, sha256), timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish_table(self, table: str) -> None:
+        """Marks that no more parts will be queued for a table
+
+        :param table: the name of the table
+        """
+        with self._lock:
+            self._finished_tables.add(table)
+            done = self._pending.get(table, 0) == 0
+        if done:
+            self._finish(table)
+
+    def close(self) -> None:
+        """Waits for all queued parts to finish uploading and stops the workers"""
+        for _ in self._threads:
+            self._queue.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self) -> None:
+        while (item := self._queue.get()) is not _DONE:
+            table, path, sha256 = item
+            if self._cancelled.is_set():
+                # Keep draining, so that a blocked producer can notice the cancellation
+                continue
+            try:
+                remote_path = upload_part(
+                    self.db,
+                    file=path,
+                    study=self.study,
+                    topic=table,
+                    sha256=sha256,
+                    ledger=self.ledger,
+                    release=self.release,
+                    force_upload=self.force_upload,
+                    retries=self.retries,
+                    backoff=self.backoff,
+                    metrics=self.metrics,
+                )
+            except Exception as e:
+                with self._lock:
+                    if self.error is None:
+                        self.error = e
+                self._cancelled.set()
+                continue
+            with self._lock:
+                self.remote_paths[table] = remote_path
+                self.uploaded.append((table, path))
+                self._pending[table] -= 1
+                done = self._pending[table] == 0 and table in self._finished_tables
+            if done:
+                try:
+                    self._finish(table)
+                except Exception as e:
+                    with self._lock:
+                        if self.error is None:
+                            self.error = e
+                    self._cancelled.set()
+
+    def _finish(self, table: str) -> None:
+        """Removes a table's stale remote files, once all its parts are uploaded"""
+        if self.remove_stale:
+            with self._lock:
+                keep = [get_remote_filename(path) for name, path in self.uploaded if name == table]
+            removed = remove_stale_files(self.db, self.remote_paths.get(table), keep)
+            if self.ledger is not None:
+                self.ledger.forget(table, removed)
+        self.on_table_uploaded(table)
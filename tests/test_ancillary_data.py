@@ -2,7 +2,7 @@ import pathlib
 
 from cumulus_library import base_utils, databases, db_config
 
-from cumulus_library_umls import umls_builder
+from cumulus_library_umls import icd10_utils, release_utils, umls_builder
 
 
 def test_ancillary_tables(tmp_path):
@@ -71,12 +71,13 @@ def test_ancillary_tables(tmp_path):
             FROM read_parquet('{tmp_path}/{file}/{file}_0.parquet')"""
             )
 
-    with open(
-        pathlib.Path(__file__).parent.parent / "cumulus_library_umls/ancillary_tables.sql"
-    ) as f:
-        queries = f.read().split(";")
-        for query in queries:
-            cursor.execute(query)
+    # The ICD-10 tables are built from the converted parquet, rather than in SQL
+    tables = icd10_utils.build_tables(
+        release_utils.read_rows(tmp_path, "MRCONSO", icd10_utils.CONCEPT_COLUMNS, {"ICD10CM"}),
+        release_utils.read_rows(tmp_path, "MRREL", icd10_utils.RELATION_COLUMNS, {"ICD10CM"}),
+    )
+    for name, df in tables.items():
+        cursor.register(f"umls__{name}", icd10_utils.to_arrow(name, df))
     tree = cursor.execute("SELECT  * FROM umls__icd10_tree ORDER BY rui ASC").fetchall()
     assert len(tree) == 584
     assert tree[0] == (
@@ -99,7 +100,7 @@ def test_ancillary_tables(tmp_path):
     )
 
     hierarchy = cursor.execute(
-        "SELECT  * FROM umls__icd10_hierarchy ORDER BY subcategory_2_code ASC"
+        "SELECT  * FROM umls__icd10_hierarchy ORDER BY subcategory_2_code ASC, block_code ASC"
     ).fetchall()
     assert len(hierarchy) == 438
     assert hierarchy[0] == (
@@ -0,0 +1,43 @@
+import pathlib
+import pickle
+import zipfile
+
+import pytest
+
+from cumulus_library_umls import archive_utils
+
+ZIP_PATH = pathlib.Path(__file__).parent / "test_data/2000AA.zip"
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def test_list_members():
+    members = archive_utils.list_members(ZIP_PATH, ".ctl")
+    assert members == [archive_utils.ZipMember(ZIP_PATH, "2000AA/META/TESTTABLE.ctl")]
+    ctl = members[0]
+    assert ctl.name == "TESTTABLE.ctl"
+    assert ctl.stem == "TESTTABLE"
+    rrf = ctl.with_name("TESTTABLE.RRF")
+    assert rrf == archive_utils.ZipMember(ZIP_PATH, "2000AA/META/TESTTABLE.RRF")
+    # Members are sent to conversion worker processes
+    assert pickle.loads(pickle.dumps(rrf)) == rrf
+
+
+def test_member_matches_extracted_file():
+    member = archive_utils.ZipMember(ZIP_PATH, "2000AA/META/TESTTABLE.RRF")
+    extracted = META_PATH / "TESTTABLE.RRF"
+    assert member.stat().st_size == extracted.stat().st_size
+    with member.open("rb") as f:
+        assert f.read() == extracted.read_bytes()
+    with member.open() as f:
+        assert f.readlines() == extracted.read_text().splitlines(keepends=True)
+    with pytest.raises(ValueError):
+        member.open("w")
+
+
+def test_find_archive(tmp_path):
+    assert archive_utils.find_archive(tmp_path / "missing") is None
+    (tmp_path / "partial.zip").write_bytes(b"PK\x03\x04")
+    assert archive_utils.find_archive(tmp_path) is None
+    with zipfile.ZipFile(tmp_path / "release.zip", "w") as archive:
+        archive.writestr("2000AA/META/MRSTY.ctl", "")
+    assert archive_utils.find_archive(tmp_path) == tmp_path / "release.zip"
@@ -0,0 +1,58 @@
+import pandas
+
+from benchmarks import run, synthetic
+from cumulus_library_umls import parquet_utils, umls_builder
+
+
+def test_generate_release(tmp_path):
+    meta_path = synthetic.generate_release(tmp_path, dict.fromkeys(synthetic.TABLES, 250))
+    builder = umls_builder.UMLSBuilder()
+    tables = {}
+    for name in synthetic.TABLES:
+        with open(meta_path / f"{name}.ctl") as f:
+            datasource, table = builder.parse_ctl_file(f.readlines())
+        assert datasource == f"{name}.RRF"
+        df = parquet_utils.read_rrf_dataframe(meta_path / datasource, table)
+        assert len(df) == 250
+        assert list(df.columns) == table["headers"]
+        tables[name] = table
+    # Releases are reproducible from their seed
+    again = synthetic.generate_release(tmp_path / "again", {"MRCONSO": 250})
+    assert (again / "MRCONSO.RRF").read_bytes() == (meta_path / "MRCONSO.RRF").read_bytes()
+    parts = builder.create_parquet(
+        meta_path / "MRCONSO.RRF", tmp_path / "parquet", tables["MRCONSO"]
+    )
+    df = pandas.read_parquet(parts[0][0])
+    # Free text has a long tail of lengths
+    assert df["STR"].str.len().max() > df["STR"].str.len().median()
+
+
+def test_run(tmp_path):
+    meta_path = synthetic.generate_release(tmp_path / "release", {"MRSTY": 1000})
+    results = run.run(meta_path, tmp_path / "work", engine="arrow")
+    assert list(results) == ["MRSTY"]
+    assert results["MRSTY"]["convert"]["rows"] == 1000
+    assert results["MRSTY"]["convert"]["peak_rss_mb"] > 0
+    assert results["MRSTY"]["convert"]["output_bytes"] > 0
+    assert list((tmp_path / "work/remote/umls/MRSTY").iterdir())
+    assert run.compare(results, results, 0.2) == []
+
+
+def test_compare():
+    baseline = {
+        "MRCONSO": {
+            "convert": {"rows": 100, "seconds": 1.0, "rows_per_sec": 100, "peak_rss_mb": 100},
+            "upload": {"seconds": 1.0, "mb_per_sec": 10},
+        }
+    }
+    results = {
+        "MRCONSO": {
+            "convert": {"rows": 100, "seconds": 2.0, "rows_per_sec": 50, "peak_rss_mb": 110},
+            "upload": {"seconds": 0.5, "mb_per_sec": 20},
+        },
+        "MRREL": {"convert": {"rows_per_sec": 1}},
+    }
+    assert run.compare(results, baseline, 0.2) == [
+        "MRCONSO convert rows_per_sec: 50 vs baseline 100 (50% worse)"
+    ]
+    assert len(run.compare(results, baseline, 0.05)) == 2
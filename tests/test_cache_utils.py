@@ -0,0 +1,152 @@
+import fcntl
+import os
+import pathlib
+
+import pytest
+
+from cumulus_library_umls import cache_utils, release_utils
+
+
+def write(path: pathlib.Path, size: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+
+
+def get_artifacts(base_path: pathlib.Path) -> list[str]:
+    return sorted(
+        f"{kind}/{path.name}"
+        for kind in cache_utils.ARTIFACTS
+        for path in (base_path / kind).iterdir()
+    )
+
+
+def make_cache(base_path: pathlib.Path, releases: list[str], budget: int):
+    """Writes 100 bytes of download & 10 bytes of parquet per release, built in order"""
+    cache = cache_utils.ReleaseCache(base_path, budget)
+    for release in releases:
+        write(base_path / f"downloads/{release}/META/MRCONSO.RRF", 100)
+        write(base_path / f"generated_parquet/{release}/MRCONSO/MRCONSO_0.parquet", 10)
+        cache.record_build(release)
+    return cache
+
+
+def test_evict_order(tmp_path):
+    # Built out of release order, so 2000AA is the least recently built
+    cache = make_cache(tmp_path, ["2000AA", "1999AA", "2000AB", "2001AA"], 330)
+    assert cache.evict({"2001AA"}) == []
+
+    # Downloads go first, least recently built first
+    cache.budget = 300
+    evicted = cache.evict({"2001AA"})
+    assert [(artifact.kind, artifact.release) for artifact in evicted] == [("downloads", "2000AA")]
+    cache.budget = 30
+    evicted = cache.evict({"2001AA"})
+    assert [(artifact.kind, artifact.release) for artifact in evicted] == [
+        ("downloads", "1999AA"),
+        ("downloads", "2000AB"),
+    ]
+    # ...then parquet
+    cache.budget = 15
+    evicted = cache.evict({"2001AA"})
+    assert [(artifact.kind, artifact.release) for artifact in evicted] == [
+        ("generated_parquet", "2000AA"),
+        ("generated_parquet", "1999AA"),
+    ]
+    assert get_artifacts(tmp_path) == [
+        "downloads/2001AA",
+        "generated_parquet/2000AB",
+        "generated_parquet/2001AA",
+    ]
+    # Releases with nothing left are dropped from the index
+    cache = cache_utils.ReleaseCache(tmp_path)
+    assert sorted(cache.index["last_built"]) == ["2000AB", "2001AA"]
+    assert cache.index["current"] == "2001AA"
+
+    # Kept releases are never evicted, whatever the budget
+    cache.evict({"2000AB", "2001AA"})
+    assert get_artifacts(tmp_path) == [
+        "downloads/2001AA",
+        "generated_parquet/2000AB",
+        "generated_parquet/2001AA",
+    ]
+    cache.evict({"2001AA"})
+    assert get_artifacts(tmp_path) == ["downloads/2001AA", "generated_parquet/2001AA"]
+
+
+def test_evict_kinds(tmp_path):
+    cache = make_cache(tmp_path, ["2000AA", "2000AB"], 0)
+    cache.evict({"2000AB"}, kinds=(cache_utils.DOWNLOADS_DIR,))
+    assert get_artifacts(tmp_path) == [
+        "downloads/2000AB",
+        "generated_parquet/2000AA",
+        "generated_parquet/2000AB",
+    ]
+
+
+def test_evict_hard_links(tmp_path):
+    cache = make_cache(tmp_path, ["2000AA", "2000AB"], 15)
+    # A delta table in 2000AB reusing a file of 2000AA costs nothing extra to keep
+    write(tmp_path / "generated_parquet/2000AA/MRREL/MRREL_0.parquet", 50)
+    os.link(
+        tmp_path / "generated_parquet/2000AA/MRREL/MRREL_0.parquet",
+        tmp_path / "generated_parquet/2000AB/MRREL_0.parquet",
+    )
+    cache.evict({"2000AB"})
+    assert get_artifacts(tmp_path) == [
+        "downloads/2000AB",
+        "generated_parquet/2000AA",
+        "generated_parquet/2000AB",
+    ]
+    cache.budget = 5
+    cache.evict({"2000AB"})
+    assert get_artifacts(tmp_path) == ["downloads/2000AB", "generated_parquet/2000AB"]
+    assert (tmp_path / "generated_parquet/2000AB/MRREL_0.parquet").stat().st_size == 50
+
+
+def test_evict_only_releases(tmp_path):
+    cache = make_cache(tmp_path, ["2000AA", "2000AB"], 0)
+    write(tmp_path / "generated_parquet/scratch/MRCONSO_0.parquet", 10)
+    cache.evict({"2000AB"})
+    assert get_artifacts(tmp_path) == [
+        "downloads/2000AB",
+        "generated_parquet/2000AB",
+        "generated_parquet/scratch",
+    ]
+
+
+def test_evict_skips_locked(tmp_path):
+    cache = make_cache(tmp_path, ["1999AA", "2000AA", "2000AB"], 0)
+    # Another builder is building 2000AA, and copying a stored table into 1999AA
+    other = cache_utils.ReleaseCache(tmp_path)
+    other.lock("2000AA")
+    with (tmp_path / "generated_parquet/1999AA/.MRCONSO.lock").open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        cache.evict({"2000AB"})
+    assert get_artifacts(tmp_path) == [
+        "downloads/1999AA",
+        "downloads/2000AA",
+        "downloads/2000AB",
+        "generated_parquet/1999AA",
+        "generated_parquet/2000AA",
+        "generated_parquet/2000AB",
+    ]
+    other.unlock()
+    cache.evict({"2000AB"})
+    assert get_artifacts(tmp_path) == ["downloads/2000AB", "generated_parquet/2000AB"]
+
+
+def test_current_release(tmp_path):
+    make_cache(tmp_path, ["2000AB", "2000AA"], 0)
+    assert cache_utils.get_current_release(tmp_path) == "2000AA"
+    # The release last built is read from, rather than the latest on disk
+    parquet_path = tmp_path / "generated_parquet"
+    assert release_utils.get_release_path(parquet_path, ["MRCONSO"]).name == "2000AA"
+    # ...unless it doesn't have the tables needed
+    write(parquet_path / "2000AB/MRREL/MRREL_0.parquet", 10)
+    assert release_utils.get_release_path(parquet_path, ["MRREL"]).name == "2000AB"
+    assert cache_utils.get_current_release(tmp_path / "empty") is None
+
+
+def test_negative_budget(tmp_path):
+    with pytest.raises(ValueError, match="can't be negative"):
+        cache_utils.ReleaseCache(tmp_path, -1)
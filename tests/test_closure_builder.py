@@ -0,0 +1,65 @@
+import pathlib
+from unittest import mock
+
+from cumulus_library import base_utils, db_config, study_manifest
+from pyarrow import parquet
+
+from cumulus_library_umls import closure_builder, metrics_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def get_config(options: dict) -> base_utils.StudyConfig:
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="umls", options=options)
+    config.db.upload_file.side_effect = (
+        lambda *, file, study, topic, remote_filename=None, force_upload=False: (
+            f"s3://bucket/{study}/{topic}"
+        )
+    )
+    return config
+
+
+def get_manifest() -> study_manifest.StudyManifest:
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    manifest._study_prefix = "umls"
+    return manifest
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_closure_tables(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    builder = umls_builder.UMLSBuilder()
+    with open(META_PATH / "MRREL.ctl") as f:
+        datasource, table = builder.parse_ctl_file(f.readlines())
+    builder.create_parquet(META_PATH / datasource, tmp_path / "generated_parquet/2000AA", table)
+    config = get_config({"closure_sabs": "ICD10CM", "parquet_compression": "zstd"})
+
+    builder = closure_builder.ClosureBuilder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=config, manifest=get_manifest())
+    assert config.db.upload_file.call_count == 1
+    assert len(builder.queries) == 1
+    assert "`umls`.`umls__icd10cm_closure`" in builder.queries[0]
+    assert "depth Integer" in builder.queries[0]
+    assert "LOCATION 's3://bucket/umls/icd10cm_closure'" in builder.queries[0]
+    path = tmp_path / "generated_parquet/2000AA/icd10cm_closure/icd10cm_closure_0.parquet"
+    metadata = parquet.read_metadata(path)
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+    ancestors = parquet.read_table(path)["ancestor_cui"].to_pylist()
+    assert ancestors == sorted(ancestors)
+    message = log_transaction.call_args.kwargs["message"]
+    assert message.startswith("Closure tables from UMLS version 2000AA: read ")
+    assert message.endswith("ICD10CM concepts are in cycles")
+    assert list((tmp_path / metrics_utils.REPORT_DIR).glob("closure_2000AA_*.json"))
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_closure_tables_not_configured(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    builder = closure_builder.ClosureBuilder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=get_config({}), manifest=get_manifest())
+    assert builder.queries == []
+    assert not log_transaction.called
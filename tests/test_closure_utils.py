@@ -0,0 +1,119 @@
+import collections
+import pathlib
+
+import pandas
+from cumulus_library import base_utils
+
+from cumulus_library_umls import closure_utils, release_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def get_edges(pairs: list[tuple[str, str]]) -> pandas.DataFrame:
+    return pandas.DataFrame(pairs, columns=["parent", "child"])
+
+
+def search(edges: pandas.DataFrame) -> dict[tuple[str, str], int]:
+    """Finds the closure the slow way, with a breadth first search from each concept"""
+    children = collections.defaultdict(list)
+    for parent, child in zip(edges["parent"], edges["child"], strict=True):
+        children[parent].append(child)
+    depths = {}
+    for ancestor in list(children):
+        queue = collections.deque([(ancestor, 0)])
+        seen = {ancestor}
+        while queue:
+            node, depth = queue.popleft()
+            for child in children[node]:
+                if child not in seen:
+                    seen.add(child)
+                    depths[(ancestor, child)] = depth + 1
+                    queue.append((child, depth + 1))
+    return depths
+
+
+def test_get_closure():
+    edges = get_edges(
+        [
+            ("A", "B"),
+            ("A", "C"),
+            ("B", "D"),
+            ("C", "D"),
+            ("D", "E"),
+            # A shortcut, so E is both 1 & 3 below A
+            ("A", "E"),
+            # A cycle, entered from E
+            ("E", "F"),
+            ("F", "G"),
+            ("G", "F"),
+        ]
+    )
+    closure, cyclic = closure_utils.get_closure(edges)
+    pairs = {
+        (row.ancestor_cui, row.descendant_cui): row.depth
+        for row in closure.to_pandas().itertuples()
+    }
+    assert pairs == search(edges)
+    assert pairs[("A", "E")] == 1
+    assert pairs[("A", "G")] == 3
+    assert pairs[("G", "F")] == 1
+    assert ("F", "F") not in pairs
+    assert cyclic == ["F", "G"]
+    assert closure.schema == closure_utils.SCHEMA
+    # Rows are sorted by ancestor, for row group statistics to be useful
+    ancestors = closure["ancestor_cui"].to_pylist()
+    assert ancestors == sorted(ancestors)
+
+
+def test_get_closure_empty():
+    closure, cyclic = closure_utils.get_closure(get_edges([]))
+    assert closure.num_rows == 0
+    assert closure.schema == closure_utils.SCHEMA
+    assert cyclic == []
+
+
+def test_get_closure_matches_search(tmp_path):
+    with open(META_PATH / "MRREL.ctl") as f:
+        datasource, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    umls_builder.UMLSBuilder().create_parquet(META_PATH / datasource, tmp_path, table)
+    relations = release_utils.read_rows(
+        tmp_path, "MRREL", closure_utils.RELATION_COLUMNS, {"ICD10CM"}
+    )
+    config = closure_utils.ClosureConfig(sab="ICD10CM", rels={"CHD"}, relas=set())
+    edges = closure_utils.get_edges(relations, config)
+    assert len(edges) == len(
+        relations[relations["REL"] == "CHD"][["CUI1", "CUI2"]].drop_duplicates()
+    )
+    closure, cyclic = closure_utils.get_closure(edges)
+    expected = search(edges)
+    assert len(closure) == len(expected)
+    assert {
+        (row.ancestor_cui, row.descendant_cui): row.depth
+        for row in closure.to_pandas().itertuples()
+    } == expected
+    # Concepts shared by more than one level of ICD-10 codes are their own ancestor
+    loops = {
+        parent
+        for parent, child in zip(edges["parent"], edges["child"], strict=True)
+        if parent == child
+    }
+    assert cyclic == sorted(
+        {ancestor for ancestor, descendant in expected if (descendant, ancestor) in expected}
+        | loops
+    )
+    assert cyclic
+
+
+def test_get_closure_configs():
+    config = base_utils.StudyConfig(db=None, schema="umls", options={})
+    assert closure_utils.get_closure_configs(config) == []
+    config.options = {
+        "closure_sabs": "SNOMEDCT_US, RXNORM",
+        "closure_relas": "isa",
+        "RXNORM.closure_rels": "CHD,RN",
+    }
+    assert closure_utils.get_closure_configs(config) == [
+        closure_utils.ClosureConfig(sab="RXNORM", rels={"CHD", "RN"}, relas={"isa"}),
+        closure_utils.ClosureConfig(sab="SNOMEDCT_US", rels={"CHD"}, relas={"isa"}),
+    ]
+    assert closure_utils.get_table_name("MED-RT") == "med_rt_closure"
@@ -1,110 +1,5 @@
--- A collection of convenience views for UMLS data
-
--- Selecting only child relationships FROM mrrel
-CREATE TABLE IF NOT EXISTS umls__mrrel_drug_is_a AS
-SELECT
-    cui1,
-    aui1,
-    stype1,
-    rel,
-    cui2,
-    aui2,
-    stype2,
-    rela,
-    rui,
-    srui,
-    sab,
-    sl,
-    rg,
-    dir,
-    suppress,
-    cvf
-FROM umls__mrrel
-WHERE (
-    rel = 'CHD'
-    OR rela IN (
-        'isa',
-        'tradename_of',
-        'has_tradename',
-        'has_basis_of_strength_substance'
-    )
-)
-AND rel NOT IN ('RB', 'PAR');
-
--- Selecting only drug-related concepts FROM mrconso
-CREATE TABLE IF NOT EXISTS umls__mrconso_drugs AS
-SELECT
-    cui,
-    lat,
-    ts,
-    lui,
-    stt,
-    sui,
-    ispref,
-    aui,
-    saui,
-    scui,
-    sdui,
-    sab,
-    tty,
-    code,
-    str
-FROM umls__mrconso
-WHERE sab IN (
-    'ATC',
-    'CVX',
-    'DRUGBANK',
-    'GS',
-    'MED-RT',
-    'MMSL',
-    'MMX',
-    'MTHCMSFRF',
-    'MTHSPL',
-    'NDDF', 'RXNORM', 'SNOMEDCT_US', 'USP', 'VANDF'
-);
-
--- ICD-10CM convenience views
-
-CREATE TABLE IF NOT EXISTS umls__mrconso_icd10cm AS
-SELECT
-    cui,
-    lat,
-    ts,
-    lui,
-    stt,
-    sui,
-    ispref,
-    aui,
-    saui,
-    scui,
-    sdui,
-    sab,
-    tty,
-    code,
-    str
-FROM umls__mrconso
-WHERE sab = 'ICD10CM';
-
-CREATE TABLE IF NOT EXISTS umls__mrrel_icd10cm AS
-SELECT
-    cui1,
-    aui1,
-    stype1,
-    rel,
-    cui2,
-    aui2,
-    stype2,
-    rela,
-    rui,
-    srui,
-    sab,
-    sl,
-    rg,
-    dir,
-    suppress,
-    cvf
-FROM umls__mrrel
-WHERE sab = 'ICD10CM';
+-- The ICD-10 tables as they were built in SQL, before icd10_utils replaced them.
+-- Kept to check its output against, and run after slice_tables.sql.
 
 -- The following views slice out individual ICD layers.
 -- This lines up with how a human might traverse the nomenclature to find
@@ -440,4 +335,4 @@ LEFT JOIN umls__icd10_tree AS c
     ON
         p.cui2 = c.cui1
         AND length(c.code) = 8
-        AND c.code LIKE concat(p.subcategory_1_code, '%')
+        AND c.code LIKE concat(p.subcategory_1_code, '%');
@@ -0,0 +1,108 @@
+-- The slice tables as they were built in SQL, before slice_utils replaced them.
+-- Kept to check the slices written during conversion against.
+
+-- Selecting only child relationships FROM mrrel
+CREATE TABLE umls__mrrel_drug_is_a AS
+SELECT
+    cui1,
+    aui1,
+    stype1,
+    rel,
+    cui2,
+    aui2,
+    stype2,
+    rela,
+    rui,
+    srui,
+    sab,
+    sl,
+    rg,
+    dir,
+    suppress,
+    cvf
+FROM umls__mrrel
+WHERE (
+    rel = 'CHD'
+    OR rela IN (
+        'isa',
+        'tradename_of',
+        'has_tradename',
+        'has_basis_of_strength_substance'
+    )
+)
+AND rel NOT IN ('RB', 'PAR');
+
+-- Selecting only drug-related concepts FROM mrconso
+CREATE TABLE umls__mrconso_drugs AS
+SELECT
+    cui,
+    lat,
+    ts,
+    lui,
+    stt,
+    sui,
+    ispref,
+    aui,
+    saui,
+    scui,
+    sdui,
+    sab,
+    tty,
+    code,
+    str
+FROM umls__mrconso
+WHERE sab IN (
+    'ATC',
+    'CVX',
+    'DRUGBANK',
+    'GS',
+    'MED-RT',
+    'MMSL',
+    'MMX',
+    'MTHCMSFRF',
+    'MTHSPL',
+    'NDDF', 'RXNORM', 'SNOMEDCT_US', 'USP', 'VANDF'
+);
+
+-- ICD-10CM convenience views
+
+CREATE TABLE umls__mrconso_icd10cm AS
+SELECT
+    cui,
+    lat,
+    ts,
+    lui,
+    stt,
+    sui,
+    ispref,
+    aui,
+    saui,
+    scui,
+    sdui,
+    sab,
+    tty,
+    code,
+    str
+FROM umls__mrconso
+WHERE sab = 'ICD10CM';
+
+CREATE TABLE umls__mrrel_icd10cm AS
+SELECT
+    cui1,
+    aui1,
+    stype1,
+    rel,
+    cui2,
+    aui2,
+    stype2,
+    rela,
+    rui,
+    srui,
+    sab,
+    sl,
+    rg,
+    dir,
+    suppress,
+    cvf
+FROM umls__mrrel
+WHERE sab = 'ICD10CM';
@@ -0,0 +1,192 @@
+import os
+import pathlib
+from unittest import mock
+
+import pandas
+import pyarrow.parquet
+import pytest
+
+from cumulus_library_umls import delta_utils, parquet_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+# Row positions & columns of MRCONSO.RRF
+AUI, STR = 7, 14
+
+
+def get_table(name: str) -> dict:
+    with open(META_PATH / f"{name}.ctl") as f:
+        _, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    return table
+
+
+def write_release(tmp_path: pathlib.Path, release: str, lines: list[str]) -> pathlib.Path:
+    rrf_path = tmp_path / f"META_{release}/MRCONSO.RRF"
+    rrf_path.parent.mkdir()
+    rrf_path.write_text("".join(lines))
+    return rrf_path
+
+
+def change(line: str, column: int, value: str) -> str:
+    fields = line.rstrip("\n").split("|")
+    fields[column] = value
+    return "|".join(fields) + "\n"
+
+
+def convert(tmp_path, release, lines, base=None, table=None):
+    table = delta_utils.delta_table(table or get_table("MRCONSO"), "AUI", base)
+    rrf_path = write_release(tmp_path, release, lines)
+    parts = delta_utils.convert_rrf_delta(
+        rrf_path, tmp_path / release, table, release=release, chunksize=100
+    )
+    return rrf_path, parts
+
+
+def read_delta(parquet_path: pathlib.Path) -> pandas.DataFrame:
+    """Reads a delta table the way its view does: every file, minus tombstones"""
+    frames = []
+    for path in sorted((parquet_path / "MRCONSO").glob("*/*.parquet")):
+        df = pandas.read_parquet(path)
+        df["umls_release"] = delta_utils.get_generation(path.relative_to(path.parents[1]))
+        frames.append(df)
+    rows = pandas.concat(frames, ignore_index=True)
+    tombstones = pandas.read_parquet(delta_utils.get_tombstone_path(parquet_path, "MRCONSO"))
+    dead = rows.merge(tombstones, on=["AUI", "umls_release"], how="left", indicator=True)
+    rows = rows[(dead["_merge"] == "left_only").to_numpy()]
+    return rows.drop(columns="umls_release").sort_values("AUI").reset_index(drop=True)
+
+
+def read_full(tmp_path: pathlib.Path, rrf_path: pathlib.Path) -> pandas.DataFrame:
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "full", get_table("MRCONSO"), engine="arrow")
+    df = pandas.read_parquet(tmp_path / "full/MRCONSO")
+    return df.sort_values("AUI").reset_index(drop=True)
+
+
+def test_delta_reuses_previous_release(tmp_path, capsys):
+    lines = (META_PATH / "MRCONSO.RRF").read_text().splitlines(keepends=True)
+    _, first = convert(tmp_path, "2000AA", lines)
+    assert len(first) == 6
+    assert (tmp_path / f"2000AA/MRCONSO/{delta_utils.INDEX_FILE}").exists()
+    assert (
+        pyarrow.parquet.read_table(
+            delta_utils.get_tombstone_path(tmp_path / "2000AA", "MRCONSO")
+        ).num_rows
+        == 0
+    )
+
+    new = list(lines)
+    changed = [line.split("|")[AUI] for line in new[10:13]]
+    for i in range(10, 13):
+        new[i] = change(new[i], STR, "changed")
+    deleted = [line.split("|")[AUI] for line in new[250:256]]
+    del new[250:256]
+    new.append(change(change(lines[0], AUI, "A99999999"), STR, "added"))
+    rrf_path, second = convert(tmp_path, "2000AB", new, base=tmp_path / "2000AA/MRCONSO")
+    assert (
+        "MRCONSO since 2000AA: 534 rows unchanged, 3 rows updated, 1 rows added, "
+        "6 rows removed" in capsys.readouterr().out
+    )
+
+    reused = [path for path, _ in second if path.parent.name == "umls_release=2000AA"]
+    written = [path for path, _ in second if path.parent.name == "umls_release=2000AB"]
+    assert len(reused) == 6
+    # Reused files are linked, not copied or rewritten
+    old = tmp_path / "2000AA/MRCONSO/umls_release=2000AA/MRCONSO_0.parquet"
+    assert os.path.samefile(reused[0], old)
+    assert dict(second)[reused[0]] == dict(first)[old]
+    # Only the changed & added rows were written
+    assert len(written) == 1
+    assert pyarrow.parquet.read_table(written[0]).num_rows == 4
+    tombstones = pandas.read_parquet(delta_utils.get_tombstone_path(tmp_path / "2000AB", "MRCONSO"))
+    assert sorted(tombstones["AUI"]) == sorted(changed + deleted)
+    assert set(tombstones["umls_release"]) == {"2000AA"}
+    pandas.testing.assert_frame_equal(
+        read_delta(tmp_path / "2000AB"), read_full(tmp_path, rrf_path)
+    )
+    live = delta_utils.read_live_rows(
+        tmp_path / "2000AB", "MRCONSO", "AUI", get_table("MRCONSO")["headers"]
+    )
+    pandas.testing.assert_frame_equal(
+        live.to_pandas().sort_values("AUI").reset_index(drop=True), read_delta(tmp_path / "2000AB")
+    )
+    table = delta_utils.delta_table(get_table("MRCONSO"), "AUI", None)
+    assert parquet_utils.is_converted(rrf_path, tmp_path / "2000AB", "2000AB", table["profile"])
+
+
+def test_delta_chain_rewrites_mostly_stale_files(tmp_path):
+    lines = (META_PATH / "MRCONSO.RRF").read_text().splitlines(keepends=True)
+    convert(tmp_path, "2000AA", lines)
+    deleted = lines[5]
+    second = [line for line in lines if line != deleted]
+    convert(tmp_path, "2000AB", second, base=tmp_path / "2000AA/MRCONSO")
+
+    # Most of the first file changes, and the deleted row comes back unchanged
+    third = [change(line, STR, "changed") if 0 < i < 80 else line for i, line in enumerate(second)]
+    third.insert(5, deleted)
+    rrf_path, parts = convert(tmp_path, "2000AC", third, base=tmp_path / "2000AB/MRCONSO")
+    paths = [path.relative_to(tmp_path / "2000AC/MRCONSO").as_posix() for path, _ in parts]
+    assert "umls_release=2000AA/MRCONSO_0.parquet" not in paths
+    assert "umls_release=2000AA/MRCONSO_1.parquet" in paths
+    tombstones = pandas.read_parquet(delta_utils.get_tombstone_path(tmp_path / "2000AC", "MRCONSO"))
+    # The first file isn't reused, so none of its rows need tombstones
+    assert len(tombstones) == 0
+    pandas.testing.assert_frame_equal(
+        read_delta(tmp_path / "2000AC"), read_full(tmp_path, rrf_path)
+    )
+
+
+def test_delta_matches_key_and_hash(tmp_path, capsys):
+    lines = (META_PATH / "MRCONSO.RRF").read_text().splitlines(keepends=True)
+    real_hash_rows = delta_utils.hash_rows
+
+    def hash_rows_without_key(rows, table):
+        # Rows whose other columns match then share a hash, as if they collided
+        headers = [header for header in table["headers"] if header != "AUI"]
+        return real_hash_rows(rows, {**table, "headers": headers})
+
+    with mock.patch("cumulus_library_umls.delta_utils.hash_rows", hash_rows_without_key):
+        convert(tmp_path, "2000AA", lines)
+        new = list(lines)
+        new[3] = change(new[3], AUI, "A99999999")
+        rrf_path, _ = convert(tmp_path, "2000AB", new, base=tmp_path / "2000AA/MRCONSO")
+    # A row only matches the previous release if its identifier does too
+    assert "542 rows unchanged, 0 rows updated, 1 rows added, 1 rows removed" in (
+        capsys.readouterr().out
+    )
+    pandas.testing.assert_frame_equal(
+        read_delta(tmp_path / "2000AB"), read_full(tmp_path, rrf_path)
+    )
+
+
+def test_delta_ignores_base_with_other_profile(tmp_path):
+    lines = (META_PATH / "MRCONSO.RRF").read_text().splitlines(keepends=True)
+    convert(tmp_path, "2000AA", lines)
+    table = parquet_utils.set_write_options(get_table("MRCONSO"), {"compression": "zstd"})
+    _, parts = convert(tmp_path, "2000AB", lines, base=tmp_path / "2000AA/MRCONSO", table=table)
+    assert {path.parent.name for path, _ in parts} == {"umls_release=2000AB"}
+
+
+def test_delta_table_needs_key():
+    table = {"headers": ["CUI"], "dtype": {"CUI": "string"}, "parquet_types": ["String"]}
+    with pytest.raises(ValueError):
+        delta_utils.delta_table(table, "AUI", None)
+
+
+def test_find_base(tmp_path, capsys):
+    lines = (META_PATH / "MRCONSO.RRF").read_text().splitlines(keepends=True)
+    convert(tmp_path, "2000AA", lines)
+    parquet_path = tmp_path / "parquet"
+    (parquet_path / "2000AA").mkdir(parents=True)
+    os.rename(tmp_path / "2000AA/MRCONSO", parquet_path / "2000AA/MRCONSO")
+    # Directories which aren't releases sort between releases too, i.e. a store
+    (parquet_path / "2000AA_store/MRCONSO").mkdir(parents=True)
+    (parquet_path / "2000AA_store/MRCONSO" / parquet_utils.MANIFEST_FILE).write_text("{}")
+    # A later release whose conversion was interrupted, or partly evicted
+    (parquet_path / "2000AB/MRCONSO").mkdir(parents=True)
+    (parquet_path / "2000AB/MRCONSO/MRCONSO_0.parquet").write_bytes(b"partial")
+
+    assert delta_utils.find_base(parquet_path, "2000AC", "MRCONSO") == (
+        parquet_path / "2000AA/MRCONSO"
+    )
+    assert delta_utils.find_base(parquet_path, "2000AC", "MRREL") is None
+    assert delta_utils.find_base(parquet_path, "2000AA", "MRCONSO") is None
+    assert "copy of MRCONSO, so it is converted in full" in capsys.readouterr().out
@@ -0,0 +1,177 @@
+import http.server
+import pathlib
+import re
+import struct
+import threading
+import zipfile
+
+import pytest
+from cumulus_library import errors
+
+from cumulus_library_umls import download_utils
+
+ARCHIVE = pathlib.Path(__file__).parent / "test_data/2000AA.zip"
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the test archive, optionally with range requests, failures & corruption"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        server.requests.append(self.headers.get("Range"))
+        if not (server.ranges and match):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        first, last = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+        if first in server.failures:
+            server.failures.discard(first)
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+        self.wfile.write(data[first : last + 1])
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    server.data = ARCHIVE.read_bytes()
+    server.ranges = True
+    server.failures = set()
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/2000AA.zip"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download(server, path: pathlib.Path, **kwargs) -> pathlib.Path:
+    return download_utils.download_file(
+        server.url, path / "2000AA.zip", chunk_size=100, backoff=0, **kwargs
+    )
+
+
+def test_download_ranges(server, tmp_path):
+    path = download(server, tmp_path, workers=4)
+    assert path.read_bytes() == server.data
+    # A probe for the size, then one request per range
+    chunks = download_utils.get_chunks(len(server.data), 100)
+    assert len(chunks) == 9
+    assert sorted(server.requests[1:]) == sorted(f"bytes={first}-{last}" for first, last in chunks)
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["2000AA.zip"]
+
+
+def test_download_single_stream(server, tmp_path):
+    server.ranges = False
+    path = download(server, tmp_path)
+    assert path.read_bytes() == server.data
+    assert server.requests == ["bytes=0-0"]
+
+
+def test_download_resumes(server, tmp_path):
+    server.failures = {300, 700}
+    with pytest.raises(Exception, match="503"):
+        download(server, tmp_path, workers=1, retries=0)
+    state = download_utils.read_state(
+        tmp_path / f"2000AA.zip{download_utils.STATE_SUFFIX}", server.url, len(server.data), 100
+    )
+    assert state == {0, 100, 200, 400, 500, 600, 800}
+    assert not (tmp_path / "2000AA.zip").exists()
+
+    # Only the failed ranges are fetched again
+    server.requests = []
+    path = download(server, tmp_path, workers=2)
+    assert path.read_bytes() == server.data
+    assert sorted(server.requests) == ["bytes=0-0", "bytes=300-399", "bytes=700-799"]
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["2000AA.zip"]
+
+
+def test_download_retries(server, tmp_path):
+    server.failures = {300}
+    path = download(server, tmp_path, retries=1)
+    assert path.read_bytes() == server.data
+    assert server.requests.count("bytes=300-399") == 2
+
+
+def test_download_restarts_changed_file(server, tmp_path):
+    server.failures = {300}
+    with pytest.raises(Exception, match="503"):
+        download(server, tmp_path, workers=1, retries=0)
+    # A record of a different file's ranges isn't resumed from
+    server.requests = []
+    path = download_utils.download_file(
+        server.url, tmp_path / "2000AA.zip", source="2000AB", chunk_size=100
+    )
+    assert path.read_bytes() == server.data
+    assert len(server.requests) == 10
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_download_verifies(server, tmp_path, ranges):
+    server.ranges = ranges
+    # Overwrite a member's local header with data from elsewhere in the archive,
+    # as a misplaced range would
+    with zipfile.ZipFile(ARCHIVE) as archive:
+        info = archive.getinfo("2000AA/META/TESTTABLE.ctl")
+    corrupt = bytearray(server.data)
+    corrupt[info.header_offset : info.header_offset + 4] = server.data[8:12]
+    server.data = bytes(corrupt)
+    with pytest.raises(errors.ApiError, match="TESTTABLE.ctl in downloaded .* is corrupt"):
+        download(server, tmp_path)
+    # Nothing is left to resume from, or use
+    assert list(tmp_path.iterdir()) == []
+
+    server.data = b"not a zip"
+    with pytest.raises(errors.ApiError, match="not a valid zip archive"):
+        download(server, tmp_path)
+
+
+def test_extract_checks_crc(tmp_path):
+    path = tmp_path / "2000AA.zip"
+    path.write_bytes(ARCHIVE.read_bytes())
+    download_utils.extract_archive(path, tmp_path / "good")
+    assert (tmp_path / "good/2000AA/META/TESTTABLE.ctl").exists()
+
+    # A byte flipped inside a member's compressed data isn't checked until extraction
+    with zipfile.ZipFile(ARCHIVE) as archive:
+        info = archive.getinfo("2000AA/META/TESTTABLE.ctl")
+    corrupt = bytearray(ARCHIVE.read_bytes())
+    name_length, extra_length = struct.unpack(
+        "<HH", corrupt[info.header_offset + 26 : info.header_offset + 30]
+    )
+    corrupt[info.header_offset + 30 + name_length + extra_length + 5] ^= 0xFF
+    path.write_bytes(corrupt)
+    download_utils.verify_archive(path, ARCHIVE.stat().st_size)
+    with pytest.raises(errors.ApiError, match="TESTTABLE.ctl in 2000AA.zip failed its checksum"):
+        download_utils.extract_archive(path, tmp_path / "bad")
+    # ...and nothing half extracted is left behind
+    assert list((tmp_path / "bad").iterdir()) == []
+
+
+def test_verify_size(tmp_path):
+    path = tmp_path / "2000AA.zip"
+    path.write_bytes(ARCHIVE.read_bytes())
+    download_utils.verify_archive(path, ARCHIVE.stat().st_size)
+    with pytest.raises(errors.ApiError, match="expected 1000"):
+        download_utils.verify_archive(path, 1000)
+
+
+def test_parse_content_range():
+    assert download_utils.parse_content_range("bytes 0-99/880") == (0, 99, 880)
+    assert download_utils.parse_content_range("bytes 0-99/*") is None
+    assert download_utils.parse_content_range(None) is None
+    assert download_utils.get_chunks(250, 100) == [(0, 99), (100, 199), (200, 249)]
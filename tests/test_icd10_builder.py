@@ -0,0 +1,69 @@
+import pathlib
+from unittest import mock
+
+import pytest
+from cumulus_library import base_utils, db_config, study_manifest
+
+from cumulus_library_umls import icd10_builder, icd10_utils, metrics_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def get_config() -> base_utils.StudyConfig:
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="umls")
+    config.db.upload_file.side_effect = (
+        lambda *, file, study, topic, remote_filename=None, force_upload=False: (
+            f"s3://bucket/{study}/{topic}"
+        )
+    )
+    return config
+
+
+def get_manifest() -> study_manifest.StudyManifest:
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    manifest._study_prefix = "umls"
+    return manifest
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_icd10_tables(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    builder = umls_builder.UMLSBuilder()
+    for name in ("MRCONSO", "MRREL"):
+        with open(META_PATH / f"{name}.ctl") as f:
+            datasource, table = builder.parse_ctl_file(f.readlines())
+        builder.create_parquet(META_PATH / datasource, tmp_path / "generated_parquet/2000AA", table)
+    config = get_config()
+
+    builder = icd10_builder.ICD10Builder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=config, manifest=get_manifest())
+    names = icd10_utils.get_table_names()
+    assert config.db.upload_file.call_count == len(names)
+    assert len(builder.queries) == len(names)
+    for name, query in zip(names, builder.queries, strict=True):
+        assert f"`umls`.`umls__{name}`" in query
+        assert f"LOCATION 's3://bucket/umls/{name}'" in query
+        assert (tmp_path / f"generated_parquet/2000AA/{name}/{name}_0.parquet").exists()
+    assert "depth Integer" in builder.queries[names.index("icd10_tree")]
+    assert "leaf_code String" in builder.queries[-1]
+    message = log_transaction.call_args.kwargs["message"]
+    assert message.startswith("ICD-10 tables from UMLS version 2000AA: build ")
+    assert list((tmp_path / metrics_utils.REPORT_DIR).glob("icd10_2000AA_*.json"))
+
+    # Unchanged tables are found in the upload ledger, and not sent again
+    builder = icd10_builder.ICD10Builder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=config, manifest=get_manifest())
+    assert config.db.upload_file.call_count == len(names)
+    assert f"{len(names)} parts skipped" in log_transaction.call_args.kwargs["message"]
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_icd10_tables_need_mrconso(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    (tmp_path / "generated_parquet/2000AA/MRREL").mkdir(parents=True)
+    with pytest.raises(ValueError, match="MRCONSO and MRREL tables"):
+        icd10_builder.ICD10Builder().prepare_queries(config=get_config(), manifest=get_manifest())
@@ -0,0 +1,126 @@
+import pathlib
+
+import duckdb
+import pandas
+import pytest
+
+from cumulus_library_umls import (
+    delta_utils,
+    icd10_utils,
+    parquet_utils,
+    release_utils,
+    umls_builder,
+)
+
+TEST_DATA = pathlib.Path(__file__).parent / "test_data"
+META_PATH = TEST_DATA / "2000AA/META"
+SLICE_SQL = pathlib.Path(__file__).parent / "test_data/slice_tables.sql"
+
+
+def convert(parquet_path: pathlib.Path, name: str, table_type: str | None = None) -> None:
+    with open(META_PATH / f"{name}.ctl") as f:
+        datasource, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    if table_type == "partitioned":
+        table = parquet_utils.partition_table(table, release_utils.PARTITION_COLUMN)
+    elif table_type == "delta":
+        table = delta_utils.delta_table(table, delta_utils.DELTA_KEYS[name], None)
+    umls_builder.UMLSBuilder().create_parquet(META_PATH / datasource, parquet_path, table)
+
+
+def read_tables(parquet_path: pathlib.Path, table_type: str | None = None) -> dict:
+    return icd10_utils.build_tables(
+        release_utils.read_rows(
+            parquet_path,
+            "MRCONSO",
+            icd10_utils.CONCEPT_COLUMNS,
+            {icd10_utils.SAB},
+            partition_column="SAB" if table_type == "partitioned" else None,
+            delta_key="AUI" if table_type == "delta" else None,
+        ),
+        release_utils.read_rows(
+            parquet_path,
+            "MRREL",
+            icd10_utils.RELATION_COLUMNS,
+            {icd10_utils.SAB},
+            partition_column="SAB" if table_type == "partitioned" else None,
+            delta_key="RUI" if table_type == "delta" else None,
+        ),
+    )
+
+
+def test_build_tables_matches_sql(tmp_path):
+    """The tables match those created by the SQL they replaced, row for row"""
+    cursor = duckdb.connect()
+    for name in ("MRCONSO", "MRREL"):
+        convert(tmp_path, name)
+        cursor.execute(
+            f"""CREATE TABLE "umls__{name}" AS
+            SELECT * FROM read_parquet('{tmp_path}/{name}/*.parquet')"""
+        )
+    sql = SLICE_SQL.read_text() + (TEST_DATA / "icd10_tables.sql").read_text()
+    for query in sql.split(";"):
+        if query.strip():
+            cursor.execute(query)
+
+    tables = read_tables(tmp_path)
+    assert list(tables) == icd10_utils.get_table_names()
+    for name, df in tables.items():
+        expected = cursor.execute(f"SELECT * FROM umls__{name}")
+        assert [column[0].lower() for column in expected.description] == list(df.columns)
+        assert list(df.columns) == icd10_utils.get_schema(name).names
+        expected_rows = expected.fetchall()
+        cursor.register("actual", icd10_utils.to_arrow(name, df))
+        actual_rows = cursor.execute("SELECT * FROM actual").fetchall()
+        assert sorted(actual_rows, key=repr) == sorted(expected_rows, key=repr), name
+    assert len(tables["icd10_tree"]) == 584
+    assert len(tables["icd10_hierarchy"]) == 438
+
+
+@pytest.mark.parametrize("table_type", ["partitioned", "delta"])
+def test_read_rows_table_types(tmp_path, table_type):
+    for name in ("MRCONSO", "MRREL"):
+        convert(tmp_path / "plain", name)
+        convert(tmp_path / table_type, name, table_type)
+    expected = read_tables(tmp_path / "plain")
+    for name, df in read_tables(tmp_path / table_type, table_type).items():
+        columns = list(df.columns)
+        pandas.testing.assert_frame_equal(
+            df.sort_values(columns, ignore_index=True),
+            expected[name].sort_values(columns, ignore_index=True),
+        )
+
+
+def test_hierarchy_keeps_unmatched_rows():
+    concepts = pandas.DataFrame(
+        [
+            ("C1", "ICD10CM", "HT", "A00-B99", "Chapter"),
+            ("C2", "ICD10CM", "HT", "A00-A09", "Block"),
+            ("C3", "ICD10CM", "PT", "A00", "Category"),
+            ("C4", "ICD10CM", "PT", "A00.1", "Subcategory"),
+            ("C5", "ICD10CM", "PT", "B01.1", "Misplaced subcategory"),
+            ("C6", "ICD10CM", "HT", "A10-A19", "Empty block"),
+        ],
+        columns=icd10_utils.CONCEPT_COLUMNS,
+    )
+    relations = pandas.DataFrame(
+        [
+            ("R1", icd10_utils.ROOT_CUI, "C1", "CHD", "ICD10CM"),
+            ("R2", "C1", "C2", "CHD", "ICD10CM"),
+            ("R3", "C2", "C3", "CHD", "ICD10CM"),
+            ("R4", "C3", "C4", "CHD", "ICD10CM"),
+            ("R5", "C3", "C5", "CHD", "ICD10CM"),
+            ("R6", "C1", "C6", "CHD", "ICD10CM"),
+        ],
+        columns=icd10_utils.RELATION_COLUMNS,
+    )
+    tables = icd10_utils.build_tables(concepts, relations)
+    assert list(tables["icd10_tree"]["depth"]) == [2, 3, 3, 4, 4, 4]
+    hierarchy = (
+        tables["icd10_hierarchy"].astype(object).where(tables["icd10_hierarchy"].notna(), None)
+    )
+    rows = sorted(
+        (row["block_code"], row["category_code"], row["subcategory_1_code"], row["leaf_code"])
+        for _, row in hierarchy.iterrows()
+    )
+    # B01.1 is a child of A00, but doesn't share its code, so isn't in the hierarchy
+    assert rows == [("A00-A09", "A00", "A00.1", "A00.1"), ("A10-A19", None, None, None)]
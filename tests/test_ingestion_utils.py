@@ -0,0 +1,121 @@
+import pathlib
+
+import pytest
+from cumulus_library import base_utils
+
+from cumulus_library_umls import ingestion_utils, parquet_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+TABLE = {
+    "headers": ["CUI", "LAT", "SAB", "STR", "SRL"],
+    "dtype": {"CUI": "string", "LAT": "string", "SAB": "string", "STR": "string", "SRL": "Int64"},
+    "parquet_types": ["String", "String", "String", "String", "Integer"],
+}
+
+
+def test_get_ingestion_profile():
+    config = base_utils.StudyConfig(
+        db=None,
+        schema="umls",
+        options={
+            "include_tables": "MRCONSO, MRREL,MRSTY",
+            "exclude_tables": "MRSTY",
+            "exclude_columns": "SRL,MRCONSO.CVF",
+            "filter_LAT": "ENG",
+            "filter_SAB": "RXNORM,ICD10CM",
+            "conversion_workers": "4",
+        },
+    )
+    profile = ingestion_utils.get_ingestion_profile(config)
+    assert profile == ingestion_utils.IngestionProfile(
+        include_tables={"MRCONSO", "MRREL", "MRSTY"},
+        exclude_tables={"MRSTY"},
+        exclude_columns={"SRL", "MRCONSO.CVF"},
+        row_filters={"LAT": {"ENG"}, "SAB": {"RXNORM", "ICD10CM"}},
+    )
+    assert profile.includes_table("MRCONSO")
+    assert not profile.includes_table("MRSTY")
+    assert not profile.includes_table("MRSAT")
+
+
+def test_default_profile_changes_nothing():
+    profile = ingestion_utils.get_ingestion_profile(base_utils.StudyConfig(db=None, schema="umls"))
+    assert profile.includes_table("MRSAT")
+    assert profile.apply("MRCONSO", TABLE) is TABLE
+
+
+def test_apply_profile():
+    profile = ingestion_utils.IngestionProfile(
+        exclude_columns={"SRL", "MRREL.STR", "MRCONSO.LAT"},
+        row_filters={"LAT": {"ENG"}, "RELA": {"isa"}},
+    )
+    table = profile.apply("MRCONSO", TABLE)
+    assert table["headers"] == ["CUI", "SAB", "STR"]
+    assert table["dtype"] == {"CUI": "string", "SAB": "string", "STR": "string"}
+    assert table["parquet_types"] == ["String", "String", "String"]
+    assert table["source_headers"] == TABLE["headers"]
+    # LAT is still read to filter on, even though it isn't in the output
+    assert table["filters"] == {"LAT": ["ENG"]}
+    assert table["profile"] == {"headers": ["CUI", "SAB", "STR"], "filters": {"LAT": ["ENG"]}}
+
+    with pytest.raises(ValueError):
+        ingestion_utils.IngestionProfile(exclude_columns=set(TABLE["headers"])).apply(
+            "MRCONSO", TABLE
+        )
+
+
+def test_apply_profile_with_memory_budget(tmp_path):
+    with open(META_PATH / "MRCONSO.ctl") as f:
+        _, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    profile = ingestion_utils.IngestionProfile(
+        exclude_columns={"CVF"}, row_filters={"LAT": {"ENG"}}
+    )
+    table = parquet_utils.set_memory_budget(profile.apply("MRCONSO", table), 64 * 1024**2)
+    # The declared widths are kept, so short code columns are still held compactly
+    assert table["widths"]["ISPREF"] == 1
+    dtypes = parquet_utils.get_read_dtypes(table)
+    assert dtypes["ISPREF"] == dtypes["LAT"] == "category"
+    assert dtypes["STR"] == "string[pyarrow]"
+
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    parquet_utils.convert_rrf(rrf_path, tmp_path, table)
+    assert parquet_utils.is_converted(rrf_path, tmp_path, profile=table["profile"])
+
+
+def test_get_write_options():
+    config = base_utils.StudyConfig(
+        db=None,
+        schema="umls",
+        options={
+            "parquet_compression": "ZSTD",
+            "parquet_row_group_rows": "100000",
+            "parquet_dictionary_columns": "LAT,TS, STT",
+            "MRCONSO.parquet_sort_by": "SAB,CODE",
+            "MRCONSO.parquet_target_file_mb": "128",
+        },
+    )
+    assert ingestion_utils.get_write_options(config, "MRCONSO") == {
+        "compression": "zstd",
+        "row_group_rows": 100000,
+        "dictionary_columns": ["LAT", "TS", "STT"],
+        "sort_by": ["SAB", "CODE"],
+        "target_file_bytes": 128 * 1024**2,
+    }
+    assert ingestion_utils.get_write_options(config, "MRREL") == {
+        "compression": "zstd",
+        "row_group_rows": 100000,
+        "dictionary_columns": ["LAT", "TS", "STT"],
+    }
+    assert (
+        ingestion_utils.get_write_options(base_utils.StudyConfig(db=None, schema="umls"), "MRREL")
+        == {}
+    )
+
+
+def test_get_write_options_not_an_integer():
+    config = base_utils.StudyConfig(
+        db=None, schema="umls", options={"MRREL.parquet_row_group_rows": "lots"}
+    )
+    with pytest.raises(ValueError, match="MRREL.parquet_row_group_rows must be an integer"):
+        ingestion_utils.get_write_options(config, "MRREL")
@@ -0,0 +1,150 @@
+import pathlib
+from unittest import mock
+
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from cumulus_library_umls import (
+    delta_utils,
+    lookup_utils,
+    parquet_utils,
+    release_utils,
+    umls_builder,
+)
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def convert(release_path: pathlib.Path, table_type: str | None = None) -> None:
+    with open(META_PATH / "MRCONSO.ctl") as f:
+        datasource, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    if table_type == "partitioned":
+        table = parquet_utils.partition_table(table, release_utils.PARTITION_COLUMN)
+    elif table_type == "delta":
+        table = delta_utils.delta_table(table, "AUI", None)
+    umls_builder.UMLSBuilder().create_parquet(META_PATH / datasource, release_path, table)
+
+
+def write_semantic_types(release_path: pathlib.Path) -> None:
+    (release_path / "MRSTY").mkdir(parents=True)
+    pyarrow.parquet.write_table(
+        pyarrow.table(
+            {
+                "CUI": ["C0004030", "C0004030", "C0004030", "C0011849"],
+                "TUI": ["T047", "T033", "T047", "T047"],
+                "STY": ["Disease or Syndrome", "Finding"] + ["Disease or Syndrome"] * 2,
+                "ATUI": ["AT1", "AT2", "AT3", "AT4"],
+            }
+        ),
+        release_path / "MRSTY/MRSTY_0.parquet",
+    )
+
+
+def get_expected(release_path: pathlib.Path) -> tuple[dict, dict]:
+    rows = release_utils.read_table(release_path, "MRCONSO", lookup_utils.CONCEPT_COLUMNS)
+    preferred = {}
+    codes = {}
+    for row in sorted(
+        rows.to_pylist(),
+        key=lambda row: (
+            row["LAT"] != "ENG",
+            row["TS"] != "P",
+            row["STT"] != "PF",
+            row["ISPREF"] != "Y",
+        ),
+    ):
+        preferred.setdefault(row["CUI"], row["STR"])
+        codes.setdefault((row["SAB"], row["CODE"]), set()).add(row["CUI"])
+    return preferred, codes
+
+
+def test_lookup(tmp_path):
+    convert(tmp_path / "2000AA")
+    write_semantic_types(tmp_path / "2000AA")
+    preferred, codes = get_expected(tmp_path / "2000AA")
+    with mock.patch.object(
+        lookup_utils, "index_concepts", wraps=lookup_utils.index_concepts
+    ) as index_concepts:
+        with lookup_utils.ConceptLookup.open(parquet_path=tmp_path) as lookup:
+            assert lookup.release == "2000AA"
+            assert lookup.get_preferred_string("C0004030") == "Aspergillosis"
+            assert lookup.get_cuis("ICD10CM", "B44.9") == ["C0004030"]
+            for cui, string in preferred.items():
+                assert lookup.get_preferred_string(cui) == string
+            assert lookup.get_preferred_strings([*preferred, "C9999999", "nope"]) == preferred
+            for (sab, code), cuis in codes.items():
+                assert lookup.get_cuis(sab, code) == sorted(cuis)
+            assert lookup.get_semantic_types("C0004030") == ["T033", "T047"]
+            assert lookup.get_semantic_types("C0011849") == ["T047"]
+            assert lookup.get_semantic_type_name("T033") == "Finding"
+
+        # The index is only built once per release
+        with lookup_utils.ConceptLookup.open("2000AA", parquet_path=tmp_path) as lookup:
+            assert lookup.get_preferred_string("C0004030") == "Aspergillosis"
+        assert index_concepts.call_count == 1
+
+
+def test_lookup_missing(tmp_path):
+    convert(tmp_path / "2000AA")
+    with lookup_utils.ConceptLookup.open(parquet_path=tmp_path) as lookup:
+        assert lookup.get_preferred_string("C9999999") is None
+        assert lookup.get_preferred_string("not a cui") is None
+        assert lookup.get_cuis("ICD10CM", "Z99.999") == []
+        assert lookup.get_cuis("SNOMEDCT_US", "B44.9") == []
+        assert lookup.get_preferred_strings([]) == {}
+        with pytest.raises(ValueError, match="MRSTY table"):
+            lookup.get_semantic_types("C0004030")
+    with pytest.raises(ValueError, match="MRCONSO table"):
+        lookup_utils.build_index(tmp_path / "2001AA")
+
+
+@pytest.mark.parametrize("table_type", ["partitioned", "delta"])
+def test_lookup_table_types(tmp_path, table_type):
+    convert(tmp_path / "plain/2000AA")
+    convert(tmp_path / f"{table_type}/2000AA", table_type)
+    assert release_utils.detect_table_layout(tmp_path / f"{table_type}/2000AA", "MRCONSO") == {
+        "partition_column": "SAB" if table_type == "partitioned" else None,
+        "delta_key": "AUI" if table_type == "delta" else None,
+    }
+    preferred, codes = get_expected(tmp_path / "plain/2000AA")
+    with lookup_utils.ConceptLookup.open(parquet_path=tmp_path / table_type) as lookup:
+        assert lookup.get_preferred_strings(list(preferred)) == preferred
+        for (sab, code), cuis in codes.items():
+            assert lookup.get_cuis(sab, code) == sorted(cuis)
+
+
+def test_lookup_hash_collisions(tmp_path):
+    """Codes with the same hash are told apart by the stored code"""
+    convert(tmp_path / "2000AA")
+    _, codes = get_expected(tmp_path / "2000AA")
+    with mock.patch("zlib.crc32", return_value=7):
+        with lookup_utils.ConceptLookup.open(parquet_path=tmp_path) as lookup:
+            for (sab, code), cuis in codes.items():
+                assert lookup.get_cuis(sab, code) == sorted(cuis)
+
+
+def test_preferred_string_precedence(tmp_path):
+    rows = [
+        ("C0000001", "SPA", "P", "PF", "Y", "Spanish"),
+        ("C0000001", "ENG", "S", "PF", "Y", "Synonym"),
+        ("C0000001", "ENG", "P", "VO", "Y", "Variant"),
+        ("C0000001", "ENG", "P", "PF", "N", "Not preferred atom"),
+        ("C0000001", "ENG", "P", "PF", "Y", "Preferred"),
+        ("C0000002", "FRE", "S", "VO", "N", "Only atom"),
+    ]
+    columns = ["CUI", "LAT", "TS", "STT", "ISPREF", "STR"]
+    (tmp_path / "2000AA/MRCONSO").mkdir(parents=True)
+    pyarrow.parquet.write_table(
+        pyarrow.table(
+            {
+                **{column: [row[i] for row in rows] for i, column in enumerate(columns)},
+                "SAB": ["MTH"] * len(rows),
+                "CODE": [f"CODE{i}" for i in range(len(rows))],
+            }
+        ),
+        tmp_path / "2000AA/MRCONSO/MRCONSO_0.parquet",
+    )
+    with lookup_utils.ConceptLookup.open(parquet_path=tmp_path) as lookup:
+        assert lookup.get_preferred_string("C0000001") == "Preferred"
+        assert lookup.get_preferred_string("C0000002") == "Only atom"
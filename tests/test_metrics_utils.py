@@ -0,0 +1,48 @@
+import json
+import time
+
+from cumulus_library_umls import metrics_utils
+
+
+def test_build_metrics(tmp_path):
+    metrics = metrics_utils.BuildMetrics("umls_2000AA")
+    with metrics.measure("convert"):
+        with metrics.measure("convert", "MRCONSO"):
+            time.sleep(0.01)
+        metrics.add("convert", "MRCONSO", rows=10, input_bytes=2 * 1024**2, output_bytes=1024**2)
+        metrics.add("convert", "MRREL", rows=5, wall_seconds=1.0)
+    metrics.add("upload", "MRCONSO", wall_seconds=2.0, parts_uploaded=1, retries=2)
+    metrics.add("upload", "MRREL", wall_seconds=3.0, parts_skipped=1)
+
+    report = metrics.to_dict()
+    convert = report["stages"]["convert"]
+    # The stage's own time is kept, while its counters total those of its tables
+    assert 0.01 <= convert["wall_seconds"] < 1.0
+    assert convert["rows"] == 15
+    assert convert["tables"]["MRCONSO"]["wall_seconds"] >= 0.01
+    assert convert["tables"]["MRREL"] == {"wall_seconds": 1.0, "rows": 5}
+    # Stages without their own time total the time of their tables
+    assert report["stages"]["upload"] == {
+        "wall_seconds": 5.0,
+        "parts_uploaded": 1,
+        "parts_skipped": 1,
+        "retries": 2,
+        "tables": {
+            "MRCONSO": {"wall_seconds": 2.0, "parts_uploaded": 1, "retries": 2},
+            "MRREL": {"wall_seconds": 3.0, "parts_skipped": 1},
+        },
+    }
+    summary = metrics.summary()
+    assert summary.startswith("convert 0.0s, 0.0s CPU, 15 rows, 2.0MB input, 1.0MB output; ")
+    assert summary.endswith("upload 5.0s, 1 parts uploaded, 1 parts skipped, 2 retries")
+
+    report_path = metrics.write_report(tmp_path / "reports")
+    assert report_path.name.startswith("umls_2000AA_")
+    assert json.loads(report_path.read_text()) == report
+
+
+def test_call_measured():
+    result, wall_seconds, cpu_seconds = metrics_utils.call_measured(sum, [1, 2])
+    assert result == 3
+    assert wall_seconds >= 0
+    assert cpu_seconds >= 0
@@ -0,0 +1,157 @@
+import pathlib
+import shutil
+import time
+import zipfile
+from unittest import mock
+
+import pytest
+import requests
+import responses
+
+from cumulus_library_umls import archive_utils, json_utils, mirror_utils, umls_builder
+
+TEST_DATA = pathlib.Path(__file__).parent / "test_data"
+RELEASE_URL = "https://uts-ws.nlm.nih.gov/releases"
+METADATA = {
+    "fileName": "2000AA.zip",
+    "releaseVersion": "2000AA",
+    "downloadUrl": "https://download.nlm.nih.gov/umls/kss/2000AA/2000AA.zip",
+}
+
+
+@pytest.fixture
+def offline():
+    """Fails any outbound request, and records it"""
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as response:
+        yield response
+
+
+@pytest.fixture
+def api(offline):
+    offline.add(responses.GET, "https://utslogin.nlm.nih.gov/validateUser", body="true")
+    offline.add(responses.GET, RELEASE_URL, json=[METADATA])
+    return offline
+
+
+def get_release_calls(response) -> int:
+    return sum(call.request.url.startswith(RELEASE_URL) for call in response.calls)
+
+
+def test_find_mirror(tmp_path):
+    assert mirror_utils.find_mirror(TEST_DATA / "2000AA.zip") == mirror_utils.Mirror(
+        release="2000AA", archive=TEST_DATA / "2000AA.zip"
+    )
+    for path in (TEST_DATA / "2000AA", TEST_DATA / "2000AA/META"):
+        assert mirror_utils.find_mirror(path) == mirror_utils.Mirror(
+            release="2000AA", meta_path=TEST_DATA / "2000AA/META"
+        )
+
+    (tmp_path / "not_a_zip.zip").write_text("nope")
+    with pytest.raises(ValueError, match="not a zip archive"):
+        mirror_utils.find_mirror(tmp_path / "not_a_zip.zip")
+    with zipfile.ZipFile(tmp_path / "two.zip", "w") as archive:
+        archive.writestr("2000AA/META/MRCONSO.ctl", "")
+        archive.writestr("2000AB/META/MRCONSO.ctl", "")
+    with pytest.raises(ValueError, match="found 2"):
+        mirror_utils.find_mirror(tmp_path / "two.zip")
+    with pytest.raises(ValueError, match="directory containing META"):
+        mirror_utils.find_mirror(tmp_path)
+
+
+@pytest.mark.parametrize("stream_from_zip", [False, True])
+def test_mirror_archive(tmp_path, offline, stream_from_zip):
+    download_path = tmp_path / "downloads"
+    download_path.mkdir()
+    builder = umls_builder.UMLSBuilder()
+    files, download_required, release = builder.get_umls_data(
+        download_path,
+        tmp_path / "generated_parquet",
+        False,
+        None,
+        stream_from_zip=stream_from_zip,
+        mirror=TEST_DATA / "2000AA.zip",
+    )
+    assert (download_required, release) == (True, "2000AA")
+    assert [file.name for file in files] == ["TESTTABLE.ctl"]
+    if stream_from_zip:
+        # The mirror is read in place
+        assert files == [
+            archive_utils.ZipMember(TEST_DATA / "2000AA.zip", "2000AA/META/TESTTABLE.ctl")
+        ]
+        assert list(download_path.iterdir()) == []
+    else:
+        assert files == [download_path / "2000AA/META/TESTTABLE.ctl"]
+    assert len(offline.calls) == 0
+
+
+def test_mirror_directory(tmp_path, offline):
+    (tmp_path / "generated_parquet/2000AA").mkdir(parents=True)
+    files, download_required, release = umls_builder.UMLSBuilder().get_umls_data(
+        tmp_path / "downloads",
+        tmp_path / "generated_parquet",
+        False,
+        None,
+        mirror=TEST_DATA / "2000AA",
+    )
+    # Already converted, so not new
+    assert (download_required, release) == (False, "2000AA")
+    assert sorted(file.name for file in files) == ["MRCONSO.ctl", "MRREL.ctl", "TESTTABLE.ctl"]
+    assert all(file.parent == TEST_DATA / "2000AA/META" for file in files)
+    assert len(offline.calls) == 0
+
+
+def test_release_metadata_ttl(tmp_path, api):
+    metadata_path = tmp_path / mirror_utils.METADATA_FILE
+    assert mirror_utils.get_release_metadata("123", metadata_path) == METADATA
+    assert get_release_calls(api) == 1
+
+    # Fresh metadata is read from the cache
+    assert mirror_utils.get_release_metadata("123", metadata_path) == METADATA
+    assert get_release_calls(api) == 1
+
+    # ...unless it's refreshed, or has expired
+    mirror_utils.get_release_metadata("123", metadata_path, refresh=True)
+    assert get_release_calls(api) == 2
+    cached = json_utils.read_json(metadata_path)
+    cached["fetched"] = time.time() - 25 * 3600
+    json_utils.write_json_atomic(metadata_path, cached)
+    mirror_utils.get_release_metadata("123", metadata_path)
+    assert get_release_calls(api) == 3
+    mirror_utils.get_release_metadata("123", metadata_path, ttl_hours=0)
+    assert get_release_calls(api) == 4
+
+    # Without a cache, the API is always called
+    mirror_utils.get_release_metadata("123")
+    assert get_release_calls(api) == 5
+
+
+def test_release_metadata_unreachable(tmp_path, offline):
+    metadata_path = tmp_path / mirror_utils.METADATA_FILE
+    with pytest.raises(requests.ConnectionError):
+        mirror_utils.get_release_metadata("123", metadata_path)
+
+    # Stale metadata is better than none, when the API can't be reached
+    json_utils.write_json_atomic(metadata_path, {"fetched": 0, "metadata": METADATA})
+    assert mirror_utils.get_release_metadata("123", metadata_path) == METADATA
+
+
+def test_warm_rebuild_is_offline(tmp_path, api):
+    download_path = tmp_path / "downloads"
+    download_path.mkdir()
+    metadata_path = tmp_path / mirror_utils.METADATA_FILE
+    shutil.copytree(TEST_DATA / "2000AA", download_path / "2000AA")
+    builder = umls_builder.UMLSBuilder()
+    with mock.patch("cumulus_library_umls.download_utils.download_release") as download:
+        for _ in range(2):
+            files, download_required, release = builder.get_umls_data(
+                download_path,
+                tmp_path / "generated_parquet",
+                False,
+                "123",
+                metadata_path=metadata_path,
+            )
+            assert (download_required, release) == (False, "2000AA")
+            assert len(files) == 3
+    # Only the first build asked which release is the latest
+    assert get_release_calls(api) == 1
+    assert download.call_count == 0
@@ -0,0 +1,447 @@
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+from unittest import mock
+
+import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.parquet
+import pytest
+
+from cumulus_library_umls import ingestion_utils, parquet_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def get_table(name: str) -> dict:
+    with open(META_PATH / f"{name}.ctl") as f:
+        _, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    return table
+
+
+@pytest.mark.parametrize("num_ranges", [1, 2, 7, 50, 10_000])
+def test_split_rrf(num_ranges):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    contents = rrf_path.read_bytes()
+    ranges = parquet_utils.split_rrf(rrf_path, num_ranges)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == len(contents)
+    assert len(ranges) <= num_ranges
+    for (_, prev_end), (start, end) in itertools.pairwise(ranges):
+        assert prev_end == start
+        assert start < end
+        assert contents[start - 1 : start] == b"\n"
+
+
+@pytest.mark.parametrize("name", ["MRCONSO", "MRREL", "TESTTABLE"])
+def test_convert_rrf_range_matches_sequential(tmp_path, name):
+    rrf_path = META_PATH / f"{name}.RRF"
+    table = get_table(name)
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "sequential", table)
+    expected = pandas.read_parquet(tmp_path / f"sequential/{name}")
+
+    ranges = parquet_utils.split_rrf(rrf_path, 50)
+    rows = 0
+    for part, (start, end) in enumerate(ranges):
+        rows += parquet_utils.convert_rrf_range(
+            rrf_path, tmp_path / "ranged", table, start, end, part
+        )["rows"]
+    parts = [
+        pandas.read_parquet(tmp_path / f"ranged/{name}/{name}_{part}.parquet")
+        for part in range(len(ranges))
+    ]
+    actual = pandas.concat(parts, ignore_index=True)
+    assert rows == len(expected)
+    pandas.testing.assert_frame_equal(actual, expected)
+
+
+def test_convert_rrf_range_empty(tmp_path):
+    table = get_table("TESTTABLE")
+    chunk = parquet_utils.convert_rrf_range(META_PATH / "TESTTABLE.RRF", tmp_path, table, 0, 0, 0)
+    assert chunk["rows"] == 0
+    df = pandas.read_parquet(tmp_path / "TESTTABLE/TESTTABLE_0.parquet")
+    assert list(df.columns) == table["headers"]
+
+
+def read_sorted(path: pathlib.Path) -> pyarrow.Table:
+    """Reads a parquet dir with pandas metadata removed, in a stable row order"""
+    table = pyarrow.parquet.read_table(path).replace_schema_metadata()
+    return table.sort_by([(column, "ascending") for column in table.column_names])
+
+
+@pytest.mark.parametrize("name", ["MRCONSO", "MRREL", "TESTTABLE"])
+def test_arrow_engine_matches_pandas(tmp_path, name):
+    rrf_path = META_PATH / f"{name}.RRF"
+    table = get_table(name)
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "pandas", table)
+    # a tiny block size forces the streaming reader across many batches
+    chunks = parquet_utils.convert_rrf_arrow(rrf_path, tmp_path / "arrow", table, block_size=4096)
+    assert list(chunks) == [0]
+    chunk = chunks[0]
+    expected = read_sorted(tmp_path / f"pandas/{name}")
+    actual = read_sorted(tmp_path / f"arrow/{name}")
+    assert chunk["rows"] == expected.num_rows
+    assert (
+        chunk["sha256"]
+        == hashlib.sha256((tmp_path / f"arrow/{name}/{name}_0.parquet").read_bytes()).hexdigest()
+    )
+    assert list((tmp_path / f"arrow/{name}").iterdir()) == [
+        tmp_path / f"arrow/{name}/{name}_0.parquet"
+    ]
+    assert actual.equals(expected)
+
+
+def test_arrow_engine_ranges(tmp_path):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = get_table("MRCONSO")
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "pandas", table)
+    ranges = parquet_utils.split_rrf(rrf_path, 20)
+    rows = 0
+    for part, (start, end) in enumerate(ranges):
+        rows += parquet_utils.convert_rrf_range(
+            rrf_path, tmp_path / "arrow", table, start, end, part, engine="arrow"
+        )["rows"]
+    expected = read_sorted(tmp_path / "pandas/MRCONSO")
+    actual = read_sorted(tmp_path / "arrow/MRCONSO")
+    assert rows == expected.num_rows
+    assert actual.equals(expected)
+
+
+def get_filtered_table(name: str) -> dict:
+    profile = ingestion_utils.IngestionProfile(
+        exclude_columns={"SRL", "CVF", "SAUI", "REL"},
+        row_filters={"SAB": {"ICD10CM", "RXNORM"}, "TTY": {"HT"}, "REL": {"PAR"}},
+    )
+    return profile.apply(name, get_table(name))
+
+
+def get_expected_filtered(name: str) -> pyarrow.Table:
+    table = get_table(name)
+    df = pandas.read_csv(
+        META_PATH / f"{name}.RRF",
+        delimiter="|",
+        names=table["headers"],
+        dtype=table["dtype"],
+        index_col=False,
+    )
+    df = df[df["SAB"].isin(["ICD10CM", "RXNORM"])]
+    if "TTY" in df.columns:
+        df = df[df["TTY"] == "HT"]
+    if "REL" in df.columns:
+        df = df[df["REL"] == "PAR"]
+    df = df.drop(columns=[col for col in ["SRL", "CVF", "SAUI", "REL"] if col in df.columns])
+    arrow_table = pyarrow.Table.from_pandas(df, preserve_index=False).replace_schema_metadata()
+    return arrow_table.sort_by([(column, "ascending") for column in arrow_table.column_names])
+
+
+@pytest.mark.parametrize("name", ["MRCONSO", "MRREL"])
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_convert_rrf_filtered(tmp_path, name, engine):
+    table = get_filtered_table(name)
+    parts = parquet_utils.convert_rrf(
+        META_PATH / f"{name}.RRF", tmp_path / "whole", table, engine=engine, chunksize=100
+    )
+    ranges = parquet_utils.split_rrf(META_PATH / f"{name}.RRF", 20)
+    for part, (start, end) in enumerate(ranges):
+        parquet_utils.convert_rrf_range(
+            META_PATH / f"{name}.RRF", tmp_path / "ranged", table, start, end, part, engine
+        )
+    expected = get_expected_filtered(name)
+    assert expected.num_rows == {"MRCONSO": 121, "MRREL": 1}[name]
+    for path in [tmp_path / f"whole/{name}", tmp_path / f"ranged/{name}"]:
+        actual = read_sorted(path)
+        assert actual.column_names == table["headers"]
+        assert actual.equals(expected)
+    manifest = json.loads((tmp_path / f"whole/{name}/_manifest.json").read_text())
+    assert manifest["profile"] == table["profile"]
+    assert sum(manifest["rows_per_chunk"]) == expected.num_rows
+    assert len(parts) == len(manifest["rows_per_chunk"])
+
+    # A conversion with a different profile doesn't count as converted
+    assert parquet_utils.is_converted(
+        META_PATH / f"{name}.RRF", tmp_path / "whole", profile=table["profile"]
+    )
+    assert not parquet_utils.is_converted(META_PATH / f"{name}.RRF", tmp_path / "whole")
+
+
+def test_convert_rrf_filtered_resume(tmp_path):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = get_filtered_table("MRCONSO")
+
+    def interrupt(part, sha256):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        parquet_utils.convert_rrf(rrf_path, tmp_path, table, on_part=interrupt, chunksize=100)
+    progress = json.loads((tmp_path / "MRCONSO/_progress.json").read_text())
+    assert progress["chunks"]["0"]["lines"] == 100
+    assert progress["chunks"]["0"]["rows"] < 100
+    parquet_utils.convert_rrf(rrf_path, tmp_path, table, chunksize=100)
+    assert read_sorted(tmp_path / "MRCONSO").equals(get_expected_filtered("MRCONSO"))
+
+
+def test_convert_rrf_partitioned(tmp_path):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = parquet_utils.partition_table(get_table("MRCONSO"), "TTY")
+    written = []
+    parts = parquet_utils.convert_rrf(
+        rrf_path,
+        tmp_path,
+        table,
+        chunksize=100,
+        on_part=lambda *part: written.append(part),
+        release="2000AA",
+    )
+    assert sorted(parts) == sorted(written)
+    # 121 HT rows and 422 PT rows, in files of at most 100 rows
+    assert sorted(path.relative_to(tmp_path).as_posix() for path, _ in parts) == [
+        *[f"MRCONSO/tty=HT/MRCONSO_{i}.parquet" for i in range(2)],
+        *[f"MRCONSO/tty=PT/MRCONSO_{i}.parquet" for i in range(5)],
+    ]
+    for path, sha256 in parts:
+        assert hashlib.sha256(path.read_bytes()).hexdigest() == sha256
+        assert "TTY" not in pyarrow.parquet.read_schema(path).names
+    assert parquet_utils.get_partition_values(parts) == ["HT", "PT"]
+    assert (
+        parquet_utils.get_converted_parts(rrf_path, tmp_path, "2000AA", table["profile"]) == parts
+    )
+
+    flat = parquet_utils.convert_rrf(rrf_path, tmp_path / "flat", get_table("MRCONSO"))
+    for value in ["HT", "PT"]:
+        expected = pyarrow.parquet.read_table(flat[0][0]).replace_schema_metadata()
+        expected = expected.filter(pyarrow.compute.equal(expected["TTY"], value))
+        actual = pyarrow.parquet.read_table(tmp_path / f"MRCONSO/tty={value}")
+        actual = actual.replace_schema_metadata()
+        assert actual.equals(expected.drop_columns(["TTY"]))
+
+    # Reconverting doesn't leave stale files from a previous layout behind
+    table = parquet_utils.partition_table(get_table("MRCONSO"), "SAB")
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table, release="2000AA")
+    assert [path.relative_to(tmp_path).as_posix() for path, _ in parts] == [
+        "MRCONSO/sab=ICD10CM/MRCONSO_0.parquet"
+    ]
+    assert sorted(path.name for path in (tmp_path / "MRCONSO").iterdir()) == [
+        "_manifest.json",
+        "sab=ICD10CM",
+    ]
+
+
+def test_convert_rrf_partitioned_empty(tmp_path):
+    rrf_path = tmp_path / "MRCONSO.RRF"
+    rrf_path.touch()
+    table = parquet_utils.partition_table(get_table("MRCONSO"), "SAB")
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table)
+    assert [path.parent.name for path, _ in parts] == ["sab=__HIVE_DEFAULT_PARTITION__"]
+    assert pyarrow.parquet.read_table(parts[0][0]).num_rows == 0
+
+
+def get_column_encodings(path: pathlib.Path, column: str) -> set[str]:
+    metadata = pyarrow.parquet.ParquetFile(path).metadata
+    index = metadata.schema.names.index(column)
+    return {
+        encoding
+        for i in range(metadata.num_row_groups)
+        for encoding in metadata.row_group(i).column(index).encodings
+    }
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_convert_rrf_write_options(tmp_path, engine):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = parquet_utils.set_write_options(
+        get_table("MRCONSO"),
+        {
+            "compression": "zstd",
+            "row_group_rows": 100,
+            "dictionary_columns": ["LAT", "TTY", "RELA"],
+            "sort_by": ["CODE"],
+        },
+    )
+    # options for columns the table doesn't have are dropped
+    assert table["write_options"]["dictionary_columns"] == ["LAT", "TTY"]
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table, engine=engine)
+    path = parts[0][0]
+    metadata = pyarrow.parquet.ParquetFile(path).metadata
+    assert metadata.num_row_groups == 6
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+    assert "RLE_DICTIONARY" in get_column_encodings(path, "TTY")
+    assert "RLE_DICTIONARY" not in get_column_encodings(path, "STR")
+    codes = pyarrow.parquet.read_table(path)["CODE"].to_pylist()
+    assert codes == sorted(codes)
+    # sorted rows give each row group a narrow range of codes to skip on
+    code = metadata.schema.names.index("CODE")
+    stats = [metadata.row_group(i).column(code).statistics for i in range(6)]
+    for prev, stat in itertools.pairwise(stats):
+        assert prev.max <= stat.min
+    assert read_sorted(tmp_path / "MRCONSO").num_rows == 543
+    assert parquet_utils.is_converted(rrf_path, tmp_path, profile=table["profile"])
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+@pytest.mark.parametrize("sort_by", [None, ["CUI"]])
+def test_convert_rrf_target_file_size(tmp_path, engine, sort_by):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = parquet_utils.set_write_options(
+        get_table("MRCONSO"),
+        {"target_file_bytes": 32 * 1024, "row_group_rows": 50, "sort_by": sort_by},
+    )
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table, engine=engine, chunksize=50)
+    sizes = [path.stat().st_size for path, _ in parts]
+    assert len(parts) > 1
+    # The first pandas file is sized by chunksize, and is used to estimate the rest,
+    # and the last file of either engine holds whatever is left over
+    for size in sizes[1:-1]:
+        assert 16 * 1024 < size < 64 * 1024
+    assert sum(sizes) / len(sizes) < 64 * 1024
+    with open(rrf_path) as f:
+        assert read_sorted(tmp_path / "MRCONSO").num_rows == len(f.readlines())
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+@pytest.mark.parametrize("name", ["MRCONSO", "MRREL"])
+def test_convert_rrf_memory_budget(tmp_path, engine, name):
+    rrf_path = META_PATH / f"{name}.RRF"
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "unbounded", get_table(name), engine=engine)
+    table = parquet_utils.set_memory_budget(get_table(name), 64 * 1024)
+    with mock.patch("cumulus_library_umls.parquet_utils.BUDGET_SAMPLE_ROWS", 100):
+        parts = parquet_utils.convert_rrf(
+            rrf_path, tmp_path / "budget", table, engine=engine, chunksize=10_000
+        )
+    if engine == "pandas":
+        # Parts are sized by how much memory their rows use, not by chunksize
+        assert len(parts) > 2
+    # Output has the same rows and schema, without dictionary typed columns
+    expected = read_sorted(tmp_path / f"unbounded/{name}")
+    actual = read_sorted(tmp_path / f"budget/{name}")
+    assert actual.schema == expected.schema
+    assert actual.equals(expected)
+
+
+def test_get_read_dtypes():
+    table = get_table("MRCONSO")
+    assert parquet_utils.get_read_dtypes(table) == table["dtype"]
+    assert parquet_utils.get_block_size(table) == 64 * 1024**2
+    table = parquet_utils.set_memory_budget(table, 64 * 1024**2)
+    dtypes = parquet_utils.get_read_dtypes(table)
+    # Short codes from the .ctl schema, and known code columns, are categorical
+    assert table["widths"]["LAT"] == 3
+    assert [column for column, dtype in dtypes.items() if dtype == "category"] == [
+        "LAT",
+        "TS",
+        "STT",
+        "ISPREF",
+        "SAB",
+        "TTY",
+        "SUPPRESS",
+    ]
+    assert dtypes["STR"] == "string[pyarrow]"
+    assert dtypes["SRL"] == "Int64"
+    assert parquet_utils.get_block_size(table) == 8 * 1024**2
+    assert parquet_utils.set_memory_budget(get_table("MRREL"), None) == get_table("MRREL")
+
+
+def test_set_write_options_unknown_codec():
+    assert parquet_utils.set_write_options(get_table("TESTTABLE"), {}) == get_table("TESTTABLE")
+    with pytest.raises(ValueError):
+        parquet_utils.set_write_options(get_table("MRCONSO"), {"compression": "lzma"})
+
+
+def test_unknown_engine(tmp_path):
+    with pytest.raises(ValueError):
+        parquet_utils.convert_rrf(
+            META_PATH / "TESTTABLE.RRF", tmp_path, get_table("TESTTABLE"), engine="polars"
+        )
+
+
+def test_convert_rrf_manifest(tmp_path):
+    rrf_path = tmp_path / "MRCONSO.RRF"
+    rrf_path.write_bytes((META_PATH / "MRCONSO.RRF").read_bytes())
+    table = get_table("MRCONSO")
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table, release="2000AA", chunksize=200)
+    assert [path for path, _ in parts] == [
+        tmp_path / f"MRCONSO/MRCONSO_{i}.parquet" for i in range(3)
+    ]
+    for path, sha256 in parts:
+        assert hashlib.sha256(path.read_bytes()).hexdigest() == sha256
+    manifest = json.loads((tmp_path / "MRCONSO/_manifest.json").read_text())
+    assert manifest["source"]["release"] == "2000AA"
+    assert manifest["source"]["size"] == rrf_path.stat().st_size
+    assert manifest["chunks"] == 3
+    assert manifest["rows_per_chunk"] == [200, 200, 143]
+    assert manifest["sha256_per_chunk"] == [sha256 for _, sha256 in parts]
+    assert not (tmp_path / "MRCONSO/_progress.json").exists()
+
+    # A completed table is skipped without reading the source
+    with mock.patch("pandas.read_csv", side_effect=AssertionError("should not parse")):
+        assert parquet_utils.convert_rrf(rrf_path, tmp_path, table, release="2000AA") == parts
+    assert parquet_utils.is_converted(rrf_path, tmp_path, "2000AA")
+    assert not parquet_utils.is_converted(rrf_path, tmp_path, "2001AA")
+
+    # ...but a changed source file is reconverted
+    os.utime(rrf_path, ns=(0, 0))
+    assert not parquet_utils.is_converted(rrf_path, tmp_path, "2000AA")
+    parts = parquet_utils.convert_rrf(rrf_path, tmp_path, table, release="2000AA")
+    assert [path for path, _ in parts] == [tmp_path / "MRCONSO/MRCONSO_0.parquet"]
+    assert sorted(p.name for p in (tmp_path / "MRCONSO").iterdir()) == [
+        "MRCONSO_0.parquet",
+        "_manifest.json",
+    ]
+
+
+def test_convert_rrf_resume(tmp_path):
+    rrf_path = META_PATH / "MRREL.RRF"
+    table = get_table("MRREL")
+    written = []
+
+    def interrupt(part, sha256):
+        written.append(part)
+        if len(written) == 3:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        parquet_utils.convert_rrf(rrf_path, tmp_path, table, on_part=interrupt, chunksize=400)
+    assert not parquet_utils.is_converted(rrf_path, tmp_path)
+    progress = json.loads((tmp_path / "MRREL/_progress.json").read_text())
+    assert {part: chunk["rows"] for part, chunk in progress["chunks"].items()} == {
+        "0": 400,
+        "1": 400,
+        "2": 400,
+    }
+    first_write = (tmp_path / "MRREL/MRREL_0.parquet").stat().st_mtime_ns
+
+    resumed = []
+    parts = parquet_utils.convert_rrf(
+        rrf_path, tmp_path, table, on_part=lambda *part: resumed.append(part), chunksize=400
+    )
+    assert parts == resumed
+    assert [path for path, _ in parts] == [tmp_path / f"MRREL/MRREL_{i}.parquet" for i in range(5)]
+    assert (tmp_path / "MRREL/MRREL_0.parquet").stat().st_mtime_ns == first_write
+    manifest = json.loads((tmp_path / "MRREL/_manifest.json").read_text())
+    assert manifest["rows_per_chunk"] == [400, 400, 400, 400, 156]
+    pandas.testing.assert_frame_equal(
+        pandas.read_parquet(tmp_path / "MRREL"),
+        pandas.read_csv(
+            rrf_path,
+            delimiter="|",
+            names=table["headers"],
+            dtype=table["dtype"],
+            index_col=False,
+        ),
+    )
+
+
+def test_start_conversion_layout_change(tmp_path):
+    rrf_path = META_PATH / "MRREL.RRF"
+    layout = {"engine": "pandas", "ranges": [[0, 10], [10, 20]]}
+    assert parquet_utils.start_conversion(rrf_path, tmp_path, "2000AA", layout) == {}
+    parquet_utils.get_part_path(tmp_path, "MRREL", 0).write_bytes(b"parquet")
+    chunk = {"rows": 12, "sha256": "abc"}
+    parquet_utils.record_progress(rrf_path, tmp_path, "2000AA", layout, {0: chunk})
+    assert parquet_utils.start_conversion(rrf_path, tmp_path, "2000AA", layout) == {0: chunk}
+    # a run with differently split ranges can't reuse the existing parts
+    layout["ranges"] = [[0, 20]]
+    assert parquet_utils.start_conversion(rrf_path, tmp_path, "2000AA", layout) == {}
+    assert not parquet_utils.get_part_path(tmp_path, "MRREL", 0).exists()
@@ -0,0 +1,204 @@
+import pathlib
+from unittest import mock
+
+import duckdb
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from cumulus_library_umls import (
+    delta_utils,
+    ingestion_utils,
+    parquet_utils,
+    release_utils,
+    slice_utils,
+    umls_builder,
+)
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+SLICE_SQL = pathlib.Path(__file__).parent / "test_data/slice_tables.sql"
+
+
+def get_table(name: str, table_type: str | None = None) -> tuple[str, dict]:
+    with open(META_PATH / f"{name}.ctl") as f:
+        datasource, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    if table_type == "partitioned":
+        table = parquet_utils.partition_table(table, release_utils.PARTITION_COLUMN)
+    elif table_type == "delta":
+        table = delta_utils.delta_table(table, delta_utils.DELTA_KEYS[name], None)
+    return datasource, table
+
+
+def convert(
+    parquet_path: pathlib.Path, table_type: str | None = None, hashes: dict | None = None
+) -> tuple[slice_utils.SliceWriter, list]:
+    """Converts MRCONSO & MRREL, writing their slices, and returns the parts uploaded
+
+    :param hashes: hashes to pass in place of the actual hashes of some parts, by name
+    """
+    tables = {}
+    parts = {}
+    for name in ("MRCONSO", "MRREL"):
+        datasource, tables[name] = get_table(name, table_type)
+        parts[name] = umls_builder.UMLSBuilder().create_parquet(
+            META_PATH / datasource, parquet_path, tables[name]
+        )
+    uploaded = []
+    writer = slice_utils.SliceWriter(
+        parquet_path,
+        tables,
+        on_part=lambda name, path, sha256: uploaded.append((name, path.name)),
+    )
+    for name in tables:
+        for path, sha256 in parts[name]:
+            writer.put(name, path, (hashes or {}).get(path.name, sha256))
+        assert writer.finish_table(name) == [
+            table_slice.name for table_slice in slice_utils.SLICES if table_slice.source == name
+        ]
+    return writer, uploaded
+
+
+def get_sql_slices(tmp_path: pathlib.Path) -> dict[str, list]:
+    """Builds the slices with the SQL they replaced, from unsliced parquet"""
+    for name in ("MRCONSO", "MRREL"):
+        datasource, table = get_table(name)
+        umls_builder.UMLSBuilder().create_parquet(META_PATH / datasource, tmp_path / "sql", table)
+    cursor = duckdb.connect()
+    for name in ("MRCONSO", "MRREL"):
+        cursor.execute(
+            f"CREATE TABLE umls__{name.lower()} AS "
+            f"SELECT * FROM read_parquet('{tmp_path}/sql/{name}/*.parquet')"
+        )
+    for query in SLICE_SQL.read_text().split(";"):
+        cursor.execute(query)
+    return {
+        table_slice.name: sorted(
+            cursor.execute(f"SELECT * FROM umls__{table_slice.name}").fetchall(), key=str
+        )
+        for table_slice in slice_utils.SLICES
+    }
+
+
+def read_slice(parquet_path: pathlib.Path, name: str) -> list[tuple]:
+    rows = pyarrow.parquet.read_table(parquet_path / name).to_pylist()
+    return sorted((tuple(row.values()) for row in rows), key=str)
+
+
+@pytest.mark.parametrize("table_type", [None, "partitioned", "delta"])
+def test_slices_match_sql(tmp_path, table_type):
+    expected = get_sql_slices(tmp_path)
+    parquet_path = tmp_path / "2000AA"
+    writer, _ = convert(parquet_path, table_type=table_type)
+    assert writer.rows == {name: len(rows) for name, rows in expected.items()}
+    assert writer.rows["mrconso_icd10cm"] == 543
+    assert writer.rows["mrconso_drugs"] == 0
+    for table_slice in slice_utils.SLICES:
+        assert read_slice(parquet_path, table_slice.name) == expected[table_slice.name]
+        schema = pyarrow.parquet.read_schema(
+            next((parquet_path / table_slice.name).glob("*.parquet"))
+        )
+        assert schema.names == writer.get_columns(table_slice)
+
+
+def test_slices_reuse_parts(tmp_path):
+    parquet_path = tmp_path / "2000AA"
+    _, uploaded = convert(parquet_path)
+    assert sorted(uploaded) == [
+        ("mrconso_drugs", "mrconso_drugs_0.parquet"),
+        ("mrconso_icd10cm", "mrconso_icd10cm_0.parquet"),
+        ("mrrel_drug_is_a", "mrrel_drug_is_a_0.parquet"),
+        ("mrrel_icd10cm", "mrrel_icd10cm_0.parquet"),
+    ]
+
+    # Slices of unchanged parts aren't written again, but are still uploaded
+    with mock.patch.object(slice_utils, "read_part") as read_part:
+        _, reused = convert(parquet_path)
+    assert read_part.call_count == 0
+    assert sorted(reused) == sorted(uploaded)
+
+    # A changed part has its slices rewritten, and the slices of removed parts go
+    (parquet_path / "mrrel_icd10cm/mrrel_icd10cm_7.parquet").touch()
+    with mock.patch.object(slice_utils, "read_part", wraps=slice_utils.read_part) as read_part:
+        _, rewritten = convert(parquet_path, hashes={"MRREL_0.parquet": "changed"})
+    assert read_part.call_count == 1
+    assert sorted(rewritten) == sorted(uploaded)
+    assert sorted(path.name for path in (parquet_path / "mrrel_icd10cm").glob("*.parquet")) == [
+        "mrrel_icd10cm_0.parquet"
+    ]
+
+
+def test_partitioned_parts(tmp_path):
+    table = parquet_utils.partition_table(
+        {
+            "headers": ["CUI", "SAB", "REL", "RELA"],
+            "dtype": dict.fromkeys(["CUI", "SAB", "REL", "RELA"], "string"),
+            "parquet_types": ["STRING"] * 4,
+        },
+        "SAB",
+    )
+    for sab in ("ICD10CM", parquet_utils.HIVE_NULL_PARTITION):
+        (tmp_path / f"MRREL/sab={sab}").mkdir(parents=True)
+        pyarrow.parquet.write_table(
+            pyarrow.table(
+                {
+                    "CUI": ["C1", "C2", "C3", "C4"],
+                    "REL": ["CHD", "PAR", None, "RO"],
+                    "RELA": [None, "isa", "isa", "tradename_of"],
+                }
+            ),
+            tmp_path / f"MRREL/sab={sab}/MRREL_3.parquet",
+        )
+    writer = slice_utils.SliceWriter(tmp_path, {"MRREL": table})
+    for sab in ("ICD10CM", parquet_utils.HIVE_NULL_PARTITION):
+        writer.put("MRREL", tmp_path / f"MRREL/sab={sab}/MRREL_3.parquet", sab)
+    writer.finish_table("MRREL")
+
+    # Parts are named after the partition they came from, and rows with a null REL
+    # are left out of mrrel_drug_is_a, as SQL's NOT IN would
+    assert sorted(path.name for path in (tmp_path / "mrrel_drug_is_a").glob("*")) == [
+        "_slice_manifest.json",
+        "mrrel_drug_is_a_ICD10CM_3.parquet",
+        f"mrrel_drug_is_a_{parquet_utils.HIVE_NULL_PARTITION}_3.parquet",
+    ]
+    rows = pyarrow.parquet.read_table(tmp_path / "mrrel_drug_is_a").to_pylist()
+    assert sorted(((row["CUI"], row["SAB"]) for row in rows), key=str) == [
+        ("C1", "ICD10CM"),
+        ("C1", None),
+        ("C4", "ICD10CM"),
+        ("C4", None),
+    ]
+    rows = pyarrow.parquet.read_table(tmp_path / "mrrel_icd10cm").to_pylist()
+    assert sorted(row["CUI"] for row in rows) == ["C1", "C2", "C3", "C4"]
+
+
+def test_get_slices():
+    columns = ["CUI", "SAB", "CODE", "STR"]
+    mrconso = {"headers": columns}
+    assert [table_slice.name for table_slice in slice_utils.get_slices({"MRCONSO": mrconso})] == [
+        "mrconso_drugs",
+        "mrconso_icd10cm",
+    ]
+    assert slice_utils.SLICES[1].get_columns(columns) == columns
+
+    # Slices aren't written if their filter's columns were excluded
+    assert slice_utils.get_slices({"MRCONSO": {"headers": ["CUI", "STR"]}}) == []
+    assert slice_utils.get_slices({"MRSTY": {"headers": ["CUI", "SAB"]}}) == []
+
+
+def test_profile_warnings():
+    tables = {name: get_table(name)[1] for name in ("MRCONSO", "MRREL")}
+    assert slice_utils.get_profile_warnings(tables) == []
+
+    profile = ingestion_utils.IngestionProfile(
+        exclude_columns={"MRCONSO.STR", "MRREL.RELA", "CVF"}, row_filters={"LAT": {"ENG"}}
+    )
+    tables = {name: profile.apply(name, table) for name, table in tables.items()}
+    assert slice_utils.get_profile_warnings(tables) == [
+        "mrrel_drug_is_a is not built, since the ingestion profile excludes RELA from MRREL",
+        "mrconso_drugs is missing STR, which the ingestion profile excludes from MRCONSO",
+        "mrconso_drugs only has the rows of MRCONSO kept by the ingestion profile's filters on LAT",
+        "mrconso_icd10cm is missing STR, which the ingestion profile excludes from MRCONSO",
+        "mrconso_icd10cm only has the rows of MRCONSO kept by the ingestion profile's "
+        "filters on LAT",
+        "mrrel_icd10cm is missing RELA, CVF, which the ingestion profile excludes from MRREL",
+    ]
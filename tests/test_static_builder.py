@@ -1,9 +1,17 @@
+import shutil
+import subprocess
+import sys
+import textwrap
+from unittest import mock
+
 from cumulus_library import base_utils, databases, db_config, study_manifest
 
-from cumulus_library_umls import static_builder
+from cumulus_library_umls import metrics_utils, static_builder
 
 
-def test_static_tables(tmp_path):
+@mock.patch("platformdirs.user_cache_dir")
+def test_static_tables(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
     db_config.db_type = "duckdb"
     db = databases.DuckDatabaseBackend(f"{tmp_path}/duckdb")
     config = base_utils.StudyConfig(
@@ -21,7 +29,8 @@ def test_static_tables(tmp_path):
     }
     manifest._advanced_config = {}
     builder = static_builder.StaticBuilder()
-    builder.execute_queries(config=config, manifest=manifest)
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        builder.execute_queries(config=config, manifest=manifest)
 
     for table_conf in [
         {
@@ -73,3 +82,107 @@ def test_static_tables(tmp_path):
         assert len(res) == table_conf["size"]
         assert res[0] == table_conf["first"]
         assert res[-1] == table_conf["last"]
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_static_tables_uploads(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="umls")
+    config.db.upload_file.side_effect = (
+        lambda *, file, study, topic, remote_filename=None, force_upload=False: (
+            f"s3://bucket/{study}/{topic}"
+        )
+    )
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    manifest._study_prefix = "umls"
+    builder = static_builder.StaticBuilder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert config.db.upload_file.call_count == 6
+    assert len(builder.queries) == 6
+    message = log_transaction.call_args.kwargs["message"]
+    assert message.startswith("UMLS static tables: convert ")
+    assert "6 parts uploaded" in message
+    assert list((tmp_path / metrics_utils.REPORT_DIR).glob("static_*.json"))
+    assert "LOCATION 's3://bucket/umls/SemanticTypes_2018AB'" in builder.queries[0]
+    assert "LOCATION 's3://bucket/umls/umls_tui'" in builder.queries[-1]
+
+    parquet_path = tmp_path / static_builder.CACHE_DIR / "umls_tui/umls_tui.parquet"
+    assert parquet_path.exists()
+
+    # Unchanged files are neither converted again, nor uploaded, as their cached
+    # parquet is found in the upload ledger
+    builder = static_builder.StaticBuilder()
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        with mock.patch("pandas.read_csv") as read_csv:
+            builder.prepare_queries(config=config, manifest=manifest)
+    read_csv.assert_not_called()
+    assert config.db.upload_file.call_count == 6
+    message = log_transaction.call_args.kwargs["message"]
+    assert message.count("6 parts skipped") == 2
+    assert "LOCATION 's3://bucket/umls/umls_tui'" in builder.queries[-1]
+
+    # Changed files are converted and uploaded again
+    static_path = tmp_path / "package/static_files"
+    shutil.copytree(static_builder.StaticBuilder.base_path / "static_files", static_path)
+    with open(static_path / "umls_tui.tsv", "a") as f:
+        f.write("new\tT999\tNew semantic type\n")
+    builder = static_builder.StaticBuilder()
+    builder.base_path = static_path.parent
+    with mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction:
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert config.db.upload_file.call_count == 7
+    assert "5 parts skipped" in log_transaction.call_args.kwargs["message"]
+
+
+# Runs a build of the static tables in a fresh interpreter, with a cache directory
+CACHED_BUILD = textwrap.dedent(
+    """
+    import sys
+    from unittest import mock
+
+    from cumulus_library import base_utils, db_config, study_manifest
+
+    # cumulus-library's database backends import pandas themselves, so rather than
+    # checking it's absent, any later import of it fails
+    sys.modules["pandas"] = None
+
+    from cumulus_library_umls import static_builder
+
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="umls")
+    config.db.upload_file.side_effect = AssertionError("uploaded again")
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    manifest._study_prefix = "umls"
+    builder = static_builder.StaticBuilder()
+    with (
+        mock.patch("platformdirs.user_cache_dir", return_value=sys.argv[1]),
+        mock.patch("cumulus_library.log_utils.log_transaction"),
+    ):
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert len(builder.queries) == 6
+    assert sys.modules["pandas"] is None
+    assert "cumulus_library_umls.parquet_utils" not in sys.modules
+    """
+)
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_cached_build_skips_pandas(mock_cache_dir, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="umls")
+    config.db.upload_file.return_value = "s3://bucket/umls/static"
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    manifest._study_prefix = "umls"
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        static_builder.StaticBuilder().prepare_queries(config=config, manifest=manifest)
+
+    result = subprocess.run(
+        [sys.executable, "-c", CACHED_BUILD, str(tmp_path)], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,136 @@
+import os
+import pathlib
+
+import pandas
+import pytest
+
+from cumulus_library_umls import parquet_utils, store_utils, umls_builder
+
+META_PATH = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+
+
+def get_table(name: str) -> dict:
+    with open(META_PATH / f"{name}.ctl") as f:
+        _, table = umls_builder.UMLSBuilder().parse_ctl_file(f.readlines())
+    return table
+
+
+def test_get_key():
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = get_table("MRCONSO")
+    key = store_utils.get_key(rrf_path, table, "2000AA")
+    assert key == store_utils.get_key(rrf_path, table, "2000AA")
+    # Settings which don't change the rows share a key
+    assert key == store_utils.get_key(
+        rrf_path, parquet_utils.set_memory_budget(table, 1024**2), "2000AA"
+    )
+    # ...unlike anything which does
+    assert key != store_utils.get_key(rrf_path, table, "2000AB")
+    assert key != store_utils.get_key(META_PATH / "MRREL.RRF", table, "2000AA")
+    assert key != store_utils.get_key(
+        rrf_path, parquet_utils.partition_table(table, "SAB"), "2000AA"
+    )
+    assert key != store_utils.get_key(
+        rrf_path, parquet_utils.set_write_options(table, {"compression": "zstd"}), "2000AA"
+    )
+
+
+@pytest.mark.parametrize("partitioned", [False, True])
+def test_publish_and_fetch(tmp_path, partitioned):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = get_table("MRCONSO")
+    if partitioned:
+        table = parquet_utils.partition_table(table, "SAB")
+    profile = table.get("profile")
+    key = store_utils.get_key(rrf_path, table, "2000AA")
+    store = store_utils.ParquetStore(tmp_path / "store")
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "a", table, chunksize=200, release="2000AA")
+    assert not store.is_stored(key)
+    assert not store.fetch(key, rrf_path, tmp_path / "b", "2000AA", profile)
+
+    store.publish(key, rrf_path, tmp_path / "a", "2000AA", profile)
+    assert store.is_stored(key)
+    # Only the finished table is left in the store
+    assert sorted(path.name for path in store.path.iterdir()) == [key]
+
+    assert store.fetch(key, rrf_path, tmp_path / "b", "2000AA", profile)
+    assert parquet_utils.is_converted(rrf_path, tmp_path / "b", "2000AA", profile)
+    parts_a = parquet_utils.get_converted_parts(rrf_path, tmp_path / "a", "2000AA", profile)
+    parts_b = parquet_utils.get_converted_parts(rrf_path, tmp_path / "b", "2000AA", profile)
+    assert len(parts_a) > 1
+    assert [(path.relative_to(tmp_path / "a"), sha256) for path, sha256 in parts_a] == [
+        (path.relative_to(tmp_path / "b"), sha256) for path, sha256 in parts_b
+    ]
+    # Files are linked out of the store when it's on the same file system
+    assert os.path.samefile(
+        parts_b[0][0], store.path / key / parts_b[0][0].relative_to(tmp_path / "b/MRCONSO")
+    )
+    pandas.testing.assert_frame_equal(
+        pandas.read_parquet(tmp_path / "a/MRCONSO"), pandas.read_parquet(tmp_path / "b/MRCONSO")
+    )
+
+    # Converting again replaces the stored copy
+    parquet_utils.convert_rrf(
+        rrf_path, tmp_path / "a", table, force_upload=True, chunksize=1000, release="2000AA"
+    )
+    store.publish(key, rrf_path, tmp_path / "a", "2000AA", profile)
+    assert sorted(path.name for path in store.path.iterdir()) == [key]
+    store.fetch(key, rrf_path, tmp_path / "c", "2000AA", profile)
+    parts = parquet_utils.get_converted_parts(rrf_path, tmp_path / "c", "2000AA", profile)
+    assert len(parts) < len(parts_b)
+    # ...but a complete copy already fetched is left alone, as it may be uploading
+    assert store.fetch(key, rrf_path, tmp_path / "b", "2000AA", profile)
+    assert parquet_utils.get_converted_parts(rrf_path, tmp_path / "b", "2000AA", profile) == parts_b
+
+
+def test_publish_unconverted(tmp_path):
+    store = store_utils.ParquetStore(tmp_path / "store")
+    with pytest.raises(ValueError, match="must be converted"):
+        store.publish("key", META_PATH / "MRCONSO.RRF", tmp_path, "2000AA")
+
+
+def test_locks(tmp_path):
+    store_a = store_utils.ParquetStore(tmp_path)
+    store_b = store_utils.ParquetStore(tmp_path)
+    # Readers share a lock...
+    assert store_a.lock("key", exclusive=False)
+    assert store_b.lock("key", exclusive=False, blocking=False)
+    assert store_b.lock("other", exclusive=True)
+    store_b.unlock_all()
+    # ...but not with a writer
+    assert not store_b.lock("key", exclusive=True, blocking=False)
+    store_a.unlock("key")
+    assert store_b.lock("key", exclusive=True, blocking=False)
+    assert not store_a.lock("key", exclusive=False, blocking=False)
+    with pytest.raises(ValueError, match="already held"):
+        store_b.lock("key", exclusive=True)
+    store_b.unlock("key")
+    assert store_a.lock("key", exclusive=True, blocking=False)
+
+
+def test_fetch_shared_parquet_path(tmp_path):
+    rrf_path = META_PATH / "MRCONSO.RRF"
+    table = get_table("MRCONSO")
+    key = store_utils.get_key(rrf_path, table, "2000AA")
+    store = store_utils.ParquetStore(tmp_path / "store")
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "a", table, chunksize=200, release="2000AA")
+    store.publish(key, rrf_path, tmp_path / "a", "2000AA")
+
+    # Another builder left part of a conversion in the parquet directory
+    parquet_path = tmp_path / "shared"
+    parquet_utils.start_conversion(rrf_path, parquet_path, "2000AA", {"chunksize": 100})
+    (parquet_path / "MRCONSO/MRCONSO_7.parquet").write_bytes(b"partial")
+    assert store.fetch(key, rrf_path, parquet_path, "2000AA")
+    parts = parquet_utils.get_converted_parts(rrf_path, parquet_path, "2000AA")
+    assert sorted(path.name for path in (parquet_path / "MRCONSO").iterdir()) == sorted(
+        [parquet_utils.MANIFEST_FILE] + [path.name for path, _ in parts]
+    )
+    # Nothing is left behind but the lock file
+    assert sorted(path.name for path in parquet_path.iterdir()) == [".MRCONSO.lock", "MRCONSO"]
+
+    # Fetching again, i.e. by a second builder, leaves the files the first may be reading
+    inodes = [path.stat().st_ino for path, _ in parts]
+    other = store_utils.ParquetStore(tmp_path / "store")
+    assert other.fetch(key, rrf_path, parquet_path, "2000AA")
+    assert [path.stat().st_ino for path, _ in parts] == inodes
+    assert parquet_utils.get_converted_parts(rrf_path, parquet_path, "2000AA") == parts
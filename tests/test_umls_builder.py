@@ -1,12 +1,31 @@
+import collections
+import json
 import os
+import pathlib
+import re
+import threading
+import time
+import zipfile
 from unittest import mock
 
+import pandas
 import pytest
 import responses
 from cumulus_library import base_utils, databases, db_config, study_manifest
 from cumulus_library.builders import protected_table_builder
 
-from cumulus_library_umls import umls_builder
+from cumulus_library_umls import (
+    archive_utils,
+    cache_utils,
+    delta_utils,
+    download_utils,
+    metrics_utils,
+    parquet_utils,
+    store_utils,
+    umls_builder,
+    upload_utils,
+)
+from tests.test_upload_utils import FakeS3, FakeUploadDb
 
 AUTH_URL = "https://utslogin.nlm.nih.gov/validateUser"
 RELEASE_URL = "https://uts-ws.nlm.nih.gov/releases"
@@ -109,3 +128,595 @@ def test_create_query_download_exists(mock_resolve, mock_responses, tmp_path):
     parquet_dirs = sorted((tmp_path / "generated_parquet").iterdir())
     assert len(parquet_dirs) == 1
     assert "2000AA" in str(parquet_dirs[0])
+
+
+@pytest.mark.parametrize(
+    "workers,range_size,engine",
+    [
+        (1, None, "pandas"),
+        (3, None, "pandas"),
+        # Forces MRCONSO/MRREL to be split into many small byte ranges
+        (3, 4096, "pandas"),
+        (1, None, "arrow"),
+        (3, 4096, "arrow"),
+    ],
+)
+def test_convert_tables(tmp_path, workers, range_size, engine):
+    builder = umls_builder.UMLSBuilder()
+    meta_path = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+    tables = {}
+    for ctl in sorted(meta_path.glob("*.ctl")):
+        with open(ctl) as f:
+            datasource, table = builder.parse_ctl_file(f.readlines())
+        tables[ctl.stem] = (meta_path / datasource, table)
+    with base_utils.get_progress_bar() as progress:
+        task = progress.add_task(None, total=len(tables))
+        builder.convert_tables(
+            tables, tmp_path, False, workers, progress, task, range_size=range_size, engine=engine
+        )
+        assert progress.tasks[0].completed == len(tables)
+    for name, row_count in [("MRCONSO", 543), ("MRREL", 1756), ("TESTTABLE", 3)]:
+        df = pandas.read_parquet(tmp_path / name)
+        assert len(df) == row_count
+        assert parquet_utils.is_converted(tables[name][0], tmp_path)
+
+
+@pytest.mark.parametrize("workers,engine", [(1, "pandas"), (3, "pandas"), (3, "arrow")])
+def test_convert_tables_from_zip(tmp_path, workers, engine):
+    builder = umls_builder.UMLSBuilder()
+    meta_path = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+    zip_path = tmp_path / "2000AA.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for file in sorted(meta_path.iterdir()):
+            archive.write(file, f"2000AA/META/{file.name}")
+
+    hashes = {}
+    for source in ["extracted", "zip"]:
+        if source == "zip":
+            ctl_files = archive_utils.list_members(zip_path, ".ctl")
+        else:
+            ctl_files = meta_path.glob("*.ctl")
+        tables = {}
+        for ctl in sorted(ctl_files):
+            with ctl.open() as f:
+                datasource, table = builder.parse_ctl_file(f.readlines())
+            tables[ctl.stem] = (ctl.with_name(datasource), table)
+        parts = collections.defaultdict(list)
+        with base_utils.get_progress_bar() as progress:
+            task = progress.add_task(None, total=len(tables))
+            # A tiny range size would split every extracted file, but archive
+            # members are always converted whole
+            builder.convert_tables(
+                tables,
+                tmp_path / source,
+                False,
+                workers,
+                progress,
+                task,
+                range_size=4096 if source == "zip" else None,
+                engine=engine,
+                on_part=lambda name, path, sha256, parts=parts: parts[name].append(
+                    (path.name, sha256)
+                ),
+            )
+        hashes[source] = {name: sorted(value) for name, value in parts.items()}
+    assert hashes["zip"] == hashes["extracted"]
+    assert sorted(hashes["zip"]) == ["MRCONSO", "MRREL", "TESTTABLE"]
+    assert parquet_utils.is_converted(tables["MRCONSO"][0], tmp_path / "zip")
+
+
+@mock.patch.dict(
+    os.environ,
+    clear=True,
+)
+@mock.patch("platformdirs.user_cache_dir")
+def test_prepare_queries_stream_from_zip(mock_cache_dir, mock_responses, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "duckdb"
+    config = base_utils.StudyConfig(
+        db=databases.DuckDatabaseBackend(f"{tmp_path}/duckdb"),
+        umls_key="123",
+        schema="main",
+        options={"stream_from_zip": "true"},
+    )
+    config.db.connect()
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    # The archive is kept as downloaded, and nothing is extracted next to it
+    release_path = tmp_path / "downloads/2000AA"
+    assert sorted(path.name for path in release_path.iterdir()) == ["2000AA.zip"]
+    assert len(builder.queries) == 1
+    df = pandas.read_parquet(tmp_path / "generated_parquet/2000AA/TESTTABLE")
+    assert list(df["CODE"]) == ["Code-1", "Code-2", "Code-3"]
+
+    config.options = {"stream_from_zip": "yes"}
+    with pytest.raises(ValueError, match="stream_from_zip must be"):
+        builder.prepare_queries(config=config, manifest=manifest)
+
+
+def test_get_umls_data_resumes_download(mock_responses, tmp_path):
+    download_path = tmp_path / "downloads"
+    (download_path / "1999AA").mkdir(parents=True)
+    (download_path / "2000AA.zip.partial").write_bytes(b"partial")
+    (download_path / "1999AA.zip.partial").write_bytes(b"partial")
+    (tmp_path / "generated_parquet").mkdir()
+
+    original = download_utils.download_file
+
+    def download_file(url, path, **kwargs):
+        # Older releases are kept until this one is built, but not their partial
+        # downloads, while a partial download of this release is resumed
+        assert sorted(file.name for file in download_path.iterdir()) == [
+            "1999AA",
+            "2000AA.zip.partial",
+        ]
+        assert kwargs["params"]["apiKey"] == "123"
+        assert kwargs["workers"] == 2
+        return original(url, path, **kwargs)
+
+    with mock.patch.object(download_utils, "download_file", side_effect=download_file):
+        files, download_required, version = umls_builder.UMLSBuilder().get_umls_data(
+            download_path,
+            tmp_path / "generated_parquet",
+            False,
+            "123",
+            download_workers=2,
+        )
+    assert download_required
+    assert version == "2000AA"
+    assert [file.name for file in files] == ["TESTTABLE.ctl"]
+    # The verified archive is extracted, then removed
+    assert sorted(file.name for file in download_path.iterdir()) == ["1999AA", "2000AA"]
+
+
+@mock.patch.dict(
+    os.environ,
+    clear=True,
+)
+@mock.patch("platformdirs.user_cache_dir")
+def test_prepare_queries_release_cache(mock_cache_dir, mock_responses, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    for kind in ("downloads", "generated_parquet"):
+        (tmp_path / kind / "1999AA/TESTTABLE").mkdir(parents=True)
+        (tmp_path / kind / "1999AA/TESTTABLE/TESTTABLE_0.parquet").write_bytes(b"x" * 1024)
+    db_config.db_type = "duckdb"
+    config = base_utils.StudyConfig(
+        db=databases.DuckDatabaseBackend(f"{tmp_path}/duckdb"),
+        umls_key="123",
+        schema="main",
+        options={"cache_budget_gb": "1"},
+    )
+    config.db.connect()
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+
+    # A failed build of a new release leaves the previous one in place
+    with (
+        mock.patch.object(umls_builder.UMLSBuilder, "convert_tables", side_effect=OSError),
+        mock.patch("cumulus_library.log_utils.log_transaction"),
+        pytest.raises(OSError),
+    ):
+        umls_builder.UMLSBuilder().prepare_queries(config=config, manifest=manifest)
+    assert (tmp_path / "generated_parquet/1999AA/TESTTABLE").exists()
+
+    # Within the budget, the previous release is kept alongside the new one
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        umls_builder.UMLSBuilder().prepare_queries(config=config, manifest=manifest)
+    for kind in ("downloads", "generated_parquet"):
+        assert sorted(path.name for path in (tmp_path / kind).iterdir()) == ["1999AA", "2000AA"]
+    assert cache_utils.get_current_release(tmp_path) == "2000AA"
+
+    # By default, only the release built is kept, once it's built
+    config.options = {}
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        umls_builder.UMLSBuilder().prepare_queries(config=config, manifest=manifest)
+    for kind in ("downloads", "generated_parquet"):
+        assert sorted(path.name for path in (tmp_path / kind).iterdir()) == ["2000AA"]
+
+
+def test_worker_count():
+    builder = umls_builder.UMLSBuilder()
+    config = base_utils.StudyConfig(db=None, schema="umls")
+    assert builder.get_worker_count(config) == 1
+    config.options = {"conversion_workers": "4"}
+    assert builder.get_worker_count(config) == 4
+    config.options = {"conversion_workers": "four"}
+    with pytest.raises(ValueError):
+        builder.get_worker_count(config)
+
+
+@mock.patch.dict(
+    os.environ,
+    clear=True,
+)
+@mock.patch("platformdirs.user_cache_dir")
+def test_prepare_queries_uploads_parts(mock_cache_dir, mock_responses, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "duckdb"
+    config = base_utils.StudyConfig(
+        db=databases.DuckDatabaseBackend(f"{tmp_path}/duckdb"),
+        umls_key="123",
+        schema="main",
+        options={"upload_workers": "2"},
+    )
+    config.db.connect()
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    uploads = []
+
+    def upload_file(*, file, study, topic, remote_filename=None, force_upload=False):
+        uploads.append((topic, remote_filename))
+        return f"s3://bucket/{study}/{topic}"
+
+    with (
+        mock.patch.object(config.db, "upload_file", side_effect=upload_file),
+        mock.patch("cumulus_library.log_utils.log_transaction"),
+        mock.patch("cumulus_library_umls.upload_utils.get_s3_client") as s3_client,
+    ):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert uploads == [("TESTTABLE", "TESTTABLE_0.parquet")]
+    # The table's remote location was checked for files left by earlier builds
+    s3_client.return_value.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket="bucket", Prefix="umls/TESTTABLE/"
+    )
+    assert len(builder.queries) == 1
+    assert "TESTTABLE" in builder.queries[0]
+
+    # A rerun against the same release finds the part in the upload ledger
+    with (
+        mock.patch.object(config.db, "upload_file", side_effect=upload_file),
+        mock.patch("cumulus_library.log_utils.log_transaction"),
+        mock.patch("cumulus_library_umls.upload_utils.get_s3_client"),
+    ):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert uploads == [("TESTTABLE", "TESTTABLE_0.parquet")]
+    assert len(builder.queries) == 1
+
+
+@mock.patch.dict(
+    os.environ,
+    clear=True,
+)
+@mock.patch("platformdirs.user_cache_dir")
+def test_prepare_queries_ingestion_profile(mock_cache_dir, mock_responses, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "duckdb"
+    config = base_utils.StudyConfig(
+        db=databases.DuckDatabaseBackend(f"{tmp_path}/duckdb"),
+        umls_key="123",
+        schema="main",
+        options={"exclude_columns": "TESTTABLE.CODE", "filter_TTY": "TTY1,TTY3"},
+    )
+    config.db.connect()
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert len(builder.queries) == 1
+    assert '"CODE"' not in builder.queries[0]
+    df = pandas.read_parquet(tmp_path / "generated_parquet/2000AA/TESTTABLE")
+    assert list(df.columns) == ["TTY"]
+    assert list(df["TTY"]) == ["TTY1", "TTY3"]
+
+    config.options = {"exclude_tables": "TESTTABLE"}
+    with mock.patch("cumulus_library.log_utils.log_transaction"):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    assert builder.queries == []
+
+
+def test_partitioned_ctas_query(tmp_path):
+    db_config.db_type = "duckdb"
+    db = databases.DuckDatabaseBackend(f"{tmp_path}/duckdb")
+    db.connect()
+    config = base_utils.StudyConfig(db=db, schema="main")
+    builder = umls_builder.UMLSBuilder()
+    tables = {}
+    for name in ["MRCONSO", "MRREL"]:
+        with open(f"./tests/test_data/2000AA/META/{name}.ctl") as f:
+            _, table = builder.parse_ctl_file(f.readlines())
+        rrf_path = pathlib.Path(f"./tests/test_data/2000AA/META/{name}.RRF")
+        tables[name] = (rrf_path, parquet_utils.partition_table(table, "SAB"))
+    with base_utils.get_progress_bar() as progress:
+        task = progress.add_task(None, total=len(tables))
+        builder.convert_tables(tables, tmp_path, False, 1, progress, task, release="2000AA")
+    pipeline = mock.MagicMock(remote_paths={"MRCONSO": "s3://bucket/umls/MRCONSO"})
+    query = builder.get_partitioned_ctas_query(
+        config, "MRCONSO", *tables["MRCONSO"], tmp_path, "2000AA", pipeline
+    )
+    db.cursor().execute(query)
+    rows = db.cursor().execute(
+        'SELECT "CUI", "SAB", "CODE" FROM "main"."MRCONSO" WHERE sab = \'ICD10CM\''
+    )
+    assert len(rows.fetchall()) == 543
+
+    db_config.db_type = "athena"
+    query = builder.get_partitioned_ctas_query(
+        config, "MRCONSO", *tables["MRCONSO"], tmp_path, "2000AA", pipeline
+    )
+    assert " SAB String" not in query
+    assert "PARTITIONED BY (SAB String)" in query
+    assert "LOCATION 's3://bucket/umls/MRCONSO'" in query
+    assert '"projection.sab.values"="ICD10CM"' in query
+
+
+def get_test_tables(builder: umls_builder.UMLSBuilder) -> dict:
+    meta_path = pathlib.Path(__file__).parent / "test_data/2000AA/META"
+    tables = {}
+    for ctl in sorted(meta_path.glob("*.ctl")):
+        with open(ctl) as f:
+            datasource, table = builder.parse_ctl_file(f.readlines())
+        tables[ctl.stem] = (meta_path / datasource, table)
+    return tables
+
+
+def test_convert_shared_tables(tmp_path):
+    store_path = tmp_path / "store"
+    builder = umls_builder.UMLSBuilder()
+    tables = get_test_tables(builder)
+    keys = {
+        name: store_utils.get_key(rrf_path, table, "2000AA")
+        for name, (rrf_path, table) in tables.items()
+    }
+
+    def convert(parquet_path: pathlib.Path, finished: list[str], **kwargs):
+        builder.convert_shared_tables(
+            store_utils.ParquetStore(store_path),
+            tables,
+            parquet_path,
+            False,
+            1,
+            mock.MagicMock(),
+            None,
+            on_table=finished.append,
+            release="2000AA",
+            **kwargs,
+        )
+
+    # Another builder is part way through converting MRCONSO
+    other = store_utils.ParquetStore(store_path)
+    assert other.lock(keys["MRCONSO"], exclusive=True)
+    finished = []
+    thread = threading.Thread(target=convert, args=(tmp_path / "a", finished))
+    thread.start()
+    # This builder converts & stores the other tables, then waits on MRCONSO
+    deadline = time.monotonic() + 30
+    while not (other.is_stored(keys["MRREL"]) and other.is_stored(keys["TESTTABLE"])):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    thread.join(timeout=0.5)
+    assert thread.is_alive()
+    assert not other.is_stored(keys["MRCONSO"])
+    assert not (tmp_path / "a/MRCONSO").exists()
+
+    rrf_path, table = tables["MRCONSO"]
+    parquet_utils.convert_rrf(rrf_path, tmp_path / "other", table, release="2000AA")
+    other.publish(keys["MRCONSO"], rrf_path, tmp_path / "other", "2000AA")
+    other.unlock(keys["MRCONSO"])
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert sorted(finished) == ["MRCONSO", "MRREL", "TESTTABLE"]
+    # MRCONSO was copied from the store, rather than converted again
+    assert os.path.samefile(
+        tmp_path / "a/MRCONSO/MRCONSO_0.parquet",
+        store_path / keys["MRCONSO"] / "MRCONSO_0.parquet",
+    )
+
+    # Once everything is stored, nothing is converted again, whatever the engine
+    finished = []
+    with (
+        mock.patch("cumulus_library_umls.parquet_utils.write_dataframe") as write_dataframe,
+        mock.patch("cumulus_library_umls.parquet_utils.PartWriter") as part_writer,
+    ):
+        convert(tmp_path / "b", finished, engine="arrow")
+    assert write_dataframe.call_count == part_writer.call_count == 0
+    assert sorted(finished) == ["MRCONSO", "MRREL", "TESTTABLE"]
+    for name, row_count in [("MRCONSO", 543), ("MRREL", 1756), ("TESTTABLE", 3)]:
+        assert len(pandas.read_parquet(tmp_path / "b" / name)) == row_count
+        assert parquet_utils.is_converted(tables[name][0], tmp_path / "b", "2000AA")
+
+
+def test_convert_shared_tables_one_base_path(tmp_path):
+    # Two builders on one host share the store and their cache directory
+    tables = get_test_tables(umls_builder.UMLSBuilder())
+    parquet_path = tmp_path / "cache/2000AA"
+    finished = {"a": [], "b": [], "errors": []}
+
+    def convert(name: str):
+        try:
+            umls_builder.UMLSBuilder().convert_shared_tables(
+                store_utils.ParquetStore(tmp_path / "store"),
+                tables,
+                parquet_path,
+                False,
+                1,
+                mock.MagicMock(),
+                None,
+                on_table=finished[name].append,
+                release="2000AA",
+            )
+        except Exception as e:  # pragma: no cover - reported below
+            finished["errors"].append(e)
+
+    with mock.patch(
+        "cumulus_library_umls.parquet_utils.start_conversion",
+        wraps=parquet_utils.start_conversion,
+    ) as start_conversion:
+        threads = [threading.Thread(target=convert, args=(name,)) for name in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+    assert finished["errors"] == []
+    assert sorted(finished["a"]) == sorted(finished["b"]) == ["MRCONSO", "MRREL", "TESTTABLE"]
+    # Each table was converted once, by one of the builders
+    assert sorted(call.args[0].stem for call in start_conversion.call_args_list) == [
+        "MRCONSO",
+        "MRREL",
+        "TESTTABLE",
+    ]
+    for name, row_count in [("MRCONSO", 543), ("MRREL", 1756), ("TESTTABLE", 3)]:
+        assert parquet_utils.is_converted(tables[name][0], parquet_path, "2000AA")
+        assert len(pandas.read_parquet(parquet_path / name)) == row_count
+    assert not list(parquet_path.glob("**/*.tmp"))
+    assert not list(parquet_path.glob("**/*.stale"))
+
+
+def test_delta_queries(tmp_path):
+    db_config.db_type = "duckdb"
+    db = databases.DuckDatabaseBackend(f"{tmp_path}/duckdb")
+    db.connect()
+    config = base_utils.StudyConfig(db=db, schema="main")
+    builder = umls_builder.UMLSBuilder()
+    with open("./tests/test_data/2000AA/META/MRCONSO.ctl") as f:
+        _, table = builder.parse_ctl_file(f.readlines())
+    lines = pathlib.Path("./tests/test_data/2000AA/META/MRCONSO.RRF").read_text().splitlines(True)
+    for release, base, release_lines in [
+        ("2000AA", None, lines),
+        ("2000AB", tmp_path / "2000AA/MRCONSO", lines[10:]),
+    ]:
+        rrf_path = tmp_path / f"META_{release}/MRCONSO.RRF"
+        rrf_path.parent.mkdir()
+        rrf_path.write_text("".join(release_lines))
+        delta_table = delta_utils.delta_table(table, "AUI", base)
+        builder.create_parquet(rrf_path, tmp_path / release, delta_table, release=release)
+    pipeline = mock.MagicMock(
+        remote_paths={
+            "MRCONSO": "s3://bucket/umls/MRCONSO",
+            "MRCONSO_tombstones": "s3://bucket/umls/MRCONSO_tombstones",
+        }
+    )
+    # Files in the table's directory which aren't among its parts aren't read
+    (first, _), *_ = parquet_utils.get_converted_parts(
+        rrf_path, tmp_path / "2000AB", "2000AB", delta_table.get("profile")
+    )
+    (first.parent / "stale.parquet").write_bytes(first.read_bytes())
+    parts_query, tombstones_query, view_query = builder.get_delta_queries(
+        config, "MRCONSO", rrf_path, delta_table, tmp_path / "2000AB", "2000AB", pipeline
+    )
+    db.cursor().execute(parts_query)
+    tombstones = delta_utils.get_tombstone_path(tmp_path / "2000AB", "MRCONSO")
+    db.cursor().execute(
+        f"CREATE TABLE main.MRCONSO_tombstones AS SELECT * FROM read_parquet('{tombstones}')"
+    )
+    db.cursor().execute(view_query)
+    rows = db.cursor().execute('SELECT "AUI" FROM "main"."MRCONSO"').fetchall()
+    assert sorted(aui for (aui,) in rows) == sorted(line.split("|")[7] for line in lines[10:])
+    parts = db.cursor().execute('SELECT COUNT(*) FROM "main"."MRCONSO_parts"').fetchone()
+    assert parts == (543,)
+
+    db_config.db_type = "athena"
+    parts_query, tombstones_query, view_query = builder.get_delta_queries(
+        config, "MRCONSO", rrf_path, delta_table, tmp_path / "2000AB", "2000AB", pipeline
+    )
+    assert "PARTITIONED BY (umls_release String)" in parts_query
+    assert '"projection.umls_release.values"="2000AA"' in parts_query
+    assert "LOCATION 's3://bucket/umls/MRCONSO_tombstones'" in tombstones_query
+    assert 'CREATE OR REPLACE VIEW "main"."MRCONSO"' in view_query
+
+
+def test_delta_queries_athena_files(tmp_path):
+    """Athena's parts table reads exactly the uploaded files of the current release"""
+    db_config.db_type = "athena"
+    config = base_utils.StudyConfig(db=mock.MagicMock(), schema="main")
+    builder = umls_builder.UMLSBuilder()
+    with open("./tests/test_data/2000AA/META/MRCONSO.ctl") as f:
+        _, table = builder.parse_ctl_file(f.readlines())
+    lines = pathlib.Path("./tests/test_data/2000AA/META/MRCONSO.RRF").read_text().splitlines(True)
+    # The first file of 2000AA has no rows left, the second too few to be reused, and
+    # a row of the third is changed
+    changed = lines[250].rstrip("\n").split("|")
+    changed[14] = "changed"
+    release_lines = [*lines[160:250], "|".join(changed) + "\n", *lines[251:]]
+    s3 = FakeS3()
+    with mock.patch("cumulus_library_umls.upload_utils.get_s3_client", return_value=s3):
+        for release, base, rrf_lines in [
+            ("2000AA", None, lines),
+            ("2000AB", tmp_path / "2000AA/MRCONSO", release_lines),
+        ]:
+            rrf_path = tmp_path / f"META_{release}/MRCONSO.RRF"
+            rrf_path.parent.mkdir()
+            rrf_path.write_text("".join(rrf_lines))
+            delta_table = delta_utils.delta_table(table, "AUI", base)
+            with upload_utils.UploadPipeline(
+                FakeUploadDb(s3=s3), "umls", release=release, remove_stale=True
+            ) as pipeline:
+                parts = delta_utils.convert_rrf_delta(
+                    rrf_path,
+                    tmp_path / release,
+                    delta_table,
+                    on_part=lambda path, sha256: pipeline.put("MRCONSO", path, sha256),
+                    release=release,
+                    chunksize=100,
+                )
+                pipeline.finish_table("MRCONSO")
+    parts_query, _, _ = builder.get_delta_queries(
+        config, "MRCONSO", rrf_path, delta_table, tmp_path / "2000AB", "2000AB", pipeline
+    )
+
+    location = re.search(r"LOCATION 's3://bucket/(.*)'", parts_query)[1]
+    values = re.search(r'"projection.umls_release.values"="(.*)"', parts_query)[1].split(",")
+    read = {
+        key.removeprefix(f"{location}/")
+        for key in s3.keys
+        if key.startswith(f"{location}/umls_release=")
+        and key.removeprefix(f"{location}/umls_release=").split("/")[0] in values
+    }
+    assert read == {upload_utils.get_remote_filename(path) for path, _ in parts}
+    assert any(name.startswith("umls_release=2000AA/") for name in read)
+
+    # Those files' rows, less the tombstoned ones, are the release
+    rows = pandas.concat(
+        pandas.read_parquet(path).assign(umls_release=path.parent.name.split("=")[1])
+        for path, _ in parts
+    )
+    tombstones = pandas.read_parquet(delta_utils.get_tombstone_path(tmp_path / "2000AB", "MRCONSO"))
+    rows = rows.merge(tombstones, on=["AUI", "umls_release"], how="left", indicator=True)
+    rows = rows[rows["_merge"] == "left_only"]
+    assert sorted(zip(rows["AUI"], rows["STR"], strict=True)) == sorted(
+        (fields[7], fields[14])
+        for fields in (line.rstrip("\n").split("|") for line in release_lines)
+    )
+
+
+@mock.patch("platformdirs.user_cache_dir")
+def test_prepare_queries_build_report(mock_cache_dir, mock_responses, tmp_path):
+    mock_cache_dir.return_value = tmp_path
+    db_config.db_type = "duckdb"
+    config = base_utils.StudyConfig(
+        db=databases.DuckDatabaseBackend(f"{tmp_path}/duckdb"),
+        umls_key="123",
+        schema="main",
+    )
+    config.db.connect()
+    manifest = study_manifest.StudyManifest()
+    manifest._study_config = {"study_prefix": "umls"}
+    with (
+        mock.patch.object(config.db, "upload_file", return_value="s3://bucket/umls/TESTTABLE"),
+        mock.patch("cumulus_library.log_utils.log_transaction") as log_transaction,
+        mock.patch("cumulus_library_umls.upload_utils.get_s3_client"),
+    ):
+        builder = umls_builder.UMLSBuilder()
+        builder.prepare_queries(config=config, manifest=manifest)
+    (report_path,) = (tmp_path / metrics_utils.REPORT_DIR).glob("umls_2000AA_*.json")
+    report = json.loads(report_path.read_text())
+    assert sorted(report["stages"]) == ["convert", "download", "upload", "upload_wait"]
+    convert = report["stages"]["convert"]["tables"]["TESTTABLE"]
+    assert convert["rows"] == 3
+    rrf_path = tmp_path / "downloads/2000AA/META/TESTTABLE.RRF"
+    assert convert["input_bytes"] == rrf_path.stat().st_size
+    assert convert["output_bytes"] > 0
+    assert convert["wall_seconds"] >= 0
+    upload = report["stages"]["upload"]
+    assert upload["parts_uploaded"] == 1
+    assert upload["tables"]["TESTTABLE"]["input_bytes"] == convert["output_bytes"]
+    message = log_transaction.call_args.kwargs["message"]
+    assert message.startswith("UMLS version: 2000AA; download ")
+    assert "convert " in message and "3 rows" in message
+    assert "1 parts uploaded" in message
@@ -0,0 +1,341 @@
+import pathlib
+import threading
+import time
+from unittest import mock
+
+import pytest
+from cumulus_library import errors
+
+from cumulus_library_umls import metrics_utils, upload_utils
+
+
+class FakeS3:
+    """A stand in for an S3 client, holding the keys of the objects in one bucket"""
+
+    def __init__(self):
+        self.keys = set()
+        self.deleted = []
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, *, Bucket, Prefix):
+        keys = sorted(key for key in self.keys if key.startswith(Prefix))
+        # Pages are small, so that paging is exercised
+        for start in range(0, max(len(keys), 1), 2):
+            page = keys[start : start + 2]
+            yield {"Contents": [{"Key": key} for key in page]} if page else {}
+
+    def delete_objects(self, *, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.keys.discard(item["Key"])
+            self.deleted.append(item["Key"])
+
+
+class FakeUploadDb:
+    """A stand in for a database backend, recording what it was asked to upload"""
+
+    def __init__(
+        self,
+        fail_on: str | None = None,
+        delay: float = 0,
+        flaky: int = 0,
+        s3: FakeS3 | None = None,
+    ):
+        self.fail_on = fail_on
+        self.delay = delay
+        self.flaky = flaky
+        self.s3 = s3
+        self.attempts = {}
+        self.uploads = []
+        self.lock = threading.Lock()
+
+    def upload_file(self, *, file, study, topic, remote_filename=None, force_upload=False):
+        time.sleep(self.delay)
+        with self.lock:
+            attempt = self.attempts.get(remote_filename, 0)
+            self.attempts[remote_filename] = attempt + 1
+        if remote_filename == self.fail_on:
+            raise errors.AWSError(f"Could not upload {remote_filename}")
+        if attempt < self.flaky:
+            raise ConnectionError("Connection reset by peer")
+        with self.lock:
+            self.uploads.append((topic, remote_filename))
+            if self.s3 is not None:
+                self.s3.keys.add(f"{study}/{topic}/{remote_filename}")
+        return f"s3://bucket/{study}/{topic}"
+
+
+def make_parts(tmp_path: pathlib.Path, table: str, count: int) -> list[pathlib.Path]:
+    (tmp_path / table).mkdir(parents=True, exist_ok=True)
+    parts = []
+    for i in range(count):
+        part = tmp_path / f"{table}/{table}_{i}.parquet"
+        part.write_bytes(b"parquet")
+        parts.append(part)
+    return parts
+
+
+def test_pipeline_uploads_all_parts(tmp_path):
+    db = FakeUploadDb()
+    uploaded_tables = []
+    with upload_utils.UploadPipeline(
+        db, "umls", workers=3, on_table_uploaded=uploaded_tables.append
+    ) as pipeline:
+        for table in ["MRCONSO", "MRREL"]:
+            for part in make_parts(tmp_path, table, 5):
+                pipeline.put(table, part)
+            pipeline.finish_table(table)
+    assert sorted(db.uploads) == sorted(
+        [(table, f"{table}_{i}.parquet") for table in ["MRCONSO", "MRREL"] for i in range(5)]
+    )
+    assert sorted(uploaded_tables) == ["MRCONSO", "MRREL"]
+    assert pipeline.remote_paths == {
+        "MRCONSO": "s3://bucket/umls/MRCONSO",
+        "MRREL": "s3://bucket/umls/MRREL",
+    }
+
+
+def test_pipeline_backpressure(tmp_path):
+    db = FakeUploadDb(delay=0.05)
+    max_depth = 0
+    with upload_utils.UploadPipeline(db, "umls", workers=1, max_queued=2) as pipeline:
+        for part in make_parts(tmp_path, "MRSAT", 8):
+            pipeline.put("MRSAT", part)
+            max_depth = max(max_depth, pipeline._queue.qsize())
+        pipeline.finish_table("MRSAT")
+    assert max_depth <= 2
+    assert len(db.uploads) == 8
+
+
+def test_pipeline_failure_cancels(tmp_path):
+    db = FakeUploadDb(fail_on="MRREL_2.parquet", delay=0.01)
+    with pytest.raises(errors.FileUploadError) as exc:
+        with upload_utils.UploadPipeline(db, "umls", workers=1, max_queued=1) as pipeline:
+            for part in make_parts(tmp_path, "MRREL", 50):
+                pipeline.put("MRREL", part)
+            pipeline.finish_table("MRREL")
+    assert "MRREL_2.parquet" in str(exc.value)
+    assert db.uploads[:2] == [("MRREL", "MRREL_0.parquet"), ("MRREL", "MRREL_1.parquet")]
+    # The producer should have been stopped well before queueing every part
+    assert len(db.uploads) < 10
+    for _, filename in db.uploads:
+        assert f"  MRREL: {filename}" in str(exc.value)
+
+
+def test_upload_tables(tmp_path):
+    db = FakeUploadDb(flaky=2)
+    tables = {
+        "MRCONSO": make_parts(tmp_path, "MRCONSO", 4),
+        "MRSTY": make_parts(tmp_path, "MRSTY", 1),
+    }
+    metrics = metrics_utils.BuildMetrics("test")
+    remote_paths = upload_utils.upload_tables(
+        db, tables, study="umls", workers=3, backoff=0, metrics=metrics
+    )
+    assert remote_paths == {
+        "MRCONSO": "s3://bucket/umls/MRCONSO",
+        "MRSTY": "s3://bucket/umls/MRSTY",
+    }
+    assert len(db.uploads) == 5
+    # every part failed twice before succeeding
+    assert set(db.attempts.values()) == {3}
+    upload = metrics.to_dict()["stages"]["upload"]["tables"]
+    assert upload["MRCONSO"]["parts_uploaded"] == 4
+    assert upload["MRCONSO"]["retries"] == 8
+    assert upload["MRSTY"]["retries"] == 2
+    assert upload["MRSTY"]["input_bytes"] == tables["MRSTY"][0].stat().st_size
+
+
+def test_upload_parts(tmp_path):
+    db = FakeUploadDb()
+    remote_path = upload_utils.upload_parts(
+        db, make_parts(tmp_path, "MRREL", 3), study="umls", topic="MRREL"
+    )
+    assert remote_path == "s3://bucket/umls/MRREL"
+    assert sorted(db.uploads) == [("MRREL", f"MRREL_{i}.parquet") for i in range(3)]
+
+
+def test_upload_retries_exhausted(tmp_path):
+    db = FakeUploadDb(flaky=5)
+    with pytest.raises(ConnectionError):
+        upload_utils.upload_parts(
+            db, make_parts(tmp_path, "MRREL", 1), study="umls", topic="MRREL", backoff=0
+        )
+    assert db.attempts == {"MRREL_0.parquet": 4}
+
+
+def test_upload_permanent_error_not_retried(tmp_path):
+    db = FakeUploadDb(fail_on="MRREL_0.parquet")
+    with pytest.raises(errors.AWSError):
+        upload_utils.upload_parts(
+            db, make_parts(tmp_path, "MRREL", 1), study="umls", topic="MRREL", backoff=0
+        )
+    assert db.attempts == {"MRREL_0.parquet": 1}
+
+
+def test_ledger_skips_unchanged_parts(tmp_path):
+    db = FakeUploadDb()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena:us-east-1")
+    parts = make_parts(tmp_path, "MRCONSO", 3)
+    with upload_utils.UploadPipeline(db, "umls", ledger=ledger, release="2000AA") as pipeline:
+        for part in parts:
+            pipeline.put("MRCONSO", part, upload_utils.get_file_hash(part))
+        pipeline.finish_table("MRCONSO")
+    assert len(db.uploads) == 3
+
+    # A fresh ledger, read from disk, knows about every part
+    db = FakeUploadDb()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena:us-east-1")
+    with upload_utils.UploadPipeline(db, "umls", ledger=ledger, release="2000AA") as pipeline:
+        for part in parts:
+            pipeline.put("MRCONSO", part)
+        pipeline.finish_table("MRCONSO")
+    assert db.attempts == {}
+    assert pipeline.remote_paths == {"MRCONSO": "s3://bucket/umls/MRCONSO"}
+
+    # Changed contents, a new release, or a new destination all need uploading
+    parts[0].write_bytes(b"changed")
+    tables = {"MRCONSO": parts}
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2000AA")
+    assert db.uploads == [("MRCONSO", "MRCONSO_0.parquet")]
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2001AA")
+    assert len(db.uploads) == 4
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena:us-west-2")
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2000AA")
+    assert len(db.uploads) == 7
+
+
+def test_ledger_shared_between_builders(tmp_path):
+    # Two builders on one host each record their own uploads to the same ledger
+    ledger_a = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    ledger_b = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    parts = make_parts(tmp_path, "MRCONSO", 40)
+    threads = [
+        threading.Thread(
+            target=upload_utils.upload_parts,
+            args=(FakeUploadDb(), parts[i::2]),
+            kwargs={"study": "umls", "topic": "MRCONSO", "ledger": ledger, "release": "2000AA"},
+        )
+        for i, ledger in enumerate((ledger_a, ledger_b))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Neither builder's entries were lost, so nothing is uploaded again
+    db = FakeUploadDb()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    upload_utils.upload_parts(
+        db, parts, study="umls", topic="MRCONSO", ledger=ledger, release="2000AA"
+    )
+    assert db.uploads == []
+
+
+def test_ledger_force_upload(tmp_path):
+    db = FakeUploadDb()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    tables = {"MRSTY": make_parts(tmp_path, "MRSTY", 2)}
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2000AA")
+    upload_utils.upload_tables(
+        db, tables, study="umls", ledger=ledger, release="2000AA", force_upload=True
+    )
+    assert len(db.uploads) == 4
+
+
+def test_ledger_does_not_record_failures(tmp_path):
+    db = FakeUploadDb(fail_on="MRREL_0.parquet")
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    with pytest.raises(errors.AWSError):
+        upload_utils.upload_parts(
+            db,
+            make_parts(tmp_path, "MRREL", 1),
+            study="umls",
+            topic="MRREL",
+            ledger=ledger,
+            release="2000AA",
+        )
+    assert not (tmp_path / "ledger.json").exists()
+
+
+def test_partitioned_remote_filename(tmp_path):
+    part = tmp_path / "MRCONSO/sab=RXNORM/MRCONSO_0.parquet"
+    part.parent.mkdir(parents=True)
+    part.write_bytes(b"parquet")
+    assert upload_utils.get_remote_filename(part) == "sab=RXNORM/MRCONSO_0.parquet"
+    db = FakeUploadDb()
+    upload_utils.upload_parts(db, [part], study="umls", topic="MRCONSO")
+    assert db.uploads == [("MRCONSO", "sab=RXNORM/MRCONSO_0.parquet")]
+
+
+def test_ledger_carry_forward(tmp_path):
+    db = FakeUploadDb()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+    tables = {"MRCONSO": make_parts(tmp_path, "MRCONSO", 2)}
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2000AA")
+    ledger.carry_forward("2000AA", "2000AB", "MRCONSO")
+    ledger.carry_forward("2000AA", "2000AB", "MRREL")
+    # Only the file which changed between releases is uploaded again
+    tables["MRCONSO"][1].write_bytes(b"changed")
+    upload_utils.upload_tables(db, tables, study="umls", ledger=ledger, release="2000AB")
+    assert db.uploads[2:] == [("MRCONSO", "MRCONSO_1.parquet")]
+
+
+def test_remove_stale_files(tmp_path):
+    s3 = FakeS3()
+    s3.keys = {
+        "umls/MRCONSO/MRCONSO_0.parquet",
+        "umls/MRCONSO/MRCONSO_1.parquet",
+        "umls/MRCONSO/sab=RXNORM/MRCONSO_0.parquet",
+        "umls/MRCONSO_tombstones/MRCONSO_tombstones_0.parquet",
+    }
+    db = FakeUploadDb()
+    with mock.patch("cumulus_library_umls.upload_utils.get_s3_client", return_value=s3):
+        # Backends without a remote location have nothing to remove
+        assert upload_utils.remove_stale_files(db, None, []) == []
+        removed = upload_utils.remove_stale_files(
+            db, "s3://bucket/umls/MRCONSO", ["MRCONSO_0.parquet"]
+        )
+    assert sorted(removed) == ["MRCONSO_1.parquet", "sab=RXNORM/MRCONSO_0.parquet"]
+    # Tables whose names start with this table's are left alone
+    assert s3.keys == {
+        "umls/MRCONSO/MRCONSO_0.parquet",
+        "umls/MRCONSO_tombstones/MRCONSO_tombstones_0.parquet",
+    }
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_upload_removes_stale_files(tmp_path, pipelined):
+    s3 = FakeS3()
+    ledger = upload_utils.UploadLedger(tmp_path / "ledger.json", "athena")
+
+    def upload(parts: list[pathlib.Path]) -> FakeUploadDb:
+        db = FakeUploadDb(s3=s3)
+        kwargs = {"ledger": ledger, "release": "2000AA", "remove_stale": True}
+        if pipelined:
+            with upload_utils.UploadPipeline(db, "umls", **kwargs) as pipeline:
+                for part in parts:
+                    pipeline.put("MRCONSO", part)
+                pipeline.finish_table("MRCONSO")
+        else:
+            upload_utils.upload_tables(db, {"MRCONSO": parts}, study="umls", **kwargs)
+        return db
+
+    with mock.patch("cumulus_library_umls.upload_utils.get_s3_client", return_value=s3):
+        flat = make_parts(tmp_path, "MRCONSO", 3)
+        upload(flat)
+        # The table is then partitioned, so only the partitions are left
+        partitioned = tmp_path / "MRCONSO/sab=RXNORM/MRCONSO_0.parquet"
+        partitioned.parent.mkdir()
+        partitioned.write_bytes(b"parquet")
+        upload([partitioned])
+        assert s3.keys == {"umls/MRCONSO/sab=RXNORM/MRCONSO_0.parquet"}
+        # ...and the deleted files are forgotten, so are uploaded again if needed
+        db = upload(flat[:2])
+    assert sorted(db.uploads) == [
+        ("MRCONSO", "MRCONSO_0.parquet"),
+        ("MRCONSO", "MRCONSO_1.parquet"),
+    ]
+    assert s3.keys == {"umls/MRCONSO/MRCONSO_0.parquet", "umls/MRCONSO/MRCONSO_1.parquet"}